@@ -10,7 +10,7 @@ from django.core.paginator import Paginator
 from .models import (
     TgUser, GenRequest, UserBalance, AIModel,
     Transaction, UserSettings, Promocode, PricingSettings,
-    ChatThread, ChatMessage, BotErrorEvent,
+    ChatThread, ChatMessage, BotErrorEvent, WebhookEvent,
 )
 
 
@@ -162,6 +162,7 @@ class GenRequestAdmin(admin.ModelAdmin):
         'completed_at',
         'processing_time',
         'result_urls',
+        'result_derivatives',
         'file_sizes',
         'provider_job_id',
         'provider_metadata',
@@ -187,7 +188,7 @@ class GenRequestAdmin(admin.ModelAdmin):
             'fields': ('provider_job_id', 'provider_metadata', 'source_media')
         }),
         ('Results', {
-            'fields': ('result_urls', 'file_sizes', 'error_message')
+            'fields': ('result_urls', 'result_derivatives', 'file_sizes', 'error_message')
         }),
         ('Performance', {
             'fields': ('processing_time', 'created_at', 'started_at', 'completed_at')
@@ -283,17 +284,24 @@ class BotErrorEventAdmin(admin.ModelAdmin):
         'chat_id',
         'handler',
         'short_message',
+        'occurrences',
     )
     list_filter = ('origin', 'severity', 'status', 'occurred_at')
     search_fields = ('message', 'handler', 'error_class', 'chat_id', 'user__username')
-    readonly_fields = ('occurred_at', 'created_at', 'updated_at', 'stacktrace', 'payload', 'extra')
+    readonly_fields = (
+        'occurred_at', 'last_seen_at', 'occurrences', 'fingerprint',
+        'created_at', 'updated_at', 'stacktrace', 'payload', 'extra',
+    )
     raw_id_fields = ('user', 'gen_request')
     ordering = ('-occurred_at',)
     actions = ['mark_in_progress', 'mark_resolved']
 
     fieldsets = (
         ('Общее', {
-            'fields': ('origin', 'severity', 'status', 'occurred_at', 'handler', 'error_class')
+            'fields': (
+                'origin', 'severity', 'status', 'occurred_at', 'last_seen_at', 'occurrences',
+                'handler', 'error_class', 'fingerprint',
+            )
         }),
         ('Сообщение', {
             'fields': ('message', 'stacktrace')
@@ -595,6 +603,25 @@ class ChatMessageAdmin(admin.ModelAdmin):
     short_text.short_description = 'Text'
 
 
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('received_at', 'source', 'event_id', 'status', 'attempts', 'processed_at')
+    list_filter = ('source', 'status', 'received_at')
+    search_fields = ('event_id', 'error')
+    ordering = ('-received_at',)
+    readonly_fields = ('source', 'event_id', 'payload', 'attempts', 'error', 'received_at', 'processed_at')
+    actions = ['replay']
+
+    def replay(self, request, queryset):
+        from .webhooks import dispatch
+
+        events = list(queryset.exclude(status=WebhookEvent.Status.PROCESSED))
+        for event in events:
+            dispatch(event)
+        self.message_user(request, f"{len(events)} событий повторно поставлено в очередь")
+    replay.short_description = "Повторно обработать"
+
+
 # Настройка админ-панели
 admin.site.site_header = "TG NanoBanana Admin"
 admin.site.site_title = "TG NanoBanana"
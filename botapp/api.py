@@ -2,14 +2,17 @@ import json
 import logging
 import hashlib
 import uuid
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Dict, Optional
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.http import HttpResponse, JsonResponse
 
+from botapp import blobs, dispatch, metrics, profiling, tracing, webhooks
 from botapp.error_tracker import ErrorTracker
-from botapp.models import BotErrorEvent
+from botapp.models import BotErrorEvent, WebhookEvent
 from config.ninja_api import build_ninja_api
 
 api = build_ninja_api()
@@ -39,7 +42,7 @@ def get_presigned_upload_url(request):
     - Ускорить получение сообщения о старте генерации
 
     Request body (JSON):
-        content_type: str - MIME тип файла (image/png, image/jpeg, image/webp)
+        content_type: str - MIME тип файла (image/png, image/jpeg, image/webp, video/mp4, video/quicktime, video/webm)
 
     Response:
         upload_url: str - URL для PUT запроса с файлом
@@ -68,6 +71,9 @@ def get_presigned_upload_url(request):
             "image/jpeg": "jpg",
             "image/jpg": "jpg",
             "image/webp": "webp",
+            "video/mp4": "mp4",
+            "video/quicktime": "mov",
+            "video/webm": "webm",
         }
         extension = ext_map.get(content_type, "png")
 
@@ -135,6 +141,15 @@ def _load_geminigen_public_key_bytes() -> Optional[bytes]:
     return None
 
 
+@lru_cache(maxsize=1)
+def _geminigen_public_key():
+    """PEM-ключ Geminigen читается и разбирается один раз на процесс."""
+    public_key_bytes = _load_geminigen_public_key_bytes()
+    if not public_key_bytes:
+        return None
+    return load_pem_public_key(public_key_bytes)
+
+
 def _verify_geminigen_signature(raw_body: bytes, signature_hex: str) -> bool:
     if not signature_hex:
         return True
@@ -142,13 +157,11 @@ def _verify_geminigen_signature(raw_body: bytes, signature_hex: str) -> bool:
         logger.warning("cryptography не установлена, пропускаем проверку подписи Geminigen")
         return True
 
-    public_key_bytes = _load_geminigen_public_key_bytes()
-    if not public_key_bytes:
-        logger.warning("Публичный ключ Geminigen не настроен, пропускаем проверку подписи")
-        return True
-
     try:
-        public_key = load_pem_public_key(public_key_bytes)
+        public_key = _geminigen_public_key()
+        if public_key is None:
+            logger.warning("Публичный ключ Geminigen не настроен, пропускаем проверку подписи")
+            return True
         payload = json.loads(raw_body.decode("utf-8", errors="ignore") or "{}") if raw_body else {}
         event_uuid = payload.get("uuid") or (payload.get("data") or {}).get("uuid") or ""
         digest = hashlib.md5(str(event_uuid).encode()).digest()
@@ -159,21 +172,38 @@ def _verify_geminigen_signature(raw_body: bytes, signature_hex: str) -> bool:
         return False
 
 
+def _geminigen_event_id(payload: Dict[str, Any]) -> str:
+    data = payload.get("data") if isinstance(payload.get("data"), dict) else {}
+    job_uuid = data.get("uuid") or payload.get("uuid") or payload.get("job_id") or ""
+    event = payload.get("event") or payload.get("type") or data.get("status") or payload.get("status") or ""
+    return f"{job_uuid}:{event}" if job_uuid else ""
+
+
 @api.get("/health")
 def health(request):
     # Возвращаем минимальный ответ, чтобы health-check Railway проходил быстро.
     return {"ok": True}
 
 
+@api.get("/metrics")
+def prometheus_metrics(request):
+    """Метрики Prometheus (если задан METRICS_AUTH_TOKEN — только с Bearer-токеном)."""
+    token = getattr(settings, "METRICS_AUTH_TOKEN", "")
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponse(status=401)
+    body, content_type = metrics.render_latest()
+    return HttpResponse(body, content_type=content_type)
+
+
 def _submit_webapp_to_celery(user_id: int, data: Dict[str, Any], endpoint_name: str) -> JsonResponse:
     """
     Универсальная функция для отправки WebApp данных в Celery.
-    Возвращает мгновенный ответ клиенту.
+    Возвращает мгновенный ответ клиенту; base64 файлов уходит в задачу ссылкой (см. botapp/blobs.py).
     """
     from botapp.tasks import process_webapp_submission_task
 
     try:
-        process_webapp_submission_task.delay(user_id, data)
+        dispatch.publish(process_webapp_submission_task, user_id, blobs.offload(data))
         logger.info(f"[WEBAPP_REST][{endpoint_name}] Task queued for user {user_id}")
         return JsonResponse({"ok": True})
     except Exception as exc:
@@ -219,6 +249,8 @@ try:
         return None
 
     @api.post("/telegram/webhook")
+    @metrics.observe_webhook("telegram")
+    @tracing.traced("webhook.telegram")
     async def telegram_webhook(request):
         """
         Обработчик апдейтов Telegram.
@@ -247,6 +279,11 @@ try:
             parsed_data = json.loads(payload_body)
             update_obj = Update.model_validate(parsed_data)
 
+            # Telegram повторяет доставку, если ответ не пришёл вовремя — второй раз не обрабатываем
+            if not await sync_to_async(webhooks.claim, thread_sensitive=False)("telegram", str(update_obj.update_id)):
+                logger.info(f"[WEBHOOK] Повторная доставка update_id={update_obj.update_id} пропущена")
+                return JsonResponse({"ok": True})
+
             update_type = "unknown"
             if update_obj.message:
                 update_type = "message"
@@ -260,7 +297,8 @@ try:
                 f"[WEBHOOK] Тип обновления: {update_type}, User ID: {update_obj.message.from_user.id if update_obj.message else 'N/A'}"
             )
 
-            await dp.feed_update(bot, update_obj)
+            async with profiling.aprofile("telegram_webhook", chat_id=_extract_chat_id(update_obj)):
+                await dp.feed_update(bot, update_obj)
             logger.info(f"[WEBHOOK] Обновление успешно обработано")
             return JsonResponse({"ok": True})
         except Exception as exc:
@@ -392,6 +430,8 @@ try:
             return JsonResponse({"ok": False, "error": str(exc)}, status=500)
 
     @api.post("/geminigen/webhook")
+    @metrics.observe_webhook("geminigen")
+    @tracing.traced("webhook.geminigen")
     async def geminigen_webhook(request):
         """
         Webhook для уведомлений Geminigen (video generation completed/failed).
@@ -408,14 +448,14 @@ try:
             return JsonResponse({"ok": False, "error": "invalid json"}, status=400)
 
         try:
-            from botapp.tasks import process_geminigen_webhook
-
-            process_geminigen_webhook.delay(payload)
+            event = await sync_to_async(webhooks.ingest)(
+                WebhookEvent.Source.GEMINIGEN, _geminigen_event_id(payload), payload
+            )
         except Exception as exc:
-            logger.exception("Не удалось поставить вебхук Geminigen в очередь: %s", exc)
+            logger.exception("Не удалось сохранить вебхук Geminigen: %s", exc)
             return JsonResponse({"ok": False, "error": str(exc)}, status=500)
 
-        return JsonResponse({"ok": True})
+        return JsonResponse({"ok": True, "duplicate": event is None})
 
     @api.post("/gpt-image/webapp/submit")
     def gpt_image_webapp_submit(request):
@@ -7,6 +7,8 @@ class BotappConfig(AppConfig):
 
     def ready(self):
         from . import signals  # noqa: F401
+        from .tracing import configure_tracing
+        configure_tracing()
         try:
             from .telegram import dp  # noqa
             from .handlers import main_router  # noqa
@@ -0,0 +1,95 @@
+"""
+Вынос крупных полей (base64 изображений и видео из WebApp) из сообщений брокера.
+
+Строка длиннее WEBAPP_BLOB_INLINE_LIMIT символов один раз кладётся в Redis под ключом blob:{uuid}
+с TTL WEBAPP_BLOB_TTL, а в payload задачи остаётся ссылка на этот ключ. Ссылки живут только на время
+перехода через брокер: задача подставляет данные через restore() и удаляет их через discard(). Входные
+файлы GenRequest хранятся долговечно: крупные base64 загружаются в Supabase Storage и заменяются storage_url
+(GenerationService.create_generation_request), поэтому повтор генерации и поздний перезапуск из
+reaper/reconcile не зависят от TTL. Файлы, которые браузер загрузил напрямую в Supabase
+(presigned upload → imageUrl/imageTailUrl), и так приходят ссылками.
+Без Redis поля остаются внутри payload, как раньше.
+"""
+import logging
+import uuid
+from typing import Any, Iterator
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+REF_PREFIX = "blob:"
+_REF_LENGTH = len(REF_PREFIX) + 32
+
+
+class BlobMissingError(ValueError):
+    """Данные по ссылке истекли или удалены — входные файлы нужно загрузить заново."""
+
+
+def is_ref(value: Any) -> bool:
+    return isinstance(value, str) and len(value) == _REF_LENGTH and value.startswith(REF_PREFIX)
+
+
+def put(value: str) -> str:
+    key = f"{REF_PREFIX}{uuid.uuid4().hex}"
+    get_redis().set(key, value.encode("utf-8"), ex=int(settings.WEBAPP_BLOB_TTL))
+    return key
+
+
+def get(ref: str) -> str:
+    raw = get_redis().get(ref)
+    if raw is None:
+        raise BlobMissingError(f"Входные данные {ref} больше недоступны")
+    return raw.decode("utf-8")
+
+
+def offload(obj: Any) -> Any:
+    """Копия obj, в которой длинные строки (на любой глубине dict/list) заменены ссылками."""
+    limit = int(settings.WEBAPP_BLOB_INLINE_LIMIT)
+    if limit <= 0:
+        return obj
+    try:
+        return _map_strings(obj, lambda value: put(value) if len(value) > limit else value)
+    except RedisError as exc:
+        logger.warning("[BLOBS] Redis недоступен, данные остаются в payload: %s", exc)
+        return obj
+
+
+def restore(obj: Any) -> Any:
+    """Копия obj со ссылками, заменёнными исходными данными."""
+    return _map_strings(obj, lambda value: get(value) if is_ref(value) else value)
+
+
+def discard(obj: Any) -> None:
+    """Удаляет данные по всем ссылкам внутри obj (после того как они больше не нужны)."""
+    refs = list(_iter_refs(obj))
+    if not refs:
+        return
+    try:
+        get_redis().delete(*refs)
+    except RedisError:
+        pass
+
+
+def _map_strings(obj: Any, func) -> Any:
+    if isinstance(obj, str):
+        return func(obj)
+    if isinstance(obj, dict):
+        return {key: _map_strings(value, func) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_map_strings(value, func) for value in obj]
+    return obj
+
+
+def _iter_refs(obj: Any) -> Iterator[str]:
+    if is_ref(obj):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from _iter_refs(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            yield from _iter_refs(value)
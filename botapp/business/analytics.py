@@ -1,30 +1,53 @@
 """
 Аналитический сервис для отслеживания метрик и статистики
 """
+from collections import Counter
 from datetime import timedelta
 from typing import Dict, List, Any, Optional
 
 from django.utils import timezone
-from django.db.models import (
-    Count, Sum, Avg, Q, F,
-    ExpressionWrapper, IntegerField
-)
-from django.db.models.functions import TruncDate, TruncHour
+from django.db.models import Count, Sum, Avg, F
+from django.db.models.functions import TruncDate
 
 from ..models import (
     TgUser,
     GenRequest,
-    Transaction,
     AIModel,
+    GenerationRollup,
+    TransactionRollup,
+    RollupGranularity,
 )
+from .. import events
 from .pricing import get_base_price_tokens
+from .rollups import bucket_floor
 
 
 class AnalyticsService:
     """
     Сервис для сбора и анализа метрик использования бота
+
+    Суммируемые метрики (количество, выручка, время обработки) читаются из таблиц
+    GenerationRollup/TransactionRollup, которые обновляет refresh_analytics_rollups_task.
+    Живые запросы к GenRequest/Transaction остались только для метрик по уникальным пользователям.
     """
 
+    @staticmethod
+    def _period_start(period_days: int):
+        """Начало окна, выровненное на начало суток: дневные бакеты попадают в окно целиком."""
+        return bucket_floor(timezone.now() - timedelta(days=period_days), RollupGranularity.DAY)
+
+    @staticmethod
+    def _generation_rollups(start_date, granularity: str = RollupGranularity.DAY):
+        return GenerationRollup.objects.filter(granularity=granularity, bucket_start__gte=start_date)
+
+    @staticmethod
+    def _transaction_rollups(start_date, granularity: str = RollupGranularity.DAY):
+        return TransactionRollup.objects.filter(granularity=granularity, bucket_start__gte=start_date)
+
+    @staticmethod
+    def _avg_seconds(processing_seconds, timed_requests):
+        return processing_seconds / timed_requests if timed_requests else None
+
     @classmethod
     def get_model_usage_stats(cls,
                              model: Optional[AIModel] = None,
@@ -39,40 +62,58 @@ class AnalyticsService:
         Returns:
             Словарь со статистикой
         """
-        start_date = timezone.now() - timedelta(days=period_days)
+        start_date = cls._period_start(period_days)
 
-        # Базовый queryset
+        # Базовый queryset (только для метрик по пользователям)
         qs = GenRequest.objects.filter(
             created_at__gte=start_date,
             status='done'
         )
+        rollups = cls._generation_rollups(start_date)
 
         if model:
             qs = qs.filter(ai_model=model)
+            rollups = rollups.filter(model_slug=model.slug)
 
         # Общая статистика
-        total_stats = qs.aggregate(
-            total_requests=Count('id'),
-            unique_users=Count('user', distinct=True),
-            total_revenue=Sum('cost'),
-            avg_cost=Avg('cost'),
-            success_rate=Count('id', filter=Q(status='done')) * 100.0 / Count('id')
+        totals = rollups.aggregate(
+            requests=Sum('requests'),
+            done=Sum('done'),
+            revenue=Sum('revenue'),
+            processing_seconds=Sum('processing_seconds'),
+            timed_requests=Sum('timed_requests'),
         )
+        done_count = totals['done'] or 0
+        total_stats = {
+            'total_requests': done_count,
+            'unique_users': qs.values('user').distinct().count(),
+            'total_revenue': totals['revenue'],
+            'avg_cost': totals['revenue'] / done_count if done_count else None,
+            'success_rate': done_count * 100.0 / totals['requests'] if totals['requests'] else None,
+        }
 
         # Статистика по типам генерации
-        by_type = qs.values('generation_type').annotate(
-            count=Count('id'),
-            revenue=Sum('cost')
+        by_type = rollups.values('generation_type').annotate(
+            count=Sum('done'),
+            revenue=Sum('revenue')
         ).order_by('-count')
 
-        # Статистика по дням
-        daily_stats = qs.annotate(
-            date=TruncDate('created_at')
-        ).values('date').annotate(
-            requests=Count('id'),
-            revenue=Sum('cost'),
-            users=Count('user', distinct=True)
-        ).order_by('date')
+        # Статистика по дням. Уникальные пользователи бакетов по срезам (модель, тип, когорта) не суммируются,
+        # поэтому считаются по GenRequest за каждые сутки
+        daily_users = dict(
+            qs.annotate(date=TruncDate('created_at')).values('date').annotate(
+                users=Count('user', distinct=True)
+            ).values_list('date', 'users')
+        )
+        daily_stats = [
+            {**row, 'users': daily_users.get(row['date'], 0)}
+            for row in rollups.annotate(
+                date=TruncDate('bucket_start')
+            ).values('date').annotate(
+                requests=Sum('done'),
+                revenue=Sum('revenue'),
+            ).order_by('date')
+        ]
 
         # Топ пользователей по модели
         top_users = qs.values(
@@ -83,27 +124,15 @@ class AnalyticsService:
             spent=Sum('cost')
         ).order_by('-generations')[:10]
 
-        # Средняя задержка генерации
-        completed_requests = qs.filter(
-            status='done',
-            updated_at__isnull=False
-        ).annotate(
-            duration=ExpressionWrapper(
-                F('updated_at') - F('created_at'),
-                output_field=IntegerField()
-            )
-        )
-
-        avg_duration = completed_requests.aggregate(
-            avg_seconds=Avg('duration')
-        )['avg_seconds']
+        # Среднее время генерации
+        avg_duration = cls._avg_seconds(totals['processing_seconds'], totals['timed_requests'])
 
         return {
             'period_days': period_days,
             'model': model.display_name if model else 'All models',
             'total_stats': total_stats,
             'by_type': list(by_type),
-            'daily_stats': list(daily_stats),
+            'daily_stats': daily_stats,
             'top_users': list(top_users),
             'avg_generation_time': avg_duration
         }
@@ -119,66 +148,47 @@ class AnalyticsService:
         Returns:
             Словарь с финансовой аналитикой
         """
-        start_date = timezone.now() - timedelta(days=period_days)
+        start_date = cls._period_start(period_days)
+
+        transactions = cls._transaction_rollups(start_date)
+
+        def _totals(transaction_type: str) -> Dict[str, Any]:
+            stats = transactions.filter(type=transaction_type).aggregate(
+                total=Sum('amount'),
+                count=Sum('count'),
+            )
+            stats['avg'] = stats['total'] / stats['count'] if stats['count'] else None
+            return stats
 
         # Доходы от генераций
-        generation_revenue = Transaction.objects.filter(
-            created_at__gte=start_date,
-            transaction_type='generation',
-            status='completed'
-        ).aggregate(
-            total=Sum('amount'),
-            count=Count('id'),
-            avg=Avg('amount')
-        )
+        generation_revenue = _totals('generation')
 
         # Доходы от пополнений
-        deposit_revenue = Transaction.objects.filter(
-            created_at__gte=start_date,
-            transaction_type='deposit',
-            status='completed'
-        ).aggregate(
-            total=Sum('amount'),
-            count=Count('id'),
-            avg=Avg('amount')
-        )
+        deposit_revenue = _totals('deposit')
 
         # Расходы на бонусы
-        bonus_expenses = Transaction.objects.filter(
-            created_at__gte=start_date,
-            transaction_type='bonus',
-            status='completed'
-        ).aggregate(
-            total=Sum('amount'),
-            count=Count('id')
-        )
+        bonus_expenses = _totals('bonus')
 
         # Доходы по методам оплаты
-        by_payment_method = Transaction.objects.filter(
-            created_at__gte=start_date,
-            transaction_type='deposit',
-            status='completed'
+        by_payment_method = transactions.filter(
+            type='deposit'
         ).values('payment_method').annotate(
             total=Sum('amount'),
-            count=Count('id')
+            count=Sum('count')
         ).order_by('-total')
 
         # Доходы по моделям
-        by_model = GenRequest.objects.filter(
-            created_at__gte=start_date,
-            status='done'
-        ).values(
-            'ai_model__display_name',
-            'ai_model__slug'
+        by_model = cls._generation_rollups(start_date).values(
+            'model_slug',
         ).annotate(
-            revenue=Sum('cost'),
-            requests=Count('id')
+            revenue=Sum('revenue'),
+            requests=Sum('done')
         ).order_by('-revenue')
 
         # ARPU (Average Revenue Per User)
         active_users = TgUser.objects.filter(
             transactions__created_at__gte=start_date,
-            transactions__transaction_type='generation'
+            transactions__type='generation'
         ).distinct().count()
 
         arpu = (generation_revenue['total'] or 0) / active_users if active_users > 0 else 0
@@ -186,8 +196,8 @@ class AnalyticsService:
         # Конверсия (пользователи, которые сделали платеж)
         total_users = TgUser.objects.filter(created_at__gte=start_date).count()
         paying_users = TgUser.objects.filter(
-            transactions__transaction_type='deposit',
-            transactions__status='completed',
+            transactions__type='deposit',
+            transactions__is_completed=True,
             transactions__created_at__gte=start_date
         ).distinct().count()
 
@@ -219,7 +229,7 @@ class AnalyticsService:
         Returns:
             Словарь с пользовательской аналитикой
         """
-        start_date = timezone.now() - timedelta(days=period_days)
+        start_date = cls._period_start(period_days)
 
         # Новые пользователи
         new_users = TgUser.objects.filter(
@@ -228,7 +238,7 @@ class AnalyticsService:
 
         # Активные пользователи (сделали хотя бы одну генерацию)
         active_users = TgUser.objects.filter(
-            requests__created_at__gte=start_date
+            generations__created_at__gte=start_date
         ).distinct().count()
 
         # Retention (пользователи, вернувшиеся на следующий день)
@@ -236,43 +246,57 @@ class AnalyticsService:
         day_before = yesterday - timedelta(days=1)
 
         users_day_before = TgUser.objects.filter(
-            requests__created_at__date=day_before
+            generations__created_at__date=day_before
         ).distinct()
 
         users_returned = users_day_before.filter(
-            requests__created_at__date=yesterday
+            generations__created_at__date=yesterday
         ).distinct().count()
 
         retention_rate = (users_returned / users_day_before.count() * 100) if users_day_before.exists() else 0
 
-        # Распределение по количеству генераций
-        generation_distribution = TgUser.objects.annotate(
-            total_generations=Count('requests')
-        ).values('total_generations').annotate(
-            users=Count('id')
-        ).order_by('total_generations')
+        # Распределение по количеству генераций за период
+        per_user = Counter(
+            GenRequest.objects.filter(
+                created_at__gte=start_date,
+                user__isnull=False
+            ).values('user').annotate(
+                total_generations=Count('id')
+            ).values_list('total_generations', flat=True)
+        )
+        generation_distribution = [
+            {'total_generations': total, 'users': users}
+            for total, users in sorted(per_user.items())
+        ]
+
+        # Активность по когортам (месяц регистрации)
+        by_cohort = cls._generation_rollups(start_date).values('cohort').annotate(
+            requests=Sum('requests'),
+            revenue=Sum('revenue')
+        ).order_by('cohort')
 
         # Топ пользователей по тратам
         top_spenders = TgUser.objects.filter(
             transactions__created_at__gte=start_date,
-            transactions__transaction_type='generation'
+            transactions__type='generation'
         ).annotate(
             total_spent=Sum('transactions__amount')
         ).order_by('-total_spent')[:20]
 
         # Средние показатели на пользователя
+        period_totals = cls._generation_rollups(start_date).aggregate(requests=Sum('requests'))
+        spent_total = cls._transaction_rollups(start_date).filter(
+            type='generation'
+        ).aggregate(total=Sum('amount'))['total']
         user_averages = TgUser.objects.filter(
             created_at__gte=start_date
         ).aggregate(
             avg_balance=Avg('balance__balance'),
-            avg_generations=Avg(
-                Count('requests')
-            ),
-            avg_spent=Avg(
-                Sum('transactions__amount',
-                    filter=Q(transactions__transaction_type='generation'))
-            )
         )
+        user_averages.update({
+            'avg_generations': (period_totals['requests'] or 0) / active_users if active_users else 0,
+            'avg_spent': abs(spent_total or 0) / active_users if active_users else 0,
+        })
 
         # Пользователи по языкам
         by_language = TgUser.objects.values('language_code').annotate(
@@ -284,7 +308,7 @@ class AnalyticsService:
             'new_users': new_users,
             'active_users': active_users,
             'retention_rate': float(retention_rate),
-            'generation_distribution': list(generation_distribution)[:20],
+            'generation_distribution': generation_distribution[:20],
             'top_spenders': [
                 {
                     'username': u.username,
@@ -294,6 +318,7 @@ class AnalyticsService:
                 for u in top_spenders
             ],
             'user_averages': user_averages,
+            'by_cohort': list(by_cohort),
             'by_language': list(by_language)
         }
 
@@ -309,55 +334,44 @@ class AnalyticsService:
         last_hour = now - timedelta(hours=1)
         last_day = now - timedelta(days=1)
 
-        # Запросы за последний час
-        hourly_requests = GenRequest.objects.filter(
-            created_at__gte=last_hour
-        ).count()
-
-        # Успешность за последний день
-        daily_requests = GenRequest.objects.filter(
-            created_at__gte=last_day
+        hourly = cls._generation_rollups(
+            bucket_floor(last_day, RollupGranularity.HOUR), RollupGranularity.HOUR
         )
 
-        success_rate = daily_requests.filter(
-            status='done'
-        ).count() / daily_requests.count() * 100 if daily_requests.exists() else 0
+        # Запросы за последний час (текущий и предыдущий часовые бакеты)
+        hourly_requests = hourly.filter(
+            bucket_start__gte=bucket_floor(last_hour, RollupGranularity.HOUR)
+        ).aggregate(total=Sum('requests'))['total'] or 0
+
+        # Успешность и ошибки за последний день
+        daily = hourly.aggregate(requests=Sum('requests'), done=Sum('done'), errors=Sum('errors'))
+        success_rate = (daily['done'] or 0) / daily['requests'] * 100 if daily['requests'] else 0
+        errors = daily['errors'] or 0
 
         # Среднее время генерации по моделям
-        avg_times_by_model = GenRequest.objects.filter(
-            created_at__gte=last_day,
-            status='done',
-            updated_at__isnull=False
-        ).values(
-            'ai_model__display_name'
-        ).annotate(
-            avg_time=Avg(
-                ExpressionWrapper(
-                    F('updated_at') - F('created_at'),
-                    output_field=IntegerField()
-                )
-            ),
-            count=Count('id')
-        )
+        avg_times_by_model = [
+            {
+                'model_slug': row['model_slug'],
+                'avg_time': cls._avg_seconds(row['processing_seconds'], row['timed_requests']),
+                'count': row['count'],
+            }
+            for row in hourly.values('model_slug').annotate(
+                processing_seconds=Sum('processing_seconds'),
+                timed_requests=Sum('timed_requests'),
+                count=Sum('done'),
+            ).order_by('model_slug')
+        ]
 
         # Очередь ожидания
         pending_requests = GenRequest.objects.filter(
-            status='pending'
-        ).count()
-
-        # Ошибки за последний день
-        errors = GenRequest.objects.filter(
-            created_at__gte=last_day,
-            status='error'
+            status__in=['queued', 'processing']
         ).count()
 
         # Загрузка по часам
-        hourly_load = GenRequest.objects.filter(
-            created_at__gte=last_day
-        ).annotate(
-            hour=TruncHour('created_at')
+        hourly_load = hourly.annotate(
+            hour=F('bucket_start')
         ).values('hour').annotate(
-            requests=Count('id')
+            requests=Sum('requests')
         ).order_by('hour')
 
         return {
@@ -379,19 +393,26 @@ class AnalyticsService:
             Список с данными по каждой модели
         """
         models = AIModel.objects.filter(is_active=True)
+        rollup_stats = {
+            row['model_slug']: row
+            for row in cls._generation_rollups(cls._period_start(30)).values(
+                'model_slug'
+            ).annotate(
+                requests=Sum('requests'),
+                done=Sum('done'),
+                revenue=Sum('revenue'),
+            )
+        }
         comparison = []
 
         for model in models:
-            stats = GenRequest.objects.filter(
-                ai_model=model,
-                created_at__gte=timezone.now() - timedelta(days=30)
-            ).aggregate(
-                total_requests=Count('id'),
-                success_rate=Count('id', filter=Q(status='done')) * 100.0 / Count('id'),
-                total_revenue=Sum('cost'),
-                unique_users=Count('user', distinct=True),
-                avg_satisfaction=Avg('user_rating')  # Если добавить рейтинг
-            )
+            row = rollup_stats.get(model.slug) or {}
+            total_requests = row.get('requests') or 0
+            stats = {
+                'total_requests': total_requests,
+                'success_rate': (row.get('done') or 0) * 100.0 / total_requests if total_requests else None,
+                'total_revenue': row.get('revenue'),
+            }
 
             # Добавляем информацию о модели
             base_price = get_base_price_tokens(model)
@@ -445,21 +466,5 @@ class AnalyticsService:
             event_type: Тип события
             metadata: Дополнительные данные
         """
-        # Здесь можно интегрировать с внешней аналитикой (Amplitude, Mixpanel, etc)
-        # Или сохранять в отдельную таблицу событий
-
-        event_data = {
-            'user_id': user.chat_id,
-            'username': user.username,
-            'event_type': event_type,
-            'timestamp': timezone.now().isoformat(),
-            'metadata': metadata or {}
-        }
-
-        # Пример отправки в внешний сервис
-        # send_to_analytics_service(event_data)
-
-        # Или логирование
-        import logging
-        logger = logging.getLogger('analytics')
-        logger.info(f"Event: {event_type}", extra=event_data)
+        # Событие уходит в буфер процесса → Redis stream → ProductEvent (см. botapp.events)
+        events.emit(event_type, chat_id=user.chat_id, username=user.username, **(metadata or {}))
@@ -10,21 +10,54 @@
 """
 from __future__ import annotations
 
+import logging
+from datetime import datetime
 from decimal import Decimal
 from typing import Any, Dict, Optional, Tuple, Union
 
+from django.db import connection
 from django.db import transaction as db_transaction
 from django.utils import timezone
+from redis.exceptions import RedisError
 
-from botapp.models import AIModel, TgUser, Transaction, UserBalance
+from botapp.models import AIModel, GenRequest, TgUser, Transaction, UserBalance
+from botapp.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
 
 ZERO = Decimal("0.00")
+DAILY_COUNTER_TTL = 2 * 24 * 3600
 
 
 class InsufficientBalanceError(Exception):
     """Недостаточно средств на балансе пользователя."""
 
 
+class DailyLimitExceededError(ValueError):
+    """Исчерпан дневной лимит генераций модели."""
+
+
+# DECR только существующего положительного счётчика: возврат после истечения ключа не уводит его в минус
+_RELEASE_SLOT_SCRIPT = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+if used > 0 then
+    return redis.call('DECR', KEYS[1])
+end
+return 0
+"""
+
+
+def _daily_limit_key(user_id: int, ai_model_id: int, moment: Optional[datetime] = None) -> str:
+    return f"daily_limit:{user_id}:{ai_model_id}:{moment or timezone.now():%Y%m%d}"
+
+
+def _insufficient_message(balance: Decimal, total_cost: Decimal) -> str:
+    return (
+        f"Недостаточно средств. Баланс: {balance} токенов, требуется: {total_cost} токенов "
+        f"(нужно пополнить на {total_cost - balance} токенов)"
+    )
+
+
 class BalanceService:
     """Бизнес-логика для работы с балансами пользователей."""
 
@@ -225,6 +258,26 @@ class BalanceService:
     # Генерация и списания
     # --------------------------------------------------------------------- #
 
+    @staticmethod
+    def _debit(user: TgUser, amount: Decimal) -> Optional[Decimal]:
+        """
+        Списывает сумму одним условным UPDATE ... WHERE balance >= amount RETURNING balance.
+
+        Возвращает новый баланс или None, если средств не хватило (или записи баланса ещё нет).
+        Строка блокируется только на время этого оператора, без предварительного SELECT FOR UPDATE.
+        """
+        table = connection.ops.quote_name(UserBalance._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET balance = balance - %s, total_spent = total_spent + %s, updated_at = %s "
+                f"WHERE user_id = %s AND balance >= %s RETURNING balance",
+                [amount, amount, timezone.now(), user.pk, amount],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return Decimal(str(row[0])).quantize(Decimal("0.01"))
+
     @staticmethod
     @db_transaction.atomic
     def charge_for_generation(
@@ -235,6 +288,10 @@ class BalanceService:
     ) -> Transaction:
         """
         Списывает средства за генерацию и создаёт запись транзакции.
+
+        Raises:
+            InsufficientBalanceError: средств недостаточно
+            DailyLimitExceededError: исчерпан дневной лимит модели
         """
         if quantity <= 0:
             raise ValueError("quantity должен быть положительным")
@@ -243,31 +300,86 @@ class BalanceService:
             total_cost = total_cost_tokens.quantize(Decimal("0.01"))
         else:
             total_cost = (ai_model.price * quantity).quantize(Decimal("0.01"))
-        balance = BalanceService.ensure_balance(user, for_update=True)
 
-        if balance.balance < total_cost:
-            raise InsufficientBalanceError(
-                f"Недостаточно средств. Баланс: {balance.balance}, требуется: {total_cost}"
+        if not BalanceService.reserve_daily_slot(user, ai_model):
+            raise DailyLimitExceededError(f"Достигнут дневной лимит для модели {ai_model.display_name}")
+
+        # Любая ошибка после резерва откатывает списание — слот возвращается вместе с ним
+        try:
+            balance_after = BalanceService._debit(user, total_cost)
+            if balance_after is None:
+                # Записи баланса может ещё не быть — создаём и пробуем ещё раз
+                balance = BalanceService.ensure_balance(user)
+                if balance.balance >= total_cost:
+                    balance_after = BalanceService._debit(user, total_cost)
+                if balance_after is None:
+                    raise InsufficientBalanceError(_insufficient_message(balance.balance, total_cost))
+
+            transaction = Transaction.objects.create(
+                **BalanceService._build_transaction_kwargs(
+                    user=user,
+                    amount=-total_cost,
+                    transaction_type="generation",
+                    description=f"Генерация {ai_model.display_name} x{quantity}",
+                    description_en=f"Generation {ai_model.display_name} x{quantity}",
+                ),
+                balance_after=balance_after,
+                is_completed=True,
+                is_pending=False,
             )
+        except BaseException:
+            BalanceService.release_daily_slot(user, ai_model)
+            raise
 
-        balance.balance -= total_cost
-        balance.total_spent += total_cost
-        balance.save(update_fields=["balance", "total_spent", "updated_at"])
+        return transaction
 
-        transaction = Transaction.objects.create(
-            **BalanceService._build_transaction_kwargs(
-                user=user,
-                amount=-total_cost,
-                transaction_type="generation",
-                description=f"Генерация {ai_model.display_name} x{quantity}",
-                description_en=f"Generation {ai_model.display_name} x{quantity}",
-            ),
-            balance_after=balance.balance,
-            is_completed=True,
-            is_pending=False,
-        )
+    # --------------------------------------------------------------------- #
+    # Дневные лимиты моделей (счётчики в Redis)
+    # --------------------------------------------------------------------- #
 
-        return transaction
+    @staticmethod
+    def _count_today_from_db(user: TgUser, ai_model: AIModel) -> int:
+        today_start = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        return GenRequest.objects.filter(user=user, ai_model=ai_model, created_at__gte=today_start).count()
+
+    @staticmethod
+    def daily_generations(user: TgUser, ai_model: AIModel) -> int:
+        """Сколько генераций модели пользователь запустил сегодня."""
+        try:
+            value = get_redis().get(_daily_limit_key(user.pk, ai_model.pk))
+        except RedisError as exc:
+            logger.warning("[BALANCE] Redis недоступен, дневной лимит считается по БД: %s", exc)
+            return BalanceService._count_today_from_db(user, ai_model)
+        return int(value or 0)
+
+    @staticmethod
+    def reserve_daily_slot(user: TgUser, ai_model: AIModel) -> bool:
+        """Атомарно занимает слот дневного лимита (INCR); False — лимит исчерпан."""
+        if not ai_model.daily_limit:
+            return True
+        key = _daily_limit_key(user.pk, ai_model.pk)
+        try:
+            pipe = get_redis().pipeline()
+            pipe.incr(key)
+            pipe.expire(key, DAILY_COUNTER_TTL)
+            used, _ = pipe.execute()
+        except RedisError as exc:
+            logger.warning("[BALANCE] Redis недоступен, дневной лимит считается по БД: %s", exc)
+            return BalanceService._count_today_from_db(user, ai_model) < ai_model.daily_limit
+        if used > ai_model.daily_limit:
+            BalanceService.release_daily_slot(user, ai_model)
+            return False
+        return True
+
+    @staticmethod
+    def release_daily_slot(user: TgUser, ai_model: AIModel, *, reserved_at: Optional[datetime] = None) -> None:
+        """Возвращает слот дневного лимита; reserved_at — момент резерва (для возвратов на следующий день)."""
+        if not ai_model.daily_limit:
+            return
+        try:
+            get_redis().eval(_RELEASE_SLOT_SCRIPT, 1, _daily_limit_key(user.pk, ai_model.pk, reserved_at))
+        except RedisError:
+            pass
 
     # --------------------------------------------------------------------- #
     # Бонусы и депозиты
@@ -391,8 +503,14 @@ class BalanceService:
 
     @staticmethod
     @db_transaction.atomic
-    def refund_generation(user: TgUser, original_transaction: Transaction, *, reason: str) -> Transaction:
-        """Возвращает средства за неудачную генерацию."""
+    def refund_generation(
+        user: TgUser,
+        original_transaction: Transaction,
+        *,
+        reason: str,
+        ai_model: Optional[AIModel] = None,
+    ) -> Transaction:
+        """Возвращает средства за неудачную генерацию (и слот дневного лимита модели, если она указана)."""
         if original_transaction.amount >= ZERO:
             raise ValueError("Оригинальная транзакция должна быть списанием")
 
@@ -414,6 +532,13 @@ class BalanceService:
             is_pending=False,
         )
 
+        if ai_model is not None:
+            db_transaction.on_commit(
+                lambda: BalanceService.release_daily_slot(
+                    user, ai_model, reserved_at=original_transaction.created_at
+                )
+            )
+
         return refund_tx
 
     @staticmethod
@@ -444,23 +569,9 @@ class BalanceService:
             total_cost = (ai_model.price * quantity).quantize(Decimal("0.01"))
 
         if balance.balance < total_cost:
-            needed = total_cost - balance.balance
-            return (
-                False,
-                f"Недостаточно средств. Баланс: {balance.balance} токенов, требуется: {total_cost} токенов "
-                f"(нужно пополнить на {needed} токенов)",
-            )
-
-        if ai_model.daily_limit:
-            today_start = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
-            today_generations = Transaction.objects.filter(
-                user=user,
-                type="generation",
-                created_at__gte=today_start,
-                generation_request__ai_model=ai_model,
-            ).count()
+            return False, _insufficient_message(balance.balance, total_cost)
 
-            if today_generations >= ai_model.daily_limit:
-                return False, f"Достигнут дневной лимит для модели {ai_model.display_name}"
+        if ai_model.daily_limit and BalanceService.daily_generations(user, ai_model) >= ai_model.daily_limit:
+            return False, f"Достигнут дневной лимит для модели {ai_model.display_name}"
 
         return True, "OK"
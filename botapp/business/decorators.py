@@ -14,7 +14,7 @@ from asgiref.sync import sync_to_async
 from aiogram.fsm.context import FSMContext
 from aiogram.types import CallbackQuery, Message
 
-from botapp.business.balance import BalanceService, InsufficientBalanceError
+from botapp.business.balance import BalanceService, DailyLimitExceededError, InsufficientBalanceError
 from botapp.keyboards import get_main_menu_inline_keyboard
 from botapp.models import AIModel, TgUser
 
@@ -92,7 +92,7 @@ def check_balance_and_charge(
 
             try:
                 transaction = await sync_to_async(BalanceService.charge_for_generation)(user, ai_model)
-            except InsufficientBalanceError as exc:
+            except (InsufficientBalanceError, DailyLimitExceededError) as exc:
                 await message.answer(
                     f"❌ {exc}",
                     reply_markup=get_main_menu_inline_keyboard(),
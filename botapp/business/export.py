@@ -0,0 +1,252 @@
+"""
+Потоковая выгрузка сырых данных (GenRequest, Transaction) для аналитики
+"""
+import csv
+import io
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+from typing import IO, Any, AsyncIterator, Iterable, Iterator, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from asgiref.sync import sync_to_async
+from django.db import models
+from django.utils.dateparse import parse_date, parse_datetime
+
+from ..models import GenRequest, Transaction
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+class ExportError(Exception):
+    """Некорректные параметры выгрузки."""
+
+
+@dataclass(frozen=True)
+class ExportDataset:
+    model: type
+    fields: Tuple[str, ...]
+
+    @property
+    def columns(self) -> List[str]:
+        return [field.replace("__", "_") for field in self.fields]
+
+
+DATASETS = {
+    "generations": ExportDataset(
+        model=GenRequest,
+        fields=(
+            "id",
+            "created_at",
+            "started_at",
+            "completed_at",
+            "user_id",
+            "chat_id",
+            "ai_model__slug",
+            "ai_model__provider",
+            "generation_type",
+            "status",
+            "quantity",
+            "cost",
+            "cost_usd",
+            "processing_time",
+            "duration",
+            "video_resolution",
+            "aspect_ratio",
+        ),
+    ),
+    "transactions": ExportDataset(
+        model=Transaction,
+        fields=(
+            "id",
+            "created_at",
+            "user_id",
+            "type",
+            "amount",
+            "balance_after",
+            "payment_method",
+            "is_completed",
+            "generation_request_id",
+        ),
+    ),
+}
+
+FORMATS = ("csv", "parquet")
+
+
+def parse_moment(value: Optional[str], *, end_of_day: bool = False) -> Optional[datetime]:
+    """
+    Граница периода из ISO даты/времени; пустое значение — без границы.
+    Дата без времени — начало дня UTC, с end_of_day — начало следующего дня (день включительно).
+    """
+    if not value:
+        return None
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is not None:
+        moment = datetime.combine(day, time.min, tzinfo=dt_timezone.utc)
+        return moment + timedelta(days=1) if end_of_day else moment
+    try:
+        moment = parse_datetime(value)
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise ExportError(f"Не удалось разобрать дату: {value}")
+    return moment
+
+
+def get_dataset(name: str) -> ExportDataset:
+    try:
+        return DATASETS[name]
+    except KeyError:
+        raise ExportError(f"Неизвестный набор данных: {name}. Доступны: {', '.join(DATASETS)}")
+
+
+def iter_chunks(
+    dataset: ExportDataset,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[List[Tuple[Any, ...]]]:
+    """
+    Отдаёт строки пачками по keyset-пагинации (id > последний id).
+
+    Каждая пачка — отдельный короткий запрос по первичному ключу, поэтому OFFSET не растёт,
+    а память ограничена размером одной пачки. На PostgreSQL .iterator() читает через серверный курсор.
+    """
+    qs = _queryset(dataset, since, until)
+    last_id = 0
+    while True:
+        chunk = _fetch_chunk(qs, last_id, chunk_size)
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1][0]
+        if len(chunk) < chunk_size:
+            return
+
+
+async def aiter_csv_chunks(
+    dataset: ExportDataset,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> AsyncIterator[str]:
+    """
+    CSV пачками для StreamingHttpResponse под ASGI.
+
+    Синхронный итератор Django под ASGI сначала целиком собирает через sync_to_async(list), поэтому
+    здесь каждая пачка читается отдельным sync_to_async, и первые байты уходят клиенту сразу.
+    """
+    qs = _queryset(dataset, since, until)
+    fetch = sync_to_async(_fetch_chunk)
+    yield _csv_text([dataset.columns])
+    last_id = 0
+    while True:
+        chunk = await fetch(qs, last_id, chunk_size)
+        if not chunk:
+            return
+        yield _csv_text(chunk)
+        last_id = chunk[-1][0]
+        if len(chunk) < chunk_size:
+            return
+
+
+def _queryset(dataset: ExportDataset, since: Optional[datetime], until: Optional[datetime]) -> models.QuerySet:
+    qs: models.QuerySet = dataset.model.objects.all()
+    if since:
+        qs = qs.filter(created_at__gte=since)
+    if until:
+        qs = qs.filter(created_at__lt=until)
+    return qs.order_by("id").values_list(*dataset.fields)
+
+
+def _fetch_chunk(qs: models.QuerySet, last_id: int, chunk_size: int) -> List[Tuple[Any, ...]]:
+    return list(qs.filter(id__gt=last_id)[:chunk_size].iterator(chunk_size=chunk_size))
+
+
+def _csv_text(rows: Iterable[Iterable[Any]]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def write_csv(dataset: ExportDataset, stream: IO[str], **kwargs: Any) -> int:
+    writer = csv.writer(stream)
+    writer.writerow(dataset.columns)
+    total = 0
+    for chunk in iter_chunks(dataset, **kwargs):
+        writer.writerows(chunk)
+        total += len(chunk)
+    return total
+
+
+def write_parquet(dataset: ExportDataset, path: str, **kwargs: Any) -> int:
+    """Пишет Parquet по row group на пачку."""
+    schema = _arrow_schema(dataset)
+    total = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in iter_chunks(dataset, **kwargs):
+            columns = [
+                pa.array(list(values), type=field.type)
+                for values, field in zip(zip(*chunk), schema)
+            ]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            total += len(chunk)
+    return total
+
+
+def _resolve_field(model: type, path: str) -> models.Field:
+    *relations, name = path.split("__")
+    for relation in relations:
+        model = model._meta.get_field(relation).related_model
+    return model._meta.get_field(name)
+
+
+def _arrow_type(field: models.Field) -> Any:
+    """Тип Arrow по полю модели (схема фиксирована, даже если в первой пачке одни NULL)."""
+    if field.is_relation:
+        field = field.target_field
+    internal = field.get_internal_type()
+    if internal in {"AutoField", "BigAutoField", "IntegerField", "BigIntegerField",
+                    "PositiveIntegerField", "PositiveSmallIntegerField", "SmallIntegerField"}:
+        return pa.int64()
+    if internal == "DecimalField":
+        return pa.decimal128(field.max_digits, field.decimal_places)
+    if internal == "FloatField":
+        return pa.float64()
+    if internal == "BooleanField":
+        return pa.bool_()
+    if internal == "DateTimeField":
+        return pa.timestamp("us", tz="UTC")
+    return pa.string()
+
+
+def _arrow_schema(dataset: ExportDataset) -> Any:
+    return pa.schema(
+        [
+            pa.field(column, _arrow_type(_resolve_field(dataset.model, path)))
+            for column, path in zip(dataset.columns, dataset.fields)
+        ]
+    )
+
+
+def export(
+    dataset_name: str,
+    fmt: str,
+    output: Any,
+    *,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> int:
+    """Выгружает набор данных в файл/поток; возвращает количество строк."""
+    dataset = get_dataset(dataset_name)
+    options = {"since": since, "until": until, "chunk_size": chunk_size}
+    if fmt == "csv":
+        return write_csv(dataset, output, **options)
+    if fmt == "parquet":
+        return write_parquet(dataset, output, **options)
+    raise ExportError(f"Неизвестный формат: {fmt}. Доступны: {', '.join(FORMATS)}")
@@ -1,16 +1,102 @@
 """
 Сервис для управления генерацией контента
 """
+import base64
+import binascii
+import logging
 import uuid
 from decimal import Decimal
 from typing import Optional, List, Dict, Any
+from django.conf import settings
 from django.db import transaction as db_transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
 from django.utils import timezone
 
-from botapp.models import TgUser, GenRequest, AIModel, BotErrorEvent
-from botapp.business.balance import BalanceService, InsufficientBalanceError
+from botapp.models import TgUser, GenRequest, AIModel, BotErrorEvent, UserSettings
+from botapp.business.analytics import AnalyticsService
+from botapp.business.balance import BalanceService
 from botapp.business.pricing import calculate_request_cost
 from botapp.error_tracker import ErrorTracker
+from botapp.services import supabase_upload_input
+from botapp import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+
+_IMAGE_TYPES = ('text2image', 'image2image')
+_VIDEO_TYPES = ('text2video', 'image2video', 'video2video')
+
+
+def _record_generation_stats(user_id: int, ai_model_id: int, generation_type: str, quantity: int) -> None:
+    """Увеличивает счётчики модели и пользователя одним UPDATE на таблицу, без чтения строк."""
+    AIModel.objects.filter(pk=ai_model_id).update(total_generations=F('total_generations') + 1)
+
+    counters: Dict[str, Any] = {
+        'total_generations': F('total_generations') + 1,
+        'last_generation_at': timezone.now(),
+        'updated_at': timezone.now(),
+    }
+    if generation_type in _IMAGE_TYPES:
+        counters['total_images_generated'] = F('total_images_generated') + quantity
+    elif generation_type in _VIDEO_TYPES:
+        counters['total_videos_generated'] = F('total_videos_generated') + quantity
+    UserSettings.objects.filter(user_id=user_id).update(**counters)
+
+
+_INLINE_DATA_KEYS = ('content_base64', 'base64')
+
+
+def _persist_inputs(entries: List[Any]) -> List[Any]:
+    """
+    Крупные base64 входных файлов (длиннее WEBAPP_BLOB_INLINE_LIMIT) загружаются в Supabase Storage,
+    в GenRequest остаётся storage_url: строка не растёт на мегабайты, а повтор генерации и перезапуск
+    из reaper не зависят от TTL, как blob-ссылки Redis. Если загрузка не удалась, данные остаются в строке.
+    """
+    limit = int(settings.WEBAPP_BLOB_INLINE_LIMIT)
+    if limit <= 0:
+        return entries
+    uploaded: Dict[str, str] = {}
+    persisted = []
+    for entry in entries:
+        key = next((k for k in _INLINE_DATA_KEYS if isinstance(entry, dict) and isinstance(entry.get(k), str)), None)
+        if key is None or len(entry[key]) <= limit:
+            persisted.append(entry)
+            continue
+        raw = entry[key]
+        mime_type = entry.get('mime_type') or entry.get('mime') or 'image/png'
+        url = uploaded.get(raw)
+        if url is None:
+            try:
+                content = base64.b64decode(raw.split(',')[-1])
+                url = supabase_upload_input(content, mime_type)
+            except (binascii.Error, ValueError):
+                persisted.append(entry)
+                continue
+            except Exception as exc:
+                logger.warning("[GENERATION] Не удалось загрузить входной файл в Storage, остаётся в строке: %s", exc)
+                persisted.append(entry)
+                continue
+            uploaded[raw] = url
+        persisted.append({
+            **{k: v for k, v in entry.items() if k not in _INLINE_DATA_KEYS},
+            'storage_url': url,
+            'mime_type': mime_type,
+        })
+    return persisted
+
+
+def _track_generation(gen_request: GenRequest, event_type: str, **metadata: Any) -> None:
+    """Продуктовое событие по запросу — после коммита, чтобы откаченная транзакция не оставляла событий."""
+    if not gen_request.user_id:
+        return
+    user = gen_request.user
+    metadata.update(
+        request_id=gen_request.pk,
+        model=gen_request.model,
+        generation_type=gen_request.generation_type,
+    )
+    db_transaction.on_commit(lambda: AnalyticsService.track_event(user, event_type, metadata))
 
 
 class GenerationService:
@@ -50,7 +136,7 @@ class GenerationService:
 
         Raises:
             InsufficientBalanceError: Если недостаточно средств
-            ValueError: Если параметры некорректны
+            ValueError: Если параметры некорректны или исчерпан дневной лимит (DailyLimitExceededError)
         """
         # Проверяем параметры
         if quantity > ai_model.max_quantity:
@@ -94,7 +180,8 @@ class GenerationService:
         if input_image_file_id:
             media_source.setdefault("telegram_file_id", input_image_file_id)
 
-        input_images_payload = input_images or []
+        # Загрузка в Storage идёт до списания, чтобы не держать блокировку баланса; одинаковые данные — один файл
+        *input_images_payload, media_source = _persist_inputs([*(input_images or []), media_source])
         if not input_images_payload and media_source:
             input_images_payload = [media_source]
 
@@ -105,62 +192,49 @@ class GenerationService:
             params=params,
         )
 
-        can_generate, error_message = BalanceService.check_can_generate(
+        # Баланс и дневной лимит проверяются при списании: условный UPDATE + счётчик в Redis
+        transaction = BalanceService.charge_for_generation(
             user,
             ai_model,
             quantity=quantity,
             total_cost_tokens=total_cost_tokens,
         )
-        if not can_generate:
-            raise ValueError(error_message)
 
+        # Создаем запрос на генерацию; при ошибке списание откатится вместе с транзакцией — возвращаем и слот
         try:
-            transaction = BalanceService.charge_for_generation(
-                user,
-                ai_model,
+            gen_request = GenRequest.objects.create(
+                run_code=str(uuid.uuid4()),
+                user=user,
+                chat_id=user.chat_id,
+                prompt=prompt,
+                generation_type=generation_type,
+                ai_model=ai_model,
+                model=ai_model.api_model_name,  # Для обратной совместимости
                 quantity=quantity,
-                total_cost_tokens=total_cost_tokens,
+                input_images=input_images_payload,
+                generation_params=params,
+                cost=total_cost_tokens.quantize(Decimal('0.01')),
+                cost_usd=cost_usd,
+                status='queued',
+                transaction=transaction,
+                parent_request=parent_request,
+                duration=duration,
+                video_resolution=video_resolution or "",
+                aspect_ratio=aspect_ratio or "",
+                source_media=media_source,
             )
-        except InsufficientBalanceError:
+        except BaseException:
+            BalanceService.release_daily_slot(user, ai_model)
             raise
 
-        # Создаем запрос на генерацию
-        gen_request = GenRequest.objects.create(
-            run_code=str(uuid.uuid4()),
-            user=user,
-            chat_id=user.chat_id,
-            prompt=prompt,
-            generation_type=generation_type,
-            ai_model=ai_model,
-            model=ai_model.api_model_name,  # Для обратной совместимости
-            quantity=quantity,
-            input_images=input_images_payload,
-            generation_params=params,
-            cost=total_cost_tokens.quantize(Decimal('0.01')),
-            cost_usd=cost_usd,
-            status='queued',
-            transaction=transaction,
-            parent_request=parent_request,
-            duration=duration,
-            video_resolution=video_resolution or "",
-            aspect_ratio=aspect_ratio or "",
-            source_media=media_source,
+        # Счётчики обновляются атомарным UPDATE уже после коммита списания:
+        # строка AIModel общая для всех запросов и не должна блокироваться внутри транзакции
+        db_transaction.on_commit(
+            lambda: _record_generation_stats(user.pk, ai_model.pk, generation_type, quantity)
         )
 
-        # Обновляем статистику пользователя
-        if hasattr(user, 'settings'):
-            user.settings.total_generations += 1
-            if generation_type in ['text2image', 'image2image']:
-                user.settings.total_images_generated += quantity
-            elif generation_type in ['text2video', 'image2video', 'video2video']:
-                user.settings.total_videos_generated += quantity
-            user.settings.last_generation_at = timezone.now()
-            user.settings.save()
-
-        # Обновляем статистику модели
-        ai_model.total_generations += 1
-        ai_model.save()
-
+        _track_generation(gen_request, 'generation_requested', cost=str(gen_request.cost))
+        tracing.annotate_request(gen_request)
         return gen_request
 
     @staticmethod
@@ -220,28 +294,25 @@ class GenerationService:
             processing_time = (gen_request.completed_at - gen_request.started_at).total_seconds()
             gen_request.processing_time = processing_time
 
-            # Обновляем среднее время генерации модели
-            ai_model = gen_request.ai_model
-            if ai_model:
-                total_gens = ai_model.total_generations
-                current_avg = ai_model.average_generation_time
-                # Рассчитываем новое среднее время
-                new_avg = ((current_avg * (total_gens - 1)) + processing_time) / total_gens
-                ai_model.average_generation_time = new_avg
-                ai_model.save()
+            # Обновляем среднее время генерации модели (скользящее среднее считается в SQL)
+            if gen_request.ai_model_id:
+                average = F('average_generation_time')
+                AIModel.objects.filter(pk=gen_request.ai_model_id).update(
+                    average_generation_time=average + (processing_time - average) / Greatest(F('total_generations'), 1)
+                )
 
         gen_request.save()
 
-        # Начисляем опыт пользователю
-        if hasattr(gen_request.user, 'settings'):
-            settings = gen_request.user.settings
-            settings.experience_points += 10 * gen_request.quantity
-            # Проверяем повышение уровня (каждые 100 очков = новый уровень)
-            new_level = settings.experience_points // 100
-            if new_level > settings.user_level:
-                settings.user_level = new_level
-                # Можно добавить уведомление о повышении уровня
-            settings.save()
+        # Начисляем опыт пользователю (каждые 100 очков = новый уровень)
+        if gen_request.user_id:
+            experience = F('experience_points') + 10 * gen_request.quantity
+            UserSettings.objects.filter(user_id=gen_request.user_id).update(
+                experience_points=experience,
+                user_level=Greatest(F('user_level'), experience / 100),
+                updated_at=timezone.now(),
+            )
+
+        _track_generation(gen_request, 'generation_completed', processing_time=gen_request.processing_time)
 
     @staticmethod
     @db_transaction.atomic
@@ -265,9 +336,10 @@ class GenerationService:
         gen_request.save()
 
         # Обновляем статистику ошибок модели
-        if gen_request.ai_model:
-            gen_request.ai_model.total_errors += 1
-            gen_request.ai_model.save()
+        if gen_request.ai_model_id:
+            AIModel.objects.filter(pk=gen_request.ai_model_id).update(total_errors=F('total_errors') + 1)
+
+        _track_generation(gen_request, 'generation_failed', refund=refund)
 
         ErrorTracker.log(
             origin=BotErrorEvent.Origin.GENERATION,
@@ -289,8 +361,10 @@ class GenerationService:
             BalanceService.refund_generation(
                 user=gen_request.user,
                 original_transaction=gen_request.transaction,
-                reason=error_message
+                reason=error_message,
+                ai_model=gen_request.ai_model,
             )
+            metrics.REFUNDS.labels(gen_request.ai_model.provider if gen_request.ai_model else "unknown").inc()
 
     @staticmethod
     def cancel_generation(gen_request: GenRequest, refund: bool = True) -> None:
@@ -310,7 +384,8 @@ class GenerationService:
             BalanceService.refund_generation(
                 user=gen_request.user,
                 original_transaction=gen_request.transaction,
-                reason="Генерация отменена"
+                reason="Генерация отменена",
+                ai_model=gen_request.ai_model,
             )
 
     @staticmethod
@@ -0,0 +1,266 @@
+"""
+Активация промокодов.
+
+Лимиты проверяются в Redis одним Lua-скриптом: счётчик использований и множество активировавших
+пользователей меняются атомарно, поэтому max_uses соблюдается точно и строка Promocode не становится
+горячей точкой при массовой активации. Окончательная защита от повторной активации — уникальность
+пары (promocode, user) в таблице used_by. Счётчики current_uses / total_activated / total_bonus_given
+переносятся в Promocode периодической задачей. Без Redis лимит считается по used_by под блокировкой
+строки промокода; такие активации Redis не видел, поэтому его счётчики сбрасываются сразу (если Redis
+уже доступен) или подтягиваются к used_by той же периодической задачей.
+"""
+import logging
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Dict, Optional
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Value
+from django.utils import timezone
+from redis.exceptions import RedisError
+
+from ..models import Promocode, TgUser
+from ..redis_client import get_redis
+from .analytics import AnalyticsService
+from .balance import BalanceService
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal("0.00")
+
+
+class RedemptionStatus:
+    OK = "ok"
+    NOT_FOUND = "not_found"  # нет, выключен, вне периода действия или тип не поддерживается
+    ALREADY_USED = "already_used"
+    EXHAUSTED = "exhausted"
+
+
+@dataclass(frozen=True)
+class RedemptionResult:
+    status: str
+    promocode: Optional[Promocode] = None
+    amount: Decimal = ZERO
+
+    @property
+    def ok(self) -> bool:
+        return self.status == RedemptionStatus.OK
+
+
+# KEYS: счётчик использований, множество пользователей. ARGV: user_id, max_uses (0 — без лимита).
+# Возвращает 1 — слот занят, -1 — пользователь уже активировал, 0 — лимит исчерпан,
+# -2 — счётчик ещё не инициализирован из БД.
+_CLAIM_SCRIPT = """
+local used = redis.call('GET', KEYS[1])
+if not used then
+    return -2
+end
+if redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 1 then
+    return -1
+end
+local limit = tonumber(ARGV[2])
+if limit > 0 and tonumber(used) >= limit then
+    return 0
+end
+redis.call('INCR', KEYS[1])
+redis.call('SADD', KEYS[2], ARGV[1])
+return 1
+"""
+
+_RELEASE_SCRIPT = """
+redis.call('DECR', KEYS[1])
+if ARGV[2] == '1' then
+    redis.call('SREM', KEYS[2], ARGV[1])
+end
+return 1
+"""
+
+
+# KEYS: счётчик использований, множество пользователей. ARGV: число активаций в used_by, id пользователей.
+# Счётчик только растёт: активации в полёте (INCR уже сделан, запись в БД ещё нет) не теряются.
+_RESYNC_SCRIPT = """
+local used = redis.call('GET', KEYS[1])
+if not used then
+    return 0
+end
+if tonumber(used) < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+for i = 2, #ARGV do
+    redis.call('SADD', KEYS[2], ARGV[i])
+end
+return 1
+"""
+
+
+def _keys(promocode: Promocode):
+    return _keys_for(promocode.pk)
+
+
+def _keys_for(pk: int):
+    return [f"promo:{pk}:uses", f"promo:{pk}:users"]
+
+
+class _AlreadyUsed(Exception):
+    pass
+
+
+class PromocodeService:
+    """Активация промокодов с точным соблюдением max_uses."""
+
+    @classmethod
+    def find_active(cls, raw_code: str) -> Optional[Promocode]:
+        code = Promocode.normalize(raw_code)
+        if not code:
+            return None
+        now = timezone.now()
+        return Promocode.objects.filter(
+            normalized_code=code,
+            is_active=True,
+            valid_from__lte=now,
+            valid_until__gte=now,
+        ).first()
+
+    @classmethod
+    def redeem(cls, user: TgUser, raw_code: str) -> RedemptionResult:
+        promocode = cls.find_active(raw_code)
+        if promocode is None or promocode.is_percentage:
+            # Процентные промокоды применяются к пополнению, а не активируются отдельно
+            return RedemptionResult(RedemptionStatus.NOT_FOUND, promocode)
+
+        try:
+            result = cls._redeem_with_redis(user, promocode)
+        except RedisError as exc:
+            logger.warning("[PROMOCODE] Redis недоступен, активация через БД: %s", exc)
+            result = cls._redeem_with_db(user, promocode)
+        if result.ok:
+            AnalyticsService.track_event(user, "promocode_redeemed", {"code": promocode.code, "value": str(promocode.value)})
+        return result
+
+    @classmethod
+    def _redeem_with_redis(cls, user: TgUser, promocode: Promocode) -> RedemptionResult:
+        client = get_redis()
+        keys = _keys(promocode)
+        claim = client.register_script(_CLAIM_SCRIPT)
+        args = [user.pk, promocode.max_uses or 0]
+
+        claimed = claim(keys=keys, args=args)
+        if claimed == -2:
+            # Первый запрос после старта/сброса Redis: поднимаем счётчик из БД
+            used = promocode.used_by.through.objects.filter(promocode_id=promocode.pk).count()
+            client.set(keys[0], used, nx=True)
+            claimed = claim(keys=keys, args=args)
+
+        if claimed == -1:
+            return RedemptionResult(RedemptionStatus.ALREADY_USED, promocode, promocode.value)
+        if claimed != 1:
+            return RedemptionResult(RedemptionStatus.EXHAUSTED, promocode)
+
+        release = client.register_script(_RELEASE_SCRIPT)
+        try:
+            with transaction.atomic():
+                cls._record_redemption(user, promocode)
+        except _AlreadyUsed:
+            # Запись в БД уже есть (множество в Redis было потеряно) — освобождаем только слот
+            release(keys=keys, args=[user.pk, "0"])
+            return RedemptionResult(RedemptionStatus.ALREADY_USED, promocode, promocode.value)
+        except Exception:
+            release(keys=keys, args=[user.pk, "1"])
+            raise
+        return RedemptionResult(RedemptionStatus.OK, promocode, promocode.value)
+
+    @classmethod
+    def _redeem_with_db(cls, user: TgUser, promocode: Promocode) -> RedemptionResult:
+        # current_uses отстаёт от активаций через Redis до sync_stats, поэтому лимит считается по used_by;
+        # блокировка строки промокода сериализует параллельные активации на время подсчёта
+        try:
+            with transaction.atomic():
+                Promocode.objects.select_for_update().get(pk=promocode.pk)
+                redemptions = promocode.used_by.through.objects.filter(promocode_id=promocode.pk)
+                if redemptions.filter(tguser_id=user.pk).exists():
+                    return RedemptionResult(RedemptionStatus.ALREADY_USED, promocode, promocode.value)
+                if promocode.max_uses and redemptions.count() >= promocode.max_uses:
+                    return RedemptionResult(RedemptionStatus.EXHAUSTED, promocode)
+                cls._record_redemption(user, promocode)
+                Promocode.objects.filter(pk=promocode.pk).update(
+                    current_uses=F("current_uses") + 1,
+                    total_activated=F("total_activated") + 1,
+                    total_bonus_given=F("total_bonus_given") + promocode.value,
+                )
+        except _AlreadyUsed:
+            return RedemptionResult(RedemptionStatus.ALREADY_USED, promocode, promocode.value)
+        cls._forget_redis_counters(promocode)
+        return RedemptionResult(RedemptionStatus.OK, promocode, promocode.value)
+
+    @staticmethod
+    def _forget_redis_counters(promocode: Promocode) -> None:
+        """Удаляет счётчики Redis, чтобы следующая активация подняла их из used_by."""
+        try:
+            get_redis().delete(*_keys(promocode))
+        except RedisError as exc:
+            # Сверит resync_redis_counters, когда Redis вернётся
+            logger.warning("[PROMOCODE] Не удалось сбросить счётчики %s в Redis: %s", promocode.code, exc)
+
+    @staticmethod
+    def _record_redemption(user: TgUser, promocode: Promocode) -> None:
+        """Фиксирует активацию (уникальная пара в used_by) и начисляет бонус."""
+        try:
+            with transaction.atomic():
+                promocode.used_by.through.objects.create(promocode_id=promocode.pk, tguser_id=user.pk)
+        except IntegrityError:
+            raise _AlreadyUsed()
+        BalanceService.add_bonus(
+            user,
+            amount=promocode.value,
+            description=f"Промокод {promocode.code}",
+            description_en=f"Promocode {promocode.code}",
+        )
+
+    @classmethod
+    def sync_stats(cls) -> Dict[str, int]:
+        """Переносит число активаций из used_by в счётчики Promocode (только для изменившихся)."""
+        stale = (
+            Promocode.objects.annotate(redeemed=Count("used_by"))
+            .exclude(current_uses=F("redeemed"))
+            .values_list("pk", "redeemed")
+        )
+        updated = 0
+        for pk, redeemed in stale:
+            delta = Value(redeemed) - F("current_uses")
+            updated += Promocode.objects.filter(pk=pk).update(
+                total_activated=F("total_activated") + delta,
+                total_bonus_given=F("total_bonus_given") + ExpressionWrapper(
+                    F("value") * delta, output_field=DecimalField(max_digits=10, decimal_places=2)
+                ),
+                current_uses=redeemed,
+                updated_at=timezone.now(),
+            )
+        return {"updated": updated}
+
+    @classmethod
+    def resync_redis_counters(cls) -> Dict[str, int]:
+        """
+        Подтягивает счётчики Redis к used_by для действующих промокодов.
+        Нужна после активаций через БД, пока Redis был недоступен: иначе скрипт активации
+        видит старое число использований и старое множество пользователей.
+        """
+        promos = list(
+            Promocode.objects.filter(is_active=True, valid_until__gte=timezone.now())
+            .annotate(redeemed=Count("used_by"))
+            .filter(redeemed__gt=0)
+            .values_list("pk", "redeemed")
+        )
+        if not promos:
+            return {"resynced": 0}
+        client = get_redis()
+        counters = client.mget([_keys_for(pk)[0] for pk, _ in promos])
+        resync = client.register_script(_RESYNC_SCRIPT)
+        resynced = 0
+        for (pk, redeemed), used in zip(promos, counters):
+            if used is None or int(used) >= redeemed:
+                continue
+            user_ids = list(
+                Promocode.used_by.through.objects.filter(promocode_id=pk).values_list("tguser_id", flat=True)
+            )
+            resynced += int(resync(keys=_keys_for(pk), args=[redeemed, *user_ids]))
+        return {"resynced": resynced}
@@ -0,0 +1,241 @@
+"""
+Хранение и очистка больших таблиц (BotErrorEvent, ChatMessage, ProductEvent, ...)
+"""
+import gzip
+import io
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.utils import timezone
+from redis.exceptions import RedisError
+
+from ..models import BotErrorEvent, ChatMessage, GenRequest, ProductEvent, ProfileReport, WebhookEvent
+from ..redis_client import get_redis
+from ..services import supabase_upload_object
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionAction:
+    DELETE = "delete"
+    SCRUB = "scrub"  # Строка остаётся, тяжёлые поля сбрасываются в значение по умолчанию
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    name: str
+    model: type
+    date_field: str
+    days_setting: str
+    action: str = RetentionAction.DELETE
+    archive: bool = False
+    scrub_fields: Tuple[str, ...] = ()
+    filters: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def days(self) -> int:
+        return int(getattr(settings, self.days_setting, 0) or 0)
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in (
+        RetentionPolicy(
+            name="bot_errors",
+            model=BotErrorEvent,
+            date_field="occurred_at",
+            days_setting="ERROR_LOG_RETENTION_DAYS",
+        ),
+        RetentionPolicy(
+            name="chat_messages",
+            model=ChatMessage,
+            date_field="message_date",
+            days_setting="CHAT_MESSAGE_RETENTION_DAYS",
+            archive=True,
+        ),
+        RetentionPolicy(
+            # Ответы провайдеров и тела webhook'ов (provider_metadata["webhook"]) завершённых генераций
+            name="provider_metadata",
+            model=GenRequest,
+            date_field="created_at",
+            days_setting="PROVIDER_METADATA_RETENTION_DAYS",
+            action=RetentionAction.SCRUB,
+            archive=True,
+            scrub_fields=("provider_metadata",),
+            filters={"status__in": ("done", "error", "cancelled")},
+        ),
+        RetentionPolicy(
+            name="product_events",
+            model=ProductEvent,
+            date_field="occurred_at",
+            days_setting="PRODUCT_EVENTS_RETENTION_DAYS",
+            archive=True,
+        ),
+        RetentionPolicy(
+            name="profile_reports",
+            model=ProfileReport,
+            date_field="created_at",
+            days_setting="PROFILE_REPORT_RETENTION_DAYS",
+        ),
+        RetentionPolicy(
+            name="webhook_events",
+            model=WebhookEvent,
+            date_field="received_at",
+            days_setting="WEBHOOK_EVENT_RETENTION_DAYS",
+            archive=True,
+        ),
+    )
+}
+
+
+class RetentionError(Exception):
+    """Неизвестная политика хранения или не настроено хранилище архива."""
+
+
+def archive_configured() -> bool:
+    """Архив пишется только в долговечное хранилище: файловая система контейнера теряется при деплое."""
+    return bool(settings.RETENTION_ARCHIVE_BUCKET and settings.SUPABASE_URL and settings.SUPABASE_KEY)
+
+
+def get_policy(name: str) -> RetentionPolicy:
+    try:
+        return POLICIES[name]
+    except KeyError:
+        raise RetentionError(f"Неизвестная политика: {name}. Доступны: {', '.join(POLICIES)}")
+
+
+def _cursor_key(policy: RetentionPolicy) -> str:
+    return f"retention:cursor:{policy.name}"
+
+
+class RetentionService:
+    """
+    Очистка пачками по RETENTION_BATCH_SIZE строк, каждая в своей короткой транзакции.
+
+    Строки выбираются по первичному ключу (id > курсор), между пачками — пауза RETENTION_BATCH_PAUSE,
+    за один запуск не больше RETENTION_MAX_BATCHES пачек. Если запуск упёрся в лимит, курсор
+    сохраняется в Redis и следующий запуск продолжает с него; полностью пройденный проход курсор сбрасывает.
+    При archive=True пачка сначала загружается в Supabase Storage (RETENTION_ARCHIVE_BUCKET) как
+    {политика}/{дата}/{первый pk}-{последний pk}.jsonl.gz и удаляется только после успешной загрузки;
+    без настроенного bucket такие политики не запускаются.
+    """
+
+    @classmethod
+    def run_all(cls, now: Optional[datetime] = None) -> Dict[str, int]:
+        summary: Dict[str, int] = {}
+        for policy in POLICIES.values():
+            if policy.days <= 0:
+                continue
+            try:
+                summary[policy.name] = cls.run(policy, now=now)
+            except Exception:
+                logger.exception("[RETENTION] Ошибка политики %s", policy.name)
+        return summary
+
+    @classmethod
+    def run(
+        cls,
+        policy: RetentionPolicy,
+        *,
+        now: Optional[datetime] = None,
+        max_batches: Optional[int] = None,
+        dry_run: bool = False,
+    ) -> int:
+        """Применяет политику; возвращает количество удалённых/очищенных строк (в dry_run — найденных)."""
+        if policy.days <= 0:
+            return 0
+        cutoff = (now or timezone.now()) - timedelta(days=policy.days)
+        batch_size = int(settings.RETENTION_BATCH_SIZE)
+        max_batches = max_batches or int(settings.RETENTION_MAX_BATCHES)
+        pause = float(settings.RETENTION_BATCH_PAUSE)
+
+        qs = cls._queryset(policy, cutoff)
+        if dry_run:
+            return qs.count()
+        if policy.archive and not archive_configured():
+            raise RetentionError(
+                f"Политика {policy.name} архивирует строки, но RETENTION_ARCHIVE_BUCKET/Supabase не настроены — "
+                "удаление пропущено"
+            )
+
+        cursor = cls._load_cursor(policy)
+        total = 0
+        for batch_number in range(max_batches):
+            pks = list(qs.filter(pk__gt=cursor).order_by("pk").values_list("pk", flat=True)[:batch_size])
+            if not pks:
+                cls._save_cursor(policy, None)
+                break
+            total += cls._process_batch(policy, pks)
+            cursor = pks[-1]
+            if len(pks) < batch_size:
+                cls._save_cursor(policy, None)
+                break
+            cls._save_cursor(policy, cursor)
+            if pause and batch_number + 1 < max_batches:
+                time.sleep(pause)
+
+        if total:
+            logger.info("[RETENTION] %s: обработано %s строк старше %s", policy.name, total, cutoff.isoformat())
+        return total
+
+    @staticmethod
+    def _queryset(policy: RetentionPolicy, cutoff: datetime) -> models.QuerySet:
+        qs = policy.model.objects.filter(**{f"{policy.date_field}__lt": cutoff}, **policy.filters)
+        if policy.action == RetentionAction.SCRUB:
+            for name in policy.scrub_fields:
+                qs = qs.exclude(**{name: policy.model._meta.get_field(name).get_default()})
+        return qs
+
+    @classmethod
+    def _process_batch(cls, policy: RetentionPolicy, pks: List[Any]) -> int:
+        if policy.archive:
+            cls._archive(policy, pks)
+        with transaction.atomic():
+            if policy.action == RetentionAction.SCRUB:
+                defaults = {
+                    name: policy.model._meta.get_field(name).get_default() for name in policy.scrub_fields
+                }
+                return policy.model.objects.filter(pk__in=pks).update(**defaults)
+            deleted, _ = policy.model.objects.filter(pk__in=pks).delete()
+            return deleted
+
+    @staticmethod
+    def _archive(policy: RetentionPolicy, pks: List[Any]) -> None:
+        if policy.action == RetentionAction.SCRUB:
+            rows = policy.model.objects.filter(pk__in=pks).values("pk", *policy.scrub_fields)
+        else:
+            rows = policy.model.objects.filter(pk__in=pks).values()
+        buffer = io.BytesIO()
+        with gzip.open(buffer, "wt", encoding="utf-8") as archive:
+            for row in rows.iterator():
+                archive.write(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False))
+                archive.write("\n")
+        # Ключ по диапазону pk: повтор пачки после сбоя перезаписывает тот же объект
+        key = f"{policy.name}/{timezone.localdate().isoformat()}/{pks[0]}-{pks[-1]}.jsonl.gz"
+        supabase_upload_object(buffer.getvalue(), key, "application/gzip", settings.RETENTION_ARCHIVE_BUCKET)
+
+    @staticmethod
+    def _load_cursor(policy: RetentionPolicy) -> Any:
+        try:
+            value = get_redis().get(_cursor_key(policy))
+        except RedisError as exc:
+            logger.warning("[RETENTION] Redis недоступен, %s начинается сначала: %s", policy.name, exc)
+            return 0
+        return int(value) if value else 0
+
+    @staticmethod
+    def _save_cursor(policy: RetentionPolicy, cursor: Optional[int]) -> None:
+        try:
+            if cursor is None:
+                get_redis().delete(_cursor_key(policy))
+            else:
+                get_redis().set(_cursor_key(policy), cursor, ex=7 * 24 * 3600)
+        except RedisError:
+            pass
@@ -0,0 +1,144 @@
+"""
+Инкрементальные агрегаты (rollup) для аналитики
+"""
+import logging
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q, Sum
+from django.db.models.functions import TruncDay, TruncHour, TruncMonth
+from django.utils import timezone
+
+from ..models import (
+    GenRequest,
+    GenerationRollup,
+    RollupGranularity,
+    Transaction,
+    TransactionRollup,
+)
+
+logger = logging.getLogger(__name__)
+
+_TRUNC = {
+    RollupGranularity.HOUR: TruncHour,
+    RollupGranularity.DAY: TruncDay,
+}
+
+
+def bucket_floor(value: datetime, granularity: str) -> datetime:
+    """Начало бакета, содержащего момент времени."""
+    value = timezone.localtime(value).replace(minute=0, second=0, microsecond=0)
+    if granularity == RollupGranularity.DAY:
+        value = value.replace(hour=0)
+    return value
+
+
+class RollupService:
+    """
+    Поддержка таблиц GenerationRollup / TransactionRollup.
+
+    Каждый запуск пересчитывает только бакеты начиная с последнего сохранённого
+    (минус ANALYTICS_ROLLUP_LOOKBACK_HOURS — статусы запросов меняются после создания)
+    и заменяет их в одной транзакции. Первый запуск заполняет всю историю.
+    """
+
+    @classmethod
+    def refresh(cls, now: Optional[datetime] = None) -> Dict[str, int]:
+        now = now or timezone.now()
+        lookback = timedelta(hours=settings.ANALYTICS_ROLLUP_LOOKBACK_HOURS)
+        summary: Dict[str, int] = {}
+        for granularity in (RollupGranularity.HOUR, RollupGranularity.DAY):
+            summary[f"generations_{granularity}"] = cls._refresh_generations(granularity, now, lookback)
+            summary[f"transactions_{granularity}"] = cls._refresh_transactions(granularity, now, lookback)
+        return summary
+
+    @staticmethod
+    def _window_start(
+        rollup_model, source_model, granularity: str, lookback: timedelta
+    ) -> Optional[datetime]:
+        last_bucket = rollup_model.objects.filter(granularity=granularity).aggregate(
+            last=Max('bucket_start')
+        )['last']
+        if last_bucket is not None:
+            return bucket_floor(last_bucket - lookback, granularity)
+        first = source_model.objects.aggregate(first=Min('created_at'))['first']
+        return bucket_floor(first, granularity) if first else None
+
+    @classmethod
+    def _refresh_generations(cls, granularity: str, now: datetime, lookback: timedelta) -> int:
+        start = cls._window_start(GenerationRollup, GenRequest, granularity, lookback)
+        if start is None:
+            return 0
+
+        rows = (
+            GenRequest.objects.filter(created_at__gte=start, created_at__lte=now)
+            .annotate(bucket=_TRUNC[granularity]('created_at'), cohort_month=TruncMonth('user__created_at'))
+            .values('bucket', 'ai_model__slug', 'ai_model__provider', 'generation_type', 'cohort_month')
+            .annotate(
+                requests=Count('id'),
+                done=Count('id', filter=Q(status='done')),
+                errors=Count('id', filter=Q(status='error')),
+                unique_users=Count('user', distinct=True),
+                revenue=Sum('cost', filter=Q(status='done')),
+                cost_usd=Sum('cost_usd', filter=Q(status='done')),
+                processing_seconds=Sum('processing_time'),
+                timed_requests=Count('processing_time'),
+            )
+            .order_by()
+        )
+        rollups = [
+            GenerationRollup(
+                granularity=granularity,
+                bucket_start=row['bucket'],
+                model_slug=row['ai_model__slug'] or "",
+                provider=row['ai_model__provider'] or "",
+                generation_type=row['generation_type'] or "",
+                cohort=row['cohort_month'].strftime('%Y-%m') if row['cohort_month'] else "",
+                requests=row['requests'],
+                done=row['done'],
+                errors=row['errors'],
+                unique_users=row['unique_users'],
+                revenue=row['revenue'] or Decimal('0.00'),
+                cost_usd=row['cost_usd'] or Decimal('0.0000'),
+                processing_seconds=row['processing_seconds'] or 0,
+                timed_requests=row['timed_requests'],
+            )
+            for row in rows
+        ]
+        with transaction.atomic():
+            GenerationRollup.objects.filter(granularity=granularity, bucket_start__gte=start).delete()
+            GenerationRollup.objects.bulk_create(rollups, batch_size=500)
+        return len(rollups)
+
+    @classmethod
+    def _refresh_transactions(cls, granularity: str, now: datetime, lookback: timedelta) -> int:
+        start = cls._window_start(TransactionRollup, Transaction, granularity, lookback)
+        if start is None:
+            return 0
+
+        rows = (
+            Transaction.objects.filter(created_at__gte=start, created_at__lte=now, is_completed=True)
+            .annotate(bucket=_TRUNC[granularity]('created_at'))
+            .values('bucket', 'type', 'payment_method')
+            .annotate(count=Count('id'), amount=Sum('amount'), unique_users=Count('user', distinct=True))
+            .order_by()
+        )
+        rollups = [
+            TransactionRollup(
+                granularity=granularity,
+                bucket_start=row['bucket'],
+                type=row['type'],
+                payment_method=row['payment_method'] or "",
+                count=row['count'],
+                amount=row['amount'] or Decimal('0.00'),
+                unique_users=row['unique_users'],
+            )
+            for row in rows
+        ]
+        with transaction.atomic():
+            TransactionRollup.objects.filter(granularity=granularity, bucket_start__gte=start).delete()
+            TransactionRollup.objects.bulk_create(rollups, batch_size=500)
+        return len(rollups)
@@ -0,0 +1,107 @@
+"""
+Производные результатов генерации изображений.
+
+Из каждого результата провайдера получаются:
+- original — файл как есть, для скачивания (отправляется документом);
+- preview — JPEG/WebP до RESULT_PREVIEW_MAX_SIDE для альбомов sendMediaGroup;
+- thumbnail — маленький WebP для истории и WebApp.
+Кодирование и загрузка в Supabase выполняются параллельно в пуле потоков (Pillow отпускает GIL
+при декодировании, ресайзе и кодировании). Ссылки по видам сохраняются в GenRequest.result_derivatives.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from . import image_optimizer
+from .media_utils import detect_reference_mime
+from .services import supabase_upload_image
+
+logger = logging.getLogger(__name__)
+
+ORIGINAL = "original"
+PREVIEW = "preview"
+THUMBNAIL = "thumbnail"
+
+# Лимит Telegram на фото в sendPhoto/sendMediaGroup
+TELEGRAM_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+
+_FOLDERS = {ORIGINAL: "images", PREVIEW: "images/previews", THUMBNAIL: "images/thumbnails"}
+
+Rendered = Dict[str, Tuple[bytes, str]]
+
+_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(settings.RESULT_DERIVATIVE_WORKERS),
+                thread_name_prefix="derivatives",
+            )
+        return _executor
+
+
+def _profiles() -> Dict[str, image_optimizer.ImageProfile]:
+    return {
+        PREVIEW: image_optimizer.ImageProfile(
+            (settings.RESULT_PREVIEW_MIME,),
+            max_side=int(settings.RESULT_PREVIEW_MAX_SIDE),
+            max_bytes=TELEGRAM_PHOTO_MAX_BYTES,
+        ),
+        THUMBNAIL: image_optimizer.ImageProfile(("image/webp",), max_side=int(settings.RESULT_THUMBNAIL_SIDE)),
+    }
+
+
+def _original_mime(content: bytes) -> str:
+    mime = detect_reference_mime(content, None, None)
+    return mime if mime.startswith("image/") else "image/png"
+
+
+def render_all(images: List[bytes]) -> List[Rendered]:
+    """Возвращает для каждого изображения {вид: (байты, mime)}; все виды кодируются параллельно."""
+    profiles = _profiles()
+    executor = _get_executor()
+    futures = [
+        {kind: executor.submit(image_optimizer.optimize, content, None, profile) for kind, profile in profiles.items()}
+        for content in images
+    ]
+    rendered: List[Rendered] = []
+    for content, pending in zip(images, futures):
+        variants: Rendered = {ORIGINAL: (content, _original_mime(content))}
+        for kind, future in pending.items():
+            variants[kind] = future.result()
+        rendered.append(variants)
+    return rendered
+
+
+def upload_all(rendered: List[Rendered]) -> List[Optional[Dict[str, str]]]:
+    """
+    Загружает все виды в Supabase параллельно и возвращает {вид: публичный URL} для каждого изображения.
+    Без original изображение считается незагруженным (None); ошибка preview/thumbnail только пропускает вид.
+    """
+    executor = _get_executor()
+    futures = [
+        {
+            kind: executor.submit(supabase_upload_image, content, mime, _FOLDERS[kind])
+            for kind, (content, mime) in variants.items()
+        }
+        for variants in rendered
+    ]
+    results: List[Optional[Dict[str, str]]] = []
+    for idx, pending in enumerate(futures, start=1):
+        urls: Dict[str, str] = {}
+        for kind, future in pending.items():
+            try:
+                url_obj = future.result()
+            except Exception as exc:
+                logger.warning("[DERIVATIVES] Не удалось загрузить %s изображения %s: %s", kind, idx, exc)
+                continue
+            urls[kind] = url_obj.get("public_url") if isinstance(url_obj, dict) else url_obj
+        results.append(urls if ORIGINAL in urls else None)
+    return results
@@ -0,0 +1,106 @@
+"""
+Постановка Celery-задач без блокировки event loop.
+
+apply_async — синхронная публикация в Redis (с переподключениями), поэтому async-хендлеры ставят
+задачи через enqueue(): публикация выполняется в небольшом пуле потоков (TASK_DISPATCH_WORKERS),
+а хендлер ждёт её не дольше TASK_DISPATCH_TIMEOUT секунд. task_id выдаётся заранее. Если брокер
+недоступен, задача сохраняется в TaskOutbox и досылается пачками задачей drain_task_outbox_task,
+как только брокер снова принимает сообщения. Синхронный код использует publish() с тем же откатом.
+Поток пула получает копию contextvars хендлера, поэтому before_task_publish видит текущий спан
+и задача продолжает трейс вебхука.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Sequence
+
+from celery import current_app
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+
+from .models import TaskOutbox
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(settings.TASK_DISPATCH_WORKERS),
+                thread_name_prefix="task-dispatch",
+            )
+        return _executor
+
+
+def _publish(task, task_id: str, args: Sequence[Any], kwargs: Dict[str, Any]) -> None:
+    try:
+        task.apply_async(args=list(args), kwargs=kwargs, task_id=task_id, retry=False)
+    except Exception as exc:
+        logger.warning("[DISPATCH] Брокер недоступен, %s %s сохранена в outbox: %s", task.name, task_id, exc)
+        try:
+            TaskOutbox.objects.create(
+                task_name=task.name,
+                task_id=task_id,
+                args=list(args),
+                kwargs=kwargs,
+                last_error=str(exc)[:2000],
+            )
+        except Exception:
+            logger.exception("[DISPATCH] Не удалось сохранить %s %s в outbox", task.name, task_id)
+
+
+def _publish_in_thread(task, task_id: str, args: Sequence[Any], kwargs: Dict[str, Any]) -> None:
+    """_publish в потоке пула: соединение с БД для outbox живёт только на время вызова."""
+    close_old_connections()
+    try:
+        _publish(task, task_id, args, kwargs)
+    finally:
+        close_old_connections()
+
+
+def publish(task, *args: Any, **kwargs: Any) -> str:
+    """Синхронная постановка задачи с откатом в outbox; возвращает task_id."""
+    task_id = str(uuid.uuid4())
+    _publish(task, task_id, args, kwargs)
+    return task_id
+
+
+async def enqueue(task, *args: Any, **kwargs: Any) -> str:
+    """Ставит задачу из async-кода; возвращает task_id, не дожидаясь медленного брокера."""
+    task_id = str(uuid.uuid4())
+    call = functools.partial(contextvars.copy_context().run, _publish_in_thread, task, task_id, args, kwargs)
+    future = asyncio.get_running_loop().run_in_executor(_get_executor(), call)
+    try:
+        await asyncio.wait_for(asyncio.shield(future), timeout=float(settings.TASK_DISPATCH_TIMEOUT))
+    except asyncio.TimeoutError:
+        # Публикация продолжается в потоке и при ошибке сама уйдёт в outbox
+        logger.warning("[DISPATCH] Публикация %s %s продолжается в фоне", task.name, task_id)
+    return task_id
+
+
+def drain(limit: int = 200) -> Dict[str, int]:
+    """Досылает задачи из outbox по порядку; останавливается на первой ошибке брокера."""
+    sent = 0
+    for entry in TaskOutbox.objects.order_by("pk")[:limit]:
+        task = current_app.tasks.get(entry.task_name)
+        if task is None:
+            logger.error("[DISPATCH] Неизвестная задача %s в outbox (id=%s)", entry.task_name, entry.pk)
+            continue
+        try:
+            task.apply_async(args=entry.args, kwargs=entry.kwargs, task_id=entry.task_id or None, retry=False)
+        except Exception as exc:
+            TaskOutbox.objects.filter(pk=entry.pk).update(attempts=F("attempts") + 1, last_error=str(exc)[:2000])
+            break
+        entry.delete()
+        sent += 1
+    return {"sent": sent, "pending": TaskOutbox.objects.count()}
@@ -1,17 +1,37 @@
+"""
+Запись ошибок бота.
+
+ErrorTracker.log только формирует событие и кладёт его в очередь: поиск пользователя, запись
+в БД и алерт в Telegram выполняет фоновый поток, поэтому упавший запрос не ждёт I/O.
+Поток группирует одинаковые ошибки по отпечатку (origin, handler, класс, нормализованное
+сообщение): в пределах окна ERROR_GROUP_WINDOW это одна запись BotErrorEvent со счётчиком
+occurrences. Повтор алертов ограничивается ключом в Redis, общим для всех процессов.
+"""
 from __future__ import annotations
 
+import atexit
+import hashlib
 import logging
+import os
+import queue
+import re
+import threading
 import time
 import traceback
-from typing import Any, Dict, Optional
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
 
 import httpx
 from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.db import OperationalError
+from django.db import OperationalError, close_old_connections
+from django.db.models import F
 from django.utils import timezone
+from redis.exceptions import RedisError
 
 from botapp.models import BotErrorEvent, GenRequest, TgUser
+from botapp.redis_client import get_redis
 
 try:
     import sentry_sdk
@@ -21,11 +41,57 @@ except ImportError:  # pragma: no cover
 
 logger = logging.getLogger(__name__)
 
+_NORMALIZE_PATTERNS = (
+    (re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.I), "<uuid>"),
+    (re.compile(r"0x[0-9a-f]+", re.I), "<hex>"),
+    (re.compile(r"https?://\S+"), "<url>"),
+    (re.compile(r"'[^']*'|\"[^\"]*\""), "<str>"),
+    (re.compile(r"\d+(\.\d+)?"), "<n>"),
+)
+
+
+def normalize_message(message: str) -> str:
+    """Убирает из текста ошибки id, числа, URL и строковые литералы."""
+    value = (message or "")[:1000]
+    for pattern, replacement in _NORMALIZE_PATTERNS:
+        value = pattern.sub(replacement, value)
+    return " ".join(value.split())[:500]
+
+
+def error_fingerprint(origin: str, handler: str, error_class: str, message: str) -> str:
+    raw = "|".join((origin or "", handler or "", error_class or "", normalize_message(message)))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class _ErrorRecord:
+    fingerprint: str
+    origin: str
+    severity: str
+    status: str
+    occurred_at: datetime
+    handler: str
+    error_class: str
+    message: str
+    stacktrace: str
+    payload: Any
+    extra: Any
+    chat_id: Optional[int]
+    user_id: Optional[int]
+    username: str
+    gen_request_id: Optional[int]
+    occurrences: int = field(default=1)
+    last_seen_at: Optional[datetime] = None
+
 
 class ErrorTracker:
     """Центральное место для записи ошибок бота."""
 
-    _alert_cache: Dict[str, float] = {}
+    _queue: "queue.Queue[_ErrorRecord]" = queue.Queue(maxsize=settings.ERROR_TRACKER_QUEUE_SIZE)
+    _writer: Optional[threading.Thread] = None
+    _writer_pid: Optional[int] = None
+    _writer_lock = threading.Lock()
+    _dropped = 0
 
     @classmethod
     def log(
@@ -43,11 +109,7 @@ class ErrorTracker:
         payload: Optional[Any] = None,
         extra: Optional[Dict[str, Any]] = None,
         exc: Optional[BaseException] = None,
-    ) -> Optional[BotErrorEvent]:
-        resolved_user = user or (TgUser.objects.filter(chat_id=chat_id).first() if chat_id else None)
-        username_snapshot = (resolved_user.username if resolved_user and resolved_user.username else "")
-        chat_id_value = chat_id or (resolved_user.chat_id if resolved_user else None)
-
+    ) -> None:
         if not message and exc:
             message = str(exc)
         error_cls = error_class or (exc.__class__.__name__ if exc else "")
@@ -56,41 +118,169 @@ class ErrorTracker:
             stacktrace = "".join(traceback.format_exception(exc.__class__, exc, exc.__traceback__))
 
         payload_data = cls._to_serializable(payload)
-        extra_data = cls._to_serializable(extra)
+        handler = handler[:255]
+        record = _ErrorRecord(
+            fingerprint=error_fingerprint(origin, handler, error_cls, message),
+            origin=origin,
+            severity=severity,
+            status=status,
+            occurred_at=timezone.now(),
+            handler=handler,
+            error_class=error_cls[:255],
+            message=cls._trim_text(message),
+            stacktrace=cls._trim_text(stacktrace),
+            payload=payload_data,
+            extra=cls._to_serializable(extra),
+            chat_id=chat_id or (user.chat_id if user else None),
+            user_id=user.pk if user else None,
+            username=(user.username or "") if user else "",
+            gen_request_id=gen_request.pk if gen_request else None,
+        )
 
+        # Sentry остаётся в вызывающем потоке: его транспорт и так асинхронный,
+        # а здесь доступен scope текущего запроса/задачи
+        cls._send_to_sentry(record=record, exc=exc, message=message, payload=payload_data)
+
+        if not settings.ERROR_TRACKER_ASYNC:
+            cls._write_batch([record])
+            return
         try:
-            event = BotErrorEvent.objects.create(
-                origin=origin,
-                severity=severity,
-                status=status,
-                occurred_at=timezone.now(),
-                handler=handler[:255],
-                error_class=error_cls[:255],
-                message=cls._trim_text(message),
-                stacktrace=cls._trim_text(stacktrace),
-                payload=payload_data,
-                extra=extra_data,
-                chat_id=chat_id_value,
-                user=resolved_user,
-                username_snapshot=username_snapshot,
-                gen_request=gen_request,
-            )
-        except OperationalError:
-            logger.exception("Не удалось сохранить BotErrorEvent (OperationalError)")
-            event = None
-        except Exception:
-            logger.exception("Не удалось сохранить BotErrorEvent")
-            event = None
+            cls._queue.put_nowait(record)
+        except queue.Full:
+            cls._dropped += 1
+            return
+        cls._ensure_writer()
+
+    @classmethod
+    async def alog(cls, **kwargs) -> None:
+        if settings.ERROR_TRACKER_ASYNC:
+            # В асинхронном режиме log() не делает I/O — поток sync_to_async не нужен
+            cls.log(**kwargs)
+            return
+        await sync_to_async(cls.log, thread_sensitive=True)(**kwargs)
+
+    @classmethod
+    def _drain(cls) -> List[_ErrorRecord]:
+        batch: List[_ErrorRecord] = []
+        while True:
+            try:
+                batch.append(cls._queue.get_nowait())
+            except queue.Empty:
+                break
+        if cls._dropped:
+            logger.warning("[ERROR_TRACKER] Очередь переполнена, потеряно %s событий", cls._dropped)
+            cls._dropped = 0
+        return batch
 
-        cls._send_to_sentry(event=event, exc=exc, message=message, payload=payload_data)
-        if severity == BotErrorEvent.Severity.CRITICAL:
-            cls._notify_telegram(event, message)
+    @classmethod
+    def flush(cls) -> int:
+        """Записывает всё, что накопилось в очереди; возвращает количество событий."""
+        batch = cls._drain()
+        if batch:
+            cls._write_batch(batch)
+        return len(batch)
+
+    @classmethod
+    def _writer_loop(cls) -> None:
+        interval = float(settings.ERROR_TRACKER_FLUSH_INTERVAL)
+        while True:
+            first = cls._queue.get()
+            # Небольшая задержка собирает всплеск одинаковых ошибок в одну пачку
+            time.sleep(interval)
+            try:
+                cls._write_batch([first] + cls._drain())
+            except Exception:  # pragma: no cover - поток не должен умирать
+                logger.exception("[ERROR_TRACKER] Ошибка фоновой записи")
+
+    @classmethod
+    def _ensure_writer(cls) -> None:
+        """Запускает фоновый поток (заново после fork воркера Celery)."""
+        pid = os.getpid()
+        if cls._writer is not None and cls._writer_pid == pid and cls._writer.is_alive():
+            return
+        with cls._writer_lock:
+            if cls._writer is not None and cls._writer_pid == pid and cls._writer.is_alive():
+                return
+            cls._writer = threading.Thread(target=cls._writer_loop, name="error-tracker-writer", daemon=True)
+            cls._writer_pid = pid
+            cls._writer.start()
 
-        return event
+    @staticmethod
+    def _group(batch: List[_ErrorRecord]) -> List[_ErrorRecord]:
+        """Схлопывает пачку по отпечатку: первая запись + счётчик и время последней."""
+        groups: Dict[str, _ErrorRecord] = {}
+        for record in batch:
+            group = groups.get(record.fingerprint)
+            if group is None:
+                record.last_seen_at = record.occurred_at
+                groups[record.fingerprint] = record
+                continue
+            group.occurrences += 1
+            group.last_seen_at = max(group.last_seen_at or record.occurred_at, record.occurred_at)
+            if record.severity == BotErrorEvent.Severity.CRITICAL:
+                group.severity = record.severity
+        return list(groups.values())
 
     @classmethod
-    async def alog(cls, **kwargs) -> Optional[BotErrorEvent]:
-        return await sync_to_async(cls.log, thread_sensitive=True)(**kwargs)
+    def _write_batch(cls, batch: List[_ErrorRecord]) -> None:
+        close_old_connections()
+        for record in cls._group(batch):
+            try:
+                event = cls._store(record)
+            except OperationalError:
+                logger.exception("Не удалось сохранить BotErrorEvent (OperationalError)")
+                event = None
+            except Exception:
+                logger.exception("Не удалось сохранить BotErrorEvent")
+                event = None
+            if record.severity == BotErrorEvent.Severity.CRITICAL:
+                cls._notify_telegram(record, event)
+
+    @classmethod
+    def _store(cls, record: _ErrorRecord) -> BotErrorEvent:
+        """Добавляет повторы к записи с тем же отпечатком за последнее окно или создаёт новую."""
+        window = timedelta(seconds=max(int(settings.ERROR_GROUP_WINDOW), 1))
+        existing = (
+            BotErrorEvent.objects.filter(
+                fingerprint=record.fingerprint,
+                occurred_at__gt=record.occurred_at - window,
+            )
+            .order_by("-occurred_at")
+            .only("id")
+            .first()
+        )
+        if existing:
+            BotErrorEvent.objects.filter(pk=existing.pk).update(
+                occurrences=F("occurrences") + record.occurrences,
+                last_seen_at=record.last_seen_at,
+            )
+            return existing
+
+        user_id, username = record.user_id, record.username
+        if user_id is None and record.chat_id:
+            row = TgUser.objects.filter(chat_id=record.chat_id).values_list("id", "username").first()
+            if row:
+                user_id, username = row[0], row[1] or ""
+
+        return BotErrorEvent.objects.create(
+            fingerprint=record.fingerprint,
+            occurrences=record.occurrences,
+            last_seen_at=record.last_seen_at,
+            origin=record.origin,
+            severity=record.severity,
+            status=record.status,
+            occurred_at=record.occurred_at,
+            handler=record.handler,
+            error_class=record.error_class,
+            message=record.message,
+            stacktrace=record.stacktrace,
+            payload=record.payload,
+            extra=record.extra,
+            chat_id=record.chat_id,
+            user_id=user_id,
+            username_snapshot=username,
+            gen_request_id=record.gen_request_id,
+        )
 
     @staticmethod
     def _to_serializable(data: Any) -> Any:
@@ -118,7 +308,7 @@ class ErrorTracker:
         return value[: limit - 1] + "…"
 
     @classmethod
-    def _send_to_sentry(cls, *, event: Optional[BotErrorEvent], exc: Optional[BaseException], message: str, payload: Any) -> None:
+    def _send_to_sentry(cls, *, record: _ErrorRecord, exc: Optional[BaseException], message: str, payload: Any) -> None:
         if not sentry_sdk or not getattr(settings, "SENTRY_DSN", None):
             return
 
@@ -126,12 +316,12 @@ class ErrorTracker:
 
         def _with_scope(callback):
             with sentry_sdk.push_scope() as scope:  # type: ignore[attr-defined]
-                if event and event.chat_id:
-                    scope.set_user({"id": str(event.chat_id), "username": event.username_snapshot})
-                if event:
-                    scope.set_tag("origin", event.origin)
-                    if event.gen_request_id:
-                        scope.set_tag("gen_request_id", event.gen_request_id)
+                if record.chat_id:
+                    scope.set_user({"id": str(record.chat_id), "username": record.username})
+                scope.set_tag("origin", record.origin)
+                if record.gen_request_id:
+                    scope.set_tag("gen_request_id", record.gen_request_id)
+                scope.fingerprint = [record.fingerprint]
                 for key, value in payload_repr.items():
                     scope.set_extra(key, value)
                 callback()
@@ -142,27 +332,28 @@ class ErrorTracker:
             _with_scope(lambda: sentry_sdk.capture_message(message))
 
     @classmethod
-    def _notify_telegram(cls, event: Optional[BotErrorEvent], fallback_message: str) -> None:
+    def _notify_telegram(cls, record: _ErrorRecord, event: Optional[BotErrorEvent]) -> None:
         token = getattr(settings, "TELEGRAM_BOT_TOKEN", None)
         target_chat = getattr(settings, "ERROR_ALERT_CHAT_ID", None)
         if not token or not target_chat:
             return
 
-        key = cls._alert_key(event, fallback_message)
-        if not cls._should_alert(key):
+        if not cls._should_alert(record.fingerprint):
             return
 
-        summary = fallback_message or (event.message if event else "Critical error")
-        origin = event.origin if event else "unknown"
-        handler = event.handler if event else "-"
-        chat_info = f"chat_id={event.chat_id}" if event and event.chat_id else "chat_id=—"
+        summary = record.message or record.error_class or "Critical error"
+        chat_info = f"chat_id={record.chat_id}" if record.chat_id else "chat_id=—"
         text = (
             "⚠️ Критическая ошибка бота\n"
-            f"Источник: {origin}\n"
-            f"Хендлер: {handler or '-'}\n"
+            f"Источник: {record.origin}\n"
+            f"Хендлер: {record.handler or '-'}\n"
             f"{chat_info}\n"
             f"Сообщение: {summary[:400]}"
         )
+        if record.occurrences > 1:
+            text += f"\nПовторов: {record.occurrences}"
+        if event is not None:
+            text += f"\nBotErrorEvent #{event.pk}"
 
         url = f"https://api.telegram.org/bot{token}/sendMessage"
         data = {"chat_id": target_chat, "text": text}
@@ -172,18 +363,16 @@ class ErrorTracker:
         except Exception:
             logger.exception("Не удалось отправить критическое уведомление в Telegram")
 
-    @classmethod
-    def _alert_key(cls, event: Optional[BotErrorEvent], fallback_message: str) -> str:
-        if event:
-            return f"{event.origin}:{event.handler}:{event.error_class or event.message}"
-        return f"fallback:{fallback_message}"
+    @staticmethod
+    def _should_alert(fingerprint: str) -> bool:
+        """Один алерт на отпечаток за ERROR_ALERT_COOLDOWN секунд во всех процессах."""
+        cooldown = max(int(getattr(settings, "ERROR_ALERT_COOLDOWN", 300)), 1)
+        try:
+            return bool(get_redis().set(f"errors:alert:{fingerprint}", "1", nx=True, ex=cooldown))
+        except RedisError as exc:
+            # Без Redis лучше получить лишний алерт, чем пропустить критическую ошибку
+            logger.warning("[ERROR_TRACKER] Redis недоступен для троттлинга алертов: %s", exc)
+            return True
 
-    @classmethod
-    def _should_alert(cls, key: str) -> bool:
-        cooldown = getattr(settings, "ERROR_ALERT_COOLDOWN", 300)
-        now = time.monotonic()
-        last = cls._alert_cache.get(key)
-        if last and (now - last) < cooldown:
-            return False
-        cls._alert_cache[key] = now
-        return True
+
+atexit.register(ErrorTracker.flush)
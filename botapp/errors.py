@@ -0,0 +1,180 @@
+"""
+Классификация ошибок генерации и политика повторов по классам.
+
+Классы:
+- transient — сетевые сбои, таймауты, 5xx: повторяем с экспоненциальной задержкой;
+- rate_limited — 429 и «слишком много задач»: повторяем через Retry-After провайдера;
+- permanent — ошибки конфигурации/запроса, 4xx, отказ провайдера: без повторов;
+- provider_account — исчерпан баланс или квота аккаунта провайдера: без повторов, аккаунт выводится из ротации;
+- user_error — проблемы входных данных пользователя (модерация, валидация): без повторов.
+
+Провайдеры и services.py могут явно поднимать исключения из этого модуля; прочие ошибки
+классифицируются по цепочке __cause__ (httpx) и тексту сообщения.
+"""
+from __future__ import annotations
+
+import random
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from enum import Enum
+from typing import Any, Optional
+
+import httpx
+from django.conf import settings
+
+
+class ErrorKind(str, Enum):
+    TRANSIENT = "transient"
+    RATE_LIMITED = "rate_limited"
+    PERMANENT = "permanent"
+    PROVIDER_ACCOUNT = "provider_account"
+    USER_ERROR = "user_error"
+
+
+@dataclass(frozen=True)
+class ErrorClassification:
+    kind: ErrorKind
+    retry_after: Optional[float] = None
+    reason: str = ""
+
+    @property
+    def retryable(self) -> bool:
+        return self.kind in {ErrorKind.TRANSIENT, ErrorKind.RATE_LIMITED}
+
+
+class ProviderError(Exception):
+    """Базовая ошибка провайдера с заранее известным классом."""
+
+    kind: ErrorKind = ErrorKind.TRANSIENT
+
+    def __init__(self, message: str, *, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TransientProviderError(ProviderError):
+    kind = ErrorKind.TRANSIENT
+
+
+class RateLimitedError(ProviderError):
+    kind = ErrorKind.RATE_LIMITED
+
+
+class PermanentProviderError(ProviderError):
+    kind = ErrorKind.PERMANENT
+
+
+class ProviderAccountError(ProviderError):
+    """Баланс или квота аккаунта провайдера исчерпаны: повтор до пополнения бесполезен."""
+
+    kind = ErrorKind.PROVIDER_ACCOUNT
+
+
+class UserInputError(ProviderError):
+    kind = ErrorKind.USER_ERROR
+
+
+_TRANSIENT_STATUSES = {408, 425, 500, 502, 503, 504, 520, 522, 524}
+_RATE_LIMIT_MARKERS = ("429", "rate limit", "too many")
+# Коды ошибок в теле ответа: OpenAI отдаёт insufficient_quota со статусом 429, его нельзя повторять
+_ACCOUNT_ERROR_CODES = {"insufficient_quota", "billing_hard_limit_reached", "insufficient_balance", "insufficient_credits"}
+# Последний рубеж для ошибок без HTTP-ответа в цепочке; провайдерам лучше поднимать ProviderAccountError
+_ACCOUNT_MARKERS = ("quota", "квота", "insufficient balance", "insufficient credit", "billing")
+_TRANSIENT_MARKERS = ("timeout", "timed out", "temporarily", "временно", "connection reset", "502", "503", "504")
+
+
+def parse_retry_after(value: Any) -> Optional[float]:
+    """Разбирает Retry-After: число секунд или HTTP-дата."""
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        try:
+            moment = parsedate_to_datetime(str(value))
+        except (TypeError, ValueError, IndexError):
+            return None
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        seconds = (moment - datetime.now(timezone.utc)).total_seconds()
+    return max(0.0, seconds)
+
+
+def _response_error_code(response: httpx.Response) -> str:
+    """code/type из JSON-тела ошибки ({"error": {"code": ...}} или {"code": ...}); пусто, если тела нет."""
+    try:
+        payload = response.json()
+    except Exception:
+        return ""
+    if not isinstance(payload, dict):
+        return ""
+    error = payload.get("error") if isinstance(payload.get("error"), dict) else payload
+    return str(error.get("code") or error.get("type") or "").lower()
+
+
+def _classify_response(response: httpx.Response) -> ErrorClassification:
+    status = response.status_code
+    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+    if status == 402 or (status in {403, 429} and _response_error_code(response) in _ACCOUNT_ERROR_CODES):
+        return ErrorClassification(ErrorKind.PROVIDER_ACCOUNT, None, f"HTTP {status}")
+    if status == 429:
+        return ErrorClassification(ErrorKind.RATE_LIMITED, retry_after, f"HTTP {status}")
+    if status in _TRANSIENT_STATUSES:
+        kind = ErrorKind.RATE_LIMITED if retry_after is not None else ErrorKind.TRANSIENT
+        return ErrorClassification(kind, retry_after, f"HTTP {status}")
+    if status in {400, 413, 415, 422}:
+        return ErrorClassification(ErrorKind.USER_ERROR, None, f"HTTP {status}")
+    return ErrorClassification(ErrorKind.PERMANENT, None, f"HTTP {status}")
+
+
+def classify_error(exc: BaseException) -> ErrorClassification:
+    """Определяет класс ошибки, проходя по цепочке причин исключения."""
+    current: Optional[BaseException] = exc
+    seen = set()
+    while current is not None and id(current) not in seen:
+        seen.add(id(current))
+        if isinstance(current, ProviderError):
+            return ErrorClassification(current.kind, current.retry_after, type(current).__name__)
+        if isinstance(current, httpx.HTTPStatusError) and current.response is not None:
+            return _classify_response(current.response)
+        if isinstance(current, (httpx.TransportError, ConnectionError, TimeoutError)):
+            return ErrorClassification(ErrorKind.TRANSIENT, None, type(current).__name__)
+        current = current.__cause__ or current.__context__
+
+    message = str(exc).lower()
+    if any(marker in message for marker in _ACCOUNT_MARKERS):
+        return ErrorClassification(ErrorKind.PROVIDER_ACCOUNT, None, "message")
+    if any(marker in message for marker in _RATE_LIMIT_MARKERS):
+        return ErrorClassification(ErrorKind.RATE_LIMITED, None, "message")
+    if any(marker in message for marker in _TRANSIENT_MARKERS):
+        return ErrorClassification(ErrorKind.TRANSIENT, None, "message")
+    # Ошибки валидации и явные отказы провайдера не лечатся повтором
+    from .providers.video.base import VideoGenerationError
+
+    if isinstance(exc, (ValueError, VideoGenerationError)):
+        return ErrorClassification(ErrorKind.PERMANENT, None, type(exc).__name__)
+    return ErrorClassification(ErrorKind.TRANSIENT, None, type(exc).__name__)
+
+
+def get_retry_countdown(classification: ErrorClassification, retries: int) -> Optional[int]:
+    """
+    Задержка до следующей попытки (сек) или None, если повторять не нужно.
+
+    retries — сколько повторов уже было (task.request.retries).
+    """
+    if classification.kind == ErrorKind.TRANSIENT:
+        max_retries = settings.GENERATION_RETRY_TRANSIENT_MAX
+    elif classification.kind == ErrorKind.RATE_LIMITED:
+        max_retries = settings.GENERATION_RETRY_RATE_LIMITED_MAX
+    else:
+        return None
+    if retries >= max_retries:
+        return None
+
+    backoff_max = settings.GENERATION_RETRY_BACKOFF_MAX
+    if classification.retry_after is not None:
+        return int(min(max(classification.retry_after, 1), backoff_max))
+    base = settings.GENERATION_RETRY_BACKOFF_BASE * (2 ** retries)
+    # Джиттер, чтобы повторы разных задач не били провайдера одновременно
+    return int(min(base + random.uniform(0, base / 2), backoff_max))
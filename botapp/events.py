@@ -0,0 +1,235 @@
+"""
+Конвейер продуктовых событий: буфер в процессе → Redis stream → пакетная запись в ProductEvent.
+
+Обработчик только кладёт событие в кольцевой буфер (deque, O(1), без I/O). Фоновый поток раз в
+PRODUCT_EVENTS_FLUSH_INTERVAL секунд отправляет накопленное в Redis stream одним pipeline.
+ingest_product_events_task читает stream через consumer group и пишет события пачками bulk_create.
+При переполнении буфера или недоступности Redis события теряются — это аналитика, а не биллинг.
+
+В PostgreSQL ProductEvent секционирована по месяцам occurred_at (UTC); ensure_partitions() заранее
+создаёт секции на PRODUCT_EVENTS_PARTITION_MONTHS_AHEAD месяцев вперёд. Строки вне секций попадают в DEFAULT
+и переносятся в секцию своего месяца, когда она создаётся.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from collections import deque
+from datetime import datetime, timezone as dt_timezone
+from typing import Any, Deque, Dict, List, Optional
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from redis.exceptions import RedisError, ResponseError
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+CONSUMER_GROUP = "ingest"
+
+_buffer: Deque[Dict[str, str]] = deque(maxlen=settings.PRODUCT_EVENTS_BUFFER_SIZE)
+_flusher: Optional[threading.Thread] = None
+_flusher_pid: Optional[int] = None
+_flusher_lock = threading.Lock()
+_wakeup = threading.Event()
+
+
+def emit(event_type: str, chat_id: Optional[int] = None, username: str = "", **metadata: Any) -> None:
+    """Регистрирует событие. Не выполняет I/O в вызывающем потоке."""
+    _buffer.append(
+        {
+            "event_type": event_type,
+            "chat_id": "" if chat_id is None else str(chat_id),
+            "username": username or "",
+            "occurred_at": timezone.now().isoformat(),
+            "metadata": json.dumps(metadata, ensure_ascii=False, default=str),
+        }
+    )
+    _ensure_flusher()
+    if len(_buffer) >= settings.PRODUCT_EVENTS_FLUSH_BATCH:
+        _wakeup.set()
+
+
+def flush() -> int:
+    """Отправляет содержимое буфера в Redis stream; возвращает количество событий."""
+    batch: List[Dict[str, str]] = []
+    while _buffer:
+        try:
+            batch.append(_buffer.popleft())
+        except IndexError:
+            break
+    if not batch:
+        return 0
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for event in batch:
+            pipe.xadd(
+                settings.PRODUCT_EVENTS_STREAM,
+                event,
+                maxlen=settings.PRODUCT_EVENTS_STREAM_MAXLEN,
+                approximate=True,
+            )
+        pipe.execute()
+    except RedisError as exc:
+        logger.warning("[EVENTS] Redis недоступен, потеряно %s событий: %s", len(batch), exc)
+        return 0
+    return len(batch)
+
+
+def _flush_loop() -> None:
+    interval = float(settings.PRODUCT_EVENTS_FLUSH_INTERVAL)
+    while True:
+        _wakeup.wait(interval)
+        _wakeup.clear()
+        try:
+            flush()
+        except Exception:  # pragma: no cover - поток не должен умирать
+            logger.exception("[EVENTS] Ошибка фоновой отправки событий")
+
+
+def _ensure_flusher() -> None:
+    """Запускает фоновый поток (заново после fork воркера Celery)."""
+    global _flusher, _flusher_pid
+    pid = os.getpid()
+    if _flusher is not None and _flusher_pid == pid and _flusher.is_alive():
+        return
+    with _flusher_lock:
+        if _flusher is not None and _flusher_pid == pid and _flusher.is_alive():
+            return
+        _flusher = threading.Thread(target=_flush_loop, name="product-events-flusher", daemon=True)
+        _flusher_pid = pid
+        _flusher.start()
+
+
+def _ensure_group(client) -> None:
+    try:
+        client.xgroup_create(settings.PRODUCT_EVENTS_STREAM, CONSUMER_GROUP, id="0", mkstream=True)
+    except ResponseError as exc:
+        if "BUSYGROUP" not in str(exc):
+            raise
+
+
+def _decode(value: Any) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _to_model(stream_id: Any, raw_fields: Dict[Any, Any]):
+    from .models import ProductEvent
+
+    fields = {_decode(key): _decode(value) for key, value in raw_fields.items()}
+    occurred_at: Optional[datetime] = None
+    raw_time = fields.get("occurred_at")
+    if raw_time:
+        occurred_at = datetime.fromisoformat(raw_time)
+    try:
+        metadata = json.loads(fields.get("metadata") or "{}")
+    except ValueError:
+        metadata = {}
+    chat_id = fields.get("chat_id")
+    return ProductEvent(
+        stream_id=_decode(stream_id),
+        occurred_at=occurred_at or timezone.now(),
+        event_type=(fields.get("event_type") or "")[:64],
+        chat_id=int(chat_id) if chat_id else None,
+        username=(fields.get("username") or "")[:255],
+        metadata=metadata,
+    )
+
+
+def ingest(consumer: str = "worker", max_batches: Optional[int] = None) -> int:
+    """
+    Читает события из stream пачками и сохраняет в ProductEvent.
+
+    Сначала дочитываются неподтверждённые сообщения этого consumer'а (после падения), затем новые.
+    stream_id уникален, поэтому повторная доставка не создаёт дублей.
+    """
+    from .models import ProductEvent
+
+    client = get_redis()
+    stream = settings.PRODUCT_EVENTS_STREAM
+    batch_size = settings.PRODUCT_EVENTS_INGEST_BATCH
+    max_batches = max_batches or settings.PRODUCT_EVENTS_INGEST_MAX_BATCHES
+    _ensure_group(client)
+
+    total = 0
+    cursor = "0"
+    for _ in range(max_batches):
+        response = client.xreadgroup(CONSUMER_GROUP, consumer, {stream: cursor}, count=batch_size)
+        messages = response[0][1] if response else []
+        if not messages:
+            if cursor == ">":
+                break
+            cursor = ">"
+            continue
+
+        # Неподтверждённое сообщение, уже срезанное XADD MAXLEN, приходит без полей — только подтверждаем
+        events = [_to_model(stream_id, fields) for stream_id, fields in messages if fields]
+        ProductEvent.objects.bulk_create(events, ignore_conflicts=True)
+        client.xack(stream, CONSUMER_GROUP, *[stream_id for stream_id, _ in messages])
+        total += len(events)
+    return total
+
+
+def _month_starts(now: datetime, count: int) -> List[datetime]:
+    year, month = now.year, now.month
+    starts = []
+    for _ in range(count):
+        starts.append(datetime(year, month, 1, tzinfo=dt_timezone.utc))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return starts
+
+
+def ensure_partitions(now: Optional[datetime] = None) -> List[str]:
+    """Создаёт недостающие месячные секции ProductEvent; возвращает имена созданных (только PostgreSQL)."""
+    if connection.vendor != "postgresql":
+        return []
+    from .models import ProductEvent
+
+    table = ProductEvent._meta.db_table
+    now = (now or timezone.now()).astimezone(dt_timezone.utc)
+    starts = _month_starts(now, int(settings.PRODUCT_EVENTS_PARTITION_MONTHS_AHEAD) + 2)
+    created = []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass",
+            [table],
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        for start, end in zip(starts, starts[1:]):
+            name = f"{table}_p{start:%Y_%m}"
+            if name in existing:
+                continue
+            try:
+                with transaction.atomic():
+                    _create_partition(cursor, table, name, start, end)
+            except DatabaseError:
+                logger.exception("[EVENTS] Не удалось создать секцию %s", name)
+                continue
+            created.append(name)
+    return created
+
+
+def _create_partition(cursor, table: str, name: str, start: datetime, end: datetime) -> None:
+    """
+    Создаёт секцию отдельной таблицей, переносит в неё строки месяца из DEFAULT и подключает.
+    CREATE TABLE ... PARTITION OF не проходит, если DEFAULT уже содержит строки этого диапазона.
+    """
+    default = f"{table}_default"
+    bounds = [start, end]
+    cursor.execute(f'CREATE TABLE "{name}" (LIKE "{table}" INCLUDING DEFAULTS)')
+    cursor.execute(
+        f'WITH moved AS (DELETE FROM "{default}" WHERE occurred_at >= %s AND occurred_at < %s RETURNING *) '
+        f'INSERT INTO "{name}" SELECT * FROM moved',
+        bounds,
+    )
+    if cursor.rowcount:
+        logger.info("[EVENTS] Перенесено %s строк из %s в %s", cursor.rowcount, default, name)
+    cursor.execute(
+        f'ALTER TABLE "{table}" ATTACH PARTITION "{name}" '
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    )
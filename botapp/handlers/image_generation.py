@@ -5,7 +5,6 @@ import asyncio
 import json
 import logging
 from typing import List, Dict, Any, Optional
-import base64
 from decimal import Decimal
 
 from aiogram import Router, F
@@ -28,6 +27,7 @@ from botapp.business.balance import BalanceService, InsufficientBalanceError
 from botapp.business.pricing import get_base_price_tokens
 from botapp.tasks import generate_image_task
 from botapp.error_tracker import ErrorTracker
+from botapp import dispatch, media_pool
 from botapp.generation_text import (
     format_image_start_message,
     resolve_format_and_quality,
@@ -230,7 +230,7 @@ async def handle_midjourney_webapp_data(message: Message, state: FSMContext):
                     "file_name": image_name
                 })
                 # Декодируем только для проверки размера
-                raw = base64.b64decode(image_data)
+                raw = await media_pool.b64decode(image_data)
                 logging.info(f"[MIDJOURNEY_WEBAPP] Изображение подготовлено: {len(raw)} байт")
             except Exception as e:
                 logging.error(f"[MIDJOURNEY_WEBAPP] Ошибка обработки изображения: {e}")
@@ -437,7 +437,7 @@ async def handle_gpt_image_webapp_data(message: Message, state: FSMContext):
         })
         # Декодируем только для валидации
         try:
-            raw_bytes = base64.b64decode(base)
+            raw_bytes = await media_pool.b64decode(base)
         except Exception as exc:
             logger.error(f"[GPT_IMAGE_WEBAPP] Ошибка декодирования изображения: {exc}")
             await message.answer(
@@ -616,7 +616,7 @@ async def handle_nanobanana_webapp_data(message: Message, state: FSMContext):
             if "," in data_b64:
                 data_b64 = data_b64.split(",")[-1]
             try:
-                raw_bytes = base64.b64decode(data_b64)
+                raw_bytes = await media_pool.b64decode(data_b64)
             except Exception:
                 continue
             if len(raw_bytes) > 10 * 1024 * 1024:
@@ -625,7 +625,7 @@ async def handle_nanobanana_webapp_data(message: Message, state: FSMContext):
             name = img.get("name") or img.get("file_name") or f"image_{idx + 1}.png"
             images_payload.append(
                 {
-                    "content_base64": base64.b64encode(raw_bytes).decode(),
+                    "content_base64": await media_pool.b64encode(raw_bytes),
                     "mime_type": mime,
                     "file_name": name,
                     "size": len(raw_bytes),
@@ -696,7 +696,7 @@ async def handle_nanobanana_webapp_data(message: Message, state: FSMContext):
         parse_mode="HTML",
     )
 
-    generate_image_task.delay(gen_request.id)
+    await dispatch.enqueue(generate_image_task, gen_request.id)
     await state.clear()
 
 
@@ -841,8 +841,8 @@ async def _start_generation(message: Message, state: FSMContext, prompt: str):
 
         # Запускаем задачу генерации
         logging.info(f"[_START_GENERATION] Запуск Celery задачи для request_id={gen_request.id}")
-        task_result = generate_image_task.delay(gen_request.id)
-        logging.info(f"[_START_GENERATION] Celery задача запущена: task_id={task_result.id}")
+        task_id = await dispatch.enqueue(generate_image_task, gen_request.id)
+        logging.info(f"[_START_GENERATION] Celery задача запущена: task_id={task_id}")
 
         # Очищаем состояние
         await state.clear()
@@ -17,6 +17,7 @@ from botapp.keyboards import (
     get_support_keyboard,
 )
 from botapp.models import TgUser, UserSettings
+from botapp.business.analytics import AnalyticsService
 from botapp.business.balance import BalanceService
 from asgiref.sync import sync_to_async
 
@@ -71,6 +72,8 @@ async def cmd_start(message: Message, state: FSMContext):
     # Пытаемся начислить приветственный бонус
     # Метод вернёт транзакцию только если бонус ещё не был начислен (новый пользователь)
     bonus_tx = await sync_to_async(BalanceService.add_welcome_bonus)(user)
+    # Без I/O: событие уходит в буфер процесса (см. botapp/events.py)
+    AnalyticsService.track_event(user, "start", {"new_user": bool(bonus_tx)})
 
     # Основное приветственное сообщение (всегда)
     welcome_text = (
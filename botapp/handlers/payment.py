@@ -7,7 +7,6 @@ from aiogram.types import Message, CallbackQuery, PreCheckoutQuery
 from aiogram.fsm.context import FSMContext
 from decimal import Decimal
 from django.conf import settings
-from django.utils import timezone
 from asgiref.sync import sync_to_async
 
 from botapp.states import BotStates
@@ -17,8 +16,9 @@ from botapp.keyboards import (
     get_main_menu_keyboard,
     format_balance
 )
-from botapp.models import TgUser, Transaction, Promocode
+from botapp.models import TgUser, Transaction
 from botapp.business.balance import BalanceService
+from botapp.business.promocodes import PromocodeService, RedemptionStatus
 
 router = Router()
 _configured_payment_url = getattr(settings, 'PAYMENT_MINI_APP_URL', None)
@@ -45,74 +45,24 @@ async def _process_promocode_activation(
     success_markup,
     failure_markup,
 ) -> bool:
-    promo_code = (promo_code_raw or "").strip()
+    result = await sync_to_async(PromocodeService.redeem)(user, promo_code_raw)
 
-    if not promo_code:
-        await message.answer(
-            "Извините, такого промокода нет в базе, пожалуйста введите корректный промокод.",
-            reply_markup=failure_markup,
-        )
-        return False
-
-    try:
-        promocode = await sync_to_async(Promocode.objects.get)(
-            code__iexact=promo_code,
-            is_active=True,
-        )
-    except Promocode.DoesNotExist:
-        await message.answer(
-            "Извините, такого промокода нет в базе, пожалуйста введите корректный промокод.",
-            reply_markup=failure_markup,
-        )
-        return False
-
-    now = timezone.now()
-    if promocode.valid_from > now or promocode.valid_until < now:
-        await message.answer(
-            "Извините, такого промокода нет в базе, пожалуйста введите корректный промокод.",
-            reply_markup=failure_markup,
-        )
-        return False
-
-    already_used = await sync_to_async(promocode.used_by.filter(id=user.id).exists)()
-    if already_used:
+    if result.status == RedemptionStatus.ALREADY_USED:
         await message.answer(
             f"Данный промокод уже был активирован, вам уже было начислено "
-            f"{_format_tokens(promocode.value)} бонусных токенов.",
+            f"{_format_tokens(result.amount)} бонусных токенов.",
             reply_markup=failure_markup,
         )
         return False
 
-    if promocode.max_uses and promocode.current_uses >= promocode.max_uses:
+    if not result.ok:
         await message.answer(
             "Извините, такого промокода нет в базе, пожалуйста введите корректный промокод.",
             reply_markup=failure_markup,
         )
         return False
 
-    if promocode.is_percentage:
-        await message.answer(
-            "Извините, такого промокода нет в базе, пожалуйста введите корректный промокод.",
-            reply_markup=failure_markup,
-        )
-        return False
-
-    bonus_amount = promocode.value
-    await sync_to_async(BalanceService.add_bonus)(
-        user,
-        amount=bonus_amount,
-        description=f"Промокод {promocode.code}",
-        description_en=f"Promocode {promocode.code}",
-    )
-
-    await sync_to_async(promocode.used_by.add)(user)
-    promocode.current_uses += 1
-    promocode.total_activated += 1
-    promocode.total_bonus_given += bonus_amount
-    await sync_to_async(promocode.save)(
-        update_fields=["current_uses", "total_activated", "total_bonus_given", "updated_at"]
-    )
-
+    bonus_amount = result.amount
     new_balance = await sync_to_async(BalanceService.get_balance)(user)
 
     await message.answer(
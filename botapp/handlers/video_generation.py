@@ -2,9 +2,7 @@
 Обработчики генерации видео
 """
 import asyncio
-import base64
 import json
-from io import BytesIO
 from typing import Any, Dict, List, Optional, Tuple
 
 from aiogram import Router, F
@@ -32,6 +30,7 @@ from botapp.providers.video.openai_sora import resolve_sora_dimensions
 from asgiref.sync import sync_to_async
 from botapp.services import supabase_upload_png, supabase_upload_video
 from botapp.error_tracker import ErrorTracker
+from botapp import dispatch, media_pool
 
 router = Router()
 START_MESSAGE_DELAY = 0.6
@@ -111,23 +110,6 @@ MAX_KLING_IMAGE_BYTES = 10 * 1024 * 1024
 MAX_RUNWAY_ALEPH_VIDEO_BYTES = 10 * 1024 * 1024
 
 
-def _convert_to_png_bytes(raw: bytes, mime: Optional[str]) -> bytes:
-    mime_value = (mime or "").lower()
-    if mime_value == "image/png":
-        return raw
-    try:
-        from PIL import Image
-    except ImportError:
-        return raw
-    try:
-        with Image.open(BytesIO(raw)) as img:
-            buffer = BytesIO()
-            img.save(buffer, format="PNG")
-            return buffer.getvalue()
-    except Exception:
-        return raw
-
-
 def _extract_public_url(upload_obj) -> Optional[str]:
     if isinstance(upload_obj, dict):
         return upload_obj.get("public_url") or upload_obj.get("publicUrl") or upload_obj.get("publicURL")
@@ -392,7 +374,7 @@ async def _handle_sora_webapp_data_impl(message: Message, state: FSMContext, pay
             )
             return
         try:
-            raw = base64.b64decode(image_b64)
+            raw = await media_pool.b64decode(image_b64)
         except Exception:
             await message.answer(
                 "Не удалось прочитать изображение. Загрузите файл ещё раз.",
@@ -408,7 +390,7 @@ async def _handle_sora_webapp_data_impl(message: Message, state: FSMContext, pay
 
         mime = payload.get("imageMime") or "image/png"
         file_name = payload.get("imageName") or "image.png"
-        png_bytes = _convert_to_png_bytes(raw, mime)
+        png_bytes = await media_pool.to_png(raw, mime)
         try:
             upload_obj = await sync_to_async(supabase_upload_png)(png_bytes)
         except Exception as exc:  # pragma: no cover - сеть/хранилище
@@ -510,7 +492,7 @@ async def _handle_sora_webapp_data_impl(message: Message, state: FSMContext, pay
         ),
     )
 
-    generate_video_task.delay(gen_request.id)
+    await dispatch.enqueue(generate_video_task, gen_request.id)
     await state.clear()
 
 
@@ -587,7 +569,7 @@ async def _handle_runway_aleph_webapp_data_impl(message: Message, state: FSMCont
         await message.answer("Загрузите видео для режима Видео → Видео.", reply_markup=get_cancel_keyboard())
         return
     try:
-        raw = base64.b64decode(video_b64)
+        raw = await media_pool.b64decode(video_b64)
     except Exception:
         await message.answer(
             "Не удалось прочитать видео. Загрузите файл ещё раз.",
@@ -708,7 +690,7 @@ async def _handle_runway_aleph_webapp_data_impl(message: Message, state: FSMCont
         ),
     )
 
-    generate_video_task.delay(gen_request.id)
+    await dispatch.enqueue(generate_video_task, gen_request.id)
     await state.clear()
 
 
@@ -801,7 +783,7 @@ async def _handle_runway_webapp_data_impl(message: Message, state: FSMContext, p
         await message.answer("Загрузите изображение для режима Изображение → Видео.", reply_markup=get_cancel_keyboard())
         return
     try:
-        raw = base64.b64decode(image_b64)
+        raw = await media_pool.b64decode(image_b64)
     except Exception:
         await message.answer(
             "Не удалось прочитать изображение. Загрузите файл ещё раз.",
@@ -817,7 +799,7 @@ async def _handle_runway_webapp_data_impl(message: Message, state: FSMContext, p
 
     mime = payload.get("imageMime") or "image/png"
     file_name = payload.get("imageName") or "image.png"
-    png_bytes = _convert_to_png_bytes(raw, mime)
+    png_bytes = await media_pool.to_png(raw, mime)
     try:
         upload_obj = await sync_to_async(supabase_upload_png)(png_bytes)
     except Exception as exc:  # pragma: no cover - сеть/хранилище
@@ -927,7 +909,7 @@ async def _handle_runway_webapp_data_impl(message: Message, state: FSMContext, p
         ),
     )
 
-    generate_video_task.delay(gen_request.id)
+    await dispatch.enqueue(generate_video_task, gen_request.id)
     await state.clear()
 
 
@@ -1004,7 +986,7 @@ async def _handle_midjourney_video_webapp_data_impl(message: Message, state: FSM
         await message.answer("Загрузите изображение в WebApp для Midjourney Video.", reply_markup=get_cancel_keyboard())
         return
     try:
-        raw = base64.b64decode(image_b64)
+        raw = await media_pool.b64decode(image_b64)
     except Exception:
         await message.answer(
             "Не удалось прочитать изображение. Загрузите файл ещё раз.",
@@ -1020,7 +1002,7 @@ async def _handle_midjourney_video_webapp_data_impl(message: Message, state: FSM
 
     mime = payload.get("imageMime") or "image/png"
     file_name = payload.get("imageName") or "image.png"
-    png_bytes = _convert_to_png_bytes(raw, mime)
+    png_bytes = await media_pool.to_png(raw, mime)
     try:
         upload_obj = await sync_to_async(supabase_upload_png)(png_bytes)
     except Exception as exc:  # pragma: no cover - сеть/хранилище
@@ -1137,7 +1119,7 @@ async def _handle_midjourney_video_webapp_data_impl(message: Message, state: FSM
         ),
     )
 
-    generate_video_task.delay(gen_request.id)
+    await dispatch.enqueue(generate_video_task, gen_request.id)
     await state.clear()
 
 async def _handle_kling_webapp_data_impl(message: Message, state: FSMContext, payload: dict):
@@ -1312,7 +1294,7 @@ async def _handle_kling_webapp_data_impl(message: Message, state: FSMContext, pa
             )
             return
         try:
-            raw = base64.b64decode(image_b64)
+            raw = await media_pool.b64decode(image_b64)
         except Exception:
             await message.answer(
                 "Не удалось прочитать изображение. Загрузите файл ещё раз.",
@@ -1341,7 +1323,7 @@ async def _handle_kling_webapp_data_impl(message: Message, state: FSMContext, pa
         tail_image_b64 = payload.get("imageTailData")
         if tail_image_b64 and model_slug != "kling-v2-1-master":
             try:
-                tail_raw = base64.b64decode(tail_image_b64)
+                tail_raw = await media_pool.b64decode(tail_image_b64)
             except Exception:
                 await message.answer(
                     "Не удалось прочитать конечное изображение. Загрузите файл ещё раз.",
@@ -1412,7 +1394,7 @@ async def _kling_background_process(
         mime = image_data["mime"]
         file_name = image_data["file_name"]
 
-        png_bytes = _convert_to_png_bytes(raw, mime)
+        png_bytes = await media_pool.to_png(raw, mime)
         try:
             upload_obj = await sync_to_async(supabase_upload_png)(png_bytes)
         except Exception as exc:
@@ -1453,7 +1435,7 @@ async def _kling_background_process(
             tail_mime = tail_image_data["mime"]
             tail_file_name = tail_image_data["file_name"]
 
-            tail_png_bytes = _convert_to_png_bytes(tail_raw, tail_mime)
+            tail_png_bytes = await media_pool.to_png(tail_raw, tail_mime)
             try:
                 tail_upload_obj = await sync_to_async(supabase_upload_png)(tail_png_bytes)
             except Exception as exc:
@@ -1540,7 +1522,7 @@ async def _kling_background_process(
     )
 
     # Запускаем Celery задачу
-    generate_video_task.delay(gen_request.id)
+    await dispatch.enqueue(generate_video_task, gen_request.id)
 
 
 async def _handle_kling_o1_webapp_data_impl(message: Message, state: FSMContext, payload: dict):
@@ -1772,7 +1754,7 @@ async def _kling_o1_background_process(
     )
 
     # Запускаем Celery задачу
-    generate_video_task.delay(gen_request.id)
+    await dispatch.enqueue(generate_video_task, gen_request.id)
 
 
 async def _handle_veo_webapp_data_impl(message: Message, state: FSMContext, payload: dict):
@@ -1846,16 +1828,16 @@ async def _handle_veo_webapp_data_impl(message: Message, state: FSMContext, payl
     input_images = []
     final_frame = None
 
-    def _prepare_inline_image(raw_b64, mime, name):
+    async def _prepare_inline_image(raw_b64, mime, name):
         if not raw_b64:
             raise ValueError("missing")
         try:
-            decoded = base64.b64decode(raw_b64)
+            decoded = await media_pool.b64decode(raw_b64)
         except Exception as exc:
             raise ValueError("decode") from exc
         if len(decoded) > MAX_VEO_IMAGE_BYTES:
             raise ValueError("too_large")
-        normalized = base64.b64encode(decoded).decode("ascii")
+        normalized = await media_pool.b64encode(decoded)
         return {
             "content_base64": normalized,
             "mime_type": mime or "image/png",
@@ -1887,7 +1869,7 @@ async def _handle_veo_webapp_data_impl(message: Message, state: FSMContext, payl
             return
 
         try:
-            start_image = _prepare_inline_image(start_raw, start_mime, start_name)
+            start_image = await _prepare_inline_image(start_raw, start_mime, start_name)
         except ValueError as exc:
             reason = str(exc)
             if reason == "too_large":
@@ -1925,7 +1907,7 @@ async def _handle_veo_webapp_data_impl(message: Message, state: FSMContext, payl
             )
 
             try:
-                final_frame = _prepare_inline_image(end_raw, end_mime, end_name)
+                final_frame = await _prepare_inline_image(end_raw, end_mime, end_name)
             except ValueError as exc:
                 reason = str(exc)
                 if reason == "too_large":
@@ -2041,7 +2023,7 @@ async def _handle_veo_webapp_data_impl(message: Message, state: FSMContext, payl
         ),
     )
 
-    generate_video_task.delay(gen_request.id)
+    await dispatch.enqueue(generate_video_task, gen_request.id)
     await state.clear()
 
 
@@ -2528,7 +2510,7 @@ async def handle_video_prompt(message: Message, state: FSMContext):
         ),
     )
 
-    generate_video_task.delay(gen_request.id)
+    await dispatch.enqueue(generate_video_task, gen_request.id)
     await state.clear()
 
 
@@ -2747,7 +2729,7 @@ async def handle_video_extension_prompt(message: Message, state: FSMContext):
         ),
     )
 
-    extend_video_task.delay(gen_request.id)
+    await dispatch.enqueue(extend_video_task, gen_request.id)
     await state.clear()
 
 
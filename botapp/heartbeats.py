@@ -0,0 +1,113 @@
+"""
+Heartbeat'ы и чекпоинты задач генерации в Redis.
+
+Пока задача обрабатывает GenRequest, фоновый поток обновляет ключ heartbeat с TTL.
+Если воркер упал (OOM, деплой), ключ истекает, и reap_stuck_requests_task видит зависший запрос.
+Чекпоинт хранит последний пройденный этап (started → provider_call → delivered), по нему
+reaper решает: перезапустить задачу, закрыть запрос как выполненный или вернуть средства.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+STAGE_STARTED = "started"
+STAGE_PROVIDER_CALL = "provider_call"
+STAGE_DELIVERED = "delivered"
+
+_CHECKPOINT_TTL = 24 * 60 * 60
+
+
+def _heartbeat_key(request_id: int) -> str:
+    return f"genreq:heartbeat:{request_id}"
+
+
+def _checkpoint_key(request_id: int) -> str:
+    return f"genreq:checkpoint:{request_id}"
+
+
+def touch(request_id: int, ttl: Optional[int] = None, task_id: Optional[str] = None) -> None:
+    """Обновляет heartbeat запроса."""
+    ttl = int(ttl or settings.GENERATION_HEARTBEAT_TTL)
+    value = json.dumps({"ts": time.time(), "task_id": task_id})
+    try:
+        get_redis().set(_heartbeat_key(request_id), value, ex=ttl)
+    except RedisError as exc:
+        logger.debug("[HEARTBEAT] Не удалось обновить heartbeat %s: %s", request_id, exc)
+
+
+def clear(request_id: int, *, keep_checkpoint: bool = False) -> None:
+    keys = [_heartbeat_key(request_id)]
+    if not keep_checkpoint:
+        keys.append(_checkpoint_key(request_id))
+    try:
+        get_redis().delete(*keys)
+    except RedisError as exc:
+        logger.debug("[HEARTBEAT] Не удалось удалить heartbeat %s: %s", request_id, exc)
+
+
+def alive(request_ids: Iterable[int]) -> Dict[int, bool]:
+    """Для каждого запроса — есть ли живой heartbeat. При недоступности Redis считаем все живыми."""
+    ids = list(request_ids)
+    if not ids:
+        return {}
+    try:
+        values = get_redis().mget([_heartbeat_key(request_id) for request_id in ids])
+    except RedisError as exc:
+        logger.warning("[HEARTBEAT] Redis недоступен, проверка heartbeat пропущена: %s", exc)
+        return {request_id: True for request_id in ids}
+    return {request_id: value is not None for request_id, value in zip(ids, values)}
+
+
+def checkpoint(request_id: int, stage: str, **data: Any) -> None:
+    """Фиксирует пройденный этап обработки запроса."""
+    payload = {"stage": stage, "ts": time.time(), **data}
+    try:
+        get_redis().set(_checkpoint_key(request_id), json.dumps(payload, default=str), ex=_CHECKPOINT_TTL)
+    except RedisError as exc:
+        logger.debug("[HEARTBEAT] Не удалось сохранить чекпоинт %s/%s: %s", request_id, stage, exc)
+
+
+def get_checkpoint(request_id: int) -> Dict[str, Any]:
+    try:
+        raw = get_redis().get(_checkpoint_key(request_id))
+    except RedisError:
+        return {}
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return {}
+
+
+class HeartbeatThread(threading.Thread):
+    """Фоновый поток, обновляющий heartbeat, пока задача выполняется."""
+
+    def __init__(self, request_id: int, task_id: Optional[str] = None):
+        super().__init__(name=f"heartbeat-{request_id}", daemon=True)
+        self.request_id = request_id
+        self.task_id = task_id
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        interval = float(settings.GENERATION_HEARTBEAT_INTERVAL)
+        while not self._stop_event.wait(interval):
+            touch(self.request_id, task_id=self.task_id)
+
+    def start(self) -> None:
+        touch(self.request_id, task_id=self.task_id)
+        super().start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
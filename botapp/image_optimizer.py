@@ -0,0 +1,181 @@
+"""
+Подготовка входных изображений под возможности провайдера.
+
+Раньше каждый референс перекодировался в RGBA PNG (часто в разы тяжелее исходного JPEG) и в таком
+виде уходил провайдеру, в том числе base64 внутри JSON. Теперь для провайдера берётся профиль
+(принимаемые форматы, максимальная сторона, лимит байт на файл и на весь запрос), и изображение:
+- отдаётся без перекодирования, если формат принят и лимиты соблюдены;
+- уменьшается через draft()/reduce() (JPEG декодируется сразу в уменьшенном масштабе);
+- кодируется в принятый формат, качество JPEG/WebP выбирается по одной пробной кодировке.
+"""
+from __future__ import annotations
+
+import logging
+import math
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+_PIL_FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG", "image/webp": "WEBP"}
+_MIME_BY_PIL = {value: key for key, value in _PIL_FORMATS.items()}
+
+_REFERENCE_QUALITY = 85
+# Доля размера файла относительно quality=85 (усреднено по фото; для оценки, не для точного попадания)
+_QUALITY_SIZE_FACTORS = ((85, 1.0), (75, 0.72), (60, 0.5), (45, 0.38))
+_MIN_SIDE = 256
+
+
+@dataclass(frozen=True)
+class ImageProfile:
+    formats: Tuple[str, ...]  # Принимаемые MIME; первый — формат перекодирования по умолчанию
+    max_side: Optional[int] = None  # Пикселей по большей стороне
+    max_bytes: Optional[int] = None  # На одно изображение
+    max_total_bytes: Optional[int] = None  # На все изображения запроса (inline base64 в JSON)
+
+
+# Прежнее поведение: всё в PNG без ограничений
+DEFAULT_PROFILE = ImageProfile(formats=("image/png",))
+
+PROFILES: Dict[str, ImageProfile] = {
+    # Gemini масштабирует вход до ~3K сам; лимит запроса с inline-данными — 20 МБ вместе с base64
+    "gemini": ImageProfile(("image/jpeg", "image/png", "image/webp"), max_side=2048, max_bytes=4 * MB,
+                           max_total_bytes=12 * MB),
+    "vertex": ImageProfile(("image/jpeg", "image/png"), max_side=2048, max_bytes=7 * MB),
+    # Редактирование OpenAI: PNG (прозрачные области работают как маска)
+    "openai_image": ImageProfile(("image/png",), max_side=2048, max_bytes=20 * MB),
+    # Референсы Midjourney загружаются в Supabase как PNG
+    "midjourney": ImageProfile(("image/png",), max_side=2048),
+    "kling": ImageProfile(("image/jpeg", "image/png", "image/webp"), max_bytes=10 * MB),
+}
+
+
+def profile_for(provider: Optional[str]) -> ImageProfile:
+    return PROFILES.get(provider or "", DEFAULT_PROFILE)
+
+
+def optimize(
+    content: bytes,
+    mime_type: Optional[str],
+    profile: ImageProfile,
+    *,
+    max_bytes: Optional[int] = None,
+    lossless: bool = False,
+) -> Tuple[bytes, str]:
+    """Возвращает (байты, mime) под профиль; нечитаемые данные отдаются как есть."""
+    limit = max_bytes or profile.max_bytes
+    try:
+        with Image.open(BytesIO(content)) as img:
+            source_mime = _MIME_BY_PIL.get(img.format or "", (mime_type or "").lower() or "image/png")
+            too_large = bool(profile.max_side and max(img.size) > profile.max_side)
+            fits = source_mime in profile.formats and not too_large and (not limit or len(content) <= limit)
+            if fits and (not lossless or source_mime == "image/png" or "image/png" not in profile.formats):
+                return content, source_mime
+
+            target_mime = _target_mime(img, source_mime, profile, lossless)
+            if too_large:
+                img = _downscale(img, profile.max_side)
+            else:
+                img.load()
+            encoded = _encode_within(img, target_mime, limit)
+    except (UnidentifiedImageError, OSError, ValueError) as exc:
+        logger.warning("[IMAGE_OPTIMIZER] Не удалось обработать изображение (%s): %s", mime_type, exc)
+        return content, mime_type or "application/octet-stream"
+
+    logger.debug(
+        "[IMAGE_OPTIMIZER] %s %s байт -> %s %s байт", source_mime, len(content), target_mime, len(encoded)
+    )
+    return encoded, target_mime
+
+
+def optimize_all(images: List[Dict[str, Any]], profile: ImageProfile) -> List[Dict[str, Any]]:
+    """Оптимизирует подготовленные референсы ({"content", "mime_type", "role", ...}) с общим бюджетом."""
+    per_image = profile.max_bytes
+    if profile.max_total_bytes and images:
+        share = profile.max_total_bytes // len(images)
+        per_image = min(per_image, share) if per_image else share
+    optimized = []
+    for image in images:
+        content, mime = optimize(
+            image["content"],
+            image.get("mime_type"),
+            profile,
+            max_bytes=per_image,
+            lossless=image.get("role") == "mask",
+        )
+        optimized.append({**image, "content": content, "mime_type": mime})
+    return optimized
+
+
+def _target_mime(img: Image.Image, source_mime: str, profile: ImageProfile, lossless: bool) -> str:
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    if (lossless or has_alpha) and "image/png" in profile.formats:
+        return "image/png"
+    if source_mime in profile.formats:
+        return source_mime
+    return profile.formats[0]
+
+
+def _downscale(img: Image.Image, max_side: int) -> Image.Image:
+    scale = max_side / max(img.size)
+    size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+    # Для JPEG draft() выбирает масштаб DCT-декодирования (1/2, 1/4, 1/8) ещё до чтения пикселей
+    img.draft("RGB" if img.mode == "CMYK" else img.mode, size)
+    img = img.copy()
+    # reducing_gap: сначала быстрый reduce() до ~2x целевого размера, затем LANCZOS
+    img.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+    return img
+
+
+def _prepare_mode(img: Image.Image, mime: str) -> Image.Image:
+    if mime == "image/jpeg":
+        if img.mode in ("RGBA", "LA", "PA", "P"):
+            rgba = img.convert("RGBA")
+            background = Image.new("RGB", rgba.size, (255, 255, 255))
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            return background
+        if img.mode != "RGB":
+            return img.convert("RGB")
+    elif img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+        return img.convert("RGBA")
+    return img
+
+
+def _save(img: Image.Image, mime: str, quality: int) -> bytes:
+    buffer = BytesIO()
+    options: Dict[str, Any] = {}
+    if mime in ("image/jpeg", "image/webp"):
+        options["quality"] = quality
+    if mime == "image/jpeg":
+        options["optimize"] = True
+    img.save(buffer, format=_PIL_FORMATS[mime], **options)
+    return buffer.getvalue()
+
+
+def _encode_within(img: Image.Image, mime: str, limit: Optional[int]) -> bytes:
+    """Пробное кодирование с эталонным качеством, затем не больше одного пересчёта по оценке размера."""
+    img = _prepare_mode(img, mime)
+    encoded = _save(img, mime, _REFERENCE_QUALITY)
+    if not limit or len(encoded) <= limit:
+        return encoded
+
+    lossy = mime in ("image/jpeg", "image/webp")
+    if lossy:
+        for quality, factor in _QUALITY_SIZE_FACTORS[1:]:
+            if len(encoded) * factor <= limit * 0.95:
+                return _save(img, mime, quality)
+        quality, factor = _QUALITY_SIZE_FACTORS[-1]
+    else:
+        quality, factor = _REFERENCE_QUALITY, 1.0
+
+    # Качество не спасает — уменьшаем площадь (размер файла примерно пропорционален числу пикселей)
+    scale = math.sqrt(limit * 0.9 / (len(encoded) * factor))
+    side = max(_MIN_SIDE, int(max(img.size) * scale))
+    img = img.copy()
+    img.thumbnail((side, side), Image.LANCZOS, reducing_gap=2.0)
+    return _save(img, mime, quality)
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from botapp.business.retention import POLICIES, RetentionError, RetentionService, get_policy
+
+
+class Command(BaseCommand):
+    help = "Применяет политики хранения: пачками удаляет или архивирует устаревшие строки."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--policy", action="append", help=f"Политика ({', '.join(POLICIES)}); по умолчанию все")
+        parser.add_argument("--max-batches", type=int, help="Лимит пачек за запуск (по умолчанию RETENTION_MAX_BATCHES)")
+        parser.add_argument("--dry-run", action="store_true", help="Только посчитать подходящие строки")
+
+    def handle(self, *args, **options):
+        try:
+            policies = [get_policy(name) for name in options["policy"] or POLICIES]
+        except RetentionError as exc:
+            raise CommandError(str(exc)) from exc
+
+        for policy in policies:
+            if policy.days <= 0:
+                self.stdout.write(f"{policy.name}: выключена ({policy.days_setting}=0)")
+                continue
+            try:
+                total = RetentionService.run(
+                    policy,
+                    max_batches=options["max_batches"],
+                    dry_run=options["dry_run"],
+                )
+            except RetentionError as exc:
+                self.stderr.write(self.style.ERROR(f"{policy.name}: {exc}"))
+                continue
+            verb = "к обработке" if options["dry_run"] else "обработано"
+            self.stdout.write(self.style.SUCCESS(f"{policy.name}: {verb} {total} строк старше {policy.days} дн."))
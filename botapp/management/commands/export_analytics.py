@@ -0,0 +1,40 @@
+
+from django.core.management.base import BaseCommand, CommandError
+
+from botapp.business.export import DATASETS, DEFAULT_CHUNK_SIZE, FORMATS, ExportError, export, parse_moment
+
+
+class Command(BaseCommand):
+    help = "Потоково выгружает GenRequest/Transaction в CSV или Parquet (память не зависит от объёма)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("dataset", choices=sorted(DATASETS))
+        parser.add_argument("--format", choices=FORMATS, default="csv")
+        parser.add_argument("--output", "-o", help="Путь к файлу (для CSV по умолчанию stdout)")
+        parser.add_argument("--since", help="Начало периода (ISO дата/время)")
+        parser.add_argument("--until", help="Конец периода, не включительно (ISO дата/время)")
+        parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        fmt = options["format"]
+        output_path = options["output"]
+        if fmt == "parquet" and not output_path:
+            raise CommandError("Для Parquet укажите --output.")
+
+        try:
+            params = {
+                "since": parse_moment(options["since"]),
+                "until": parse_moment(options["until"]),
+                "chunk_size": options["chunk_size"],
+            }
+            if fmt == "csv" and not output_path:
+                total = export(options["dataset"], fmt, self.stdout, **params)
+            elif fmt == "csv":
+                with open(output_path, "w", newline="", encoding="utf-8") as stream:
+                    total = export(options["dataset"], fmt, stream, **params)
+            else:
+                total = export(options["dataset"], fmt, output_path, **params)
+        except ExportError as exc:
+            raise CommandError(str(exc)) from exc
+
+        self.stderr.write(self.style.SUCCESS(f"Выгружено {total} строк ({options['dataset']}, {fmt})."))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from redis.exceptions import RedisError
+
+from botapp import profiling
+
+
+class Command(BaseCommand):
+    help = "Включает/выключает сэмплирующее профилирование задачи, хендлера или чата."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--target",
+            help="Имя задачи (botapp.tasks.generate_image_task) или хендлера (telegram_webhook)",
+        )
+        parser.add_argument("--chat", type=int, help="chat_id пользователя")
+        parser.add_argument("--ttl", type=int, help="Сколько секунд держать флаг (по умолчанию PROFILING_FLAG_TTL)")
+        parser.add_argument("--disable", action="store_true", help="Снять флаг")
+
+    def handle(self, *args, **options):
+        target = options["target"]
+        chat_id = options["chat"]
+        if not target and chat_id is None:
+            raise CommandError("Укажите --target и/или --chat.")
+
+        try:
+            if options["disable"]:
+                profiling.disable(target, chat_id)
+                self.stdout.write(self.style.SUCCESS("Профилирование выключено."))
+                return
+            profiling.enable(target, chat_id, ttl=options["ttl"])
+        except RedisError as exc:
+            raise CommandError(f"Redis недоступен: {exc}") from exc
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Профилирование включено: target={target or '-'} chat={chat_id if chat_id is not None else '-'}. "
+                "Результаты — в /dashboard/profiles/."
+            )
+        )
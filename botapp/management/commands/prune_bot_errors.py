@@ -1,20 +1,15 @@
-from datetime import timedelta
-
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.utils import timezone
 
-from botapp.models import BotErrorEvent
+from botapp.business.retention import RetentionService, get_policy
 
 
 class Command(BaseCommand):
-    help = "Удаляет старые записи BotErrorEvent."
+    help = "Удаляет старые записи BotErrorEvent (пачками, см. manage.py apply_retention)."
 
     def handle(self, *args, **options):
         retention_days = getattr(settings, "ERROR_LOG_RETENTION_DAYS", 30)
-        cutoff = timezone.now() - timedelta(days=retention_days)
-        qs = BotErrorEvent.objects.filter(occurred_at__lt=cutoff)
-        deleted, _ = qs.delete()
+        deleted = RetentionService.run(get_policy("bot_errors"))
         self.stdout.write(
             self.style.SUCCESS(
                 f"Удалено {deleted} записей BotErrorEvent старше {retention_days} дней."
@@ -0,0 +1,188 @@
+"""
+Локальный дисковый LRU-кэш медиа на воркере.
+
+Цепочки продлений, повторные отправки и откаты на ссылку скачивают одни и те же объекты Supabase,
+файлы Telegram и результаты провайдеров. Кэш хранит их в MEDIA_CACHE_DIR:
+- objects/ab/<sha256 содержимого> — данные (одинаковое содержимое под разными URL хранится один раз);
+- keys/<sha256 ключа>.json — ключ (URL, telegram:<file_id>) → хэш, размер и MIME.
+Запись атомарная (временный файл + os.replace), поэтому процессы prefork-воркера делят каталог
+без блокировок. Попадание обновляет mtime объекта; при превышении MEDIA_CACHE_MAX_BYTES удаляются
+самые старые объекты. Процесс не обходит каталог на каждой записи: общий размер известен после
+последнего обхода и увеличивается на записанные объекты. Полный обход с очисткой запускается, когда
+оценка превысила лимит или после _RESCAN_EVERY записей (учесть записи других процессов).
+MEDIA_CACHE_MAX_BYTES = 0 выключает кэш.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+Entry = Tuple[bytes, Optional[str]]
+
+# После очистки оставляем запас, чтобы не чистить на каждой записи
+_EVICT_TARGET_RATIO = 0.9
+# Записей между полными обходами, даже если оценка размера в пределах лимита
+_RESCAN_EVERY = 100
+
+# Каталог кэша → [оценка общего размера, записей после обхода]
+_usage: Dict[str, list] = {}
+_usage_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return int(settings.MEDIA_CACHE_MAX_BYTES) > 0
+
+
+def _root() -> str:
+    return str(settings.MEDIA_CACHE_DIR)
+
+
+def _key_path(key: str) -> str:
+    return os.path.join(_root(), "keys", hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+
+def _object_path(digest: str) -> str:
+    return os.path.join(_root(), "objects", digest[:2], digest)
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def get(key: str) -> Optional[Entry]:
+    """(данные, mime) из кэша или None."""
+    if not enabled():
+        return None
+    try:
+        with open(_key_path(key), "rb") as fh:
+            meta = json.load(fh)
+        path = _object_path(meta["sha256"])
+        with open(path, "rb") as fh:
+            content = fh.read()
+    except (OSError, ValueError, KeyError):
+        metrics.MEDIA_CACHE_REQUESTS.labels("miss").inc()
+        return None
+    if len(content) != meta.get("size"):
+        metrics.MEDIA_CACHE_REQUESTS.labels("miss").inc()
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    metrics.MEDIA_CACHE_REQUESTS.labels("hit").inc()
+    return content, meta.get("mime_type")
+
+
+def put(key: str, content: bytes, mime_type: Optional[str] = None) -> None:
+    """Сохраняет данные под ключом; ошибки диска только логируются."""
+    if not enabled() or not content or len(content) > int(settings.MEDIA_CACHE_MAX_ENTRY_BYTES):
+        return
+    digest = hashlib.sha256(content).hexdigest()
+    try:
+        path = _object_path(digest)
+        added = 0
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            _atomic_write(path, content)
+            added = len(content)
+        meta = {"sha256": digest, "size": len(content), "mime_type": mime_type}
+        _atomic_write(_key_path(key), json.dumps(meta).encode("utf-8"))
+        _account(added)
+    except OSError as exc:
+        logger.warning("[MEDIA_CACHE] Не удалось сохранить %s: %s", key, exc)
+
+
+def fetch(key: str, loader: Callable[[], Entry]) -> Entry:
+    """Возвращает (данные, mime) из кэша, иначе вызывает loader() и кэширует результат."""
+    cached = get(key)
+    if cached is not None:
+        return cached
+    content, mime_type = loader()
+    put(key, content, mime_type)
+    return content, mime_type
+
+
+def _account(added: int) -> None:
+    """Учитывает запись в оценке размера; обход каталога — только при превышении или раз в _RESCAN_EVERY."""
+    root = _root()
+    limit = int(settings.MEDIA_CACHE_MAX_BYTES)
+    with _usage_lock:
+        usage = _usage.get(root)
+        if usage is not None:
+            usage[0] += added
+            usage[1] += 1
+            if usage[0] <= limit and usage[1] < _RESCAN_EVERY:
+                return
+        total = _evict()
+        _usage[root] = [total, 0]
+
+
+def _evict() -> int:
+    """Обходит объекты, удаляет самые старые сверх лимита и возвращает оставшийся размер."""
+    limit = int(settings.MEDIA_CACHE_MAX_BYTES)
+    objects_dir = os.path.join(_root(), "objects")
+    entries = []
+    total = 0
+    for bucket in os.scandir(objects_dir):
+        if not bucket.is_dir():
+            continue
+        for entry in os.scandir(bucket.path):
+            if entry.name.startswith(".tmp-"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    if total <= limit:
+        return total
+    target = limit * _EVICT_TARGET_RATIO
+    removed = set()
+    for _, size, path in sorted(entries):
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        removed.add(os.path.basename(path))
+        total -= size
+        if total <= target:
+            break
+    _drop_keys(removed)
+    return total
+
+
+def _drop_keys(digests: set) -> None:
+    """Удаляет ключи, указывающие на вытесненные объекты (ключ, записанный заново, просто промахнётся)."""
+    if not digests:
+        return
+    for entry in os.scandir(os.path.join(_root(), "keys")):
+        try:
+            with open(entry.path, "rb") as fh:
+                digest = json.load(fh).get("sha256")
+            if digest in digests:
+                os.unlink(entry.path)
+        except (OSError, ValueError, AttributeError):
+            continue
@@ -0,0 +1,93 @@
+"""
+Пул процессов для CPU-ёмкой обработки медиа из async-хендлеров (base64, Pillow).
+
+Декодирование мегабайтного base64 и перекодирование в PNG прямо в корутине блокирует event loop
+webhook'а для всех чатов. Функции ниже выполняют эту работу в ProcessPoolExecutor из
+MEDIA_POOL_WORKERS процессов; данные меньше MEDIA_POOL_INLINE_BYTES обрабатываются на месте —
+передача в другой процесс обошлась бы дороже самой работы. Если процесс пула упал (например, OOM),
+пул пересоздаётся, а текущая операция выполняется в потоке.
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional, Sized
+
+from django.conf import settings
+
+from .media_utils import convert_to_png_bytes
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            # forkserver: дочерние процессы не наследуют потоки и соединения процесса uvicorn
+            _executor = ProcessPoolExecutor(
+                max_workers=int(settings.MEDIA_POOL_WORKERS),
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        return _executor
+
+
+def _reset_executor(broken: ProcessPoolExecutor) -> None:
+    global _executor
+    with _lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown() -> None:
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def run(func: Callable, *args: Any, size: Optional[int] = None) -> Any:
+    """Выполняет func(*args) вне event loop; size — объём входных данных в байтах."""
+    if size is not None and size < int(settings.MEDIA_POOL_INLINE_BYTES):
+        return func(*args)
+    executor = _get_executor()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    except BrokenProcessPool:
+        logger.warning("[MEDIA_POOL] Процесс пула завершился аварийно, пул будет пересоздан")
+        _reset_executor(executor)
+        return await asyncio.to_thread(func, *args)
+
+
+def _size(value: Sized) -> int:
+    return len(value) if value is not None else 0
+
+
+async def b64decode(data: str) -> bytes:
+    """base64.b64decode вне event loop (ошибки декодирования пробрасываются как есть)."""
+    return await run(base64.b64decode, data, size=_size(data))
+
+
+async def to_png(raw: bytes, mime: Optional[str]) -> bytes:
+    """Перекодирование в PNG (см. media_utils.convert_to_png_bytes) вне event loop."""
+    if (mime or "").lower() == "image/png":
+        return raw
+    return await run(convert_to_png_bytes, raw, mime, size=_size(raw))
+
+
+def _b64encode_ascii(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+async def b64encode(data: bytes) -> str:
+    return await run(_b64encode_ascii, data, size=_size(data))
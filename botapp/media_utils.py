@@ -135,3 +135,16 @@ def ensure_png_format(data: bytes, mime_type: Optional[str]) -> Tuple[bytes, str
             return buffer.getvalue(), "image/png"
     except (UnidentifiedImageError, OSError, ValueError):
         return data, mime_type or "application/octet-stream"
+
+
+def convert_to_png_bytes(raw: bytes, mime: Optional[str]) -> bytes:
+    """Перекодирует изображение в PNG; при ошибке возвращает исходные байты."""
+    if (mime or "").lower() == "image/png":
+        return raw
+    try:
+        with Image.open(BytesIO(raw)) as img:
+            buffer = BytesIO()
+            img.save(buffer, format="PNG")
+            return buffer.getvalue()
+    except Exception:
+        return raw
@@ -0,0 +1,211 @@
+"""
+Метрики Prometheus для пайплайна бота (webhook → Celery → провайдер → Telegram).
+
+prometheus_client — опциональная зависимость: без неё все метрики превращаются в no-op.
+Для gunicorn/Celery prefork задайте PROMETHEUS_MULTIPROC_DIR — тогда значения из всех процессов
+собираются через MultiProcessCollector (и в /api/metrics, и в экспортере воркера).
+"""
+from __future__ import annotations
+
+import inspect
+import logging
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Iterator, Tuple
+
+from . import tracing
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST,
+        REGISTRY,
+        CollectorRegistry,
+        Counter,
+        Histogram,
+        generate_latest,
+        multiprocess,
+        start_http_server,
+    )
+    from prometheus_client.core import GaugeMetricFamily
+    _prometheus_available = True
+except ImportError:  # pragma: no cover - prometheus_client опционален
+    _prometheus_available = False
+    CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _NoopMetric:
+    def labels(self, *args: Any, **kwargs: Any) -> "_NoopMetric":
+        return self
+
+    def observe(self, value: float) -> None:
+        pass
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+
+# Длинный хвост: генерация видео идёт минутами
+_STAGE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+
+if _prometheus_available:
+    WEBHOOK_SECONDS = Histogram(
+        "bot_webhook_seconds",
+        "Время обработки входящего webhook",
+        ["endpoint"],
+    )
+    TASK_SECONDS = Histogram(
+        "bot_celery_task_seconds",
+        "Длительность выполнения Celery-задач",
+        ["task", "state"],
+        buckets=_STAGE_BUCKETS,
+    )
+    PROVIDER_STAGE_SECONDS = Histogram(
+        "bot_provider_stage_seconds",
+        "Длительность этапов генерации (submit, poll, download, upload, deliver)",
+        ["provider", "stage"],
+        buckets=_STAGE_BUCKETS,
+    )
+    TASK_RETRIES = Counter(
+        "bot_generation_retries_total",
+        "Повторы задач генерации по классу ошибки",
+        ["task", "kind"],
+    )
+    PROVIDER_RATE_LIMITED = Counter(
+        "bot_provider_rate_limited_total",
+        "Ответы провайдеров 429 / превышение квоты",
+        ["provider"],
+    )
+    REFUNDS = Counter(
+        "bot_generation_refunds_total",
+        "Возвраты средств за неудачные генерации",
+        ["provider"],
+    )
+    TELEGRAM_SEND_ERRORS = Counter(
+        "bot_telegram_send_errors_total",
+        "Ошибки отправки в Telegram Bot API",
+        ["method", "status"],
+    )
+    MEDIA_CACHE_REQUESTS = Counter(
+        "bot_media_cache_requests_total",
+        "Обращения к локальному дисковому кэшу медиа (hit/miss)",
+        ["result"],
+    )
+else:  # pragma: no cover
+    WEBHOOK_SECONDS = TASK_SECONDS = PROVIDER_STAGE_SECONDS = _NoopMetric()
+    TASK_RETRIES = PROVIDER_RATE_LIMITED = REFUNDS = TELEGRAM_SEND_ERRORS = _NoopMetric()
+    MEDIA_CACHE_REQUESTS = _NoopMetric()
+
+
+@contextmanager
+def stage(provider: str, name: str) -> Iterator[None]:
+    """Замеряет этап пайплайна генерации (в том числе при исключении) и пишет его спан."""
+    started = time.perf_counter()
+    try:
+        with tracing.span(f"generation.{name}", provider=provider):
+            yield
+    finally:
+        PROVIDER_STAGE_SECONDS.labels(provider or "unknown", name).observe(time.perf_counter() - started)
+
+
+def timed_stage(name: str) -> Callable:
+    """Декоратор для методов видео-провайдеров: провайдер берётся из self.slug."""
+
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(self, *args: Any, **kwargs: Any) -> Any:
+            with stage(getattr(self, "slug", "unknown"), name):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def observe_webhook(endpoint: str) -> Callable:
+    """Декоратор view webhook'а (sync или async): гистограмма времени обработки."""
+
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    WEBHOOK_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                WEBHOOK_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def _multiprocess_enabled() -> bool:
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def _collection_registry():
+    if _multiprocess_enabled():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+class _GenRequestCollector:
+    """Gauge по числу GenRequest в очереди/обработке — считается в момент scrape."""
+
+    def collect(self):
+        from django.db.models import Count
+
+        from .models import GenRequest
+
+        gauge = GaugeMetricFamily("bot_genrequests", "GenRequest в статусах queued/processing", labels=["status"])
+        counts = dict.fromkeys(("queued", "processing"), 0)
+        rows = (
+            GenRequest.objects.filter(status__in=counts.keys())
+            .values_list("status")
+            .annotate(total=Count("id"))
+            .order_by()
+        )
+        counts.update(dict(rows))
+        for status, total in counts.items():
+            gauge.add_metric([status], total)
+        yield gauge
+
+
+def render_latest() -> Tuple[bytes, str]:
+    """Текст экспозиции для /metrics: метрики процессов + gauge из БД."""
+    if not _prometheus_available:
+        return b"# prometheus_client is not installed\n", CONTENT_TYPE_LATEST
+    db_registry = CollectorRegistry()
+    db_registry.register(_GenRequestCollector())
+    return generate_latest(_collection_registry()) + generate_latest(db_registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int) -> None:
+    """Удаляет файлы метрик завершившегося процесса (режим multiprocess)."""
+    if _prometheus_available and _multiprocess_enabled():
+        multiprocess.mark_process_dead(pid)
+
+
+def start_worker_exporter(port: int) -> None:
+    """HTTP-экспортер метрик Celery-воркера (вызывается один раз в главном процессе)."""
+    if not _prometheus_available:
+        logger.warning("[METRICS] prometheus_client не установлен, экспортер воркера не запущен")
+        return
+    start_http_server(port, registry=_collection_registry())
+    logger.info("[METRICS] Экспортер метрик воркера слушает порт %s", port)
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-19 06:11
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botapp', '0058_add_int200_promocode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenerationRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=8)),
+                ('bucket_start', models.DateTimeField()),
+                ('model_slug', models.CharField(blank=True, default='', max_length=100)),
+                ('provider', models.CharField(blank=True, default='', max_length=50)),
+                ('generation_type', models.CharField(blank=True, default='', max_length=20)),
+                ('cohort', models.CharField(blank=True, default='', max_length=7)),
+                ('requests', models.PositiveIntegerField(default=0)),
+                ('done', models.PositiveIntegerField(default=0)),
+                ('errors', models.PositiveIntegerField(default=0)),
+                ('unique_users', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('cost_usd', models.DecimalField(decimal_places=4, default=Decimal('0.0000'), max_digits=14)),
+                ('processing_seconds', models.FloatField(default=0)),
+                ('timed_requests', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Generation Rollup',
+                'verbose_name_plural': 'Generation Rollups',
+                'ordering': ['-bucket_start'],
+                'indexes': [models.Index(fields=['granularity', 'bucket_start'], name='botapp_gene_granula_8bbbe6_idx')],
+                'constraints': [models.UniqueConstraint(fields=('granularity', 'bucket_start', 'model_slug', 'provider', 'generation_type', 'cohort'), name='uniq_generation_rollup_bucket')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TransactionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=8)),
+                ('bucket_start', models.DateTimeField()),
+                ('type', models.CharField(max_length=20)),
+                ('payment_method', models.CharField(blank=True, default='', max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('unique_users', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Transaction Rollup',
+                'verbose_name_plural': 'Transaction Rollups',
+                'ordering': ['-bucket_start'],
+                'indexes': [models.Index(fields=['granularity', 'bucket_start'], name='botapp_tran_granula_446daf_idx')],
+                'constraints': [models.UniqueConstraint(fields=('granularity', 'bucket_start', 'type', 'payment_method'), name='uniq_transaction_rollup_bucket')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 06:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botapp', '0059_analytics_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('occurred_at', models.DateTimeField(db_index=True)),
+                ('event_type', models.CharField(max_length=64)),
+                ('chat_id', models.BigIntegerField(blank=True, null=True)),
+                ('username', models.CharField(blank=True, default='', max_length=255)),
+                ('metadata', models.JSONField(blank=True, default=dict)),
+                ('stream_id', models.CharField(max_length=32, unique=True)),
+            ],
+            options={
+                'verbose_name': 'Product Event',
+                'verbose_name_plural': 'Product Events',
+                'ordering': ['-occurred_at'],
+                'indexes': [models.Index(fields=['event_type', 'occurred_at'], name='botapp_prod_event_t_39aceb_idx'), models.Index(fields=['chat_id', 'occurred_at'], name='botapp_prod_chat_id_1efff5_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 06:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botapp', '0060_product_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileReport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target', models.CharField(db_index=True, max_length=255)),
+                ('chat_id', models.BigIntegerField(blank=True, null=True)),
+                ('task_id', models.CharField(blank=True, default='', max_length=255)),
+                ('duration', models.FloatField(default=0)),
+                ('samples', models.PositiveIntegerField(default=0)),
+                ('interval_ms', models.PositiveIntegerField(default=0)),
+                ('folded', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Profile Report',
+                'verbose_name_plural': 'Profile Reports',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-19 06:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botapp', '0061_profile_reports'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='boterrorevent',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='boterrorevent',
+            name='last_seen_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='boterrorevent',
+            name='occurrences',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AlterField(
+            model_name='boterrorevent',
+            name='severity',
+            field=models.CharField(choices=[('info', 'Info'), ('warning', 'Warning'), ('error', 'Error'), ('critical', 'Critical')], default='warning', max_length=16),
+        ),
+        migrations.AddIndex(
+            model_name='boterrorevent',
+            index=models.Index(fields=['fingerprint', 'occurred_at'], name='botapp_bote_fingerp_b54a1c_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 06:30
+
+from django.db import migrations, models
+
+
+def fill_normalized_code(apps, schema_editor):
+    Promocode = apps.get_model("botapp", "Promocode")
+    for promocode in Promocode.objects.only("id", "code").iterator():
+        Promocode.objects.filter(pk=promocode.pk).update(normalized_code=(promocode.code or "").strip().upper())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botapp', '0062_error_event_grouping'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='promocode',
+            name='normalized_code',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=50),
+        ),
+        migrations.RunPython(fill_normalized_code, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 06:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botapp', '0065_taskoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='genrequest',
+            name='result_derivatives',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
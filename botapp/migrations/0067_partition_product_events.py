@@ -0,0 +1,118 @@
+# Generated by Django 5.2.18 on 2026-10-19 07:05
+
+from django.db import migrations, models
+
+
+# Секции по месяцам (UTC): от месяца самого старого события до месяца через два от текущего.
+# Дальше секции создаёт maintain_product_event_partitions_task (botapp.events.ensure_partitions).
+PARTITION_SQL = """
+ALTER TABLE botapp_productevent RENAME TO botapp_productevent_plain;
+ALTER TABLE botapp_productevent_plain DROP CONSTRAINT botapp_productevent_stream_uniq;
+
+CREATE TABLE botapp_productevent (
+    id bigserial NOT NULL,
+    occurred_at timestamp with time zone NOT NULL,
+    event_type varchar(64) NOT NULL,
+    chat_id bigint NULL,
+    username varchar(255) NOT NULL,
+    metadata jsonb NOT NULL,
+    stream_id varchar(32) NOT NULL,
+    PRIMARY KEY (id, occurred_at),
+    CONSTRAINT botapp_productevent_stream_uniq UNIQUE (stream_id, occurred_at)
+) PARTITION BY RANGE (occurred_at);
+
+CREATE TABLE botapp_productevent_default PARTITION OF botapp_productevent DEFAULT;
+
+DO $$
+DECLARE
+    month_start timestamp;
+BEGIN
+    FOR month_start IN
+        SELECT generate_series(
+            date_trunc('month', COALESCE((SELECT MIN(occurred_at) FROM botapp_productevent_plain), now()) AT TIME ZONE 'UTC'),
+            date_trunc('month', now() AT TIME ZONE 'UTC') + interval '2 months',
+            interval '1 month'
+        )
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF botapp_productevent FOR VALUES FROM (%L) TO (%L)',
+            'botapp_productevent_p' || to_char(month_start, 'YYYY_MM'),
+            month_start AT TIME ZONE 'UTC',
+            (month_start + interval '1 month') AT TIME ZONE 'UTC'
+        );
+    END LOOP;
+END $$;
+
+INSERT INTO botapp_productevent (id, occurred_at, event_type, chat_id, username, metadata, stream_id)
+SELECT id, occurred_at, event_type, chat_id, username, metadata, stream_id FROM botapp_productevent_plain;
+
+SELECT setval(
+    pg_get_serial_sequence('botapp_productevent', 'id'),
+    COALESCE((SELECT MAX(id) FROM botapp_productevent), 0) + 1,
+    false
+);
+
+DROP TABLE botapp_productevent_plain;
+
+CREATE INDEX botapp_productevent_occurred_at_idx ON botapp_productevent (occurred_at);
+CREATE INDEX botapp_prod_event_t_39aceb_idx ON botapp_productevent (event_type, occurred_at);
+CREATE INDEX botapp_prod_chat_id_1efff5_idx ON botapp_productevent (chat_id, occurred_at);
+"""
+
+UNPARTITION_SQL = """
+CREATE TABLE botapp_productevent_plain (LIKE botapp_productevent INCLUDING DEFAULTS);
+DO $$
+BEGIN
+    EXECUTE format(
+        'ALTER SEQUENCE %s OWNED BY botapp_productevent_plain.id',
+        pg_get_serial_sequence('botapp_productevent', 'id')
+    );
+END $$;
+
+INSERT INTO botapp_productevent_plain SELECT * FROM botapp_productevent;
+
+DROP TABLE botapp_productevent CASCADE;
+ALTER TABLE botapp_productevent_plain RENAME TO botapp_productevent;
+
+ALTER TABLE botapp_productevent ADD PRIMARY KEY (id);
+ALTER TABLE botapp_productevent ADD CONSTRAINT botapp_productevent_stream_uniq UNIQUE (stream_id, occurred_at);
+CREATE INDEX botapp_productevent_occurred_at_idx ON botapp_productevent (occurred_at);
+CREATE INDEX botapp_prod_event_t_39aceb_idx ON botapp_productevent (event_type, occurred_at);
+CREATE INDEX botapp_prod_chat_id_1efff5_idx ON botapp_productevent (chat_id, occurred_at);
+"""
+
+
+def _run_script(schema_editor, sql):
+    for statement in schema_editor.connection.ops.prepare_sql_script(sql):
+        schema_editor.execute(statement, params=None)
+
+
+# Секционирование есть только в PostgreSQL; на других СУБД (SQLite в разработке) остаётся обычная таблица
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        _run_script(schema_editor, PARTITION_SQL)
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        _run_script(schema_editor, UNPARTITION_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('botapp', '0066_genrequest_result_derivatives'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productevent',
+            name='stream_id',
+            field=models.CharField(max_length=32),
+        ),
+        migrations.AddConstraint(
+            model_name='productevent',
+            constraint=models.UniqueConstraint(fields=('stream_id', 'occurred_at'), name='botapp_productevent_stream_uniq'),
+        ),
+        migrations.RunPython(partition, unpartition),
+    ]
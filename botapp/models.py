@@ -187,6 +187,8 @@ class GenRequest(models.Model):
     quantity = models.PositiveSmallIntegerField(default=1)
     status = models.CharField(max_length=16, choices=STATUS_CHOICES, default="queued", db_index=True)
     result_urls = models.JSONField(default=list)  # Публичные URL из Supabase Storage
+    # [{"original": url, "preview": url, "thumbnail": url}, ...] — см. botapp/derivatives.py
+    result_derivatives = models.JSONField(default=list, blank=True)
     error_message = models.TextField(blank=True)
 
     # Для видео
@@ -341,6 +343,8 @@ class UserSettings(models.Model):
 class Promocode(models.Model):
     """Промокоды для пополнения баланса"""
     code = models.CharField(max_length=50, unique=True, db_index=True)
+    # Код в верхнем регистре без пробелов по краям — для индексного поиска без iexact
+    normalized_code = models.CharField(max_length=50, blank=True, default="", db_index=True, editable=False)
     description = models.TextField()
 
     # Тип и значение
@@ -380,6 +384,17 @@ class Promocode(models.Model):
     def __str__(self):
         return f"Promo: {self.code} ({self.value})"
 
+    @staticmethod
+    def normalize(code: str) -> str:
+        return (code or "").strip().upper()
+
+    def save(self, *args, **kwargs):
+        self.normalized_code = self.normalize(self.code)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "code" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "normalized_code"}
+        super().save(*args, **kwargs)
+
 
 class PricingSettings(models.Model):
     """Глобальные настройки курсов и наценки для расчёта прайса."""
@@ -518,6 +533,7 @@ class BotErrorEvent(models.Model):
     class Severity(models.TextChoices):
         INFO = "info", "Info"
         WARNING = "warning", "Warning"
+        ERROR = "error", "Error"
         CRITICAL = "critical", "Critical"
 
     class Status(models.TextChoices):
@@ -543,6 +559,11 @@ class BotErrorEvent(models.Model):
         db_index=True,
     )
     occurred_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # Одинаковые ошибки (origin, handler, класс, нормализованное сообщение) в пределах окна
+    # ERROR_GROUP_WINDOW хранятся одной записью со счётчиком повторов
+    fingerprint = models.CharField(max_length=40, blank=True, default="")
+    occurrences = models.PositiveIntegerField(default=1)
+    last_seen_at = models.DateTimeField(null=True, blank=True)
     handler = models.CharField(max_length=255, blank=True, default="")
     error_class = models.CharField(max_length=255, blank=True, default="")
     message = models.TextField(blank=True, default="")
@@ -575,8 +596,192 @@ class BotErrorEvent(models.Model):
         indexes = [
             models.Index(fields=['origin', 'severity', 'occurred_at']),
             models.Index(fields=['status', 'occurred_at']),
+            models.Index(fields=['fingerprint', 'occurred_at']),
         ]
 
     def __str__(self):
         base = self.message or self.error_class or "Ошибка"
         return f"{self.get_origin_display()} · {base[:60]}"
+
+
+class RollupGranularity(models.TextChoices):
+    HOUR = "hour", "Hour"
+    DAY = "day", "Day"
+
+
+class GenerationRollup(models.Model):
+    """Агрегаты генераций по часам/суткам в разрезе модели, провайдера, типа и когорты пользователей."""
+
+    granularity = models.CharField(max_length=8, choices=RollupGranularity.choices)
+    bucket_start = models.DateTimeField()
+    model_slug = models.CharField(max_length=100, blank=True, default="")
+    provider = models.CharField(max_length=50, blank=True, default="")
+    generation_type = models.CharField(max_length=20, blank=True, default="")
+    cohort = models.CharField(max_length=7, blank=True, default="")  # Месяц регистрации пользователя, YYYY-MM
+
+    requests = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    errors = models.PositiveIntegerField(default=0)
+    unique_users = models.PositiveIntegerField(default=0)  # В пределах бакета, между бакетами не суммируется
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    cost_usd = models.DecimalField(max_digits=14, decimal_places=4, default=Decimal('0.0000'))
+    processing_seconds = models.FloatField(default=0)
+    timed_requests = models.PositiveIntegerField(default=0)  # Запросы с известным processing_time
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Generation Rollup"
+        verbose_name_plural = "Generation Rollups"
+        ordering = ['-bucket_start']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['granularity', 'bucket_start', 'model_slug', 'provider', 'generation_type', 'cohort'],
+                name='uniq_generation_rollup_bucket',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['granularity', 'bucket_start']),
+        ]
+
+    def __str__(self):
+        return f"{self.granularity} {self.bucket_start:%Y-%m-%d %H:%M} {self.model_slug or '-'}"
+
+
+class TransactionRollup(models.Model):
+    """Агрегаты транзакций по часам/суткам в разрезе типа и метода оплаты."""
+
+    granularity = models.CharField(max_length=8, choices=RollupGranularity.choices)
+    bucket_start = models.DateTimeField()
+    type = models.CharField(max_length=20)
+    payment_method = models.CharField(max_length=20, blank=True, default="")
+
+    count = models.PositiveIntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    unique_users = models.PositiveIntegerField(default=0)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Transaction Rollup"
+        verbose_name_plural = "Transaction Rollups"
+        ordering = ['-bucket_start']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['granularity', 'bucket_start', 'type', 'payment_method'],
+                name='uniq_transaction_rollup_bucket',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['granularity', 'bucket_start']),
+        ]
+
+    def __str__(self):
+        return f"{self.granularity} {self.bucket_start:%Y-%m-%d %H:%M} {self.type}"
+
+
+class ProductEvent(models.Model):
+    """
+    Продуктовые события (воронки). Только добавление; очистка — по occurred_at.
+
+    В PostgreSQL таблица секционирована по месяцам occurred_at (миграция 0067, секции заранее создаёт
+    events.ensure_partitions), поэтому ключ секционирования входит в первичный ключ и уникальность stream_id.
+    """
+
+    occurred_at = models.DateTimeField(db_index=True)
+    event_type = models.CharField(max_length=64)
+    chat_id = models.BigIntegerField(null=True, blank=True)
+    username = models.CharField(max_length=255, blank=True, default="")
+    metadata = models.JSONField(default=dict, blank=True)
+    stream_id = models.CharField(max_length=32)  # ID сообщения Redis stream — защита от дублей
+
+    class Meta:
+        verbose_name = "Product Event"
+        verbose_name_plural = "Product Events"
+        ordering = ['-occurred_at']
+        indexes = [
+            models.Index(fields=['event_type', 'occurred_at']),
+            models.Index(fields=['chat_id', 'occurred_at']),
+        ]
+        constraints = [
+            # occurred_at приходит из сообщения stream, поэтому повторная доставка попадает в тот же ключ
+            models.UniqueConstraint(fields=['stream_id', 'occurred_at'], name='botapp_productevent_stream_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} ({self.chat_id})"
+
+
+class ProfileReport(models.Model):
+    """Результат сэмплирующего профилирования задачи/хендлера (стеки в формате folded для flamegraph)."""
+
+    target = models.CharField(max_length=255, db_index=True)  # Имя Celery-задачи или хендлера
+    chat_id = models.BigIntegerField(null=True, blank=True)
+    task_id = models.CharField(max_length=255, blank=True, default="")
+    duration = models.FloatField(default=0)  # Секунды
+    samples = models.PositiveIntegerField(default=0)
+    interval_ms = models.PositiveIntegerField(default=0)
+    folded = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = "Profile Report"
+        verbose_name_plural = "Profile Reports"
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.target} · {self.duration:.2f}s"
+
+
+class WebhookEvent(models.Model):
+    """Журнал входящих webhook'ов провайдеров: сырое тело сохраняется до обработки в Celery."""
+
+    class Source(models.TextChoices):
+        LAVA = "lava", "Lava.top"
+        GEMINIGEN = "geminigen", "Geminigen"
+
+    class Status(models.TextChoices):
+        RECEIVED = "received", "Received"
+        PROCESSED = "processed", "Processed"
+        FAILED = "failed", "Failed"
+
+    source = models.CharField(max_length=32, choices=Source.choices)
+    event_id = models.CharField(max_length=255, blank=True, default="")  # Ключ идемпотентности провайдера
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.RECEIVED)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    received_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Webhook Event"
+        verbose_name_plural = "Webhook Events"
+        ordering = ['-received_at']
+        indexes = [
+            models.Index(fields=['source', 'event_id']),
+            models.Index(fields=['status', 'received_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.source} · {self.event_id or self.pk} · {self.status}"
+
+
+class TaskOutbox(models.Model):
+    """Celery-задачи, которые не удалось отправить в брокер; досылаются задачей drain_task_outbox_task."""
+
+    task_name = models.CharField(max_length=255)
+    task_id = models.CharField(max_length=64, blank=True, default="")
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = "Task Outbox"
+        verbose_name_plural = "Task Outbox"
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.task_name} ({self.task_id or self.pk})"
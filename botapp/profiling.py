@@ -0,0 +1,226 @@
+"""
+Профилирование по запросу: сэмплирующий профайлер для Celery-задач и webhook-хендлера.
+
+Профилирование включается флагом в Redis на имя задачи или chat_id (manage.py profiling ...),
+поэтому не требует передеплоя; процессы замечают флаг в течение PROFILING_FLAG_CACHE_SECONDS. Профайлер — фоновый поток, который раз в PROFILING_INTERVAL_MS
+снимает стек целевого потока через sys._current_frames(). Результат сохраняется в ProfileReport
+в формате folded stacks («a;b;c 42»), который открывают speedscope и flamegraph.pl.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+_MAX_DEPTH = 128
+_active: Dict[str, Tuple["SamplingProfiler", str, Optional[int]]] = {}
+
+
+# Все флаги лежат в одном hash: поле (profiling:task:<имя> / profiling:chat:<id>) → unix-время окончания.
+# Процесс перечитывает его не чаще раза в PROFILING_FLAG_CACHE_SECONDS, а не на каждый update/задачу.
+FLAGS_KEY = "profiling:flags"
+
+_flags: Dict[str, float] = {}
+_flags_loaded_at: Optional[float] = None
+_flags_lock = threading.Lock()
+
+
+def _task_key(target: str) -> str:
+    return f"profiling:task:{target}"
+
+
+def _chat_key(chat_id: int) -> str:
+    return f"profiling:chat:{chat_id}"
+
+
+def _flag_keys(target: Optional[str], chat_id: Optional[int]) -> List[str]:
+    keys = []
+    if target:
+        keys.append(_task_key(target))
+    if chat_id is not None:
+        keys.append(_chat_key(chat_id))
+    return keys
+
+
+def enable(target: Optional[str] = None, chat_id: Optional[int] = None, ttl: Optional[int] = None) -> None:
+    """Включает профилирование задачи/хендлера или всех запросов чата на ttl секунд."""
+    ttl = int(ttl or settings.PROFILING_FLAG_TTL)
+    keys = _flag_keys(target, chat_id)
+    if not keys:
+        return
+    client = get_redis()
+    now = time.time()
+    expired = [key for key, until in _parse_flags(client.hgetall(FLAGS_KEY)).items() if until <= now]
+    if expired:
+        client.hdel(FLAGS_KEY, *expired)
+    client.hset(FLAGS_KEY, mapping={key: now + ttl for key in keys})
+    _invalidate()
+
+
+def disable(target: Optional[str] = None, chat_id: Optional[int] = None) -> None:
+    keys = _flag_keys(target, chat_id)
+    if keys:
+        get_redis().hdel(FLAGS_KEY, *keys)
+        _invalidate()
+
+
+def _invalidate() -> None:
+    global _flags_loaded_at
+    _flags_loaded_at = None
+
+
+def _parse_flags(raw: Dict) -> Dict[str, float]:
+    return {key.decode() if isinstance(key, bytes) else key: float(until) for key, until in raw.items()}
+
+
+def _cached_flags() -> Optional[Dict[str, float]]:
+    """Флаги из памяти процесса или None, если пора перечитать Redis."""
+    loaded_at = _flags_loaded_at
+    if loaded_at is None or time.monotonic() - loaded_at >= float(settings.PROFILING_FLAG_CACHE_SECONDS):
+        return None
+    return _flags
+
+
+def _load_flags() -> Dict[str, float]:
+    global _flags, _flags_loaded_at
+    with _flags_lock:
+        flags = _cached_flags()
+        if flags is not None:
+            return flags
+        try:
+            raw = get_redis().hgetall(FLAGS_KEY)
+        except RedisError:
+            raw = {}
+        _flags = _parse_flags(raw)
+        _flags_loaded_at = time.monotonic()
+        return _flags
+
+
+def _enabled_in(flags: Dict[str, float], target: Optional[str], chat_id: Optional[int]) -> bool:
+    now = time.time()
+    return any(flags.get(key, 0) > now for key in _flag_keys(target, chat_id))
+
+
+def is_enabled(target: Optional[str] = None, chat_id: Optional[int] = None) -> bool:
+    if not _flag_keys(target, chat_id):
+        return False
+    flags = _cached_flags()
+    if flags is None:
+        flags = _load_flags()
+    return _enabled_in(flags, target, chat_id)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Снимает стек заданного потока с фиксированным интервалом и агрегирует одинаковые стеки."""
+
+    def __init__(self, thread_id: Optional[int] = None, interval_ms: Optional[int] = None):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval_ms = int(interval_ms or settings.PROFILING_INTERVAL_MS)
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started_at = 0.0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "SamplingProfiler":
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> "SamplingProfiler":
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+        self.duration = time.perf_counter() - self.started_at
+        return self
+
+    def _run(self) -> None:
+        interval = self.interval_ms / 1000.0
+        while not self._stop.wait(interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < _MAX_DEPTH:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+def _save_report(profiler: SamplingProfiler, target: str, chat_id: Optional[int], task_id: str) -> None:
+    from .models import ProfileReport
+
+    try:
+        ProfileReport.objects.create(
+            target=target,
+            chat_id=chat_id,
+            task_id=task_id or "",
+            duration=profiler.duration,
+            samples=profiler.samples,
+            interval_ms=profiler.interval_ms,
+            folded=profiler.folded(),
+        )
+    except Exception as exc:  # pragma: no cover - профилирование не должно ломать задачу
+        logger.warning("[PROFILING] Не удалось сохранить профиль %s: %s", target, exc)
+
+
+def maybe_start(key: str, target: str, chat_id: Optional[int] = None) -> bool:
+    """Запускает профайлер текущего потока, если он включён для задачи или чата."""
+    if key in _active or not is_enabled(target, chat_id):
+        return False
+    _active[key] = (SamplingProfiler().start(), target, chat_id)
+    logger.info("[PROFILING] Профилирование %s (chat_id=%s) запущено", target, chat_id)
+    return True
+
+
+def finish(key: str) -> None:
+    entry = _active.pop(key, None)
+    if entry is None:
+        return
+    profiler, target, chat_id = entry
+    profiler.stop()
+    _save_report(profiler, target, chat_id, key)
+
+
+@asynccontextmanager
+async def aprofile(target: str, chat_id: Optional[int] = None):
+    """Профилирует блок async-хендлера, если включено (сэмплируется поток event loop)."""
+    flags = _cached_flags()
+    if flags is not None:
+        enabled = _enabled_in(flags, target, chat_id)
+    else:
+        # Redis читается раз в PROFILING_FLAG_CACHE_SECONDS — и только вне event loop
+        enabled = await sync_to_async(is_enabled, thread_sensitive=False)(target, chat_id)
+    if not enabled:
+        yield
+        return
+    profiler = SamplingProfiler().start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        await sync_to_async(_save_report)(profiler, target, chat_id, "")
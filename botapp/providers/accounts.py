@@ -0,0 +1,214 @@
+"""
+Пулы аккаунтов провайдеров (useapi, KIE, Gemini) с балансировкой по загрузке.
+
+Аккаунты задаются JSON-списком в настройках (USEAPI_ACCOUNTS, USEAPI_KLING_ACCOUNTS, KIE_ACCOUNTS,
+GEMINI_API_KEYS). Если пул не задан, используется единственный аккаунт из старых настроек
+(USEAPI_API_KEY, MIDJOURNEY_KIE_API_KEY, GEMINI_API_KEY и т.д.) с именем "default".
+
+Выбранный аккаунт сохраняется в GenRequest.provider_metadata["account"], чтобы повторы, опрос
+и скачивание результата шли через тот же ключ.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import random
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import httpx
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from botapp.errors import ProviderAccountError
+from botapp.redis_client import get_redis
+
+from .limits import DEFAULT_ACCOUNT, get_active_slots, get_concurrency_limit
+
+logger = logging.getLogger(__name__)
+
+# Провайдер AIModel → пул аккаунтов
+_POOL_BY_PROVIDER = {
+    "useapi": "useapi",
+    "kling": "kling",
+    "midjourney": "midjourney",
+    "gemini": "gemini",
+    "gemini_vertex": "gemini",
+}
+
+# Пул → (настройка со списком аккаунтов, ключ, email, пароль, max_jobs) для аккаунта по умолчанию
+_POOL_SETTINGS = {
+    "useapi": ("USEAPI_ACCOUNTS", "USEAPI_API_KEY", "USEAPI_ACCOUNT_EMAIL", "USEAPI_ACCOUNT_PASSWORD", "USEAPI_MAX_JOBS"),
+    "kling": (
+        "USEAPI_KLING_ACCOUNTS",
+        "USEAPI_API_KEY",
+        "USEAPI_KLING_ACCOUNT_EMAIL",
+        "USEAPI_KLING_ACCOUNT_PASSWORD",
+        "USEAPI_KLING_MAX_JOBS",
+    ),
+    "midjourney": ("KIE_ACCOUNTS", "MIDJOURNEY_KIE_API_KEY", None, None, None),
+    "gemini": ("GEMINI_API_KEYS", "GEMINI_API_KEY", None, None, None),
+}
+
+# HTTP-статусы, после которых аккаунт временно выводится из ротации
+_UNHEALTHY_STATUSES = {401, 402, 403, 429}
+
+
+@dataclass(frozen=True)
+class ProviderAccount:
+    """Учётные данные одного аккаунта провайдера."""
+
+    pool: str
+    name: str
+    api_key: str
+    email: Optional[str] = None
+    password: Optional[str] = None
+    max_jobs: Optional[int] = None
+
+    def to_metadata(self) -> Dict[str, str]:
+        return {"pool": self.pool, "name": self.name}
+
+
+def pool_for_provider(provider: Optional[str]) -> Optional[str]:
+    return _POOL_BY_PROVIDER.get(provider or "")
+
+
+def _parse_pool(pool: str, raw: Any) -> List[ProviderAccount]:
+    if not raw:
+        return []
+    if isinstance(raw, str):
+        raw = raw.strip()
+        try:
+            entries = json.loads(raw)
+        except ValueError:
+            # Допускаем простой список ключей через запятую
+            entries = [key.strip() for key in raw.split(",") if key.strip()]
+    else:
+        entries = raw
+
+    accounts: List[ProviderAccount] = []
+    for idx, entry in enumerate(entries or [], start=1):
+        if isinstance(entry, str):
+            entry = {"api_key": entry}
+        if not isinstance(entry, dict) or not entry.get("api_key"):
+            logger.warning("[PROVIDER_ACCOUNTS] Пропущен некорректный аккаунт #%s в пуле %s", idx, pool)
+            continue
+        max_jobs = entry.get("max_jobs")
+        accounts.append(
+            ProviderAccount(
+                pool=pool,
+                name=str(entry.get("name") or f"{pool}-{idx}"),
+                api_key=str(entry["api_key"]),
+                email=entry.get("email"),
+                password=entry.get("password"),
+                max_jobs=int(max_jobs) if max_jobs else None,
+            )
+        )
+    return accounts
+
+
+def get_account_pool(pool: str) -> List[ProviderAccount]:
+    """Список аккаунтов пула (из JSON-настройки или из одиночных legacy-настроек)."""
+    config = _POOL_SETTINGS.get(pool)
+    if not config:
+        return []
+    pool_setting, key_setting, email_setting, password_setting, jobs_setting = config
+    accounts = _parse_pool(pool, getattr(settings, pool_setting, None))
+    if accounts:
+        return accounts
+
+    api_key = getattr(settings, key_setting, None)
+    if not api_key:
+        return []
+    max_jobs = getattr(settings, jobs_setting, None) if jobs_setting else None
+    return [
+        ProviderAccount(
+            pool=pool,
+            name=DEFAULT_ACCOUNT,
+            api_key=api_key,
+            email=getattr(settings, email_setting, None) if email_setting else None,
+            password=getattr(settings, password_setting, None) if password_setting else None,
+            max_jobs=int(max_jobs) if max_jobs else None,
+        )
+    ]
+
+
+def _health_key(pool: str, name: str) -> str:
+    return f"provider-accounts:unhealthy:{pool}:{name}"
+
+
+def _unhealthy_names(pool: str, accounts: List[ProviderAccount]) -> set:
+    try:
+        flags = get_redis().mget([_health_key(pool, account.name) for account in accounts])
+    except RedisError as exc:
+        logger.warning("[PROVIDER_ACCOUNTS] Не удалось прочитать состояние аккаунтов %s: %s", pool, exc)
+        return set()
+    return {account.name for account, flag in zip(accounts, flags) if flag}
+
+
+def mark_account_unhealthy(account: ProviderAccount, reason: str, cooldown: Optional[int] = None) -> None:
+    """Временно исключает аккаунт из выбора (например, после 401/429)."""
+    cooldown = int(cooldown or settings.PROVIDER_ACCOUNT_COOLDOWN)
+    logger.warning(
+        "[PROVIDER_ACCOUNTS] Аккаунт %s/%s выведен из ротации на %sс: %s",
+        account.pool,
+        account.name,
+        cooldown,
+        reason,
+    )
+    try:
+        get_redis().set(_health_key(account.pool, account.name), reason[:200], ex=cooldown)
+    except RedisError as exc:
+        logger.warning("[PROVIDER_ACCOUNTS] Не удалось сохранить состояние аккаунта: %s", exc)
+
+
+def report_account_error(account: Optional[ProviderAccount], exc: BaseException) -> None:
+    """Помечает аккаунт нездоровым, если ошибка провайдера указывает на ключ или квоту."""
+    if account is None:
+        return
+    current: Optional[BaseException] = exc
+    while current is not None:
+        if isinstance(current, ProviderAccountError):
+            mark_account_unhealthy(account, str(current) or type(current).__name__)
+            return
+        if isinstance(current, httpx.HTTPStatusError) and current.response is not None:
+            if current.response.status_code in _UNHEALTHY_STATUSES:
+                mark_account_unhealthy(account, f"HTTP {current.response.status_code}")
+            return
+        current = current.__cause__ or current.__context__
+
+
+def select_account(pool: str) -> Optional[ProviderAccount]:
+    """
+    Выбирает наименее загруженный здоровый аккаунт пула.
+
+    Загрузка — доля занятых слотов от лимита аккаунта; при равенстве выбор случайный,
+    чтобы RPM-лимитированные пулы (Gemini) распределялись равномерно.
+    """
+    accounts = get_account_pool(pool)
+    if len(accounts) <= 1:
+        return accounts[0] if accounts else None
+
+    unhealthy = _unhealthy_names(pool, accounts)
+    candidates = [account for account in accounts if account.name not in unhealthy] or accounts
+
+    def _load(account: ProviderAccount) -> float:
+        capacity = account.max_jobs or get_concurrency_limit(pool) or 1
+        return get_active_slots(pool, account.name) / capacity
+
+    loads = {account.name: _load(account) for account in candidates}
+    best = min(loads.values())
+    return random.choice([account for account in candidates if loads[account.name] == best])
+
+
+def resolve_account(pool: Optional[str], metadata: Optional[Dict[str, Any]] = None) -> Optional[ProviderAccount]:
+    """Аккаунт, закреплённый за запросом, либо новый выбор по загрузке."""
+    if not pool:
+        return None
+    pinned = (metadata or {}).get("account") if isinstance(metadata, dict) else None
+    if isinstance(pinned, dict) and pinned.get("pool") == pool:
+        for account in get_account_pool(pool):
+            if account.name == pinned.get("name"):
+                return account
+        logger.warning("[PROVIDER_ACCOUNTS] Аккаунт %s/%s больше не настроен, выбираем другой", pool, pinned.get("name"))
+    return select_account(pool)
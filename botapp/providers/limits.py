@@ -0,0 +1,204 @@
+"""
+Распределённые лимиты провайдеров: семафоры параллельных задач и token bucket по RPM.
+
+Состояние хранится в Redis, поэтому лимиты общие для всех Celery-воркеров.
+Ключи строятся по паре (провайдер, аккаунт), чтобы лимит соответствовал квоте конкретного аккаунта.
+"""
+from __future__ import annotations
+
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from botapp.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ACCOUNT = "default"
+
+# KEYS[1] — zset слотов; ARGV: now, limit, expires_at, token, key_ttl
+_SEMAPHORE_ACQUIRE = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    return 1
+end
+return 0
+"""
+
+# KEYS[1] — hash ведра; ARGV: rate (токенов/сек), capacity, now
+_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class ProviderSlotUnavailable(Exception):
+    """Свободного слота у провайдера нет — задачу нужно перепланировать."""
+
+    def __init__(self, provider: str, account: str, retry_after: float):
+        self.provider = provider
+        self.account = account
+        self.retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(
+            f"Провайдер {provider} (аккаунт {account}) занят, повтор через {self.retry_after} с."
+        )
+
+
+def get_concurrency_limit(provider: str) -> int:
+    return int((getattr(settings, "PROVIDER_CONCURRENCY_LIMITS", {}) or {}).get(provider) or 0)
+
+
+def get_rate_limit(provider: str) -> int:
+    return int((getattr(settings, "PROVIDER_RATE_LIMITS_RPM", {}) or {}).get(provider) or 0)
+
+
+def _key(kind: str, provider: str, account: str) -> str:
+    return f"provider-limits:{kind}:{provider}:{account}"
+
+
+def _take_rate_token(provider: str, account: str, rpm: int) -> float:
+    """Берёт токен из ведра; возвращает 0 при успехе или время ожидания в секундах."""
+    rate = rpm / 60.0
+    wait = get_redis().eval(_TOKEN_BUCKET, 1, _key("rate", provider, account), rate, rpm, time.time())
+    return float(wait)
+
+
+def _try_acquire_slot(provider: str, account: str, limit: int, token: str, ttl: int) -> bool:
+    now = time.time()
+    acquired = get_redis().eval(
+        _SEMAPHORE_ACQUIRE,
+        1,
+        _key("slots", provider, account),
+        now,
+        limit,
+        now + ttl,
+        token,
+        ttl,
+    )
+    return bool(acquired)
+
+
+def _release_slot(provider: str, account: str, token: str) -> None:
+    try:
+        get_redis().zrem(_key("slots", provider, account), token)
+    except RedisError as exc:
+        logger.warning("[PROVIDER_LIMITS] Не удалось освободить слот %s/%s: %s", provider, account, exc)
+
+
+class SlotLease:
+    """Занятый слот; hold() оставляет его занятым после выхода из provider_slot."""
+
+    def __init__(self, provider: str, account: str):
+        self.provider = provider
+        self.account = account
+        self.token: Optional[str] = None
+        self.held = False
+
+    def hold(self, ttl: int) -> Optional[Dict[str, Any]]:
+        """
+        Продлевает слот на ttl секунд и не освобождает его при выходе: задача у провайдера продолжается
+        после ответа API (Geminigen), слот освобождает release_held_slot() при её завершении.
+        Возвращает описание слота для provider_metadata или None, если слот не занимался.
+        """
+        if self.token is None:
+            return None
+        try:
+            get_redis().zadd(_key("slots", self.provider, self.account), {self.token: time.time() + ttl}, xx=True)
+        except RedisError as exc:
+            logger.warning("[PROVIDER_LIMITS] Не удалось продлить слот %s/%s: %s", self.provider, self.account, exc)
+        self.held = True
+        return {"provider": self.provider, "account": self.account, "token": self.token}
+
+
+def release_held_slot(slot: Optional[Dict[str, Any]]) -> None:
+    """Освобождает слот, сохранённый через SlotLease.hold(); повторный вызов безопасен."""
+    if slot and slot.get("token"):
+        _release_slot(slot["provider"], slot.get("account") or DEFAULT_ACCOUNT, slot["token"])
+
+
+def get_active_slots(provider: str, account: str = DEFAULT_ACCOUNT) -> int:
+    """Количество занятых (не просроченных) слотов провайдера."""
+    try:
+        return int(get_redis().zcount(_key("slots", provider, account), time.time(), "+inf"))
+    except RedisError:
+        return 0
+
+
+@contextmanager
+def provider_slot(
+    provider: str,
+    account: str = DEFAULT_ACCOUNT,
+    *,
+    wait: Optional[float] = None,
+    ttl: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> Iterator[SlotLease]:
+    """
+    Занимает слот провайдера на время вызова API.
+
+    Сначала соблюдается RPM (PROVIDER_RATE_LIMITS_RPM), затем лимит параллельных задач
+    (PROVIDER_CONCURRENCY_LIMITS). Если слот не освободился за `wait` секунд — ProviderSlotUnavailable.
+    `limit` переопределяет лимит провайдера (например, max_jobs конкретного аккаунта из пула).
+    Слот живёт не дольше `ttl`, поэтому упавший воркер не блокирует аккаунт навсегда.
+    При недоступности Redis лимиты не применяются (fail-open).
+    """
+    lease = SlotLease(provider, account)
+    limit = limit or get_concurrency_limit(provider)
+    rpm = get_rate_limit(provider)
+    if not limit and not rpm:
+        yield lease
+        return
+
+    wait = float(settings.PROVIDER_SLOT_WAIT_SECONDS if wait is None else wait)
+    ttl = int(ttl or settings.PROVIDER_SLOT_TTL)
+    poll_interval = float(settings.PROVIDER_SLOT_POLL_INTERVAL)
+    deadline = time.monotonic() + wait
+    token = uuid.uuid4().hex
+    acquired = False
+
+    try:
+        if rpm:
+            while True:
+                delay = _take_rate_token(provider, account, rpm)
+                if delay <= 0:
+                    break
+                if time.monotonic() + delay > deadline:
+                    raise ProviderSlotUnavailable(provider, account, delay)
+                time.sleep(delay)
+
+        if limit:
+            while not _try_acquire_slot(provider, account, limit, token, ttl):
+                if time.monotonic() + poll_interval > deadline:
+                    raise ProviderSlotUnavailable(provider, account, settings.PROVIDER_SLOT_RETRY_DELAY)
+                time.sleep(poll_interval)
+            acquired = True
+            lease.token = token
+    except RedisError as exc:
+        logger.warning("[PROVIDER_LIMITS] Redis недоступен, лимиты %s не применяются: %s", provider, exc)
+
+    try:
+        yield lease
+    finally:
+        if acquired and not lease.held:
+            _release_slot(provider, account, token)
@@ -1,10 +1,13 @@
 """
 Video generation provider registry and utilities.
 """
-from typing import Dict, Type
+from typing import TYPE_CHECKING, Dict, Optional, Type
 
 from .base import BaseVideoProvider, VideoGenerationError, VideoGenerationResult
 
+if TYPE_CHECKING:  # pragma: no cover
+    from ..accounts import ProviderAccount
+
 _VIDEO_PROVIDERS: Dict[str, Type[BaseVideoProvider]] = {}
 
 
@@ -13,12 +16,12 @@ def register_video_provider(slug: str, provider_cls: Type[BaseVideoProvider]) ->
     _VIDEO_PROVIDERS[slug] = provider_cls
 
 
-def get_video_provider(slug: str) -> BaseVideoProvider:
-    """Instantiate provider by slug."""
+def get_video_provider(slug: str, account: Optional["ProviderAccount"] = None) -> BaseVideoProvider:
+    """Instantiate provider by slug (optionally bound to a pooled account)."""
     provider_cls = _VIDEO_PROVIDERS.get(slug)
     if not provider_cls:
         raise VideoGenerationError(f"Video provider '{slug}' не настроен.")
-    return provider_cls()
+    return provider_cls(account=account)
 
 
 __all__ = [
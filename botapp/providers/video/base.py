@@ -2,7 +2,10 @@ from __future__ import annotations
 
 import abc
 from dataclasses import dataclass, field
-from typing import Any, Dict, Optional
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+if TYPE_CHECKING:  # pragma: no cover
+    from ..accounts import ProviderAccount
 
 
 class VideoGenerationError(Exception):
@@ -27,7 +30,9 @@ class BaseVideoProvider(abc.ABC):
 
     slug: str = "base"
 
-    def __init__(self) -> None:
+    def __init__(self, account: Optional["ProviderAccount"] = None) -> None:
+        # Аккаунт из пула (см. providers.accounts); None — ключи из настроек
+        self._account = account
         self._validate_settings()
 
     @abc.abstractmethod
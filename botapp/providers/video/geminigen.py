@@ -3,11 +3,14 @@ from __future__ import annotations
 import json
 import logging
 import time
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import httpx
 from django.conf import settings
 
+from botapp import media_cache
+from botapp.metrics import timed_stage
+
 from . import register_video_provider
 from .base import BaseVideoProvider, VideoGenerationError, VideoGenerationResult
 
@@ -32,6 +35,10 @@ class GeminigenVeoProvider(BaseVideoProvider):
     }
 
     _ENDPOINT = "/uapi/v1/video-gen/veo"
+    _STATUS_ENDPOINT = "/uapi/v1/history/{uuid}"
+
+    _COMPLETED_STATUSES = {"2", "completed", "success"}
+    _FAILED_STATUSES = {"3", "failed", "error"}
 
     def _validate_settings(self) -> None:
         self._api_key: Optional[str] = getattr(settings, "GEMINIGEN_API_KEY", None)
@@ -98,14 +105,71 @@ class GeminigenVeoProvider(BaseVideoProvider):
                 return data.get(key)
         return None
 
+    def fetch_job_statuses(self, job_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Запрашивает статусы пачки задач через одно HTTP-соединение.
+
+        Возвращает словарь uuid → {"status": completed|failed|processing, "media_url", "thumbnail_url",
+        "error_message", "response"}. Задачи, статус которых получить не удалось, в результат не попадают.
+        """
+        endpoint = getattr(settings, "GEMINIGEN_STATUS_ENDPOINT", None) or self._STATUS_ENDPOINT
+        statuses: Dict[str, Dict[str, Any]] = {}
+        with httpx.Client(timeout=self._timeout) as client:
+            for job_id in job_ids:
+                url = f"{self._base_url}{endpoint.format(uuid=job_id)}"
+                try:
+                    response = client.get(url, headers=self._build_headers(), follow_redirects=True)
+                    response.raise_for_status()
+                    payload = response.json()
+                except (httpx.HTTPError, ValueError) as exc:
+                    logger.warning("[GEMINIGEN] Не удалось получить статус задачи %s: %s", job_id, exc)
+                    continue
+                if not isinstance(payload, dict):
+                    continue
+                statuses[str(job_id)] = self._normalize_job_status(payload)
+        return statuses
+
+    @classmethod
+    def _normalize_job_status(cls, payload: Dict[str, Any]) -> Dict[str, Any]:
+        raw_status = cls._extract_field(payload, "status", "status_code", "statusCode")
+        media_url = cls._extract_field(payload, "media_url", "mediaUrl", "video_url", "videoUrl")
+        if not media_url:
+            videos = cls._extract_field(payload, "generated_video", "generatedVideo")
+            if isinstance(videos, list):
+                for item in videos:
+                    if isinstance(item, dict) and (item.get("video_url") or item.get("media_url")):
+                        media_url = item.get("video_url") or item.get("media_url")
+                        break
+
+        normalized = str(raw_status).lower() if raw_status is not None else ""
+        if normalized in cls._FAILED_STATUSES:
+            status = "failed"
+        elif normalized in cls._COMPLETED_STATUSES and media_url:
+            status = "completed"
+        else:
+            status = "processing"
+
+        return {
+            "status": status,
+            "media_url": media_url,
+            "thumbnail_url": cls._extract_field(payload, "thumbnail_url", "thumbnailUrl"),
+            "error_message": cls._extract_field(payload, "error_message", "errorMessage"),
+            "response": payload,
+        }
+
+    @timed_stage("download")
     def _download_media(self, url: str) -> Tuple[bytes, str]:
         """Скачивает видео по media_url, возвращает байты и MIME."""
-        timeout = httpx.Timeout(300.0, connect=10.0)
-        with httpx.Client(timeout=timeout) as client:
-            resp = client.get(url, follow_redirects=True)
-            resp.raise_for_status()
-            mime_type = resp.headers.get("content-type", "video/mp4")
-            return resp.content, mime_type.split(";")[0].strip()
+        def _load() -> Tuple[bytes, str]:
+            timeout = httpx.Timeout(300.0, connect=10.0)
+            with httpx.Client(timeout=timeout) as client:
+                resp = client.get(url, follow_redirects=True)
+                resp.raise_for_status()
+                mime_type = resp.headers.get("content-type", "video/mp4")
+                return resp.content, mime_type.split(";")[0].strip()
+
+        content, mime_type = media_cache.fetch(url, _load)
+        return content, mime_type or "video/mp4"
 
     def generate(
         self,
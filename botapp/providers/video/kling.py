@@ -8,6 +8,9 @@ from typing import Any, Dict, Iterable, Optional, Tuple
 import httpx
 from django.conf import settings
 
+from botapp import image_optimizer, media_cache
+from botapp.metrics import timed_stage
+
 from . import register_video_provider
 from .base import BaseVideoProvider, VideoGenerationError, VideoGenerationResult
 
@@ -31,7 +34,12 @@ class KlingVideoProvider(BaseVideoProvider):
     _FAIL_STATUSES = {"FAILED", "ERROR", "CANCELLED", "CANCELED", "REJECTED", "53", "54", "58", "6", "7", "9", "50"}
 
     def _validate_settings(self) -> None:
-        self._api_key: Optional[str] = getattr(settings, "USEAPI_API_KEY", None) or getattr(settings, "KLING_API_KEY", None)
+        account = self._account
+        self._api_key: Optional[str] = (
+            account.api_key
+            if account
+            else getattr(settings, "USEAPI_API_KEY", None) or getattr(settings, "KLING_API_KEY", None)
+        )
         if not self._api_key:
             raise VideoGenerationError("USEAPI_API_KEY не задан — Kling недоступен.")
 
@@ -53,15 +61,20 @@ class KlingVideoProvider(BaseVideoProvider):
         )
 
         max_jobs_raw = (
-            getattr(settings, "USEAPI_KLING_MAX_JOBS", None)
+            (account and account.max_jobs)
+            or getattr(settings, "USEAPI_KLING_MAX_JOBS", None)
             or getattr(settings, "USEAPI_MAX_JOBS", None)
         )
         self._max_jobs: Optional[int] = (
             self._sanitize_max_jobs(max_jobs_raw) if max_jobs_raw is not None else None
         )
 
-        self._account_email: Optional[str] = getattr(settings, "USEAPI_KLING_ACCOUNT_EMAIL", None)
-        self._account_password: Optional[str] = getattr(settings, "USEAPI_KLING_ACCOUNT_PASSWORD", None)
+        if account:
+            self._account_email: Optional[str] = account.email
+            self._account_password: Optional[str] = account.password
+        else:
+            self._account_email = getattr(settings, "USEAPI_KLING_ACCOUNT_EMAIL", None)
+            self._account_password = getattr(settings, "USEAPI_KLING_ACCOUNT_PASSWORD", None)
         self._account_ready: bool = False
 
     def generate(
@@ -509,6 +522,7 @@ class KlingVideoProvider(BaseVideoProvider):
             self._request("POST", "/v1/kling/accounts", json_payload=payload)
             self._account_ready = True
 
+    @timed_stage("poll")
     def _poll_task(self, task_id: str) -> Dict[str, Any]:
         deadline = time.time() + self._poll_timeout
         last_payload: Dict[str, Any] = {}
@@ -841,25 +855,33 @@ class KlingVideoProvider(BaseVideoProvider):
             file_name="tail_image.png",
         )
 
+    @timed_stage("download")
     def _download_file(self, url: str) -> Tuple[bytes, Optional[str]]:
-        try:
-            with httpx.Client(timeout=self._request_timeout, follow_redirects=True) as client:
-                response = client.get(url)
-                response.raise_for_status()
-        except httpx.HTTPError as exc:  # type: ignore[attr-defined]
-            raise VideoGenerationError(f"Не удалось скачать видео Kling: {exc}") from exc
+        def _load() -> Tuple[bytes, Optional[str]]:
+            try:
+                with httpx.Client(timeout=self._request_timeout, follow_redirects=True) as client:
+                    response = client.get(url)
+                    response.raise_for_status()
+            except httpx.HTTPError as exc:  # type: ignore[attr-defined]
+                raise VideoGenerationError(f"Не удалось скачать видео Kling: {exc}") from exc
+            return response.content, None
+
         # Kling всегда возвращает mp4, но CDN может отдавать неправильный Content-Type
         # Принудительно используем video/mp4 для корректного сохранения
-        return response.content, "video/mp4"
+        return media_cache.fetch(url, _load)[0], "video/mp4"
 
+    @timed_stage("download")
     def _download_raw(self, url: str) -> Tuple[bytes, Optional[str]]:
-        try:
-            with httpx.Client(timeout=self._request_timeout, follow_redirects=True) as client:
-                response = client.get(url)
-                response.raise_for_status()
-        except httpx.HTTPError as exc:  # type: ignore[attr-defined]
-            raise VideoGenerationError(f"Не удалось скачать изображение Kling: {exc}") from exc
-        return response.content, response.headers.get("Content-Type")
+        def _load() -> Tuple[bytes, Optional[str]]:
+            try:
+                with httpx.Client(timeout=self._request_timeout, follow_redirects=True) as client:
+                    response = client.get(url)
+                    response.raise_for_status()
+            except httpx.HTTPError as exc:  # type: ignore[attr-defined]
+                raise VideoGenerationError(f"Не удалось скачать изображение Kling: {exc}") from exc
+            return response.content, response.headers.get("Content-Type")
+
+        return media_cache.fetch(url, _load)
 
     def _request(
         self,
@@ -900,12 +922,8 @@ class KlingVideoProvider(BaseVideoProvider):
 
     def _upload_image_asset(self, content: bytes, *, mime_type: Optional[str], file_name: str) -> str:
         """Загружает изображение в Kling через useapi assets API."""
-        # Лимит Kling: 10MB для изображений
-        max_size = 10 * 1024 * 1024  # 10MB
-
-        # Если изображение больше лимита - сжимаем в JPEG
-        if len(content) > max_size:
-            content, mime_type = self._compress_image(content, max_size)
+        # Лимит Kling: 10MB; JPEG/WebP уходят как есть, крупные файлы ужимаются одной оценкой качества
+        content, mime_type = image_optimizer.optimize(content, mime_type, image_optimizer.PROFILES["kling"])
 
         mime = (mime_type or "image/png").split(";")[0].strip() or "image/png"
         if not mime.startswith("image/"):
@@ -942,45 +960,6 @@ class KlingVideoProvider(BaseVideoProvider):
             raise VideoGenerationError(f"useapi не вернул ссылку на ассет Kling: {data}")
         return asset_url
 
-    def _compress_image(self, content: bytes, max_size: int) -> Tuple[bytes, str]:
-        """Сжимает изображение до указанного размера."""
-        try:
-            from PIL import Image
-        except ImportError:
-            logger.warning("PIL не установлен, сжатие изображения невозможно")
-            return content, "image/png"
-
-        try:
-            img = Image.open(BytesIO(content))
-            # Конвертируем в RGB если нужно (для JPEG)
-            if img.mode in ("RGBA", "P"):
-                img = img.convert("RGB")
-
-            # Пробуем разные уровни качества
-            for quality in [85, 70, 50, 30]:
-                buffer = BytesIO()
-                img.save(buffer, format="JPEG", quality=quality, optimize=True)
-                compressed = buffer.getvalue()
-                if len(compressed) <= max_size:
-                    logger.info(f"Изображение сжато: {len(content)} -> {len(compressed)} байт (quality={quality})")
-                    return compressed, "image/jpeg"
-
-            # Если всё ещё большое - уменьшаем размер
-            width, height = img.size
-            while len(compressed) > max_size and width > 300 and height > 300:
-                width = int(width * 0.8)
-                height = int(height * 0.8)
-                resized = img.resize((width, height), Image.Resampling.LANCZOS)
-                buffer = BytesIO()
-                resized.save(buffer, format="JPEG", quality=70, optimize=True)
-                compressed = buffer.getvalue()
-
-            logger.info(f"Изображение сжато с ресайзом: {len(content)} -> {len(compressed)} байт")
-            return compressed, "image/jpeg"
-        except Exception as exc:
-            logger.warning(f"Ошибка сжатия изображения: {exc}")
-            return content, "image/png"
-
     @staticmethod
     def _is_useapi_asset(url: str) -> bool:
         lower = url.lower()
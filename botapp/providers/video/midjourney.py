@@ -34,7 +34,9 @@ class MidjourneyVideoProvider(BaseVideoProvider):
     _MAX_IMAGE_BYTES = 10 * 1024 * 1024
 
     def _validate_settings(self) -> None:
-        self._api_key: Optional[str] = getattr(settings, "MIDJOURNEY_KIE_API_KEY", None)
+        self._api_key: Optional[str] = (
+            self._account.api_key if self._account else getattr(settings, "MIDJOURNEY_KIE_API_KEY", None)
+        )
         if not self._api_key:
             raise VideoGenerationError("MIDJOURNEY_KIE_API_KEY не задан — Midjourney Video недоступен.")
 
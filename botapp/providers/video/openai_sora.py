@@ -7,6 +7,9 @@ from typing import Any, Dict, Optional, Tuple
 import httpx
 from django.conf import settings
 
+from botapp import media_cache
+from botapp.metrics import timed_stage
+
 from . import register_video_provider
 from .base import BaseVideoProvider, VideoGenerationError, VideoGenerationResult
 
@@ -130,13 +133,18 @@ class GeminigenSoraProvider(BaseVideoProvider):
             value = allowed[0]
         return value
 
+    @timed_stage("download")
     def _download_media(self, url: str) -> Tuple[bytes, str]:
-        timeout = httpx.Timeout(600.0, connect=30.0)
-        with httpx.Client(timeout=timeout) as client:
-            resp = client.get(url, follow_redirects=True)
-            resp.raise_for_status()
-            mime_type = resp.headers.get("content-type", "video/mp4")
-            return resp.content, mime_type.split(";")[0].strip()
+        def _load() -> Tuple[bytes, str]:
+            timeout = httpx.Timeout(600.0, connect=30.0)
+            with httpx.Client(timeout=timeout) as client:
+                resp = client.get(url, follow_redirects=True)
+                resp.raise_for_status()
+                mime_type = resp.headers.get("content-type", "video/mp4")
+                return resp.content, mime_type.split(";")[0].strip()
+
+        content, mime_type = media_cache.fetch(url, _load)
+        return content, mime_type or "video/mp4"
 
     def generate(
         self,
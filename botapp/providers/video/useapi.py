@@ -10,6 +10,7 @@ from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+from botapp.metrics import timed_stage
 from botapp.services import _download_binary_file
 
 from . import register_video_provider
@@ -31,7 +32,8 @@ class UseApiRunwayVideoProvider(BaseVideoProvider):
     _FAIL_STATUSES = {"FAILED", "ERROR", "CANCELLED", "CANCELED", "REJECTED", "MODERATED"}
 
     def _validate_settings(self) -> None:
-        self._api_key: Optional[str] = getattr(settings, "USEAPI_API_KEY", None)
+        account = self._account
+        self._api_key: Optional[str] = account.api_key if account else getattr(settings, "USEAPI_API_KEY", None)
         if not self._api_key:
             raise VideoGenerationError("USEAPI_API_KEY не задан — Runway недоступен.")
 
@@ -49,10 +51,9 @@ class UseApiRunwayVideoProvider(BaseVideoProvider):
         )
 
         try:
-            self._max_jobs: int = int(getattr(settings, "USEAPI_MAX_JOBS", "5") or 5)
+            self._max_jobs: int = int((account and account.max_jobs) or getattr(settings, "USEAPI_MAX_JOBS", "5") or 5)
         except Exception:
             self._max_jobs = 5
-        self._account_email: Optional[str] = getattr(settings, "USEAPI_ACCOUNT_EMAIL", None)
 
         try:
             self._asset_upload_retries: int = max(1, int(getattr(settings, "USEAPI_ASSET_RETRIES", "5") or 5))
@@ -63,8 +64,12 @@ class UseApiRunwayVideoProvider(BaseVideoProvider):
         except Exception:
             self._asset_retry_backoff = 2.0
         # Данные аккаунта Runway (если заданы — проверим/создадим конфиг перед генерацией)
-        self._account_email: Optional[str] = getattr(settings, "USEAPI_ACCOUNT_EMAIL", None)
-        self._account_password: Optional[str] = getattr(settings, "USEAPI_ACCOUNT_PASSWORD", None)
+        if account:
+            self._account_email: Optional[str] = account.email
+            self._account_password: Optional[str] = account.password
+        else:
+            self._account_email = getattr(settings, "USEAPI_ACCOUNT_EMAIL", None)
+            self._account_password = getattr(settings, "USEAPI_ACCOUNT_PASSWORD", None)
         self._account_ready: bool = False
 
     def generate(
@@ -415,6 +420,7 @@ class UseApiRunwayVideoProvider(BaseVideoProvider):
 
         raise VideoGenerationError("useapi: не удалось загрузить ассет после нескольких попыток.") from last_exc
 
+    @timed_stage("poll")
     def _poll_task(self, task_id: str) -> Dict[str, Any]:
         endpoint = self._TASK_ENDPOINT.format(task_id=task_id)
         deadline = time.time() + self._poll_timeout
@@ -0,0 +1,18 @@
+"""
+Общий синхронный Redis-клиент для Celery-задач и сервисов.
+
+Использует тот же Redis, что и брокер Celery (REDIS_URL).
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+
+
+@lru_cache()
+def get_redis() -> redis.Redis:
+    """Возвращает клиент Redis с пулом соединений (один на процесс)."""
+    url = getattr(settings, "CELERY_BROKER_URL", None) or "redis://localhost:6379/0"
+    return redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=5)
@@ -11,6 +11,9 @@ from json import JSONDecoder
 from typing import Any, Dict, List, Optional, Tuple
 from django.conf import settings
 
+from . import media_cache
+from .errors import UserInputError
+
 logger = logging.getLogger(__name__)
 from google.oauth2 import service_account
 from google.auth.transport.requests import AuthorizedSession
@@ -174,7 +177,7 @@ def vertex_edit_images(
             results.append(base64.b64decode(b64_data))
     return results
 
-class GeminiBlockedError(Exception):
+class GeminiBlockedError(UserInputError):
     """Исключение когда Gemini заблокировал генерацию."""
     def __init__(self, message: str, finish_reason: str = None, block_reason: str = None, safety_ratings: list = None):
         super().__init__(message)
@@ -192,8 +195,9 @@ def gemini_generate_images(
     generation_type: str = "text2image",
     input_images: Optional[List[Dict[str, Any]]] = None,
     image_mode: Optional[str] = None,
+    api_key: Optional[str] = None,
 ) -> List[bytes]:
-    """Возвращает список байтов изображений через публичный Gemini API."""
+    """Возвращает список байтов изображений через публичный Gemini API (api_key — ключ из пула аккаунтов)."""
     import logging
     logger = logging.getLogger(__name__)
 
@@ -207,7 +211,7 @@ def gemini_generate_images(
     model_id = _gemini_model_name(model_name)
 
     url = GEMINI_URL_TMPL.format(model=model_id)
-    api_key = getattr(settings, "GEMINI_API_KEY", None)
+    api_key = api_key or getattr(settings, "GEMINI_API_KEY", None)
     if not api_key:
         raise ValueError("GEMINI_API_KEY не настроен для Gemini image генерации")
     headers = {"x-goog-api-key": api_key, "Content-Type": "application/json"}
@@ -537,6 +541,7 @@ def midjourney_generate_images(
     *,
     generation_type: str = "text2image",
     input_images: Optional[List[Dict[str, Any]]] = None,
+    api_key: Optional[str] = None,
 ) -> List[bytes]:
     import logging
     logger = logging.getLogger(__name__)
@@ -544,7 +549,7 @@ def midjourney_generate_images(
     logger.info(f"[MIDJOURNEY_KIE] Начало генерации: prompt={prompt[:100]}..., quantity={quantity}, generation_type={generation_type}")
     logger.info(f"[MIDJOURNEY_KIE] Параметры: {params}")
 
-    api_key = getattr(settings, "MIDJOURNEY_KIE_API_KEY", None)
+    api_key = api_key or getattr(settings, "MIDJOURNEY_KIE_API_KEY", None)
     if not api_key:
         logger.error("[MIDJOURNEY_KIE] MIDJOURNEY_KIE_API_KEY не задан")
         raise ValueError("API-ключ Midjourney не задан.")
@@ -643,8 +648,13 @@ def generate_images_for_model(
     generation_type: str = "text2image",
     input_images: Optional[List[Dict[str, Any]]] = None,
     image_mode: Optional[str] = None,
+    api_key: Optional[str] = None,
 ) -> List[bytes]:
-    """Вызывает подходящего провайдера генерации на основе модели."""
+    """
+    Вызывает подходящего провайдера генерации на основе модели.
+
+    api_key — ключ аккаунта из пула (Gemini, Midjourney/KIE); без него берётся ключ из настроек.
+    """
     provider = getattr(model, "provider", None)
     slug = getattr(model, "slug", "")
     supports_image_input = bool(getattr(model, "supports_image_input", False))
@@ -678,6 +688,7 @@ def generate_images_for_model(
             generation_type=generation_type,
             input_images=input_images or [],
             image_mode=image_mode,
+            api_key=api_key,
         )
     elif provider == "vertex":
         if generation_type == "image2image":
@@ -690,6 +701,7 @@ def generate_images_for_model(
             params=merged_params,
             generation_type=generation_type,
             input_images=input_images or [],
+            api_key=api_key,
         )
 
     raise ValueError(f"Провайдер {provider or 'unknown'} не поддерживает генерацию изображений.")
@@ -699,21 +711,69 @@ def generate_images(prompt: str, quantity: int) -> List[bytes]:
     """Старый интерфейс для обратной совместимости (использует модель из аргумента, а не из env)."""
     raise ValueError("generate_images требует явного указания модели через AIModel; используйте generate_images_for_model.")
 
+
+_IMAGE_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+
+
 def supabase_upload_png(content: bytes) -> str:
     """Загружает PNG в Supabase Storage и возвращает ПУБЛИЧНЫЙ URL."""
+    return supabase_upload_image(content, "image/png")
+
+
+def supabase_upload_image(
+    content: bytes,
+    mime_type: str = "image/png",
+    folder: str = "images",
+    bucket: Optional[str] = None,
+) -> str:
+    """Загружает изображение (PNG/JPEG/WebP) в Supabase Storage и возвращает публичный URL."""
     if create_client is None:
         raise RuntimeError("Supabase client library не установлена")
     supabase = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
-    key = f"images/{uuid.uuid4().hex}.png"
+    bucket = bucket or settings.SUPABASE_BUCKET
+    key = f"{folder}/{uuid.uuid4().hex}.{_IMAGE_EXTENSIONS.get(mime_type, 'png')}"
     # upload (важно указать content-type)
-    supabase.storage.from_(settings.SUPABASE_BUCKET).upload(
-        path=key, file=content, file_options={"content-type": "image/png", "upsert": "true"}
+    supabase.storage.from_(bucket).upload(
+        path=key, file=content, file_options={"content-type": mime_type, "upsert": "true"}
     )
     # public URL
-    public = supabase.storage.from_(settings.SUPABASE_BUCKET).get_public_url(key)
+    public = supabase.storage.from_(bucket).get_public_url(key)
     return public  # dict или строка — у lib v2 возвращается объект; возьмём .get("publicUrl") при необходимости
 
 
+def supabase_upload_object(content: bytes, key: str, content_type: str, bucket: str) -> str:
+    """Загружает файл под заданным ключом без публичной ссылки (например, в приватный bucket); возвращает ключ."""
+    if create_client is None:
+        raise RuntimeError("Supabase client library не установлена")
+    supabase = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
+    supabase.storage.from_(bucket).upload(
+        path=key, file=content, file_options={"content-type": content_type, "upsert": "true"}
+    )
+    return key
+
+
+def supabase_upload_input(content: bytes, mime_type: str) -> str:
+    """Загружает входной файл генерации (референс, исходное видео) в Supabase Storage и возвращает публичный URL."""
+    if create_client is None:
+        raise RuntimeError("Supabase client library не установлена")
+    if mime_type.startswith("video/"):
+        bucket = settings.SUPABASE_VIDEO_BUCKET
+        extension = "mp4" if "mp4" in mime_type else "webm"
+    else:
+        bucket = settings.SUPABASE_BUCKET
+        extension = _IMAGE_EXTENSIONS.get(mime_type, "png")
+    supabase = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
+    key = f"inputs/{uuid.uuid4().hex}.{extension}"
+    supabase.storage.from_(bucket).upload(
+        path=key, file=content, file_options={"content-type": mime_type, "upsert": "true"}
+    )
+    public = supabase.storage.from_(bucket).get_public_url(key)
+    url = public.get("public_url") if isinstance(public, dict) else public
+    # Воркер скачает файл сразу после постановки задачи
+    media_cache.put(url, content, mime_type)
+    return url
+
+
 def supabase_upload_video(content: bytes, mime_type: str = "video/mp4") -> str:
     """Загружает видео в Supabase Storage и возвращает публичный URL."""
     if create_client is None:
@@ -727,6 +787,9 @@ def supabase_upload_video(content: bytes, mime_type: str = "video/mp4") -> str:
         file_options={"content-type": mime_type, "upsert": "true"},
     )
     public = supabase.storage.from_(settings.SUPABASE_VIDEO_BUCKET).get_public_url(key)
+    # Только что загруженный ролик — первый кандидат на повторное скачивание (продление, повторная отправка)
+    if isinstance(public, str):
+        media_cache.put(public, content, mime_type)
     return public
 
 
@@ -900,13 +963,16 @@ def _kie_extract_result_urls(payload: Dict[str, Any]) -> List[str]:
 
 
 def _download_binary_file(url: str) -> bytes:
-    try:
-        with httpx.Client(timeout=120.0, follow_redirects=True) as client:
-            response = client.get(url)
-            response.raise_for_status()
-            return response.content
-    except httpx.HTTPError as exc:  # type: ignore[attr-defined]
-        raise ValueError(f"Не удалось скачать файл по ссылке {url}: {exc}") from exc
+    def _load() -> Tuple[bytes, Optional[str]]:
+        try:
+            with httpx.Client(timeout=120.0, follow_redirects=True) as client:
+                response = client.get(url)
+                response.raise_for_status()
+                return response.content, None
+        except httpx.HTTPError as exc:  # type: ignore[attr-defined]
+            raise ValueError(f"Не удалось скачать файл по ссылке {url}: {exc}") from exc
+
+    return media_cache.fetch(url, _load)[0]
 
 
 def _format_kie_error(response: Optional[httpx.Response]) -> str:
@@ -5,27 +5,61 @@ import base64
 import json
 import logging
 import os
+import re
+import shutil
 import subprocess
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from decimal import Decimal
 from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
 import httpx
 from celery import shared_task, signals
+from celery.exceptions import Retry
 from django.conf import settings
-from django.db import close_old_connections
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from imageio_ffmpeg import get_ffmpeg_exe
-
+from redis.exceptions import RedisError
+
+from . import (
+    blobs,
+    derivatives,
+    dispatch,
+    events,
+    heartbeats,
+    image_optimizer,
+    media_cache,
+    metrics,
+    profiling,
+    tracing,
+    webhooks,
+)
 from .business.balance import BalanceService
 from .business.generation import GenerationService
+from .business.promocodes import PromocodeService
+from .business.retention import RetentionService
+from .business.rollups import RollupService
 from .chat_logger import ChatLogger
 from .error_tracker import ErrorTracker
+from .errors import ErrorKind, classify_error, get_retry_countdown
 from .keyboards import get_generation_complete_message
-from .media_utils import detect_reference_mime, ensure_png_format
+from .media_utils import detect_reference_mime
 from .models import BotErrorEvent, GenRequest, TgUser
 from .providers import VideoGenerationError, get_video_provider
-from .services import generate_images_for_model, supabase_upload_png, supabase_upload_video, GeminiBlockedError
+from .providers.accounts import ProviderAccount, pool_for_provider, report_account_error, resolve_account
+from .providers.limits import ProviderSlotUnavailable, provider_slot, release_held_slot
+from .services import (
+    generate_images_for_model,
+    supabase_upload_image,
+    supabase_upload_video,
+    GeminiBlockedError,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -72,6 +106,14 @@ def _log_bot_api_result(result) -> None:
         ChatLogger.log_outgoing_from_payload(result)
 
 
+def _raise_for_telegram_status(resp: httpx.Response, method: str) -> None:
+    try:
+        resp.raise_for_status()
+    except httpx.HTTPStatusError:
+        metrics.TELEGRAM_SEND_ERRORS.labels(method, str(resp.status_code)).inc()
+        raise
+
+
 def send_telegram_photo(
     chat_id: int,
     photo_bytes: bytes,
@@ -96,6 +138,7 @@ def send_telegram_photo(
         try:
             resp.raise_for_status()
         except httpx.HTTPStatusError:
+            metrics.TELEGRAM_SEND_ERRORS.labels("sendDocument", str(resp.status_code)).inc()
             # Логируем тело ответа, чтобы понимать причину 4xx от Telegram
             logger.warning(
                 "Telegram sendDocument failed: status=%s body=%s",
@@ -133,6 +176,7 @@ def send_telegram_video(
         try:
             resp.raise_for_status()
         except httpx.HTTPStatusError:
+            metrics.TELEGRAM_SEND_ERRORS.labels("sendDocument", str(resp.status_code)).inc()
             logger.warning(
                 "Telegram sendDocument failed: status=%s body=%s",
                 resp.status_code,
@@ -159,7 +203,12 @@ def send_telegram_album(
 
     for idx, (image_bytes, caption) in enumerate(images, start=1):
         file_key = f"photo{idx}"
-        files[file_key] = ("image.png", image_bytes, "image/png")
+        # Превью приходят в JPEG/WebP (см. botapp/derivatives.py), остальное считается PNG
+        mime_type = detect_reference_mime(image_bytes, None, None)
+        if not mime_type.startswith("image/"):
+            mime_type = "image/png"
+        extension = {"image/jpeg": "jpg", "image/webp": "webp"}.get(mime_type, "png")
+        files[file_key] = (f"image.{extension}", image_bytes, mime_type)
         media_item = {
             "type": "photo",
             "media": f"attach://{file_key}",
@@ -179,7 +228,7 @@ def send_telegram_album(
             },
             files=files,
         )
-        resp.raise_for_status()
+        _raise_for_telegram_status(resp, "sendMediaGroup")
         payload = resp.json()
         _log_bot_api_result(payload.get("result"))
         return payload
@@ -199,7 +248,7 @@ def send_telegram_message(chat_id: int, text: str, reply_markup: Optional[Dict]
 
     with httpx.Client(timeout=10) as client:
         resp = client.post(url, json=data)
-        resp.raise_for_status()
+        _raise_for_telegram_status(resp, "sendMessage")
         payload = resp.json()
         _log_bot_api_result(payload.get("result"))
         return payload
@@ -239,20 +288,29 @@ def get_video_result_markup(request_id: int, include_extension: bool = True) ->
 
 
 def fetch_remote_file(url: str) -> bytes:
-    """Скачать файл по URL и вернуть байтовое содержимое."""
-    with httpx.Client(timeout=httpx.Timeout(120.0, connect=10.0)) as client:
-        resp = client.get(url)
-        resp.raise_for_status()
-        return resp.content
+    """Скачать файл по URL (через дисковый кэш воркера) и вернуть байтовое содержимое."""
+
+    def _load() -> Tuple[bytes, Optional[str]]:
+        with httpx.Client(timeout=httpx.Timeout(120.0, connect=10.0)) as client:
+            resp = client.get(url)
+            resp.raise_for_status()
+            return resp.content, None
+
+    return media_cache.fetch(url, _load)[0]
 
 
 def _download_media_with_mime(url: str) -> Tuple[bytes, str]:
-    """Скачать бинарный файл и вернуть пару (контент, mime)."""
-    with httpx.Client(timeout=httpx.Timeout(300.0, connect=10.0)) as client:
-        resp = client.get(url, follow_redirects=True)
-        resp.raise_for_status()
-        mime = resp.headers.get("content-type", "video/mp4")
-        return resp.content, mime.split(";")[0].strip()
+    """Скачать бинарный файл (через дисковый кэш воркера) и вернуть пару (контент, mime)."""
+
+    def _load() -> Tuple[bytes, str]:
+        with httpx.Client(timeout=httpx.Timeout(300.0, connect=10.0)) as client:
+            resp = client.get(url, follow_redirects=True)
+            resp.raise_for_status()
+            mime = resp.headers.get("content-type", "video/mp4")
+            return resp.content, mime.split(";")[0].strip()
+
+    content, mime = media_cache.fetch(url, _load)
+    return content, mime or "video/mp4"
 
 
 
@@ -288,6 +346,106 @@ def _log_task_failure(sender=None, task_id=None, exception=None, args=None, kwar
     )
 
 
+@signals.before_task_publish.connect
+def _inject_trace_context(headers=None, **extra):
+    tracing.inject_headers(headers)
+
+
+@signals.task_prerun.connect
+def _start_task_span(sender=None, task_id=None, args=None, kwargs=None, **extra):
+    tracing.start_task_span(sender, task_id, args, kwargs)
+
+
+@signals.task_postrun.connect
+def _end_task_span(task_id=None, state=None, **extra):
+    tracing.end_task_span(task_id, state)
+
+
+_PROFILED_TASKS = {
+    "botapp.tasks.generate_image_task",
+    "botapp.tasks.generate_video_task",
+    "botapp.tasks.process_webapp_submission_task",
+}
+
+
+@signals.task_prerun.connect
+def _start_task_profiling(sender=None, task_id=None, args=None, **extra):
+    """Профилирование по флагу на задачу; для WebApp первый аргумент — chat_id пользователя."""
+    task_name = getattr(sender, "name", None)
+    if task_name not in _PROFILED_TASKS:
+        return
+    chat_id = args[0] if task_name == "botapp.tasks.process_webapp_submission_task" and args else None
+    profiling.maybe_start(task_id, task_name, chat_id)
+
+
+@signals.task_postrun.connect
+def _finish_task_profiling(task_id=None, **extra):
+    profiling.finish(task_id)
+
+
+_task_started_at: Dict[str, float] = {}
+
+
+@signals.task_prerun.connect
+def _record_task_start(task_id=None, **extra):
+    _task_started_at[task_id] = time.monotonic()
+
+
+@signals.task_postrun.connect
+def _observe_task_duration(sender=None, task_id=None, state=None, **extra):
+    started = _task_started_at.pop(task_id, None)
+    if started is not None:
+        task_name = getattr(sender, "name", "unknown")
+        metrics.TASK_SECONDS.labels(task_name, state or "unknown").observe(time.monotonic() - started)
+
+
+@signals.worker_init.connect
+def _start_metrics_exporter(**extra):
+    port = getattr(settings, "CELERY_METRICS_PORT", 0)
+    if port:
+        metrics.start_worker_exporter(port)
+
+
+@signals.worker_process_shutdown.connect
+def _mark_metrics_process_dead(pid=None, **extra):
+    metrics.mark_process_dead(pid or os.getpid())
+
+
+_HEARTBEAT_TASKS = {
+    "botapp.tasks.generate_image_task",
+    "botapp.tasks.generate_video_task",
+    "botapp.tasks.extend_video_task",
+}
+_heartbeat_threads: Dict[str, heartbeats.HeartbeatThread] = {}
+
+
+@signals.task_prerun.connect
+def _start_request_heartbeat(sender=None, task_id=None, args=None, kwargs=None, **extra):
+    """Запускает heartbeat для задач генерации (первый аргумент — id GenRequest)."""
+    if getattr(sender, "name", None) not in _HEARTBEAT_TASKS:
+        return
+    request_id = args[0] if args else (kwargs or {}).get("request_id")
+    if request_id is None:
+        return
+    thread = heartbeats.HeartbeatThread(int(request_id), task_id)
+    thread.start()
+    _heartbeat_threads[task_id] = thread
+
+
+@signals.task_postrun.connect
+def _stop_request_heartbeat(sender=None, task_id=None, state=None, **extra):
+    thread = _heartbeat_threads.pop(task_id, None)
+    if thread is None:
+        return
+    thread.stop()
+    if state == "RETRY":
+        # Запрос ждёт повтора по countdown — продлеваем heartbeat, чтобы reaper его не перезапустил
+        retry_wait = max(settings.GENERATION_RETRY_BACKOFF_MAX, settings.PROVIDER_SLOT_RETRY_DELAY)
+        heartbeats.touch(thread.request_id, ttl=retry_wait + settings.GENERATION_HEARTBEAT_TTL, task_id=task_id)
+    else:
+        heartbeats.clear(thread.request_id)
+
+
 def _run_command(command: List[str]) -> str:
     result = subprocess.run(
         command,
@@ -449,6 +607,94 @@ def extract_last_frame(video_bytes: bytes, duration_hint: Optional[float] = None
                 pass
 
 
+_POSTER_MAX_WIDTH = 640
+
+
+def _parse_media_info(info: str) -> Dict[str, Any]:
+    """Длительность, размер кадра, FPS и наличие звука первого входа из вывода `ffmpeg -i`."""
+    probe: Dict[str, Any] = {"has_audio": False}
+    for line in info.splitlines():
+        if line.startswith("Input #1") or line.startswith("Output #"):
+            break
+        if "Duration:" in line and "duration" not in probe:
+            try:
+                h, m, s = line.split("Duration:", 1)[1].split(",", 1)[0].strip().split(":")
+                probe["duration"] = round(int(h) * 3600 + int(m) * 60 + float(s), 3)
+            except ValueError:
+                continue
+        elif "Stream #0:" in line and "Video:" in line and "width" not in probe:
+            size = re.search(r"\b(\d{2,5})x(\d{2,5})\b", line)
+            if size:
+                probe["width"], probe["height"] = int(size.group(1)), int(size.group(2))
+            fps = re.search(r"([\d.]+) fps", line)
+            if fps:
+                probe["fps"] = float(fps.group(1))
+        elif "Stream #0:" in line and "Audio:" in line:
+            probe["has_audio"] = True
+    return probe
+
+
+def render_video_derivatives(video_bytes: bytes) -> Tuple[bytes, bytes, Dict[str, Any]]:
+    """
+    Один запуск ffmpeg над готовым роликом: последний кадр (PNG) для продления, постер (JPEG)
+    и метаданные (длительность, размер кадра, FPS, наличие звука) из заголовка входа.
+    """
+    temp_dir = tempfile.mkdtemp(prefix="video-derivatives-")
+    try:
+        input_path = os.path.join(temp_dir, "input.mp4")
+        frame_path = os.path.join(temp_dir, "last_frame.png")
+        poster_path = os.path.join(temp_dir, "poster.jpg")
+        with open(input_path, "wb") as fh:
+            fh.write(video_bytes)
+
+        command = [
+            _ffmpeg_bin(), "-hide_banner", "-y",
+            "-i", input_path,
+            "-sseof", "-1", "-i", input_path,
+            "-map", "0:v:0", "-frames:v", "1",
+            "-vf", f"scale='min({_POSTER_MAX_WIDTH},iw)':-2", "-q:v", "3",
+            poster_path,
+            # Кадры последней секунды пишутся в один файл по очереди — остаётся именно последний
+            "-map", "1:v:0", "-update", "1",
+            frame_path,
+        ]
+        proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=False)
+        outputs = []
+        for path in (frame_path, poster_path):
+            if proc.returncode != 0 or not os.path.exists(path) or os.path.getsize(path) == 0:
+                raise RuntimeError(f"Не удалось подготовить производные видео: {proc.stderr.strip()[-500:]}")
+            with open(path, "rb") as fh:
+                outputs.append(fh.read())
+        return outputs[0], outputs[1], _parse_media_info(proc.stderr)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _with_video_derivatives(video_bytes: bytes, metadata: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Добавляет в provider_metadata раздел derivatives (ссылки на последний кадр и постер рядом с видео,
+    метаданные ролика). Ошибка не мешает выдаче результата: продление тогда извлечёт кадр само.
+    """
+    metadata = dict(metadata or {})
+    try:
+        frame_bytes, poster_bytes, probe = render_video_derivatives(video_bytes)
+        bucket = settings.SUPABASE_VIDEO_BUCKET
+        frame_obj = supabase_upload_image(frame_bytes, "image/png", "videos/frames", bucket=bucket)
+        poster_obj = supabase_upload_image(poster_bytes, "image/jpeg", "videos/posters", bucket=bucket)
+    except Exception as exc:
+        logger.warning("[VIDEO_DERIVATIVES] Не удалось подготовить кадр/постер: %s", exc)
+        return metadata
+    metadata["derivatives"] = {
+        "last_frame_url": frame_obj.get("public_url") if isinstance(frame_obj, dict) else frame_obj,
+        "poster_url": poster_obj.get("public_url") if isinstance(poster_obj, dict) else poster_obj,
+        "probe": probe,
+    }
+    # Кадр понадобится при продлении на этом же воркере
+    if isinstance(metadata["derivatives"]["last_frame_url"], str):
+        media_cache.put(metadata["derivatives"]["last_frame_url"], frame_bytes, "image/png")
+    return metadata
+
+
 def combine_videos_with_crossfade(
     part1_bytes: bytes,
     part2_bytes: bytes,
@@ -573,24 +819,33 @@ def combine_videos_with_crossfade(
 
 
 def download_telegram_file(file_id: str) -> Tuple[bytes, str]:
-    """Скачать файл из Telegram и вернуть (bytes, mime_type)."""
-    api_base = f"https://api.telegram.org/bot{settings.TELEGRAM_BOT_TOKEN}"
-    with httpx.Client(timeout=httpx.Timeout(60.0, connect=10.0)) as client:
-        resp = client.get(f"{api_base}/getFile", params={"file_id": file_id})
-        resp.raise_for_status()
-        result = resp.json().get("result")
-        if not result:
-            raise ValueError("Не удалось получить файл из Telegram")
-        file_path = result["file_path"]
-        file_resp = client.get(f"https://api.telegram.org/file/bot{settings.TELEGRAM_BOT_TOKEN}/{file_path}")
-        file_resp.raise_for_status()
-        file_bytes = file_resp.content
-        header_mime = file_resp.headers.get("Content-Type", "application/octet-stream")
-        mime_type = detect_reference_mime(file_bytes, file_path, header_mime)
-        return file_bytes, mime_type
-
-
-def _prepare_input_images(sources: List[Any], limit: Optional[int]) -> List[Dict[str, Any]]:
+    """Скачать файл из Telegram (через дисковый кэш воркера) и вернуть (bytes, mime_type)."""
+
+    def _load() -> Tuple[bytes, str]:
+        api_base = f"https://api.telegram.org/bot{settings.TELEGRAM_BOT_TOKEN}"
+        with httpx.Client(timeout=httpx.Timeout(60.0, connect=10.0)) as client:
+            resp = client.get(f"{api_base}/getFile", params={"file_id": file_id})
+            resp.raise_for_status()
+            result = resp.json().get("result")
+            if not result:
+                raise ValueError("Не удалось получить файл из Telegram")
+            file_path = result["file_path"]
+            file_resp = client.get(f"https://api.telegram.org/file/bot{settings.TELEGRAM_BOT_TOKEN}/{file_path}")
+            file_resp.raise_for_status()
+            file_bytes = file_resp.content
+            header_mime = file_resp.headers.get("Content-Type", "application/octet-stream")
+            return file_bytes, detect_reference_mime(file_bytes, file_path, header_mime)
+
+    file_bytes, mime_type = media_cache.fetch(f"telegram:{file_id}", _load)
+    return file_bytes, mime_type or "application/octet-stream"
+
+
+def _prepare_input_images(
+    sources: List[Any],
+    limit: Optional[int],
+    profile: image_optimizer.ImageProfile = image_optimizer.DEFAULT_PROFILE,
+) -> List[Dict[str, Any]]:
+    """Скачивает референсы и приводит их к форматам и лимитам провайдера (см. image_optimizer)."""
     payloads: List[Dict[str, Any]] = []
     if not sources:
         return payloads
@@ -635,16 +890,15 @@ def _prepare_input_images(sources: List[Any], limit: Optional[int]) -> List[Dict
         if content is None:
             continue
 
-        png_bytes, png_mime = ensure_png_format(content, mime_type or "image/png")
         payloads.append(
             {
-                "content": png_bytes,
-                "mime_type": png_mime,
+                "content": content,
+                "mime_type": mime_type or "image/png",
                 "filename": filename,
                 "role": role,
             }
         )
-    return payloads
+    return image_optimizer.optimize_all(payloads, profile)
 
 
 def _extract_charge_details(req: GenRequest) -> Tuple[Optional[Decimal], Optional[Decimal]]:
@@ -680,7 +934,125 @@ def _extract_charge_details(req: GenRequest) -> Tuple[Optional[Decimal], Optiona
     return charged_amount, balance_after
 
 
-@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, max_retries=3)
+def _pin_provider_account(req: GenRequest, provider_slug: Optional[str]) -> Optional[ProviderAccount]:
+    """Выбирает аккаунт из пула провайдера и закрепляет его за запросом (provider_metadata["account"])."""
+    account = resolve_account(pool_for_provider(provider_slug), req.provider_metadata)
+    if account:
+        meta = dict(req.provider_metadata or {})
+        if meta.get("account") != account.to_metadata():
+            meta["account"] = account.to_metadata()
+            req.provider_metadata = meta
+            req.save(update_fields=["provider_metadata"])
+    return account
+
+
+def _retry_countdown(task, exc: BaseException, req: GenRequest, log_prefix: str) -> Optional[int]:
+    """Решает по классу ошибки, повторять ли задачу; возвращает задержку или None."""
+    request_id = req.id
+    classification = classify_error(exc)
+    retries = getattr(task.request, "retries", 0) or 0
+    countdown = get_retry_countdown(classification, retries)
+    if classification.kind == ErrorKind.RATE_LIMITED:
+        provider = req.ai_model.provider if req.ai_model_id else "unknown"
+        metrics.PROVIDER_RATE_LIMITED.labels(provider).inc()
+    if countdown is not None:
+        metrics.TASK_RETRIES.labels(task.name, classification.kind.value).inc()
+    if countdown is None:
+        logger.info(
+            "%s Ошибка без повтора: request_id=%s class=%s reason=%s retries=%s",
+            log_prefix,
+            request_id,
+            classification.kind.value,
+            classification.reason,
+            retries,
+        )
+    else:
+        logger.warning(
+            "%s Повтор через %sс: request_id=%s class=%s reason=%s retries=%s",
+            log_prefix,
+            countdown,
+            request_id,
+            classification.kind.value,
+            classification.reason,
+            retries,
+        )
+    return countdown
+
+
+# Заголовок сообщения Celery со счётчиком ожиданий слота провайдера. Ожидание слота — не ошибка
+# провайдера, поэтому не расходует request.retries, по которому считаются бюджеты классов ошибок.
+SLOT_WAITS_HEADER = "slot_waits"
+
+
+def _retry_slot_wait(
+    task, exc: ProviderSlotUnavailable, req: Optional[GenRequest], failure_title: str
+) -> Exception:
+    """
+    Перезапускает задачу после занятого слота с отдельным счётчиком в заголовках сообщения.
+    Когда ожидания исчерпаны, генерация завершается ошибкой с возвратом средств и возвращается exc.
+    """
+    request = task.request
+    headers = dict(request.headers or {})
+    waits = int(headers.get(SLOT_WAITS_HEADER) or 0)
+    if request.called_directly or waits >= settings.PROVIDER_SLOT_MAX_RETRIES:
+        _fail_slot_wait(req, exc, failure_title, waits)
+        return exc
+    metrics.TASK_RETRIES.labels(task.name, "slot_unavailable").inc()
+    headers[SLOT_WAITS_HEADER] = waits + 1
+    signature = task.signature_from_request(
+        request, countdown=exc.retry_after, retries=request.retries, headers=headers
+    )
+    if not request.is_eager:
+        signature.apply_async()
+    return Retry(exc=exc, when=exc.retry_after, is_eager=request.is_eager, sig=signature)
+
+
+def _fail_slot_wait(
+    req: Optional[GenRequest], exc: ProviderSlotUnavailable, failure_title: str, waits: int
+) -> None:
+    logger.warning(
+        "[PROVIDER_SLOT] Слот не освободился за %s ожиданий: request_id=%s provider=%s account=%s",
+        waits,
+        req.id if req else None,
+        exc.provider,
+        exc.account,
+    )
+    if req is None:
+        return
+    GenerationService.fail_generation(req, str(exc), refund=True)
+    try:
+        send_telegram_message(
+            req.chat_id,
+            f"❌ {failure_title}: сервис перегружен. Средства возвращены на баланс, попробуйте позже.",
+            reply_markup=get_inline_menu_markup(),
+            parse_mode=None,
+        )
+    except Exception:
+        logger.exception("[PROVIDER_SLOT] Не удалось уведомить о сбое запроса %s", req.id)
+
+
+# Провайдеры, которые ставят задачу в Geminigen и ждут webhook: Veo и Sora (GeminigenSoraProvider)
+GEMINIGEN_VIDEO_PROVIDERS = ("veo", "openai")
+
+
+def _geminigen_slot_ttl() -> int:
+    """Слот принятой задачи живёт, пока её может завершить сверка (с запасом на один проход)."""
+    return int(settings.GEMINIGEN_RECONCILE_MAX_AGE) + int(settings.GEMINIGEN_RECONCILE_STALE_AFTER)
+
+
+def _release_job_slot(req: GenRequest) -> None:
+    """Освобождает слот провайдера, удерживаемый задачей Geminigen с момента постановки."""
+    release_held_slot((req.provider_metadata or {}).get("slot"))
+
+
+def _account_slot(provider_slug: str, account: Optional[ProviderAccount]):
+    """Слот провайдера с учётом лимита конкретного аккаунта пула."""
+    if account is None:
+        return provider_slot(provider_slug)
+    return provider_slot(account.pool, account.name, limit=account.max_jobs)
+
+
+@shared_task(bind=True, max_retries=None)
 def generate_image_task(self, request_id: int):
     """
     Задача генерации изображений
@@ -690,6 +1062,9 @@ def generate_image_task(self, request_id: int):
     req: Optional[GenRequest] = None
     try:
         req = GenRequest.objects.select_related('user', 'ai_model', 'transaction').get(id=request_id)
+        tracing.annotate_request(req)
+        profiling.maybe_start(self.request.id, self.name, req.chat_id)
+        GenerationService.start_generation(req)
         logger.info(f"[CELERY_IMAGE_TASK] Запрос загружен: user={req.user.chat_id}, model={req.ai_model.name}, provider={req.ai_model.provider}")
 
         # Получаем модель и параметры
@@ -704,7 +1079,7 @@ def generate_image_task(self, request_id: int):
 
         input_images_payload: List[Dict[str, Any]] = []
         if generation_type == 'image2image':
-            input_sources = req.input_images or []
+            input_sources = blobs.restore(req.input_images or [])
             max_inputs = model.max_input_images or None
             # Для ремикса отдаем все разрешенные моделью референсы (документация Gemini допускает до 14 для Pro).
             if image_mode == "remix":
@@ -716,7 +1091,9 @@ def generate_image_task(self, request_id: int):
                 f"[TASK] Подготовка изображений для запроса {req.id}: input_sources={len(input_sources)}, "
                 f"max_inputs={max_inputs}, model.max_input_images={model.max_input_images}, mode={image_mode}"
             )
-            input_images_payload = _prepare_input_images(input_sources, max_inputs)
+            input_images_payload = _prepare_input_images(
+                input_sources, max_inputs, image_optimizer.profile_for(model.provider)
+            )
             logger.info(f"[TASK] Подготовлено {len(input_images_payload)} изображений для передачи в модель")
 
             if not input_images_payload:
@@ -725,16 +1102,20 @@ def generate_image_task(self, request_id: int):
             input_images_payload = []
 
         # Вызываем сервис генерации изображений
+        account = _pin_provider_account(req, model.provider)
+        heartbeats.checkpoint(req.id, heartbeats.STAGE_PROVIDER_CALL)
         try:
-            imgs = generate_images_for_model(
-                model,
-                prompt,
-                quantity,
-                params,
-                generation_type=generation_type,
-                input_images=input_images_payload,
-                image_mode=image_mode,
-            )
+            with _account_slot(model.provider, account), metrics.stage(model.provider, "submit"):
+                imgs = generate_images_for_model(
+                    model,
+                    prompt,
+                    quantity,
+                    params,
+                    generation_type=generation_type,
+                    input_images=input_images_payload,
+                    image_mode=image_mode,
+                    api_key=account.api_key if account else None,
+                )
         except GeminiBlockedError as blocked_err:
             # Gemini заблокировал запрос - retry бесполезен, сразу сообщаем пользователю
             logger.error(f"[TASK] Gemini заблокировал запрос {req.id}: {blocked_err}")
@@ -749,6 +1130,9 @@ def generate_image_task(self, request_id: int):
                 parse_mode=None,
             )
             return  # Выходим без retry
+        except Exception as provider_error:
+            report_account_error(account, provider_error)
+            raise
 
         # Проверка что генерация вернула результаты
         if not imgs:
@@ -783,23 +1167,26 @@ def generate_image_task(self, request_id: int):
             balance_after=balance_after,
         )
 
-        # Загружаем изображения в Storage и формируем список для отправки одним альбомом
+        # Производные (оригинал, превью, миниатюра) кодируются и загружаются в Storage параллельно
+        logger.info(f"[TASK] Подготовка и загрузка {len(imgs)} изображений в Supabase для запроса {req.id}")
+        with metrics.stage(model.provider, "derive"):
+            rendered = derivatives.render_all(imgs)
+        with metrics.stage(model.provider, "upload"):
+            uploaded = derivatives.upload_all(rendered)
+
+        # Оригиналы — для одиночной отправки документом, превью — для альбома
+        prepared_originals: List[bytes] = []
         prepared_images: List[Tuple[bytes, Optional[str]]] = []
-        for idx, img in enumerate(imgs, start=1):
-            try:
-                logger.info(f"[TASK] Загрузка изображения {idx}/{quantity} в Supabase для запроса {req.id}")
-                url_obj = supabase_upload_png(img)
-                url = url_obj.get("public_url") if isinstance(url_obj, dict) else url_obj
-                urls.append(url)
-                logger.info(f"[TASK] Изображение {idx}/{quantity} загружено: {url}")
-                caption = None
-                # caption добавляем только к первому изображению
-                prepared_images.append((img, caption))
-                logger.info(f"[TASK] Изображение {idx}/{quantity} подготовлено к отправке")
-            except Exception as img_error:
-                logger.exception(f"[TASK] Ошибка при обработке изображения {idx}/{quantity} для запроса {req.id}: {img_error}")
-                # Продолжаем обработку остальных изображений
+        result_derivatives: List[Dict[str, str]] = []
+        for idx, (variants, stored) in enumerate(zip(rendered, uploaded), start=1):
+            if stored is None:
+                logger.error(f"[TASK] Изображение {idx}/{quantity} не загружено для запроса {req.id}")
                 continue
+            urls.append(stored[derivatives.ORIGINAL])
+            result_derivatives.append(stored)
+            prepared_originals.append(variants[derivatives.ORIGINAL][0])
+            prepared_images.append((variants[derivatives.PREVIEW][0], None))
+            logger.info(f"[TASK] Изображение {idx}/{quantity} загружено: {stored[derivatives.ORIGINAL]}")
 
         # Проверка что хотя бы одно изображение было успешно обработано
         if not urls or not prepared_images:
@@ -814,20 +1201,21 @@ def generate_image_task(self, request_id: int):
 
         # Отправляем результаты одним сообщением (media group) если изображений несколько
         try:
-            if len(prepared_images) == 1:
-                img, caption = prepared_images[0]
-                send_telegram_photo(
-                    chat_id=req.chat_id,
-                    photo_bytes=img,
-                    caption=caption or system_message,
-                    reply_markup=inline_markup,
-                )
-            else:
-                send_telegram_album(
-                    chat_id=req.chat_id,
-                    images=prepared_images,
-                )
+            with metrics.stage(model.provider, "deliver"):
+                if len(prepared_images) == 1:
+                    send_telegram_photo(
+                        chat_id=req.chat_id,
+                        photo_bytes=prepared_originals[0],
+                        caption=prepared_images[0][1] or system_message,
+                        reply_markup=inline_markup,
+                    )
+                else:
+                    send_telegram_album(
+                        chat_id=req.chat_id,
+                        images=prepared_images,
+                    )
             logger.info(f"[TASK] Запрос {req.id} завершен успешно. Загружено и отправлено {len(prepared_images)}/{quantity} изображений")
+            heartbeats.checkpoint(req.id, heartbeats.STAGE_DELIVERED, result_urls=urls)
         except Exception as send_error:
             logger.exception(f"[TASK] Ошибка при отправке результатов запроса {req.id}: {send_error}")
             raise
@@ -835,35 +1223,36 @@ def generate_image_task(self, request_id: int):
         # Обновляем статус запроса
         req.status = "done"
         req.result_urls = urls
-        req.save(update_fields=["status", "result_urls"])
+        req.result_derivatives = result_derivatives
+        req.save(update_fields=["status", "result_urls", "result_derivatives"])
 
+    except ProviderSlotUnavailable as exc:
+        logger.info("[CELERY_IMAGE_TASK] %s request_id=%s", exc, request_id)
+        raise _retry_slot_wait(self, exc, req, "Ошибка генерации изображения")
     except Exception as e:
-        max_retries = getattr(self, "max_retries", 0) or 0
-        current_retry = getattr(getattr(self, "request", None), "retries", 0)
-        is_final_attempt = current_retry >= max_retries
-
         if req is None:
             raise
 
-        if is_final_attempt:
-            req.status = "error"
-            req.error_message = str(e)
-            req.save(update_fields=["status", "error_message"])
-
-            send_telegram_message(
-                req.chat_id,
-                f"❌ Ошибка генерации изображения: {str(e)}",
-                reply_markup=get_inline_menu_markup(),
-                parse_mode=None,
-            )
-        else:
+        countdown = _retry_countdown(self, e, req, "[CELERY_IMAGE_TASK]")
+        if countdown is not None:
             req.status = "processing"
             req.save(update_fields=["status"])
+            raise self.retry(exc=e, countdown=countdown, max_retries=self.request.retries + 1)
+
+        req.status = "error"
+        req.error_message = str(e)
+        req.save(update_fields=["status", "error_message"])
 
+        send_telegram_message(
+            req.chat_id,
+            f"❌ Ошибка генерации изображения: {str(e)}",
+            reply_markup=get_inline_menu_markup(),
+            parse_mode=None,
+        )
         raise
 
 
-@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, max_retries=3)
+@shared_task(bind=True, max_retries=None)
 def generate_video_task(self, request_id: int):
     """
     Задача генерации видео через провайдеров (Vertex Veo и др.)
@@ -871,6 +1260,8 @@ def generate_video_task(self, request_id: int):
     req: Optional[GenRequest] = None
     try:
         req = GenRequest.objects.select_related('user', 'ai_model', 'transaction').get(id=request_id)
+        tracing.annotate_request(req)
+        profiling.maybe_start(self.request.id, self.name, req.chat_id)
         GenerationService.start_generation(req)
 
         model = req.ai_model
@@ -880,37 +1271,42 @@ def generate_video_task(self, request_id: int):
         prompt = req.prompt
         generation_type = req.generation_type or 'text2video'
 
-        provider = get_video_provider(model.provider)
+        account = _pin_provider_account(req, model.provider)
+        provider = get_video_provider(model.provider, account=account)
 
         params: Dict[str, Any] = {}
         params.update(model.default_params or {})
-        params.update(req.generation_params or {})
+        params.update(blobs.restore(req.generation_params or {}))
 
         input_media: Optional[bytes] = None
         input_mime_type: Optional[str] = None
         last_frame_media: Optional[bytes] = None
         last_frame_mime: Optional[str] = None
 
-        source_media = req.source_media if isinstance(req.source_media, dict) else {}
+        source_media = blobs.restore(req.source_media) if isinstance(req.source_media, dict) else {}
         telegram_file_id = params.get("input_image_file_id") or source_media.get("telegram_file_id")
 
         media_to_video = generation_type in {"image2video", "video2video"}
         default_media_mime = "video/mp4" if generation_type == "video2video" else "image/png"
 
+        # Входной файл из WebApp: base64 в строке или storage_url (крупные файлы загружаются в Storage)
         inline_entry: Optional[Dict[str, Any]] = None
         if media_to_video:
-            for entry in req.input_images or []:
+            for entry in blobs.restore(req.input_images or []):
                 if not isinstance(entry, dict):
                     continue
                 raw_b64 = entry.get("content_base64") or entry.get("base64") or entry.get("data")
-                if raw_b64:
+                if raw_b64 or (entry.get("storage_url") and not entry.get("telegram_file_id")):
                     inline_entry = entry
                     break
 
         if media_to_video and inline_entry:
             raw_b64 = inline_entry.get("content_base64") or inline_entry.get("base64") or inline_entry.get("data")
             try:
-                input_media = base64.b64decode(raw_b64)
+                if raw_b64:
+                    input_media = base64.b64decode(raw_b64)
+                else:
+                    input_media = fetch_remote_file(inline_entry["storage_url"])
             except Exception as exc:
                 raise VideoGenerationError("Не удалось прочитать входные данные из WebApp.") from exc
             input_mime_type = (
@@ -996,7 +1392,21 @@ def generate_video_task(self, request_id: int):
             generate_kwargs["last_frame_media"] = last_frame_media
             generate_kwargs["last_frame_mime_type"] = last_frame_mime
 
-        result = provider.generate(**generate_kwargs)
+        heartbeats.checkpoint(req.id, heartbeats.STAGE_PROVIDER_CALL)
+        held_slot = None
+        try:
+            with _account_slot(model.provider, account) as slot, metrics.stage(model.provider, "submit"):
+                result = provider.generate(**generate_kwargs)
+                if result.content is None and result.provider_job_id:
+                    # Geminigen только принял задачу: слот занят до webhook или сверки
+                    held_slot = slot.hold(_geminigen_slot_ttl())
+        except Exception as provider_error:
+            report_account_error(account, provider_error)
+            raise
+        if account:
+            result.metadata = {**(result.metadata or {}), "account": account.to_metadata()}
+        if held_slot:
+            result.metadata = {**(result.metadata or {}), "slot": held_slot}
 
         if result.content is None:
             updates = []
@@ -1015,8 +1425,11 @@ def generate_video_task(self, request_id: int):
             )
             return
 
-        upload_result = supabase_upload_video(result.content, mime_type=result.mime_type)
+        with metrics.stage(model.provider, "upload"):
+            upload_result = supabase_upload_video(result.content, mime_type=result.mime_type)
         public_url = upload_result.get("public_url") if isinstance(upload_result, dict) else upload_result
+        with metrics.stage(model.provider, "derive"):
+            provider_metadata = _with_video_derivatives(result.content, result.metadata)
 
         GenerationService.complete_generation(
             req,
@@ -1026,7 +1439,7 @@ def generate_video_task(self, request_id: int):
             video_resolution=result.resolution,
             aspect_ratio=result.aspect_ratio,
             provider_job_id=result.provider_job_id,
-            provider_metadata=result.metadata,
+            provider_metadata=provider_metadata,
         )
 
         charged_amount, balance_after = _extract_charge_details(req)
@@ -1048,12 +1461,13 @@ def generate_video_task(self, request_id: int):
         allow_extension = bool(getattr(provider, "supports_extension", model.provider == "veo"))
 
         try:
-            send_telegram_video(
-                chat_id=req.chat_id,
-                video_bytes=result.content,
-                caption=message,
-                reply_markup=get_video_result_markup(req.id, include_extension=allow_extension),
-            )
+            with metrics.stage(model.provider, "deliver"):
+                send_telegram_video(
+                    chat_id=req.chat_id,
+                    video_bytes=result.content,
+                    caption=message,
+                    reply_markup=get_video_result_markup(req.id, include_extension=allow_extension),
+                )
         except httpx.HTTPStatusError as e:
             status = e.response.status_code if e.response else "unknown"
             body = e.response.text if e.response else str(e)
@@ -1082,7 +1496,15 @@ def generate_video_task(self, request_id: int):
             )
             raise e
 
+    except ProviderSlotUnavailable as exc:
+        logger.info("[VIDEO_TASK] %s request_id=%s", exc, request_id)
+        raise _retry_slot_wait(self, exc, req, "Ошибка генерации видео")
     except VideoGenerationError as e:
+        if req is None:
+            raise
+        countdown = _retry_countdown(self, e, req, "[VIDEO_TASK]")
+        if countdown is not None:
+            raise self.retry(exc=e, countdown=countdown, max_retries=self.request.retries + 1)
         GenerationService.fail_generation(req, str(e), refund=True)
         error_text = str(e)
         if len(error_text) > 3500:
@@ -1108,6 +1530,9 @@ def generate_video_task(self, request_id: int):
         return
     except Exception as e:
         if req:
+            countdown = _retry_countdown(self, e, req, "[VIDEO_TASK]")
+            if countdown is not None:
+                raise self.retry(exc=e, countdown=countdown, max_retries=self.request.retries + 1)
             GenerationService.fail_generation(req, str(e), refund=True)
             send_telegram_message(
                 req.chat_id,
@@ -1118,12 +1543,13 @@ def generate_video_task(self, request_id: int):
         raise
 
 
-@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, max_retries=3)
+@shared_task(bind=True, max_retries=None)
 def extend_video_task(self, request_id: int):
     """
     Продлить ранее сгенерированное видео на дополнительный сегмент.
     """
     req = GenRequest.objects.select_related('user', 'ai_model', 'transaction', 'parent_request').get(id=request_id)
+    tracing.annotate_request(req)
     parent = req.parent_request
     if not parent:
         raise VideoGenerationError("Не удалось определить исходный ролик для продления.")
@@ -1167,17 +1593,32 @@ def extend_video_task(self, request_id: int):
         if not part1_url:
             raise VideoGenerationError("Не найдена ссылка на исходное видео.")
 
-        part1_bytes = fetch_remote_file(part1_url)
-        frame_bytes = extract_last_frame(part1_bytes, parent.duration)
+        # Исходный ролик нужен только для склейки — качаем его параллельно с генерацией сегмента
+        downloader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="extend-download")
+        part1_future = downloader.submit(fetch_remote_file, part1_url)
+        downloader.shutdown(wait=False)
 
-        result = provider.generate(
-            prompt=prompt,
-            model_name=model.api_model_name,
-            generation_type=generation_type,
-            params=params,
-            input_media=frame_bytes,
-            input_mime_type="image/png",
-        )
+        parent_derivatives = (parent.provider_metadata or {}).get("derivatives") or {}
+        parent_duration = (parent_derivatives.get("probe") or {}).get("duration") or parent.duration
+        frame_bytes: Optional[bytes] = None
+        if parent_derivatives.get("last_frame_url"):
+            try:
+                frame_bytes = fetch_remote_file(parent_derivatives["last_frame_url"])
+            except Exception as exc:
+                logger.warning("[VIDEO_TASK] Сохранённый последний кадр недоступен, извлекаем заново: %s", exc)
+        if frame_bytes is None:
+            frame_bytes = extract_last_frame(part1_future.result(), parent.duration)
+
+        heartbeats.checkpoint(req.id, heartbeats.STAGE_PROVIDER_CALL)
+        with provider_slot(model.provider), metrics.stage(model.provider, "submit"):
+            result = provider.generate(
+                prompt=prompt,
+                model_name=model.api_model_name,
+                generation_type=generation_type,
+                params=params,
+                input_media=frame_bytes,
+                input_mime_type="image/png",
+            )
         if result.content is None:
             raise VideoGenerationError(
                 "Продление для Geminigen пока недоступно: провайдер вернул задачу без готового видео."
@@ -1185,16 +1626,16 @@ def extend_video_task(self, request_id: int):
         part2_bytes = result.content
 
         combined_bytes, combined_duration = combine_videos_with_crossfade(
-            part1_bytes,
+            part1_future.result(),
             part2_bytes,
-            parent.duration,
+            parent_duration,
             result.duration or params.get("duration"),
         )
 
         upload_result = supabase_upload_video(combined_bytes, mime_type="video/mp4")
         public_url = upload_result.get("public_url") if isinstance(upload_result, dict) else upload_result
 
-        provider_metadata = dict(result.metadata or {})
+        provider_metadata = _with_video_derivatives(combined_bytes, result.metadata)
         provider_metadata["extension"] = {
             "parent_request_id": parent.id,
             "segment_job_id": result.provider_job_id,
@@ -1238,7 +1679,13 @@ def extend_video_task(self, request_id: int):
             reply_markup=get_video_result_markup(req.id),
         )
 
+    except ProviderSlotUnavailable as exc:
+        logger.info("[VIDEO_TASK] %s request_id=%s", exc, request_id)
+        raise _retry_slot_wait(self, exc, req, "Ошибка продления видео")
     except VideoGenerationError as e:
+        countdown = _retry_countdown(self, e, req, "[VIDEO_TASK]")
+        if countdown is not None:
+            raise self.retry(exc=e, countdown=countdown, max_retries=self.request.retries + 1)
         GenerationService.fail_generation(req, str(e), refund=True)
         error_text = str(e)
         if len(error_text) > 3500:
@@ -1254,6 +1701,9 @@ def extend_video_task(self, request_id: int):
             pass
         raise
     except Exception as e:
+        countdown = _retry_countdown(self, e, req, "[VIDEO_TASK]")
+        if countdown is not None:
+            raise self.retry(exc=e, countdown=countdown, max_retries=self.request.retries + 1)
         GenerationService.fail_generation(req, str(e), refund=True)
         send_telegram_message(
             req.chat_id,
@@ -1289,6 +1739,7 @@ def process_geminigen_webhook(self, payload: Dict[str, Any]):
 
     try:
         req = GenRequest.objects.select_related('user', 'ai_model', 'transaction').get(provider_job_id=str(job_uuid))
+        tracing.annotate_request(req)
     except GenRequest.DoesNotExist:
         logger.warning("[GEMINIGEN_WEBHOOK] Запрос с uuid=%s не найден.", job_uuid)
         return
@@ -1315,6 +1766,7 @@ def process_geminigen_webhook(self, payload: Dict[str, Any]):
         return meta
 
     if normalized_event in success_events or normalized_status in {"2", "completed", "success"} or media_url:
+        _release_job_slot(req)
         if not media_url:
             GenerationService.fail_generation(
                 req,
@@ -1356,7 +1808,7 @@ def process_geminigen_webhook(self, payload: Dict[str, Any]):
             video_resolution=req.video_resolution,
             aspect_ratio=req.aspect_ratio,
             provider_job_id=str(job_uuid),
-            provider_metadata=_merge_metadata(),
+            provider_metadata=_with_video_derivatives(video_bytes, _merge_metadata()),
         )
 
         charged_amount, balance_after = _extract_charge_details(req)
@@ -1414,6 +1866,7 @@ def process_geminigen_webhook(self, payload: Dict[str, Any]):
         return
 
     if normalized_event in fail_events or normalized_status in {"3", "failed", "error"}:
+        _release_job_slot(req)
         GenerationService.fail_generation(req, error_message or "Geminigen сообщил об ошибке", refund=True)
         send_telegram_message(
             req.chat_id,
@@ -1425,6 +1878,312 @@ def process_geminigen_webhook(self, payload: Dict[str, Any]):
 
     logger.info("[GEMINIGEN_WEBHOOK] Событие проигнорировано: event=%s status=%s uuid=%s", event, status, job_uuid)
 
+
+@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, max_retries=3, ignore_result=True)
+def process_webhook_event_task(self, event_pk: int) -> None:
+    """Обработка сохранённого webhook-события (см. botapp/webhooks.py)."""
+    webhooks.process(event_pk)
+
+
+@shared_task(bind=True, max_retries=0, ignore_result=True)
+def drain_task_outbox_task(self) -> Dict[str, int]:
+    """Досылает в брокер задачи, сохранённые в TaskOutbox во время его недоступности."""
+    summary = dispatch.drain()
+    if summary["sent"]:
+        logger.info("[DISPATCH] Из outbox отправлено %s задач, осталось %s", summary["sent"], summary["pending"])
+    return summary
+
+
+@shared_task(bind=True, max_retries=0, ignore_result=True)
+def replay_webhook_events_task(self) -> int:
+    """Подхватывает webhook-события, задача обработки которых не была поставлена или потерялась."""
+    replayed = webhooks.replay_stale()
+    if replayed:
+        logger.warning("[WEBHOOKS] Повторно поставлено в очередь %s событий", replayed)
+    return replayed
+
+
+
+
+@shared_task(bind=True, max_retries=0, ignore_result=True)
+def reconcile_geminigen_jobs_task(self) -> Dict[str, Any]:
+    """
+    Периодическая сверка Geminigen-задач, по которым не пришёл webhook.
+
+    Берёт зависшие в processing запросы с provider_job_id, пачкой запрашивает статусы у Geminigen
+    и передаёт финальные статусы в process_geminigen_webhook (та же логика завершения и возврата средств).
+    Запросы старше GEMINIGEN_RECONCILE_MAX_AGE без финального статуса завершаются ошибкой с возвратом.
+    """
+    now = timezone.now()
+    stale_after = timedelta(seconds=settings.GEMINIGEN_RECONCILE_STALE_AFTER)
+    max_age = timedelta(seconds=settings.GEMINIGEN_RECONCILE_MAX_AGE)
+    cutoff = now - stale_after
+
+    stale_requests = list(
+        GenRequest.objects.select_related("ai_model")
+        .filter(status="processing", ai_model__provider__in=GEMINIGEN_VIDEO_PROVIDERS)
+        .exclude(provider_job_id="")
+        .filter(Q(started_at__lte=cutoff) | Q(started_at__isnull=True, created_at__lte=cutoff))
+        .order_by("created_at")[: settings.GEMINIGEN_RECONCILE_BATCH_SIZE]
+    )
+    summary: Dict[str, Any] = {
+        "checked": len(stale_requests),
+        "completed": 0,
+        "failed": 0,
+        "expired": 0,
+        "pending": 0,
+        "max_lag_seconds": 0.0,
+        "avg_lag_seconds": 0.0,
+    }
+    if not stale_requests:
+        return summary
+
+    lags = [(now - (req.started_at or req.created_at)).total_seconds() for req in stale_requests]
+    summary["max_lag_seconds"] = round(max(lags), 1)
+    summary["avg_lag_seconds"] = round(sum(lags) / len(lags), 1)
+
+    try:
+        # История задач Geminigen общая для Veo и Sora — статусы по uuid отдаёт один endpoint
+        provider = get_video_provider("veo")
+        statuses = provider.fetch_job_statuses(req.provider_job_id for req in stale_requests)
+    except VideoGenerationError as exc:
+        logger.warning("[GEMINIGEN_RECONCILE] Сверка пропущена: %s", exc)
+        return summary
+
+    for req, lag in zip(stale_requests, lags):
+        job_status = statuses.get(req.provider_job_id) or {}
+        state = job_status.get("status")
+        meta = dict(req.provider_metadata or {})
+        reconcile_meta = dict(meta.get("reconcile") or {})
+        reconcile_meta["attempts"] = int(reconcile_meta.get("attempts") or 0) + 1
+        reconcile_meta["last_checked_at"] = now.isoformat()
+        reconcile_meta["last_status"] = state
+
+        if state in {"completed", "failed"}:
+            dispatched_at = parse_datetime(reconcile_meta.get("dispatched_at") or "")
+            if dispatched_at and now - dispatched_at < stale_after:
+                # Финализация уже поставлена в очередь, ждём её выполнения
+                summary["pending"] += 1
+                continue
+            reconcile_meta["dispatched_at"] = now.isoformat()
+            meta["reconcile"] = reconcile_meta
+            GenRequest.objects.filter(pk=req.pk).update(provider_metadata=meta)
+            process_geminigen_webhook.delay(
+                {
+                    "event": "",
+                    "source": "reconcile",
+                    "data": {
+                        "uuid": req.provider_job_id,
+                        "status": state,
+                        "media_url": job_status.get("media_url"),
+                        "thumbnail_url": job_status.get("thumbnail_url"),
+                        "error_message": job_status.get("error_message"),
+                    },
+                }
+            )
+            summary[state] += 1
+            continue
+
+        if lag >= max_age.total_seconds():
+            _release_job_slot(req)
+            meta["reconcile"] = reconcile_meta
+            req.provider_metadata = meta
+            GenerationService.fail_generation(
+                req,
+                "Geminigen не прислал результат вовремя (webhook не получен).",
+                refund=True,
+            )
+            summary["expired"] += 1
+            try:
+                send_telegram_message(
+                    req.chat_id,
+                    "❌ Генерация видео не завершилась вовремя. Токены возвращены на баланс.",
+                    reply_markup=get_inline_menu_markup(),
+                    parse_mode=None,
+                )
+            except Exception as exc:  # pragma: no cover - уведомление не критично
+                logger.warning("[GEMINIGEN_RECONCILE] Не удалось уведомить пользователя %s: %s", req.chat_id, exc)
+            continue
+
+        meta["reconcile"] = reconcile_meta
+        GenRequest.objects.filter(pk=req.pk).update(provider_metadata=meta)
+        summary["pending"] += 1
+
+    logger.info(
+        "[GEMINIGEN_RECONCILE] checked=%s completed=%s failed=%s expired=%s pending=%s max_lag=%.0fs avg_lag=%.0fs",
+        summary["checked"],
+        summary["completed"],
+        summary["failed"],
+        summary["expired"],
+        summary["pending"],
+        summary["max_lag_seconds"],
+        summary["avg_lag_seconds"],
+    )
+    return summary
+
+
+@shared_task(bind=True, max_retries=0, ignore_result=True)
+def refresh_analytics_rollups_task(self) -> Dict[str, int]:
+    """Инкрементально обновляет часовые и суточные агрегаты аналитики."""
+    summary = RollupService.refresh()
+    logger.info("[ANALYTICS_ROLLUP] %s", summary)
+    return summary
+
+
+@shared_task(bind=True, max_retries=0, ignore_result=True)
+def ingest_product_events_task(self) -> int:
+    """Переносит продуктовые события из Redis stream в таблицу ProductEvent."""
+    try:
+        total = events.ingest()
+    except RedisError as exc:
+        logger.warning("[EVENTS] Redis недоступен, загрузка событий пропущена: %s", exc)
+        return 0
+    if total:
+        logger.info("[EVENTS] Сохранено %s событий", total)
+    return total
+
+
+@shared_task(bind=True, max_retries=0, ignore_result=True)
+def maintain_product_event_partitions_task(self) -> List[str]:
+    """Заранее создаёт месячные секции таблицы ProductEvent."""
+    created = events.ensure_partitions()
+    if created:
+        logger.info("[EVENTS] Созданы секции: %s", ", ".join(created))
+    return created
+
+
+@shared_task(bind=True, max_retries=0, ignore_result=True)
+def apply_retention_policies_task(self) -> Dict[str, int]:
+    """Пачками удаляет/архивирует устаревшие строки по политикам хранения."""
+    summary = RetentionService.run_all()
+    logger.info("[RETENTION] %s", summary)
+    return summary
+
+
+@shared_task(bind=True, max_retries=0, ignore_result=True)
+def sync_promocode_stats_task(self) -> Dict[str, int]:
+    """Переносит число активаций промокодов в счётчики Promocode и сверяет с ними счётчики Redis."""
+    summary = PromocodeService.sync_stats()
+    if summary["updated"]:
+        logger.info("[PROMOCODE] Обновлена статистика %s промокодов", summary["updated"])
+    try:
+        summary.update(PromocodeService.resync_redis_counters())
+    except RedisError as exc:
+        logger.warning("[PROMOCODE] Сверка счётчиков Redis пропущена: %s", exc)
+    else:
+        if summary["resynced"]:
+            logger.info("[PROMOCODE] Счётчики Redis подтянуты к БД для %s промокодов", summary["resynced"])
+    return summary
+
+
+@shared_task(bind=True, max_retries=0, ignore_result=True)
+def refresh_lava_catalog_task(self) -> Optional[int]:
+    """Обновляет общий кеш каталога Lava.top (индекс офферов для create_payment)."""
+    from lavatop.provider import get_provider
+
+    return get_provider().refresh_catalog()
+
+
+def _requeue_generation(req: GenRequest) -> None:
+    """Повторно ставит задачу генерации в очередь."""
+    if req.generation_type in {"text2image", "image2image"}:
+        generate_image_task.delay(req.id)
+    elif req.parent_request_id:
+        extend_video_task.delay(req.id)
+    else:
+        generate_video_task.delay(req.id)
+
+
+@shared_task(bind=True, max_retries=0, ignore_result=True)
+def reap_stuck_requests_task(self) -> Dict[str, int]:
+    """
+    Находит запросы в processing, у которых истёк heartbeat (воркер упал или был перезапущен).
+
+    По последнему чекпоинту: результат уже доставлен — закрываем как done; иначе перезапускаем
+    задачу (не более GENERATION_REAPER_MAX_REQUEUES раз), после чего завершаем ошибкой с возвратом.
+    Запросы с provider_job_id уже приняты провайдером и ждут webhook (Geminigen Veo и Sora) — heartbeat
+    у них нет, а перезапуск отправил бы и оплатил задачу у провайдера повторно. Их сверяет
+    reconcile_geminigen_jobs_task.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.GENERATION_REAPER_GRACE)
+    candidates = list(
+        GenRequest.objects.select_related("user", "ai_model", "transaction")
+        .filter(status="processing")
+        .filter(Q(started_at__lte=cutoff) | Q(started_at__isnull=True, created_at__lte=cutoff))
+        .filter(provider_job_id="")
+        .order_by("created_at")[: settings.GENERATION_REAPER_BATCH_SIZE]
+    )
+    summary = {"checked": len(candidates), "alive": 0, "completed": 0, "requeued": 0, "failed": 0}
+    if not candidates:
+        return summary
+
+    liveness = heartbeats.alive(req.id for req in candidates)
+    for req in candidates:
+        if liveness.get(req.id):
+            summary["alive"] += 1
+            continue
+
+        # Перечитываем под блокировкой: запрос мог завершиться, пока мы проверяли heartbeat
+        with transaction.atomic():
+            req = GenRequest.objects.select_for_update().select_related("user", "ai_model", "transaction").get(pk=req.pk)
+            if req.status != "processing":
+                continue
+            state = heartbeats.get_checkpoint(req.id)
+            stage = state.get("stage") or heartbeats.STAGE_STARTED
+            meta = dict(req.provider_metadata or {})
+            reaper_meta = dict(meta.get("reaper") or {})
+            requeues = int(reaper_meta.get("requeues") or 0)
+
+            if stage == heartbeats.STAGE_DELIVERED:
+                req.status = "done"
+                if state.get("result_urls") and not req.result_urls:
+                    req.result_urls = state["result_urls"]
+                req.completed_at = timezone.now()
+                req.save(update_fields=["status", "result_urls", "completed_at"])
+                action = "completed"
+            elif requeues < settings.GENERATION_REAPER_MAX_REQUEUES:
+                reaper_meta.update(requeues=requeues + 1, last_stage=stage, requeued_at=timezone.now().isoformat())
+                meta["reaper"] = reaper_meta
+                req.status = "queued"
+                req.provider_metadata = meta
+                req.save(update_fields=["status", "provider_metadata"])
+                transaction.on_commit(lambda req=req: _requeue_generation(req))
+                action = "requeued"
+            else:
+                action = "failed"
+
+        logger.warning(
+            "[REAPER] Запрос %s без heartbeat: stage=%s requeues=%s → %s", req.id, stage, requeues, action
+        )
+        if action == "failed":
+            GenerationService.fail_generation(
+                req,
+                f"Задача генерации прервалась (этап {stage}) и не восстановилась после перезапуска.",
+                refund=True,
+            )
+            heartbeats.clear(req.id)
+            try:
+                send_telegram_message(
+                    req.chat_id,
+                    "❌ Генерация прервалась из-за сбоя сервера. Токены возвращены на баланс.",
+                    reply_markup=get_inline_menu_markup(),
+                    parse_mode=None,
+                )
+            except Exception as exc:  # pragma: no cover - уведомление не критично
+                logger.warning("[REAPER] Не удалось уведомить пользователя %s: %s", req.chat_id, exc)
+        summary[action] += 1
+
+    logger.info(
+        "[REAPER] checked=%s alive=%s completed=%s requeued=%s failed=%s",
+        summary["checked"],
+        summary["alive"],
+        summary["completed"],
+        summary["requeued"],
+        summary["failed"],
+    )
+    return summary
+
+
 @shared_task(bind=True, max_retries=1)
 def process_payment_webhook(self, payment_data: Dict):
     """
@@ -1502,7 +2261,7 @@ def process_webapp_submission_task(self, user_id: int, data: Dict[str, Any]) ->
 
     try:
         close_old_connections()
-        return process_webapp_submission(user_id, data)
+        return process_webapp_submission(user_id, blobs.restore(data))
     except Exception as exc:
         logger.exception(
             "Ошибка обработки WebApp submission: user_id=%s, kind=%s",
@@ -1518,3 +2277,6 @@ def process_webapp_submission_task(self, user_id: int, data: Dict[str, Any]) ->
             exc=exc,
         )
         return None
+    finally:
+        # Входные файлы уже сохранены в GenRequest (в строке или в Storage), ссылки payload нужны были только брокеру
+        blobs.discard(data)
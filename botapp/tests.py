@@ -1,32 +1,69 @@
 import asyncio
+import csv
+import contextvars
+import io
 import json
 import base64
+import gzip
 import os
+import shutil
+import subprocess
+import tempfile
+import time
 import unittest
 from unittest import skip
+from datetime import timedelta
 from decimal import Decimal
 from io import BytesIO
-from unittest.mock import MagicMock, patch
+from unittest.mock import ANY, MagicMock, patch
 
+from asgiref.sync import async_to_sync
+from celery.exceptions import Retry
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
+import httpx
 from PIL import Image
 from aiogram.types import Message
+from redis.exceptions import RedisError
 
-from botapp.business.balance import BalanceService, InsufficientBalanceError
+from botapp import blobs, derivatives, dispatch, events, image_optimizer, media_cache, media_pool, metrics, profiling, tracing, webhooks
+from botapp.business.analytics import AnalyticsService
+from botapp.business.balance import BalanceService, DailyLimitExceededError, InsufficientBalanceError
+from botapp.business.export import parse_moment
 from botapp.business.generation import GenerationService
+from botapp.business.pricing import usd_to_tokens
+from botapp.business.promocodes import PromocodeService, RedemptionStatus
+from botapp.business.retention import RetentionError, RetentionService, get_policy
+from botapp.business.rollups import RollupService
 from botapp.chat_logger import ChatLogger
+from botapp.error_tracker import ErrorTracker
+from botapp.errors import ErrorKind, ProviderAccountError, classify_error, get_retry_countdown
 from botapp.models import (
     AIModel,
+    BotErrorEvent,
+    GenerationRollup,
+    GenRequest,
     PricingSettings,
+    ProductEvent,
+    ProfileReport,
+    Promocode,
+    RollupGranularity,
     TgUser,
     Transaction,
+    TransactionRollup,
     UserBalance,
+    TaskOutbox,
+    UserSettings,
+    WebhookEvent,
     ChatThread,
     ChatMessage,
 )
+from botapp.providers.accounts import get_account_pool, resolve_account, select_account
+from botapp.providers.limits import ProviderSlotUnavailable, provider_slot, release_held_slot
 from botapp.providers.video.base import VideoGenerationError
 from botapp.providers.video.openai_sora import (
     OpenAISoraProvider,
@@ -34,6 +71,16 @@ from botapp.providers.video.openai_sora import (
     resolve_sora_size,
 )
 from botapp.media_utils import detect_reference_mime
+from botapp.tasks import (
+    _ffmpeg_bin,
+    _retry_slot_wait,
+    _with_video_derivatives,
+    generate_video_task,
+    process_geminigen_webhook,
+    reap_stuck_requests_task,
+    reconcile_geminigen_jobs_task,
+    render_video_derivatives,
+)
 from botapp.services import (
     openai_generate_images,
     gemini_generate_images,
@@ -41,7 +88,10 @@ from botapp.services import (
     gemini_vertex_edit,
     generate_images_for_model,
     OPENAI_IMAGE_EDIT_URL,
+    GeminiBlockedError,
 )
+from lavatop.provider import CATALOG_CACHE_KEY, LavaProvider
+from lavatop.webhook import handle_payment_event
 
 SKIP_VERTEX_TESTS = bool(os.getenv("CI") or os.getenv("DISABLE_VERTEX_TESTS"))
 
@@ -140,6 +190,60 @@ class BalanceServiceTests(TestCase):
         with self.assertRaises(InsufficientBalanceError):
             BalanceService.charge_for_generation(self.user, expensive_model)
 
+    def test_charge_is_conditional_update_with_balance_after(self):
+        BalanceService.add_deposit(self.user, amount=Decimal("10.00"), payment_method="test")
+
+        tx = BalanceService.charge_for_generation(self.user, self.model, quantity=2)
+
+        self.assertEqual(tx.amount, Decimal("-5.00"))
+        self.assertEqual(tx.balance_after, Decimal("5.00"))
+        balance = UserBalance.objects.get(user=self.user)
+        self.assertEqual(balance.balance, Decimal("5.00"))
+        self.assertEqual(balance.total_spent, Decimal("5.00"))
+
+        with self.assertRaises(InsufficientBalanceError):
+            BalanceService.charge_for_generation(self.user, self.model, quantity=4)
+        self.assertEqual(UserBalance.objects.get(user=self.user).balance, Decimal("5.00"))
+
+    def test_daily_limit_reserved_through_redis_counter(self):
+        BalanceService.add_deposit(self.user, amount=Decimal("10.00"), payment_method="test")
+        AIModel.objects.filter(pk=self.model.pk).update(daily_limit=1)
+        self.model.refresh_from_db()
+        redis_client = MagicMock()
+        redis_client.pipeline.return_value.execute.side_effect = [[1, True], [2, True]]
+
+        with patch("botapp.business.balance.get_redis", return_value=redis_client):
+            BalanceService.charge_for_generation(self.user, self.model)
+            with self.assertRaises(DailyLimitExceededError):
+                BalanceService.charge_for_generation(self.user, self.model)
+
+        key = redis_client.pipeline.return_value.incr.call_args.args[0]
+        self.assertTrue(key.startswith(f"daily_limit:{self.user.pk}:{self.model.pk}:"))
+        redis_client.eval.assert_called_once_with(ANY, 1, key)
+        self.assertEqual(UserBalance.objects.get(user=self.user).balance, Decimal("7.50"))
+
+    def test_daily_slot_released_on_failed_charge_and_on_refund(self):
+        BalanceService.add_deposit(self.user, amount=Decimal("10.00"), payment_method="test")
+        AIModel.objects.filter(pk=self.model.pk).update(daily_limit=5)
+        self.model.refresh_from_db()
+        redis_client = MagicMock()
+        redis_client.pipeline.return_value.execute.return_value = [1, True]
+
+        with patch("botapp.business.balance.get_redis", return_value=redis_client):
+            with patch("botapp.business.balance.Transaction.objects.create", side_effect=RuntimeError("db down")):
+                with self.assertRaises(RuntimeError):
+                    BalanceService.charge_for_generation(self.user, self.model)
+            self.assertEqual(redis_client.eval.call_count, 1)
+            self.assertEqual(UserBalance.objects.get(user=self.user).balance, Decimal("10.00"))
+
+            charge_tx = BalanceService.charge_for_generation(self.user, self.model)
+            with self.captureOnCommitCallbacks(execute=True):
+                BalanceService.refund_generation(self.user, charge_tx, reason="API error", ai_model=self.model)
+
+        key = redis_client.pipeline.return_value.incr.call_args.args[0]
+        self.assertEqual(redis_client.eval.call_args_list[-1].args[1:], (1, key))
+        self.assertEqual(redis_client.eval.call_count, 2)
+
     @skip("Outdated: welcome bonus logic changed")
     def test_complete_deposit_triggers_first_bonus(self):
         tx = BalanceService.create_transaction(
@@ -246,6 +350,1451 @@ class GenerationServiceTests(TestCase):
         self.assertEqual(req.cost, Decimal("19.00"))
         self.assertIsNotNone(req.transaction)
 
+    @override_settings(WEBAPP_BLOB_INLINE_LIMIT=16)
+    @patch("botapp.business.generation.supabase_upload_input", return_value="https://cdn/inputs/a.png")
+    @patch("botapp.blobs.get_redis")
+    def test_large_inputs_are_moved_to_storage_not_redis(self, mock_get_redis, mock_upload):
+        BalanceService.add_deposit(self.user, amount=Decimal("50.00"), payment_method="test")
+        image = {"content_base64": base64.b64encode(b"x" * 90).decode(), "mime_type": "image/png", "role": "start"}
+        req = GenerationService.create_generation_request(
+            user=self.user,
+            ai_model=self.video_model,
+            prompt="Stored inputs",
+            generation_type="image2video",
+            input_images=[image],
+            source_media=image,
+        )
+
+        req.refresh_from_db()
+        stored = {"mime_type": "image/png", "role": "start", "storage_url": "https://cdn/inputs/a.png"}
+        self.assertEqual(req.input_images, [stored])
+        self.assertEqual(req.source_media, stored)
+        mock_upload.assert_called_once_with(b"x" * 90, "image/png")
+        mock_get_redis.assert_not_called()
+
+    def test_statistics_updated_with_atomic_counters(self):
+        BalanceService.add_deposit(self.user, amount=Decimal("50.00"), payment_method="test")
+        UserSettings.objects.create(user=self.user, experience_points=95)
+        AIModel.objects.filter(pk=self.video_model.pk).update(total_generations=1, average_generation_time=10.0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            req = GenerationService.create_generation_request(
+                user=self.user,
+                ai_model=self.video_model,
+                prompt="Counter prompt",
+                generation_type="text2video",
+            )
+
+        req.started_at = timezone.now() - timedelta(seconds=30)
+        GenerationService.complete_generation(req, result_urls=["https://example.com/video.mp4"])
+
+        self.video_model.refresh_from_db()
+        self.assertEqual(self.video_model.total_generations, 2)
+        self.assertAlmostEqual(self.video_model.average_generation_time, 20.0, delta=1.0)
+        stats = UserSettings.objects.get(user=self.user)
+        self.assertEqual(stats.total_generations, 1)
+        self.assertEqual(stats.total_videos_generated, 1)
+        self.assertEqual(stats.experience_points, 105)
+        self.assertEqual(stats.user_level, 1)
+
+
+@override_settings(
+    GEMINIGEN_RECONCILE_STALE_AFTER=900,
+    GEMINIGEN_RECONCILE_MAX_AGE=3 * 60 * 60,
+    GEMINIGEN_RECONCILE_BATCH_SIZE=50,
+)
+class GeminigenReconcileTests(TestCase):
+    def setUp(self):
+        self.user = TgUser.objects.create(chat_id=770001, username="reconcile")
+        self.video_model = AIModel.objects.create(
+            slug="veo-reconcile-test",
+            name="Veo 3.1 Fast",
+            display_name="Veo 3.1 Fast",
+            type="video",
+            provider="veo",
+            description="",
+            short_description="",
+            price=Decimal("19.00"),
+            unit_cost_usd=_cost_from_price(Decimal("19.00")),
+            base_cost_usd=_cost_from_price(Decimal("19.00")),
+            cost_unit=AIModel.CostUnit.GENERATION,
+            api_endpoint="",
+            api_model_name="veo-3.1-fast",
+            max_prompt_length=1000,
+            default_params={"duration": 8, "resolution": "720p", "aspect_ratio": "9:16"},
+            allowed_params={},
+        )
+        BalanceService.add_deposit(self.user, amount=Decimal("50.00"), payment_method="test")
+
+    def _make_processing_request(self, job_id: str, age_seconds: int) -> GenRequest:
+        req = GenerationService.create_generation_request(
+            user=self.user,
+            ai_model=self.video_model,
+            prompt="Reconcile prompt",
+            generation_type="text2video",
+            generation_params={"duration": 8, "resolution": "720p", "aspect_ratio": "9:16"},
+        )
+        GenRequest.objects.filter(pk=req.pk).update(
+            status="processing",
+            provider_job_id=job_id,
+            started_at=timezone.now() - timedelta(seconds=age_seconds),
+        )
+        req.refresh_from_db()
+        return req
+
+    @patch("botapp.tasks.process_geminigen_webhook.delay")
+    @patch("botapp.tasks.get_video_provider")
+    def test_completed_job_is_dispatched_to_webhook_handler(self, mock_get_provider, mock_delay):
+        req = self._make_processing_request("job-done", age_seconds=1800)
+        self._make_processing_request("job-fresh", age_seconds=60)
+        provider = MagicMock()
+        provider.fetch_job_statuses.return_value = {
+            "job-done": {"status": "completed", "media_url": "https://cdn.example/video.mp4"},
+        }
+        mock_get_provider.return_value = provider
+
+        summary = reconcile_geminigen_jobs_task.apply().get()
+
+        self.assertEqual(summary["checked"], 1)
+        self.assertEqual(summary["completed"], 1)
+        self.assertEqual(list(provider.fetch_job_statuses.call_args.args[0]), ["job-done"])
+        payload = mock_delay.call_args.args[0]
+        self.assertEqual(payload["data"]["uuid"], "job-done")
+        self.assertEqual(payload["data"]["media_url"], "https://cdn.example/video.mp4")
+        req.refresh_from_db()
+        self.assertIn("dispatched_at", req.provider_metadata["reconcile"])
+
+        # Повторный прогон не ставит финализацию в очередь второй раз
+        reconcile_geminigen_jobs_task.apply().get()
+        self.assertEqual(mock_delay.call_count, 1)
+
+    @patch("botapp.tasks.process_geminigen_webhook.delay")
+    @patch("botapp.tasks.get_video_provider")
+    def test_geminigen_sora_jobs_are_reconciled_too(self, mock_get_provider, mock_delay):
+        self.video_model.provider = "openai"
+        self.video_model.save(update_fields=["provider"])
+        self._make_processing_request("sora-job", age_seconds=1800)
+        provider = MagicMock()
+        provider.fetch_job_statuses.return_value = {"sora-job": {"status": "failed", "error_message": "nsfw"}}
+        mock_get_provider.return_value = provider
+
+        summary = reconcile_geminigen_jobs_task.apply().get()
+
+        self.assertEqual(summary["failed"], 1)
+        self.assertEqual(mock_delay.call_args.args[0]["data"]["uuid"], "sora-job")
+
+    @patch("botapp.providers.limits.get_redis")
+    @patch("botapp.tasks.send_telegram_message")
+    def test_failed_webhook_releases_held_provider_slot(self, _mock_send, mock_get_redis):
+        req = self._make_processing_request("job-held", age_seconds=60)
+        slot = {"provider": "veo", "account": "default", "token": "t-held"}
+        GenRequest.objects.filter(pk=req.pk).update(provider_metadata={"slot": slot})
+
+        process_geminigen_webhook.apply(args=[{"data": {"uuid": "job-held", "status": "failed"}}]).get()
+
+        mock_get_redis.return_value.zrem.assert_called_once_with("provider-limits:slots:veo:default", "t-held")
+        req.refresh_from_db()
+        self.assertEqual(req.status, "error")
+
+    @patch("botapp.tasks.send_telegram_message")
+    @patch("botapp.tasks.get_video_provider")
+    def test_expired_job_is_failed_and_refunded(self, mock_get_provider, _mock_send):
+        req = self._make_processing_request("job-lost", age_seconds=4 * 60 * 60)
+        provider = MagicMock()
+        provider.fetch_job_statuses.return_value = {}
+        mock_get_provider.return_value = provider
+
+        summary = reconcile_geminigen_jobs_task.apply().get()
+
+        self.assertEqual(summary["expired"], 1)
+        req.refresh_from_db()
+        self.assertEqual(req.status, "error")
+        self.assertEqual(BalanceService.get_balance(self.user), Decimal("50.00"))
+
+
+@override_settings(
+    PROVIDER_CONCURRENCY_LIMITS={"kling": 2},
+    PROVIDER_RATE_LIMITS_RPM={},
+    PROVIDER_SLOT_WAIT_SECONDS=0,
+    PROVIDER_SLOT_TTL=60,
+    PROVIDER_SLOT_POLL_INTERVAL=0,
+    PROVIDER_SLOT_RETRY_DELAY=15,
+)
+class ProviderLimitsTests(TestCase):
+    @patch("botapp.providers.limits.get_redis")
+    def test_slot_is_released_after_call(self, mock_get_redis):
+        redis_client = MagicMock()
+        redis_client.eval.return_value = 1
+        mock_get_redis.return_value = redis_client
+
+        with provider_slot("kling"):
+            pass
+
+        self.assertEqual(redis_client.eval.call_args.args[2], "provider-limits:slots:kling:default")
+        redis_client.zrem.assert_called_once()
+
+    @patch("botapp.providers.limits.get_redis")
+    def test_held_slot_survives_exit_until_released(self, mock_get_redis):
+        redis_client = MagicMock()
+        redis_client.eval.return_value = 1
+        mock_get_redis.return_value = redis_client
+
+        with provider_slot("kling") as slot:
+            held = slot.hold(600)
+
+        redis_client.zrem.assert_not_called()
+        self.assertEqual(redis_client.zadd.call_args.kwargs, {"xx": True})
+        release_held_slot(held)
+        redis_client.zrem.assert_called_once_with("provider-limits:slots:kling:default", held["token"])
+
+    @patch("botapp.providers.limits.get_redis")
+    def test_busy_provider_raises_slot_unavailable(self, mock_get_redis):
+        redis_client = MagicMock()
+        redis_client.eval.return_value = 0
+        mock_get_redis.return_value = redis_client
+
+        with self.assertRaises(ProviderSlotUnavailable) as ctx:
+            with provider_slot("kling"):
+                self.fail("Слот не должен быть выдан")
+
+        self.assertEqual(ctx.exception.retry_after, 15)
+        redis_client.zrem.assert_not_called()
+
+    @patch("botapp.providers.limits.get_redis")
+    def test_unlimited_provider_and_redis_outage_do_not_block(self, mock_get_redis):
+        with provider_slot("gemini"):
+            pass
+        mock_get_redis.assert_not_called()
+
+        mock_get_redis.return_value.eval.side_effect = RedisError("down")
+        with provider_slot("kling"):
+            pass
+
+
+@override_settings(
+    USEAPI_KLING_ACCOUNTS=json.dumps(
+        [
+            {"name": "kling-a", "api_key": "key-a", "email": "a@example.com", "max_jobs": 2},
+            {"name": "kling-b", "api_key": "key-b", "email": "b@example.com", "max_jobs": 4},
+        ]
+    ),
+    GEMINI_API_KEYS="",
+    GEMINI_API_KEY="legacy-gemini",
+    PROVIDER_CONCURRENCY_LIMITS={},
+)
+class ProviderAccountPoolTests(TestCase):
+    def test_pool_from_json_and_legacy_fallback(self):
+        kling_pool = get_account_pool("kling")
+        self.assertEqual([account.name for account in kling_pool], ["kling-a", "kling-b"])
+        self.assertEqual(kling_pool[1].max_jobs, 4)
+
+        gemini_pool = get_account_pool("gemini")
+        self.assertEqual(len(gemini_pool), 1)
+        self.assertEqual(gemini_pool[0].name, "default")
+        self.assertEqual(gemini_pool[0].api_key, "legacy-gemini")
+
+    @patch("botapp.providers.accounts.get_active_slots")
+    @patch("botapp.providers.accounts.get_redis")
+    def test_select_least_loaded_healthy_account(self, mock_get_redis, mock_active):
+        mock_get_redis.return_value.mget.return_value = [None, None]
+        mock_active.side_effect = lambda pool, name: {"kling-a": 1, "kling-b": 1}[name]
+        # kling-a занят на 50%, kling-b — на 25%
+        self.assertEqual(select_account("kling").name, "kling-b")
+
+        mock_get_redis.return_value.mget.return_value = [None, b"HTTP 429"]
+        self.assertEqual(select_account("kling").name, "kling-a")
+
+    @patch("botapp.providers.accounts.select_account")
+    def test_pinned_account_is_reused(self, mock_select):
+        account = resolve_account("kling", {"account": {"pool": "kling", "name": "kling-a"}})
+        self.assertEqual(account.api_key, "key-a")
+        mock_select.assert_not_called()
+
+
+@override_settings(
+    GENERATION_RETRY_TRANSIENT_MAX=3,
+    GENERATION_RETRY_RATE_LIMITED_MAX=5,
+    GENERATION_RETRY_BACKOFF_BASE=10,
+    GENERATION_RETRY_BACKOFF_MAX=600,
+    PROVIDER_CONCURRENCY_LIMITS={},
+    PROVIDER_RATE_LIMITS_RPM={},
+)
+class GenerationRetryPolicyTests(TestCase):
+    @staticmethod
+    def _http_error(status: int, headers=None) -> httpx.HTTPStatusError:
+        request = httpx.Request("POST", "https://provider.example/api")
+        response = httpx.Response(status, headers=headers or {}, request=request)
+        return httpx.HTTPStatusError(f"HTTP {status}", request=request, response=response)
+
+    def test_rate_limit_honours_retry_after_through_wrapped_error(self):
+        try:
+            try:
+                raise self._http_error(429, {"Retry-After": "42"})
+            except httpx.HTTPStatusError as exc:
+                raise ValueError("Сервис Midjourney вернул ошибку") from exc
+        except ValueError as wrapped:
+            classification = classify_error(wrapped)
+
+        self.assertEqual(classification.kind, ErrorKind.RATE_LIMITED)
+        self.assertEqual(get_retry_countdown(classification, retries=0), 42)
+        self.assertIsNone(get_retry_countdown(classification, retries=5))
+
+    def test_permanent_and_user_errors_are_not_retried(self):
+        cases = {
+            ValueError("model_name обязателен"): ErrorKind.PERMANENT,
+            VideoGenerationError("Kling task failed: moderation"): ErrorKind.PERMANENT,
+            GeminiBlockedError("Запрос заблокирован"): ErrorKind.USER_ERROR,
+            self._http_error(401): ErrorKind.PERMANENT,
+        }
+        for exc, kind in cases.items():
+            classification = classify_error(exc)
+            self.assertEqual(classification.kind, kind, exc)
+            self.assertIsNone(get_retry_countdown(classification, retries=0))
+
+        transient = classify_error(httpx.ConnectError("connection refused"))
+        self.assertEqual(transient.kind, ErrorKind.TRANSIENT)
+        self.assertGreaterEqual(get_retry_countdown(transient, retries=1), 20)
+
+    def test_exhausted_quota_is_provider_account_error(self):
+        request = httpx.Request("POST", "https://provider.example/api")
+        response = httpx.Response(
+            429, json={"error": {"code": "insufficient_quota", "message": "You exceeded your current quota"}},
+            request=request,
+        )
+        cases = [
+            httpx.HTTPStatusError("HTTP 429", request=request, response=response),
+            self._http_error(402),
+            ProviderAccountError("Geminigen: на аккаунте закончились кредиты"),
+            RuntimeError("Квота аккаунта исчерпана"),
+        ]
+        for exc in cases:
+            classification = classify_error(exc)
+            self.assertEqual(classification.kind, ErrorKind.PROVIDER_ACCOUNT, exc)
+            self.assertIsNone(get_retry_countdown(classification, retries=0))
+        self.assertEqual(classify_error(self._http_error(429)).kind, ErrorKind.RATE_LIMITED)
+
+    def test_slot_wait_uses_own_counter_not_task_retries(self):
+        task = MagicMock()
+        task.name = "botapp.tasks.generate_image_task"
+        task.request.called_directly = False
+        task.request.is_eager = False
+        task.request.retries = 2
+        task.request.headers = {"slot_waits": 4}
+        exc = ProviderSlotUnavailable("gemini", "default", 15)
+
+        req = MagicMock(id=17, chat_id=770017)
+
+        retry = _retry_slot_wait(task, exc, req, "Ошибка генерации изображения")
+
+        self.assertIsInstance(retry, Retry)
+        _, options = task.signature_from_request.call_args
+        self.assertEqual(options["retries"], 2)
+        self.assertEqual(options["headers"], {"slot_waits": 5})
+        self.assertEqual(options["countdown"], 15)
+        task.signature_from_request.return_value.apply_async.assert_called_once()
+
+        task.request.headers = {"slot_waits": settings.PROVIDER_SLOT_MAX_RETRIES}
+        with patch("botapp.tasks.GenerationService.fail_generation") as fail, \
+                patch("botapp.tasks.send_telegram_message") as notify:
+            self.assertIs(_retry_slot_wait(task, exc, req, "Ошибка генерации изображения"), exc)
+
+        fail.assert_called_once_with(req, str(exc), refund=True)
+        self.assertEqual(notify.call_args.args[0], 770017)
+
+    @patch("botapp.tasks.generate_video_task.retry", side_effect=RuntimeError("retry scheduled"))
+    @patch("botapp.tasks.get_video_provider")
+    def test_transient_video_error_is_retried_without_refund(self, mock_get_provider, mock_retry):
+        user = TgUser.objects.create(chat_id=770002, username="retry")
+        model = AIModel.objects.create(
+            slug="veo-retry-test",
+            name="Veo Retry",
+            display_name="Veo Retry",
+            type="video",
+            provider="veo",
+            price=Decimal("19.00"),
+            unit_cost_usd=_cost_from_price(Decimal("19.00")),
+            base_cost_usd=_cost_from_price(Decimal("19.00")),
+            cost_unit=AIModel.CostUnit.GENERATION,
+            api_model_name="veo-3.1-fast",
+            default_params={},
+            allowed_params={},
+        )
+        BalanceService.add_deposit(user, amount=Decimal("50.00"), payment_method="test")
+        req = GenerationService.create_generation_request(
+            user=user,
+            ai_model=model,
+            prompt="Retry prompt",
+            generation_type="text2video",
+            generation_params={},
+        )
+        mock_get_provider.return_value.generate.side_effect = httpx.ConnectError("connection reset")
+
+        with self.assertRaises(RuntimeError):
+            generate_video_task.run(req.id)
+
+        self.assertGreaterEqual(mock_retry.call_args.kwargs["countdown"], 10)
+        req.refresh_from_db()
+        self.assertEqual(req.status, "processing")
+        self.assertEqual(BalanceService.get_balance(user), Decimal("31.00"))
+
+
+class StuckRequestReaperTests(TestCase):
+    def setUp(self):
+        self.user = TgUser.objects.create(chat_id=770003, username="reaper")
+        self.video_model = AIModel.objects.create(
+            slug="kling-reaper-test",
+            name="Kling Reaper",
+            display_name="Kling Reaper",
+            type="video",
+            provider="kling",
+            description="",
+            short_description="",
+            price=Decimal("10.00"),
+            unit_cost_usd=_cost_from_price(Decimal("10.00")),
+            base_cost_usd=_cost_from_price(Decimal("10.00")),
+            cost_unit=AIModel.CostUnit.GENERATION,
+            api_endpoint="",
+            api_model_name="kling-v2",
+            max_prompt_length=1000,
+            default_params={"duration": 5},
+            allowed_params={},
+        )
+        BalanceService.add_deposit(self.user, amount=Decimal("50.00"), payment_method="test")
+
+    def _make_stuck_request(self, requeues: int = 0) -> GenRequest:
+        req = GenerationService.create_generation_request(
+            user=self.user,
+            ai_model=self.video_model,
+            prompt="Reaper prompt",
+            generation_type="text2video",
+            generation_params={"duration": 5},
+        )
+        GenRequest.objects.filter(pk=req.pk).update(
+            status="processing",
+            started_at=timezone.now() - timedelta(minutes=30),
+            provider_metadata={"reaper": {"requeues": requeues}} if requeues else {},
+        )
+        req.refresh_from_db()
+        return req
+
+    @patch("botapp.tasks.generate_video_task.delay")
+    @patch("botapp.tasks.heartbeats.get_checkpoint", return_value={"stage": "provider_call"})
+    @patch("botapp.tasks.heartbeats.alive")
+    def test_request_without_heartbeat_is_requeued(self, mock_alive, _mock_checkpoint, mock_delay):
+        req = self._make_stuck_request()
+        mock_alive.return_value = {req.id: False}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            summary = reap_stuck_requests_task.apply().get()
+
+        self.assertEqual(summary["requeued"], 1)
+        mock_delay.assert_called_once_with(req.id)
+        req.refresh_from_db()
+        self.assertEqual(req.status, "queued")
+        self.assertEqual(req.provider_metadata["reaper"]["requeues"], 1)
+        self.assertEqual(req.provider_metadata["reaper"]["last_stage"], "provider_call")
+
+    @patch("botapp.tasks.generate_video_task.delay")
+    @patch("botapp.tasks.heartbeats.alive", return_value={})
+    def test_request_waiting_for_webhook_is_left_to_reconcile(self, _mock_alive, mock_delay):
+        # Sora через Geminigen (provider="openai") так же ждёт webhook без heartbeat, как и Veo
+        self.video_model.provider = "openai"
+        self.video_model.save(update_fields=["provider"])
+        req = self._make_stuck_request()
+        GenRequest.objects.filter(pk=req.pk).update(provider_job_id="sora-job-1")
+
+        summary = reap_stuck_requests_task.apply().get()
+
+        self.assertEqual(summary["checked"], 0)
+        mock_delay.assert_not_called()
+        req.refresh_from_db()
+        self.assertEqual(req.status, "processing")
+
+    @patch("botapp.tasks.send_telegram_message")
+    @patch("botapp.tasks.generate_video_task.delay")
+    @patch("botapp.tasks.heartbeats.get_checkpoint", return_value={})
+    @patch("botapp.tasks.heartbeats.alive")
+    def test_request_is_refunded_after_max_requeues(self, mock_alive, _mock_checkpoint, mock_delay, _mock_send):
+        req = self._make_stuck_request(requeues=1)
+        alive_req = self._make_stuck_request()
+        mock_alive.return_value = {req.id: False, alive_req.id: True}
+
+        summary = reap_stuck_requests_task.apply().get()
+
+        self.assertEqual(summary["failed"], 1)
+        self.assertEqual(summary["alive"], 1)
+        mock_delay.assert_not_called()
+        req.refresh_from_db()
+        alive_req.refresh_from_db()
+        self.assertEqual(req.status, "error")
+        self.assertEqual(alive_req.status, "processing")
+        self.assertEqual(BalanceService.get_balance(self.user), Decimal("40.00"))
+
+
+class AnalyticsRollupTests(TestCase):
+    def setUp(self):
+        self.user = TgUser.objects.create(chat_id=770004, username="rollup")
+        self.model = AIModel.objects.create(
+            slug="rollup-image-test",
+            name="Rollup Image",
+            display_name="Rollup Image",
+            type="image",
+            provider="gemini",
+            description="",
+            short_description="",
+            price=Decimal("5.00"),
+            unit_cost_usd=_cost_from_price(Decimal("5.00")),
+            base_cost_usd=_cost_from_price(Decimal("5.00")),
+            cost_unit=AIModel.CostUnit.IMAGE,
+            api_endpoint="",
+            api_model_name="gemini-image",
+            max_prompt_length=1000,
+            default_params={},
+            allowed_params={},
+        )
+        BalanceService.add_deposit(self.user, amount=Decimal("50.00"), payment_method="card")
+        for status in ("done", "done", "error"):
+            req = GenerationService.create_generation_request(
+                user=self.user,
+                ai_model=self.model,
+                prompt="Rollup prompt",
+                quantity=1,
+            )
+            GenRequest.objects.filter(pk=req.pk).update(status=status, processing_time=4.0)
+
+    def test_refresh_builds_rollups_and_is_idempotent(self):
+        RollupService.refresh()
+        RollupService.refresh()
+
+        day = GenerationRollup.objects.get(granularity=RollupGranularity.DAY, model_slug=self.model.slug)
+        self.assertEqual(day.requests, 3)
+        self.assertEqual(day.done, 2)
+        self.assertEqual(day.errors, 1)
+        self.assertEqual(day.revenue, Decimal("10.00"))
+        self.assertEqual(day.cohort, timezone.now().strftime("%Y-%m"))
+        self.assertEqual(GenerationRollup.objects.filter(granularity=RollupGranularity.HOUR).count(), 1)
+        deposit = TransactionRollup.objects.get(granularity=RollupGranularity.DAY, type="deposit")
+        self.assertEqual((deposit.payment_method, deposit.count, deposit.amount), ("card", 1, Decimal("50.00")))
+
+    def test_reports_read_from_rollups(self):
+        RollupService.refresh()
+
+        comparison = {row["model_slug"]: row for row in AnalyticsService.get_model_comparison()}
+        self.assertEqual(comparison[self.model.slug]["total_requests"], 3)
+        revenue = AnalyticsService.get_revenue_analytics(period_days=1)
+        self.assertEqual(revenue["deposit_revenue"]["total"], Decimal("50.00"))
+        self.assertEqual(revenue["by_payment_method"][0]["payment_method"], "card")
+        metrics = AnalyticsService.get_performance_metrics()
+        self.assertEqual(metrics["daily_errors"], 1)
+        self.assertEqual(metrics["avg_times_by_model"][0]["avg_time"], 4.0)
+        report = AnalyticsService.export_analytics_report(period_days=1)
+        self.assertEqual(report["model_usage"]["total_stats"]["total_requests"], 2)
+        self.assertEqual(report["users"]["generation_distribution"], [{"total_generations": 3, "users": 1}])
+
+    def test_daily_users_are_distinct_across_rollup_slices(self):
+        other_model = AIModel.objects.create(
+            slug="rollup-image-test-2",
+            name="Rollup Image 2",
+            display_name="Rollup Image 2",
+            type="image",
+            provider="gemini",
+            price=Decimal("5.00"),
+            unit_cost_usd=_cost_from_price(Decimal("5.00")),
+            base_cost_usd=_cost_from_price(Decimal("5.00")),
+            cost_unit=AIModel.CostUnit.IMAGE,
+            api_model_name="gemini-image",
+            default_params={},
+            allowed_params={},
+        )
+        other_user = TgUser.objects.create(chat_id=770013, username="rollup-2")
+        BalanceService.add_deposit(other_user, amount=Decimal("50.00"), payment_method="card")
+        for user, model in ((self.user, other_model), (other_user, self.model)):
+            req = GenerationService.create_generation_request(user=user, ai_model=model, prompt="Slice prompt")
+            GenRequest.objects.filter(pk=req.pk).update(status="done")
+        RollupService.refresh()
+
+        # Окно с period_days=0 начинается в полночь и включает сегодняшний дневной бакет целиком
+        stats = AnalyticsService.get_model_usage_stats(period_days=0)
+
+        self.assertEqual(len(stats["daily_stats"]), 1)
+        self.assertEqual(stats["daily_stats"][0]["requests"], 4)
+        self.assertEqual(stats["daily_stats"][0]["users"], 2)
+        self.assertEqual(stats["total_stats"]["unique_users"], 2)
+
+
+class AnalyticsExportTests(TestCase):
+    def setUp(self):
+        self.user = TgUser.objects.create(chat_id=770005, username="export")
+        for index in range(5):
+            Transaction.objects.create(
+                user=self.user,
+                type="deposit",
+                amount=Decimal("10.00"),
+                balance_after=Decimal("10.00") * (index + 1),
+                description=f"Deposit {index}",
+                payment_method="card",
+            )
+
+    def test_command_streams_all_rows_in_chunks(self):
+        out = io.StringIO()
+        with self.assertNumQueries(3):
+            call_command("export_analytics", "transactions", "--chunk-size", "2", stdout=out, stderr=io.StringIO())
+
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(rows[0][:4], ["id", "created_at", "user_id", "type"])
+        self.assertEqual(len(rows), 6)
+        self.assertEqual([row[0] for row in rows[1:]], sorted((row[0] for row in rows[1:]), key=int))
+
+    def test_dashboard_export_requires_staff_and_streams_csv(self):
+        url = reverse("dashboard:analytics_export", args=["transactions"])
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        staff = get_user_model().objects.create_user(username="analyst", password="pass", is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(url)
+
+        self.assertTrue(response.streaming)
+        self.assertTrue(response.is_async)
+
+        async def collect():
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        body = async_to_sync(collect)().decode()
+        self.assertEqual(len(body.strip().splitlines()), 6)
+
+    def test_dashboard_export_validates_period(self):
+        url = reverse("dashboard:analytics_export", args=["transactions"])
+        staff = get_user_model().objects.create_user(username="analyst", password="pass", is_staff=True)
+        self.client.force_login(staff)
+
+        for bad in ("2024-13-01T00:00", "yesterday"):
+            self.assertEqual(self.client.get(url, {"since": bad}).status_code, 400, bad)
+
+        day = timezone.now().date()
+        self.assertEqual(
+            parse_moment(day.isoformat(), end_of_day=True) - parse_moment(day.isoformat()), timedelta(days=1)
+        )
+        response = self.client.get(url, {"since": (day + timedelta(days=1)).isoformat()})
+
+        async def collect():
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(len(async_to_sync(collect)().decode().strip().splitlines()), 1)
+
+
+class ProductEventPipelineTests(TestCase):
+    @patch("botapp.events._ensure_flusher")
+    @patch("botapp.events.get_redis")
+    def test_track_event_is_buffered_and_flushed_in_one_pipeline(self, mock_get_redis, _mock_flusher):
+        user = TgUser.objects.create(chat_id=770006, username="events")
+        # Буфер общий для процесса: события, оставленные другими тестами, сюда не относятся
+        events._buffer.clear()
+
+        AnalyticsService.track_event(user, "start", {"source": "ad"})
+        AnalyticsService.track_event(user, "buy_click")
+
+        mock_get_redis.assert_not_called()
+        events.flush()
+        # Фоновый поток, запущенный другими тестами, мог отправить часть событий раньше — считаем все xadd
+        pipe = mock_get_redis.return_value.pipeline.return_value
+        self.assertEqual(pipe.xadd.call_count, 2)
+        fields = pipe.xadd.call_args_list[0].args[1]
+        self.assertEqual((fields["event_type"], fields["chat_id"]), ("start", "770006"))
+        self.assertEqual(json.loads(fields["metadata"]), {"source": "ad"})
+        pipe.execute.assert_called()
+
+    @patch("botapp.events.emit")
+    def test_generation_lifecycle_emits_events_after_commit(self, mock_emit):
+        user = TgUser.objects.create(chat_id=770014, username="funnel")
+        model = AIModel.objects.create(
+            slug="events-image-test",
+            name="Events Image",
+            display_name="Events Image",
+            type="image",
+            provider="gemini",
+            price=Decimal("5.00"),
+            unit_cost_usd=_cost_from_price(Decimal("5.00")),
+            base_cost_usd=_cost_from_price(Decimal("5.00")),
+            cost_unit=AIModel.CostUnit.IMAGE,
+            api_model_name="gemini-image",
+            default_params={},
+            allowed_params={},
+        )
+        BalanceService.add_deposit(user, amount=Decimal("50.00"), payment_method="test")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            req = GenerationService.create_generation_request(user=user, ai_model=model, prompt="Funnel prompt")
+            mock_emit.assert_not_called()
+        with self.captureOnCommitCallbacks(execute=True):
+            GenerationService.complete_generation(req, result_urls=["https://example.com/a.png"])
+
+        emitted = [(call.args[0], call.kwargs["chat_id"], call.kwargs["request_id"]) for call in mock_emit.call_args_list]
+        self.assertEqual(
+            emitted,
+            [("generation_requested", 770014, req.pk), ("generation_completed", 770014, req.pk)],
+        )
+
+    @patch("botapp.events.get_redis")
+    def test_ingest_writes_batches_and_acks(self, mock_get_redis):
+        message = (
+            b"1700000000000-0",
+            {
+                b"event_type": b"start",
+                b"chat_id": b"770006",
+                b"username": b"events",
+                b"occurred_at": timezone.now().isoformat().encode(),
+                b"metadata": b'{"source": "ad"}',
+            },
+        )
+        client = mock_get_redis.return_value
+        client.xreadgroup.side_effect = [[], [[b"product-events", [message]]], []] * 2
+
+        self.assertEqual(events.ingest(), 1)
+        self.assertEqual(events.ingest(), 1)  # повторная доставка того же сообщения
+
+        event = ProductEvent.objects.get()
+        self.assertEqual((event.event_type, event.chat_id), ("start", 770006))
+        self.assertEqual(event.metadata, {"source": "ad"})
+        client.xack.assert_called_with("product-events", events.CONSUMER_GROUP, b"1700000000000-0")
+
+    @patch("botapp.events.get_redis")
+    def test_ingest_acks_pending_entries_trimmed_from_stream(self, mock_get_redis):
+        client = mock_get_redis.return_value
+        client.xreadgroup.side_effect = [[[b"product-events", [(b"1700000000000-0", None)]]], [], []]
+
+        self.assertEqual(events.ingest(), 0)
+
+        self.assertFalse(ProductEvent.objects.exists())
+        client.xack.assert_called_once_with("product-events", events.CONSUMER_GROUP, b"1700000000000-0")
+
+
+class MetricsEndpointTests(TestCase):
+    @override_settings(METRICS_AUTH_TOKEN="scrape-secret")
+    def test_metrics_endpoint_requires_bearer_token(self):
+        self.assertEqual(self.client.get("/api/metrics").status_code, 401)
+
+        response = self.client.get("/api/metrics", HTTP_AUTHORIZATION="Bearer scrape-secret")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+
+    @unittest.skipUnless(metrics._prometheus_available, "prometheus_client не установлен")
+    def test_metrics_expose_stage_latency_and_queue_gauge(self):
+        user = TgUser.objects.create(chat_id=770007, username="metrics")
+        GenRequest.objects.create(run_code="metrics-run", user=user, chat_id=user.chat_id, prompt="p", model="m")
+        with metrics.stage("kling", "poll"):
+            pass
+
+        body = self.client.get("/api/metrics").content.decode()
+
+        self.assertIn('bot_provider_stage_seconds_count{provider="kling",stage="poll"}', body)
+        self.assertIn('bot_genrequests{status="queued"} 1.0', body)
+
+
+class TracingPropagationTests(TestCase):
+    @unittest.skipUnless(tracing._otel_available, "opentelemetry-api не установлен")
+    def test_trace_context_survives_celery_publish_and_prerun(self):
+        from opentelemetry import trace
+        from opentelemetry.trace import NonRecordingSpan, SpanContext, TraceFlags
+
+        parent = SpanContext(
+            trace_id=0x1234,
+            span_id=0x5678,
+            is_remote=False,
+            trace_flags=TraceFlags(TraceFlags.SAMPLED),
+        )
+        headers = {}
+        with trace.use_span(NonRecordingSpan(parent)):
+            tracing.inject_headers(headers)
+        self.assertIn("traceparent", headers)
+
+        task = MagicMock()
+        task.name = "botapp.tasks.generate_video_task"
+        task.request = MagicMock(spec=[])
+        task.request.traceparent = headers["traceparent"]
+        tracing.start_task_span(task, "task-1", args=[42])
+        try:
+            self.assertEqual(trace.get_current_span().get_span_context().trace_id, 0x1234)
+        finally:
+            tracing.end_task_span("task-1", "SUCCESS")
+        self.assertFalse(trace.get_current_span().get_span_context().is_valid)
+
+
+class SamplingProfilerTests(TestCase):
+    @override_settings(PROFILING_INTERVAL_MS=1)
+    def test_enabled_task_profile_is_saved_as_folded_stacks(self):
+        def busy_loop():
+            deadline = time.perf_counter() + 0.1
+            while time.perf_counter() < deadline:
+                pass
+
+        with patch("botapp.profiling.is_enabled", return_value=True):
+            self.assertTrue(profiling.maybe_start("task-1", "botapp.tasks.generate_image_task", 770008))
+        busy_loop()
+        profiling.finish("task-1")
+
+        report = ProfileReport.objects.get(task_id="task-1")
+        self.assertEqual(report.chat_id, 770008)
+        self.assertGreater(report.samples, 0)
+        self.assertIn("busy_loop (tests.py:", report.folded)
+
+    def test_disabled_profiling_does_not_start_sampler(self):
+        with patch("botapp.profiling.is_enabled", return_value=False):
+            self.assertFalse(profiling.maybe_start("task-2", "botapp.tasks.generate_image_task"))
+        profiling.finish("task-2")
+        self.assertFalse(ProfileReport.objects.exists())
+
+    @override_settings(PROFILING_FLAG_CACHE_SECONDS=60)
+    def test_flags_are_read_from_redis_once_per_cache_window(self):
+        store = {}
+        redis_client = MagicMock()
+        redis_client.hgetall.side_effect = lambda key: {k.encode(): str(v).encode() for k, v in store.items()}
+        redis_client.hset.side_effect = lambda key, mapping: store.update(mapping)
+        self.addCleanup(profiling._invalidate)
+
+        with patch("botapp.profiling.get_redis", return_value=redis_client):
+            profiling.enable(chat_id=770015, ttl=60)
+            redis_client.hgetall.reset_mock()
+            for _ in range(100):
+                self.assertTrue(profiling.is_enabled("telegram_webhook", 770015))
+                self.assertFalse(profiling.is_enabled("telegram_webhook", 770016))
+
+            async def handle_update():
+                async with profiling.aprofile("telegram_webhook", chat_id=770016):
+                    pass
+
+            async_to_sync(handle_update)()
+
+        self.assertEqual(redis_client.hgetall.call_count, 1)
+        self.assertFalse(ProfileReport.objects.exists())
+
+    def test_folded_download_requires_staff(self):
+        report = ProfileReport.objects.create(target="telegram_webhook", folded="main;handler 3")
+        url = reverse("dashboard:profile_download", args=[report.pk])
+
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        staff = get_user_model().objects.create_user(username="ops", password="pass", is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"main;handler 3")
+
+
+class ErrorTrackerGroupingTests(TestCase):
+    def setUp(self):
+        self.user = TgUser.objects.create(chat_id=770008, username="errors")
+
+    @override_settings(ERROR_TRACKER_ASYNC=True)
+    def test_log_enqueues_and_flush_groups_by_fingerprint(self):
+        with patch.object(ErrorTracker, "_ensure_writer"):
+            for request_id in (101, 102, 103):
+                ErrorTracker.log(
+                    origin=BotErrorEvent.Origin.CELERY,
+                    handler="generate_video_task",
+                    chat_id=self.user.chat_id,
+                    exc=TimeoutError(f"Provider timeout for request {request_id}"),
+                )
+            ErrorTracker.log(origin=BotErrorEvent.Origin.CELERY, handler="generate_video_task", message="other")
+            self.assertFalse(BotErrorEvent.objects.exists())
+
+            self.assertEqual(ErrorTracker.flush(), 4)
+
+            grouped = BotErrorEvent.objects.get(error_class="TimeoutError")
+            self.assertEqual(grouped.occurrences, 3)
+            self.assertEqual(grouped.user_id, self.user.id)
+            self.assertIn("request 101", grouped.message)
+            self.assertEqual(BotErrorEvent.objects.count(), 2)
+
+            ErrorTracker.log(
+                origin=BotErrorEvent.Origin.CELERY,
+                handler="generate_video_task",
+                exc=TimeoutError("Provider timeout for request 104"),
+            )
+            ErrorTracker.flush()
+        grouped.refresh_from_db()
+        self.assertEqual(grouped.occurrences, 4)
+
+    @override_settings(TELEGRAM_BOT_TOKEN="token", ERROR_ALERT_CHAT_ID="1", ERROR_ALERT_COOLDOWN=300)
+    def test_critical_alert_throttled_through_redis(self):
+        redis_client = MagicMock()
+        redis_client.set.side_effect = [True, None]
+        with patch("botapp.error_tracker.get_redis", return_value=redis_client), \
+                patch("botapp.error_tracker.httpx.post") as post:
+            for _ in range(2):
+                ErrorTracker.log(
+                    origin=BotErrorEvent.Origin.WEBHOOK,
+                    severity=BotErrorEvent.Severity.CRITICAL,
+                    handler="telegram_webhook",
+                    message="Update 12345 failed",
+                )
+
+        self.assertEqual(post.call_count, 1)
+        key = redis_client.set.call_args.args[0]
+        self.assertTrue(key.startswith("errors:alert:"))
+        self.assertEqual(redis_client.set.call_args.kwargs, {"nx": True, "ex": 300})
+
+
+ARCHIVE_SETTINGS = {
+    "RETENTION_ARCHIVE_BUCKET": "retention-archive",
+    "SUPABASE_URL": "https://supabase.example",
+    "SUPABASE_KEY": "service-key",
+}
+
+
+class RetentionPolicyTests(TestCase):
+    def setUp(self):
+        self.user = TgUser.objects.create(chat_id=770009, username="retention")
+        self.old = timezone.now() - timedelta(days=200)
+        self.uploads = {}
+        upload = patch(
+            "botapp.business.retention.supabase_upload_object",
+            side_effect=lambda content, key, content_type, bucket: self.uploads.setdefault((bucket, key), content),
+        )
+        upload.start()
+        self.addCleanup(upload.stop)
+
+    @override_settings(CHAT_MESSAGE_RETENTION_DAYS=180, RETENTION_BATCH_SIZE=2, RETENTION_BATCH_PAUSE=0)
+    def test_archive_then_delete_in_batches_and_resume(self):
+        thread = ChatThread.objects.create(user=self.user)
+        for index in range(5):
+            ChatMessage.objects.create(
+                thread=thread,
+                user=self.user,
+                direction=ChatMessage.Direction.INCOMING,
+                text=f"old {index}",
+                message_date=self.old,
+            )
+        fresh = ChatMessage.objects.create(thread=thread, user=self.user, direction=ChatMessage.Direction.INCOMING)
+
+        redis_client = MagicMock()
+        redis_client.get.return_value = None
+        with self.settings(**ARCHIVE_SETTINGS), \
+                patch("botapp.business.retention.get_redis", return_value=redis_client):
+            first = RetentionService.run(get_policy("chat_messages"), max_batches=1)
+            self.assertEqual(first, 2)
+            redis_client.set.assert_called_with("retention:cursor:chat_messages", ANY, ex=ANY)
+
+            redis_client.get.return_value = str(redis_client.set.call_args.args[1]).encode()
+            rest = RetentionService.run(get_policy("chat_messages"))
+
+        self.assertEqual(rest, 3)
+        self.assertEqual(list(thread.messages.values_list("id", flat=True)), [fresh.id])
+        redis_client.delete.assert_called_with("retention:cursor:chat_messages")
+
+        texts = []
+        for (bucket, key), content in self.uploads.items():
+            self.assertEqual(bucket, "retention-archive")
+            self.assertTrue(key.startswith(f"chat_messages/{timezone.localdate().isoformat()}/"))
+            texts += [json.loads(line)["text"] for line in gzip.decompress(content).decode().splitlines()]
+        self.assertEqual(len(self.uploads), 3)
+        self.assertEqual(sorted(texts), [f"old {index}" for index in range(5)])
+
+    @override_settings(CHAT_MESSAGE_RETENTION_DAYS=180, RETENTION_ARCHIVE_BUCKET="", RETENTION_BATCH_PAUSE=0)
+    def test_archived_policy_refuses_to_delete_without_durable_storage(self):
+        thread = ChatThread.objects.create(user=self.user)
+        ChatMessage.objects.create(
+            thread=thread, user=self.user, direction=ChatMessage.Direction.INCOMING, text="old", message_date=self.old
+        )
+
+        with self.assertRaises(RetentionError):
+            RetentionService.run(get_policy("chat_messages"))
+        with patch("botapp.business.retention.get_redis", side_effect=RedisError("down")), \
+                patch("botapp.business.retention.supabase_upload_object", side_effect=RuntimeError("storage down")), \
+                self.settings(**ARCHIVE_SETTINGS):
+            with self.assertRaises(RuntimeError):
+                RetentionService.run(get_policy("chat_messages"))
+
+        self.assertEqual(thread.messages.count(), 1)
+
+    @override_settings(PROVIDER_METADATA_RETENTION_DAYS=90, RETENTION_BATCH_PAUSE=0)
+    def test_scrub_keeps_request_and_clears_provider_metadata(self):
+        done = GenRequest.objects.create(
+            run_code="retention-done", user=self.user, chat_id=self.user.chat_id, prompt="p", model="m",
+            status="done", provider_metadata={"webhook": {"payload": "x" * 100}},
+        )
+        active = GenRequest.objects.create(
+            run_code="retention-active", user=self.user, chat_id=self.user.chat_id, prompt="p", model="m",
+            status="processing", provider_metadata={"job_id": "1"},
+        )
+        GenRequest.objects.filter(pk__in=[done.pk, active.pk]).update(created_at=self.old)
+
+        with self.settings(**ARCHIVE_SETTINGS), \
+                patch("botapp.business.retention.get_redis", side_effect=RedisError("down")):
+            self.assertEqual(RetentionService.run(get_policy("provider_metadata")), 1)
+
+        done.refresh_from_db()
+        active.refresh_from_db()
+        self.assertEqual(done.provider_metadata, {})
+        self.assertEqual(active.provider_metadata, {"job_id": "1"})
+
+
+class PromocodeRedemptionTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.promocode = Promocode.objects.create(
+            code="Flash50",
+            description="Flash promo",
+            value=Decimal("50.00"),
+            max_uses=1,
+            valid_from=now - timedelta(days=1),
+            valid_until=now + timedelta(days=1),
+        )
+        self.first = TgUser.objects.create(chat_id=770010, username="promo1")
+        self.second = TgUser.objects.create(chat_id=770011, username="promo2")
+
+    def test_db_path_enforces_max_uses_and_single_use(self):
+        with patch("botapp.business.promocodes.get_redis", side_effect=RedisError("down")):
+            first = PromocodeService.redeem(self.first, "  flash50 ")
+            again = PromocodeService.redeem(self.first, "FLASH50")
+            second = PromocodeService.redeem(self.second, "flash50")
+
+        self.assertEqual(first.status, RedemptionStatus.OK)
+        self.assertEqual(again.status, RedemptionStatus.ALREADY_USED)
+        self.assertEqual(second.status, RedemptionStatus.EXHAUSTED)
+        self.assertEqual(BalanceService.get_balance(self.first), Decimal("50.00"))
+        self.assertEqual(BalanceService.get_balance(self.second), Decimal("0.00"))
+        self.promocode.refresh_from_db()
+        self.assertEqual(self.promocode.current_uses, 1)
+
+    def test_db_path_counts_redemptions_not_stale_counter(self):
+        # Активация через Redis уже записана в used_by, а current_uses обновится только в sync_stats
+        self.promocode.used_by.add(self.first)
+        self.assertEqual(self.promocode.current_uses, 0)
+
+        with patch("botapp.business.promocodes.get_redis", side_effect=RedisError("down")):
+            result = PromocodeService.redeem(self.second, "flash50")
+
+        self.assertEqual(result.status, RedemptionStatus.EXHAUSTED)
+        self.assertEqual(BalanceService.get_balance(self.second), Decimal("0.00"))
+
+    def test_redis_path_initializes_counter_and_stats_are_written_back(self):
+        redis_client = MagicMock()
+        claim = MagicMock(side_effect=[-2, 1])
+        redis_client.register_script.return_value = claim
+
+        with patch("botapp.business.promocodes.get_redis", return_value=redis_client):
+            result = PromocodeService.redeem(self.first, "flash50")
+
+        self.assertTrue(result.ok)
+        redis_client.set.assert_called_once_with(f"promo:{self.promocode.pk}:uses", 0, nx=True)
+        self.assertEqual(claim.call_args.kwargs["args"], [self.first.pk, 1])
+        self.promocode.refresh_from_db()
+        self.assertEqual(self.promocode.current_uses, 0)
+
+        self.assertEqual(PromocodeService.sync_stats(), {"updated": 1})
+        self.promocode.refresh_from_db()
+        self.assertEqual(self.promocode.current_uses, 1)
+        self.assertEqual(self.promocode.total_activated, 1)
+        self.assertEqual(self.promocode.total_bonus_given, Decimal("50.00"))
+
+
+    def test_redis_counters_catch_up_with_db_fallback_redemptions(self):
+        with patch("botapp.business.promocodes.get_redis", side_effect=RedisError("down")):
+            self.assertTrue(PromocodeService.redeem(self.first, "flash50").ok)
+
+        # Redis вернулся со старым счётчиком: активация через БД в нём не учтена
+        redis_client = MagicMock()
+        redis_client.mget.return_value = [b"0"]
+        resync = MagicMock(return_value=1)
+        redis_client.register_script.return_value = resync
+        with patch("botapp.business.promocodes.get_redis", return_value=redis_client):
+            self.assertEqual(PromocodeService.resync_redis_counters(), {"resynced": 1})
+
+        keys = [f"promo:{self.promocode.pk}:uses", f"promo:{self.promocode.pk}:users"]
+        resync.assert_called_once_with(keys=keys, args=[1, self.first.pk])
+
+
+class LavaCatalogCacheTests(SimpleTestCase):
+    CONFIG = {
+        "products": [
+            {"tokens": 100, "price": 5.0, "currency": "USD", "lava_product_id": "p1", "offer_id": "cfg-offer"},
+            {"tokens": 200, "price": 10.0, "currency": "USD"},
+        ]
+    }
+    PRODUCTS = [
+        {"id": "p1", "offers": [{"id": "cfg-offer", "prices": [{"currency": "USD", "amount": 5.0}]}]},
+        {"id": "p2", "offers": [
+            {"id": "eur-offer", "prices": [{"currency": "EUR", "amount": 10.0}]},
+            {"id": "usd-offer", "prices": [{"currency": "USD", "amount": 10.0, "periodicity": "ONE_TIME"}]},
+        ]},
+    ]
+
+    def _provider(self):
+        provider = LavaProvider()
+        provider.config = self.CONFIG
+        provider.api_key = "key"
+        return provider
+
+    def test_refresh_publishes_offer_index_to_redis(self):
+        provider = self._provider()
+        redis_client = MagicMock()
+        with patch.object(provider, "_fetch_products", return_value=self.PRODUCTS), \
+                patch("lavatop.provider.get_redis", return_value=redis_client):
+            self.assertEqual(provider.refresh_catalog(), 2)
+
+        key, payload = redis_client.set.call_args.args
+        self.assertEqual(key, CATALOG_CACHE_KEY)
+        offers = json.loads(payload)["offers"]
+        self.assertEqual(offers["200:USD:10.00"]["offer_id"], "usd-offer")
+        self.assertEqual(offers["100:USD:5.00"]["product_id"], "p1")
+
+    def test_create_payment_never_fetches_catalog_on_cold_cache(self):
+        provider = self._provider()
+        redis_client = MagicMock()
+        redis_client.get.return_value = None
+        response = MagicMock()
+        response.json.return_value = {"id": "inv-1", "paymentUrl": "https://pay.example/inv-1"}
+
+        with patch("lavatop.provider.get_redis", return_value=redis_client), \
+                patch.object(provider, "_fetch_products") as fetch, \
+                patch.object(provider, "_schedule_refresh") as schedule, \
+                patch.object(provider.session, "post", return_value=response) as post:
+            result = provider.create_payment(credits=100, order_id="1")
+
+        fetch.assert_not_called()
+        schedule.assert_called_once()
+        self.assertEqual(post.call_args.kwargs["json"]["offerId"], "cfg-offer")
+        self.assertEqual(result["payment_id"], "inv-1")
+
+
+class WebhookIngressTests(TestCase):
+    def setUp(self):
+        self.user = TgUser.objects.create(chat_id=770012, username="lava_payer")
+        BalanceService.ensure_balance(self.user)
+        self.trans = Transaction.objects.create(
+            user=self.user,
+            type="deposit",
+            amount=Decimal("5.00"),
+            balance_after=Decimal("0.00"),
+            description="Lava.top",
+            payment_id="contract-1",
+            is_pending=True,
+            is_completed=False,
+        )
+        self.payload = {"eventType": "payment.success", "contractId": "contract-1", "amount": 5, "status": "completed"}
+
+    @patch("botapp.tasks.process_webhook_event_task.delay")
+    def test_redelivered_event_is_logged_and_queued_once(self, mock_delay):
+
+        redis_client = MagicMock()
+        redis_client.set.side_effect = [True, None]
+        with patch("botapp.webhooks.get_redis", return_value=redis_client), \
+                self.captureOnCommitCallbacks(execute=True):
+            first = webhooks.ingest(WebhookEvent.Source.LAVA, "contract-1:payment.success:completed", self.payload)
+            second = webhooks.ingest(WebhookEvent.Source.LAVA, "contract-1:payment.success:completed", self.payload)
+
+        self.assertIsNotNone(first)
+        self.assertIsNone(second)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        mock_delay.assert_called_once_with(first.pk)
+
+    @patch("botapp.tasks.send_telegram_message")
+    def test_payment_event_is_credited_once(self, mock_send):
+
+        event = WebhookEvent.objects.create(source=WebhookEvent.Source.LAVA, payload=self.payload)
+        webhooks.process(event.pk)
+        # Повтор задачи после сбоя (или запоздавший failed) не меняет начисление
+        self.assertEqual(handle_payment_event(self.payload), "completed")
+        failed = dict(self.payload, eventType="payment.failed", status="failed")
+        self.assertEqual(handle_payment_event(failed), "completed")
+
+        event.refresh_from_db()
+        self.assertEqual(event.status, WebhookEvent.Status.PROCESSED)
+        self.assertEqual(event.attempts, 1)
+        self.trans.refresh_from_db()
+        self.assertTrue(self.trans.is_completed)
+        self.assertEqual(BalanceService.get_balance(self.user), usd_to_tokens(Decimal("5.00")))
+        mock_send.assert_called_once()
+
+
+@override_settings(WEBAPP_BLOB_INLINE_LIMIT=16, WEBAPP_BLOB_TTL=60)
+class WebAppBlobTests(SimpleTestCase):
+    def setUp(self):
+        self.store = {}
+        self.redis_client = MagicMock()
+        self.redis_client.set.side_effect = lambda key, value, ex=None: self.store.__setitem__(key, value)
+        self.redis_client.get.side_effect = self.store.get
+        self.redis_client.delete.side_effect = lambda *keys: [self.store.pop(key, None) for key in keys]
+        self.data = {
+            "kind": "kling_video_settings",
+            "prompt": "short prompt",
+            "imageData": "A" * 100,
+            "final_frame": {"content_base64": "B" * 100, "mime_type": "image/png"},
+        }
+
+    def test_large_fields_travel_as_references(self):
+        with patch("botapp.blobs.get_redis", return_value=self.redis_client):
+            offloaded = blobs.offload(self.data)
+            self.assertTrue(blobs.is_ref(offloaded["imageData"]))
+            self.assertTrue(blobs.is_ref(offloaded["final_frame"]["content_base64"]))
+            self.assertEqual(offloaded["prompt"], "short prompt")
+            self.assertLess(len(json.dumps(offloaded)), len(json.dumps(self.data)))
+            self.assertEqual(blobs.restore(offloaded), self.data)
+
+            blobs.discard(offloaded)
+            self.assertEqual(self.store, {})
+            with self.assertRaises(blobs.BlobMissingError):
+                blobs.restore(offloaded)
+
+    def test_payload_stays_inline_without_redis(self):
+        with patch("botapp.blobs.get_redis", side_effect=RedisError("down")):
+            self.assertEqual(blobs.offload(self.data), self.data)
+
+
+class MediaPoolTests(SimpleTestCase):
+    def tearDown(self):
+        media_pool.shutdown()
+
+    def _jpeg_bytes(self) -> bytes:
+        buffer = BytesIO()
+        Image.new("RGB", (8, 8), color=(200, 10, 10)).save(buffer, format="JPEG")
+        return buffer.getvalue()
+
+    @override_settings(MEDIA_POOL_INLINE_BYTES=1024)
+    def test_small_payload_is_handled_inline(self):
+        with patch("botapp.media_pool._get_executor") as mock_executor:
+            decoded = asyncio.run(media_pool.b64decode(base64.b64encode(b"tiny").decode()))
+        self.assertEqual(decoded, b"tiny")
+        mock_executor.assert_not_called()
+
+    @override_settings(MEDIA_POOL_INLINE_BYTES=0, MEDIA_POOL_WORKERS=1)
+    def test_large_payload_is_converted_in_process_pool(self):
+        raw = self._jpeg_bytes()
+
+        async def convert():
+            decoded = await media_pool.b64decode(base64.b64encode(raw).decode())
+            return await media_pool.to_png(decoded, "image/jpeg")
+
+        png = asyncio.run(convert())
+        self.assertTrue(png.startswith(b"\x89PNG"))
+        self.assertIsNotNone(media_pool._executor)
+
+
+class TaskDispatchTests(TestCase):
+    def _task(self, **apply_kwargs):
+        task = MagicMock()
+        task.name = "botapp.tasks.generate_image_task"
+        task.apply_async = MagicMock(**apply_kwargs)
+        return task
+
+    def test_unavailable_broker_falls_back_to_outbox_and_drain_resends(self):
+        broken = self._task(side_effect=ConnectionError("broker down"))
+        task_id = dispatch.publish(broken, 42)
+
+        entry = TaskOutbox.objects.get()
+        self.assertEqual((entry.task_name, entry.task_id, entry.args), (broken.name, task_id, [42]))
+
+        healthy = self._task()
+        with patch("botapp.dispatch.current_app") as mock_app:
+            mock_app.tasks = {broken.name: healthy}
+            summary = dispatch.drain()
+
+        self.assertEqual(summary, {"sent": 1, "pending": 0})
+        healthy.apply_async.assert_called_once_with(args=[42], kwargs={}, task_id=task_id, retry=False)
+
+    @override_settings(TASK_DISPATCH_TIMEOUT=0.05)
+    def test_enqueue_does_not_wait_for_slow_broker(self):
+        slow = self._task(side_effect=lambda **kwargs: time.sleep(0.5))
+
+        started = time.perf_counter()
+        task_id = asyncio.run(dispatch.enqueue(slow, 7))
+
+        self.assertLess(time.perf_counter() - started, 0.4)
+        self.assertTrue(task_id)
+
+    def test_enqueue_publishes_with_caller_context(self):
+        marker = contextvars.ContextVar("dispatch_marker", default=None)
+        seen = []
+        task = self._task(side_effect=lambda **kwargs: seen.append(marker.get()))
+
+        async def handler():
+            marker.set("webhook-span")
+            await dispatch.enqueue(task, 7)
+
+        with patch("botapp.dispatch.close_old_connections") as close:
+            asyncio.run(handler())
+
+        self.assertEqual(seen, ["webhook-span"])
+        self.assertEqual(close.call_count, 2)
+
+
+class ImageOptimizerTests(SimpleTestCase):
+    @staticmethod
+    def _image_bytes(size, fmt, mode="RGB"):
+        buffer = BytesIO()
+        Image.effect_noise(size, 64).convert(mode).save(buffer, format=fmt)
+        return buffer.getvalue()
+
+    def test_accepted_jpeg_is_kept_and_downscaled(self):
+        profile = image_optimizer.PROFILES["gemini"]
+        small = self._image_bytes((640, 480), "JPEG")
+        self.assertEqual(image_optimizer.optimize(small, "image/jpeg", profile), (small, "image/jpeg"))
+
+        large = self._image_bytes((4096, 1024), "JPEG")
+        content, mime = image_optimizer.optimize(large, "image/jpeg", profile)
+        self.assertEqual(mime, "image/jpeg")
+        with Image.open(BytesIO(content)) as img:
+            self.assertEqual(img.format, "JPEG")
+            self.assertEqual(max(img.size), profile.max_side)
+
+    def test_png_only_profile_and_byte_budget(self):
+        jpeg = self._image_bytes((800, 600), "JPEG")
+        content, mime = image_optimizer.optimize(jpeg, "image/jpeg", image_optimizer.profile_for("midjourney"))
+        self.assertEqual(mime, "image/png")
+        self.assertTrue(content.startswith(b"\x89PNG"))
+
+        profile = image_optimizer.ImageProfile(("image/jpeg",), max_total_bytes=120_000)
+        images = [
+            {"content": self._image_bytes((1600, 1600), "PNG"), "mime_type": "image/png", "role": None}
+            for _ in range(2)
+        ]
+        optimized = image_optimizer.optimize_all(images, profile)
+        for item in optimized:
+            self.assertEqual(item["mime_type"], "image/jpeg")
+            self.assertLessEqual(len(item["content"]), 60_000)
+
+
+class ResultDerivativeTests(SimpleTestCase):
+    @override_settings(RESULT_PREVIEW_MIME="image/jpeg", RESULT_PREVIEW_MAX_SIDE=1024, RESULT_THUMBNAIL_SIDE=128)
+    def test_render_all_builds_preview_and_thumbnail(self):
+        buffer = BytesIO()
+        Image.new("RGBA", (2048, 1536), (10, 200, 30, 255)).save(buffer, format="PNG")
+        original = buffer.getvalue()
+
+        [variants] = derivatives.render_all([original])
+
+        self.assertEqual(variants[derivatives.ORIGINAL], (original, "image/png"))
+        preview, preview_mime = variants[derivatives.PREVIEW]
+        thumbnail, thumbnail_mime = variants[derivatives.THUMBNAIL]
+        self.assertEqual((preview_mime, thumbnail_mime), ("image/jpeg", "image/webp"))
+        with Image.open(BytesIO(preview)) as img:
+            self.assertEqual(img.size, (1024, 768))
+        with Image.open(BytesIO(thumbnail)) as img:
+            self.assertEqual(img.size, (128, 96))
+
+    def test_upload_all_skips_failed_derivatives(self):
+        def fake_upload(content, mime_type, folder):
+            if content == b"broken" or folder == "images/thumbnails":
+                raise RuntimeError("storage down")
+            return {"public_url": f"https://cdn/{folder}/{content.decode()}"}
+
+        rendered = [
+            {
+                derivatives.ORIGINAL: (b"a", "image/png"),
+                derivatives.PREVIEW: (b"a-preview", "image/jpeg"),
+                derivatives.THUMBNAIL: (b"a-thumb", "image/webp"),
+            },
+            {derivatives.ORIGINAL: (b"broken", "image/png")},
+        ]
+        with patch("botapp.derivatives.supabase_upload_image", side_effect=fake_upload):
+            uploaded = derivatives.upload_all(rendered)
+
+        self.assertEqual(
+            uploaded,
+            [{"original": "https://cdn/images/a", "preview": "https://cdn/images/previews/a-preview"}, None],
+        )
+
+
+class VideoDerivativeTests(SimpleTestCase):
+    def test_single_pass_extracts_last_frame_poster_and_probe(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "clip.mp4")
+            subprocess.run(
+                [
+                    _ffmpeg_bin(), "-hide_banner", "-loglevel", "error", "-y",
+                    "-f", "lavfi", "-i", "testsrc=size=1280x720:rate=24:duration=2",
+                    "-pix_fmt", "yuv420p", path,
+                ],
+                check=True,
+            )
+            with open(path, "rb") as fh:
+                video = fh.read()
+
+        frame, poster, probe = render_video_derivatives(video)
+
+        self.assertEqual(probe, {"has_audio": False, "duration": 2.0, "width": 1280, "height": 720, "fps": 24.0})
+        with Image.open(BytesIO(frame)) as img:
+            self.assertEqual((img.format, img.size), ("PNG", (1280, 720)))
+        with Image.open(BytesIO(poster)) as img:
+            self.assertEqual((img.format, img.size), ("JPEG", (640, 360)))
+
+    def test_derivatives_are_referenced_from_metadata_and_optional(self):
+        uploads = iter(["https://cdn/frame.png", {"public_url": "https://cdn/poster.jpg"}])
+        with patch("botapp.tasks.render_video_derivatives", return_value=(b"frame", b"poster", {"duration": 8.0})), \
+                patch("botapp.tasks.supabase_upload_image", side_effect=lambda *a, **kw: next(uploads)), \
+                patch("botapp.tasks.media_cache.put") as cache_put:
+            metadata = _with_video_derivatives(b"video", {"account": "a1"})
+        cache_put.assert_called_once_with("https://cdn/frame.png", b"frame", "image/png")
+        self.assertEqual(
+            metadata,
+            {
+                "account": "a1",
+                "derivatives": {
+                    "last_frame_url": "https://cdn/frame.png",
+                    "poster_url": "https://cdn/poster.jpg",
+                    "probe": {"duration": 8.0},
+                },
+            },
+        )
+
+        with patch("botapp.tasks.render_video_derivatives", side_effect=RuntimeError("ffmpeg failed")):
+            self.assertEqual(_with_video_derivatives(b"video", None), {})
+
+
+class MediaCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, True)
+
+    def test_fetch_loads_once_and_stores_content_once(self):
+        loader = MagicMock(return_value=(b"video-bytes", "video/mp4"))
+        with override_settings(MEDIA_CACHE_DIR=self.cache_dir, MEDIA_CACHE_MAX_BYTES=1024):
+            self.assertEqual(media_cache.fetch("https://cdn/a.mp4", loader), (b"video-bytes", "video/mp4"))
+            self.assertEqual(media_cache.fetch("https://cdn/a.mp4", loader), (b"video-bytes", "video/mp4"))
+            media_cache.put("https://cdn/a.mp4?token=2", b"video-bytes", "video/mp4")
+
+        loader.assert_called_once()
+        objects = [name for _, _, files in os.walk(os.path.join(self.cache_dir, "objects")) for name in files]
+        self.assertEqual(len(objects), 1)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, "keys"))), 2)
+
+    def test_least_recently_used_objects_are_evicted(self):
+        with override_settings(MEDIA_CACHE_DIR=self.cache_dir, MEDIA_CACHE_MAX_BYTES=250, MEDIA_CACHE_MAX_ENTRY_BYTES=200):
+            media_cache.put("old", b"o" * 100)
+            media_cache.put("recent", b"r" * 100)
+            media_cache.put("too-big", b"x" * 300)
+            self.assertIsNone(media_cache.get("too-big"))
+
+            # "old" читали последним — вытесняется "recent"
+            now = time.time()
+            for key, age in (("old", 10), ("recent", 20)):
+                digest = json.loads(open(media_cache._key_path(key), "rb").read())["sha256"]
+                os.utime(media_cache._object_path(digest), (now - age, now - age))
+            self.assertIsNotNone(media_cache.get("old"))
+
+            media_cache.put("new", b"n" * 100)
+
+            self.assertIsNone(media_cache.get("recent"))
+            self.assertFalse(os.path.exists(media_cache._key_path("recent")))
+            self.assertEqual(media_cache.get("old"), (b"o" * 100, None))
+            self.assertEqual(media_cache.get("new"), (b"n" * 100, None))
+
+
+    def test_writes_under_limit_do_not_rescan_directory(self):
+        with override_settings(MEDIA_CACHE_DIR=self.cache_dir, MEDIA_CACHE_MAX_BYTES=250), \
+                patch("botapp.media_cache._evict", wraps=media_cache._evict) as evict:
+            media_cache.put("a", b"a" * 100)
+            media_cache.put("b", b"b" * 100)
+            media_cache.put("b-copy", b"b" * 100)
+            self.assertEqual(evict.call_count, 1)
+
+            media_cache.put("c", b"c" * 100)
+
+        self.assertEqual(evict.call_count, 2)
+        objects = [name for _, _, files in os.walk(os.path.join(self.cache_dir, "objects")) for name in files]
+        self.assertEqual(len(objects), 2)
+
 
 class OpenAISoraProviderTests(TestCase):
     @override_settings(
@@ -525,6 +2074,7 @@ class OpenAIImageGenerationTests(TestCase):
             params={"quality": "standard"},
             generation_type="text2image",
             input_images=[],
+            api_key=None,
         )
 
     @patch("botapp.services.gemini_generate_images", return_value=[b"ok"])
@@ -0,0 +1,167 @@
+"""
+Сквозная трассировка генерации (OpenTelemetry).
+
+Один GenRequest проходит webhook → aiogram-хендлер → Celery → провайдер → Supabase → Telegram.
+Контекст трассировки передаётся через заголовки сообщений Celery (traceparent), у спанов есть
+атрибуты genrequest.id / genrequest.run_code, поэтому медленный запрос виден целиком в коллекторе.
+
+Используется только opentelemetry-api. Экспорт включается TRACING_EXPORTER и требует
+opentelemetry-sdk (и opentelemetry-exporter-otlp для "otlp"); без них все спаны — no-op.
+"""
+from __future__ import annotations
+
+import importlib
+import inspect
+import logging
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, MutableMapping, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    from opentelemetry import context as otel_context
+    from opentelemetry import propagate, trace
+    _otel_available = True
+except ImportError:  # pragma: no cover - opentelemetry-api опционален
+    _otel_available = False
+
+_TRACE_HEADERS = ("traceparent", "tracestate", "baggage")
+_task_spans: Dict[str, Tuple[Any, Any]] = {}
+_configured = False
+
+
+def _tracer():
+    return trace.get_tracer("botapp")
+
+
+def _build_exporter(name: str):
+    if name == "console":
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+        return ConsoleSpanExporter()
+    if name == "otlp":
+        # Адрес коллектора берётся из стандартной OTEL_EXPORTER_OTLP_ENDPOINT
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        return OTLPSpanExporter()
+    # Произвольный экспортёр: "package.module:ClassName"
+    module_name, _, class_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def configure_tracing() -> None:
+    """Настраивает TracerProvider и экспорт (вызывается из AppConfig.ready)."""
+    global _configured
+    exporter_name = getattr(settings, "TRACING_EXPORTER", "") or "none"
+    if _configured or not _otel_available or exporter_name == "none":
+        return
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        provider = TracerProvider(resource=Resource.create({"service.name": settings.TRACING_SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(_build_exporter(exporter_name)))
+        trace.set_tracer_provider(provider)
+    except Exception as exc:
+        logger.warning("[TRACING] Не удалось включить экспорт %s: %s", exporter_name, exc)
+        return
+
+    try:
+        from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+
+        HTTPXClientInstrumentor().instrument()
+    except ImportError:
+        logger.info("[TRACING] opentelemetry-instrumentation-httpx не установлен, HTTP-спаны провайдеров не пишутся")
+    _configured = True
+    logger.info("[TRACING] Экспорт спанов включён: %s", exporter_name)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Any]:
+    """Дочерний спан текущего контекста."""
+    if not _otel_available:
+        yield None
+        return
+    with _tracer().start_as_current_span(name) as current:
+        for key, value in attributes.items():
+            if value is not None:
+                current.set_attribute(key, value)
+        yield current
+
+
+def traced(name: str) -> Callable:
+    """Декоратор view/функции (sync или async), открывающий спан на время вызова."""
+
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def annotate_request(gen_request: Any) -> None:
+    """Добавляет id/run_code GenRequest в текущий спан."""
+    if not _otel_available or gen_request is None:
+        return
+    current = trace.get_current_span()
+    current.set_attribute("genrequest.id", gen_request.id)
+    if getattr(gen_request, "run_code", None):
+        current.set_attribute("genrequest.run_code", gen_request.run_code)
+
+
+def inject_headers(headers: Optional[MutableMapping[str, Any]]) -> None:
+    """Кладёт контекст трассировки в заголовки публикуемого сообщения Celery."""
+    if _otel_available and headers is not None:
+        propagate.inject(headers)
+
+
+def start_task_span(task: Any, task_id: str, args: Any = None, kwargs: Any = None) -> None:
+    """Открывает спан Celery-задачи, продолжая трассу из заголовков сообщения."""
+    if not _otel_available or task is None:
+        return
+    carrier = {}
+    for key in _TRACE_HEADERS:
+        value = getattr(task.request, key, None)
+        if value is None:
+            value = (getattr(task.request, "headers", None) or {}).get(key)
+        if value:
+            carrier[key] = value
+    parent = propagate.extract(carrier)
+    task_span = _tracer().start_span(
+        f"celery.task {task.name}",
+        context=parent,
+        kind=trace.SpanKind.CONSUMER,
+        attributes={"celery.task_id": task_id or "", "celery.task_name": task.name},
+    )
+    request_id = args[0] if args else (kwargs or {}).get("request_id")
+    if isinstance(request_id, int):
+        task_span.set_attribute("genrequest.id", request_id)
+    token = otel_context.attach(trace.set_span_in_context(task_span, parent))
+    _task_spans[task_id] = (task_span, token)
+
+
+def end_task_span(task_id: str, state: Optional[str] = None) -> None:
+    entry = _task_spans.pop(task_id, None)
+    if entry is None:
+        return
+    task_span, token = entry
+    if state:
+        task_span.set_attribute("celery.state", state)
+    task_span.end()
+    otel_context.detach(token)
@@ -0,0 +1,109 @@
+"""
+Общий входной слой webhook'ов провайдеров (Lava.top, Geminigen).
+
+View проверяет подлинность запроса и вызывает ingest(): событие с уже виденным ключом идемпотентности
+отбрасывается (Redis SET NX с TTL WEBHOOK_DEDUP_TTL), новое сохраняется в WebhookEvent и обрабатывается
+задачей process_webhook_event_task. Провайдер сразу получает 200, повторные доставки не порождают
+повторной работы, а сырое тело остаётся в журнале для разбора и повторной обработки из админки.
+"""
+import logging
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from redis.exceptions import RedisError
+
+from .models import WebhookEvent
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Обработчик получает payload; исключение — повтор задачи, после исчерпания повторов статус failed
+HANDLERS = {
+    WebhookEvent.Source.GEMINIGEN: "botapp.tasks.process_geminigen_webhook",
+    WebhookEvent.Source.LAVA: "lavatop.webhook.handle_payment_event",
+}
+
+
+def _dedup_key(source: str, event_id: str) -> str:
+    return f"webhooks:seen:{source}:{event_id}"
+
+
+def claim(source: str, event_id: str) -> bool:
+    """True, если событие с таким ключом пришло впервые за WEBHOOK_DEDUP_TTL."""
+    if not event_id:
+        return True
+    try:
+        return bool(get_redis().set(_dedup_key(source, event_id), "1", nx=True, ex=int(settings.WEBHOOK_DEDUP_TTL)))
+    except RedisError as exc:
+        logger.warning("[WEBHOOKS] Redis недоступен, дедупликация по журналу: %s", exc)
+        return not WebhookEvent.objects.filter(source=source, event_id=event_id).exists()
+
+
+def release(source: str, event_id: str) -> None:
+    if not event_id:
+        return
+    try:
+        get_redis().delete(_dedup_key(source, event_id))
+    except RedisError:
+        pass
+
+
+def ingest(source: str, event_id: Any, payload: Dict[str, Any]) -> Optional[WebhookEvent]:
+    """Сохраняет событие в журнал и ставит обработку в очередь; None — повторная доставка."""
+    event_id = str(event_id or "")[:255]
+    if not claim(source, event_id):
+        logger.info("[WEBHOOKS] Повторная доставка %s %s пропущена", source, event_id)
+        return None
+    try:
+        event = WebhookEvent.objects.create(source=source, event_id=event_id, payload=payload)
+    except Exception:
+        release(source, event_id)
+        raise
+    transaction.on_commit(lambda: dispatch(event))
+    return event
+
+
+def dispatch(event: WebhookEvent) -> None:
+    from .tasks import process_webhook_event_task
+
+    try:
+        process_webhook_event_task.delay(event.pk)
+    except Exception as exc:
+        # Событие уже в журнале — его подхватит replay_webhook_events_task
+        logger.error("[WEBHOOKS] Не удалось поставить событие %s в очередь: %s", event.pk, exc)
+
+
+def process(event_pk: int) -> None:
+    """Выполняет обработчик события (вызывается из Celery)."""
+    event = WebhookEvent.objects.filter(pk=event_pk).first()
+    if event is None or event.status == WebhookEvent.Status.PROCESSED:
+        return
+    WebhookEvent.objects.filter(pk=event.pk).update(attempts=F("attempts") + 1)
+    handler = import_string(HANDLERS[event.source])
+    try:
+        handler(event.payload)
+    except Exception as exc:
+        WebhookEvent.objects.filter(pk=event.pk).update(status=WebhookEvent.Status.FAILED, error=str(exc)[:2000])
+        raise
+    WebhookEvent.objects.filter(pk=event.pk).update(
+        status=WebhookEvent.Status.PROCESSED,
+        error="",
+        processed_at=timezone.now(),
+    )
+
+
+def replay_stale(now=None) -> int:
+    """Заново ставит в очередь события, которые остались в received дольше WEBHOOK_REPLAY_AFTER."""
+    cutoff = (now or timezone.now()) - timedelta(seconds=int(settings.WEBHOOK_REPLAY_AFTER))
+    events = list(
+        WebhookEvent.objects.filter(status=WebhookEvent.Status.RECEIVED, received_at__lt=cutoff)
+        .order_by("pk")[:500]
+    )
+    for event in events:
+        dispatch(event)
+    return len(events)
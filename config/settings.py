@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 import logging
 import os
+import sys
 import dj_database_url
 from pathlib import Path
 from dotenv import load_dotenv
@@ -178,6 +179,20 @@ CELERY_TASK_ACKS_LATE = True
 CELERY_TASK_TIME_LIMIT = int(os.getenv("CELERY_TASK_TIME_LIMIT", str(15 * 60)))
 CELERY_TASK_SOFT_TIME_LIMIT = int(os.getenv("CELERY_TASK_SOFT_TIME_LIMIT", str(12 * 60)))
 
+# Повторы задач генерации по классу ошибки (см. botapp/errors.py)
+GENERATION_RETRY_TRANSIENT_MAX = int(os.getenv("GENERATION_RETRY_TRANSIENT_MAX", "3"))
+GENERATION_RETRY_RATE_LIMITED_MAX = int(os.getenv("GENERATION_RETRY_RATE_LIMITED_MAX", "5"))
+GENERATION_RETRY_BACKOFF_BASE = int(os.getenv("GENERATION_RETRY_BACKOFF_BASE", "15"))
+GENERATION_RETRY_BACKOFF_MAX = int(os.getenv("GENERATION_RETRY_BACKOFF_MAX", "600"))
+
+# Heartbeat'ы задач генерации и автоматический перезапуск зависших запросов
+GENERATION_HEARTBEAT_INTERVAL = int(os.getenv("GENERATION_HEARTBEAT_INTERVAL", "30"))
+GENERATION_HEARTBEAT_TTL = int(os.getenv("GENERATION_HEARTBEAT_TTL", "120"))
+GENERATION_REAPER_INTERVAL = int(os.getenv("GENERATION_REAPER_INTERVAL", "120"))
+GENERATION_REAPER_GRACE = int(os.getenv("GENERATION_REAPER_GRACE", "300"))
+GENERATION_REAPER_MAX_REQUEUES = int(os.getenv("GENERATION_REAPER_MAX_REQUEUES", "1"))
+GENERATION_REAPER_BATCH_SIZE = int(os.getenv("GENERATION_REAPER_BATCH_SIZE", "100"))
+
 # --- Telegram/Gemini/Supabase ---
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TG_WEBHOOK_SECRET  = os.getenv("TG_WEBHOOK_SECRET")
@@ -244,6 +259,12 @@ GEMINIGEN_WEBHOOK_PUBLIC_KEY_PATH = os.getenv("GEMINIGEN_WEBHOOK_PUBLIC_KEY_PATH
 GEMINIGEN_WEBHOOK_PUBLIC_KEY = os.getenv("GEMINIGEN_WEBHOOK_PUBLIC_KEY")
 # URL для проксирования webhook на другое окружение (staging), если uuid не найден локально
 GEMINIGEN_WEBHOOK_PROXY_URL = os.getenv("GEMINIGEN_WEBHOOK_PROXY_URL")
+# Сверка зависших задач, по которым не пришёл webhook
+GEMINIGEN_STATUS_ENDPOINT = os.getenv("GEMINIGEN_STATUS_ENDPOINT")
+GEMINIGEN_RECONCILE_INTERVAL = int(os.getenv("GEMINIGEN_RECONCILE_INTERVAL", "300"))
+GEMINIGEN_RECONCILE_STALE_AFTER = int(os.getenv("GEMINIGEN_RECONCILE_STALE_AFTER", str(15 * 60)))
+GEMINIGEN_RECONCILE_MAX_AGE = int(os.getenv("GEMINIGEN_RECONCILE_MAX_AGE", str(3 * 60 * 60)))
+GEMINIGEN_RECONCILE_BATCH_SIZE = int(os.getenv("GEMINIGEN_RECONCILE_BATCH_SIZE", "50"))
 
 # --- OpenAI Sora ---
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -308,10 +329,48 @@ USEAPI_KLING_ACCOUNT_EMAIL = os.getenv("USEAPI_KLING_ACCOUNT_EMAIL")
 USEAPI_KLING_ACCOUNT_PASSWORD = os.getenv("USEAPI_KLING_ACCOUNT_PASSWORD")
 USEAPI_KLING_MAX_JOBS = int(os.getenv("USEAPI_KLING_MAX_JOBS", os.getenv("USEAPI_MAX_JOBS", "5")))
 
+# --- Provider limits (общие для всех воркеров, через Redis) ---
+# Лимит параллельных задач на аккаунт провайдера (0 — без ограничения)
+PROVIDER_CONCURRENCY_LIMITS = {
+    "useapi": USEAPI_MAX_JOBS,
+    "kling": USEAPI_KLING_MAX_JOBS,
+    # Geminigen (Veo, Sora): слот держится с постановки задачи до webhook или сверки
+    "veo": int(os.getenv("GEMINIGEN_MAX_JOBS", "0")),
+    "openai": int(os.getenv("OPENAI_VIDEO_MAX_JOBS", "0")),
+    "midjourney": int(os.getenv("MIDJOURNEY_KIE_MAX_JOBS", "0")),
+}
+# Лимит запросов в минуту на аккаунт провайдера (0 — без ограничения)
+PROVIDER_RATE_LIMITS_RPM = {
+    "gemini": int(os.getenv("GEMINI_RPM", "0")),
+    "gemini_vertex": int(os.getenv("GEMINI_RPM", "0")),
+    "vertex": int(os.getenv("VERTEX_RPM", "0")),
+    "openai": int(os.getenv("OPENAI_RPM", "0")),
+    "openai_image": int(os.getenv("OPENAI_RPM", "0")),
+}
+PROVIDER_SLOT_TTL = int(os.getenv("PROVIDER_SLOT_TTL", str(CELERY_TASK_TIME_LIMIT)))
+PROVIDER_SLOT_WAIT_SECONDS = float(os.getenv("PROVIDER_SLOT_WAIT_SECONDS", "10"))
+PROVIDER_SLOT_POLL_INTERVAL = float(os.getenv("PROVIDER_SLOT_POLL_INTERVAL", "1"))
+PROVIDER_SLOT_RETRY_DELAY = int(os.getenv("PROVIDER_SLOT_RETRY_DELAY", "20"))
+PROVIDER_SLOT_MAX_RETRIES = int(os.getenv("PROVIDER_SLOT_MAX_RETRIES", "30"))
+
+# --- Provider account pools ---
+# JSON-список аккаунтов: [{"name": "acc1", "api_key": "...", "email": "...", "password": "...", "max_jobs": 5}]
+# или ключи через запятую. Пусто — используется одиночный ключ из настроек провайдера.
+USEAPI_ACCOUNTS = os.getenv("USEAPI_ACCOUNTS", "")
+USEAPI_KLING_ACCOUNTS = os.getenv("USEAPI_KLING_ACCOUNTS", "")
+KIE_ACCOUNTS = os.getenv("KIE_ACCOUNTS", "")
+GEMINI_API_KEYS = os.getenv("GEMINI_API_KEYS", "")
+# На сколько секунд аккаунт выводится из ротации после 401/402/403/429
+PROVIDER_ACCOUNT_COOLDOWN = int(os.getenv("PROVIDER_ACCOUNT_COOLDOWN", "300"))
+
 # --- Lava.top Payment ---
 LAVA_WEBHOOK_SECRET = os.getenv("LAVA_WEBHOOK_SECRET")
 LAVA_API_KEY = os.getenv("LAVA_API_KEY")
 LAVA_FALLBACK_CHAT_ID = os.getenv("LAVA_FALLBACK_CHAT_ID", "283738604")
+# Каталог продуктов Lava обновляется в фоне; индекс в Redis живёт дольше интервала,
+# чтобы платежи продолжали работать при временной недоступности Lava API
+LAVA_CATALOG_REFRESH_INTERVAL = int(os.getenv("LAVA_CATALOG_REFRESH_INTERVAL", "300"))
+LAVA_CATALOG_CACHE_TTL = int(os.getenv("LAVA_CATALOG_CACHE_TTL", str(24 * 3600)))
 # Безопасная обработка PUBLIC_BASE_URL (может быть None в CI окружении)
 PAYMENT_MINI_APP_URL = f"{PUBLIC_BASE_URL.rstrip('/')}/miniapp/" if PUBLIC_BASE_URL else None
 
@@ -331,6 +390,150 @@ if SENTRY_DSN:
 ERROR_ALERT_CHAT_ID = os.getenv("ERROR_ALERT_CHAT_ID") or LAVA_FALLBACK_CHAT_ID
 ERROR_ALERT_COOLDOWN = int(os.getenv("ERROR_ALERT_COOLDOWN", "300"))
 ERROR_LOG_RETENTION_DAYS = int(os.getenv("ERROR_LOG_RETENTION_DAYS", "30"))
+# Ошибки пишет фоновый поток; в тестах — синхронно, чтобы запись шла в транзакции теста
+ERROR_TRACKER_ASYNC = (
+    os.getenv("ERROR_TRACKER_ASYNC", "true").lower() in ("true", "1", "yes")
+    and sys.argv[1:2] != ["test"]
+)
+ERROR_TRACKER_QUEUE_SIZE = int(os.getenv("ERROR_TRACKER_QUEUE_SIZE", "10000"))
+ERROR_TRACKER_FLUSH_INTERVAL = float(os.getenv("ERROR_TRACKER_FLUSH_INTERVAL", "1.0"))
+# Окно, в котором одинаковые ошибки сворачиваются в одну запись BotErrorEvent
+ERROR_GROUP_WINDOW = int(os.getenv("ERROR_GROUP_WINDOW", "300"))
+
+# --- Analytics rollups ---
+ANALYTICS_ROLLUP_INTERVAL = int(os.getenv("ANALYTICS_ROLLUP_INTERVAL", "300"))
+# Сколько часов назад пересчитывать при каждом запуске: статусы запросов меняются после создания
+ANALYTICS_ROLLUP_LOOKBACK_HOURS = int(os.getenv("ANALYTICS_ROLLUP_LOOKBACK_HOURS", "48"))
+
+# --- Product events ---
+PRODUCT_EVENTS_STREAM = os.getenv("PRODUCT_EVENTS_STREAM", "product-events")
+PRODUCT_EVENTS_STREAM_MAXLEN = int(os.getenv("PRODUCT_EVENTS_STREAM_MAXLEN", "1000000"))
+PRODUCT_EVENTS_BUFFER_SIZE = int(os.getenv("PRODUCT_EVENTS_BUFFER_SIZE", "10000"))
+PRODUCT_EVENTS_FLUSH_INTERVAL = float(os.getenv("PRODUCT_EVENTS_FLUSH_INTERVAL", "1.0"))
+PRODUCT_EVENTS_FLUSH_BATCH = int(os.getenv("PRODUCT_EVENTS_FLUSH_BATCH", "500"))
+PRODUCT_EVENTS_INGEST_INTERVAL = int(os.getenv("PRODUCT_EVENTS_INGEST_INTERVAL", "10"))
+PRODUCT_EVENTS_INGEST_BATCH = int(os.getenv("PRODUCT_EVENTS_INGEST_BATCH", "1000"))
+PRODUCT_EVENTS_INGEST_MAX_BATCHES = int(os.getenv("PRODUCT_EVENTS_INGEST_MAX_BATCHES", "50"))
+# Секции ProductEvent по месяцам (PostgreSQL): на сколько месяцев вперёд создавать и как часто проверять
+PRODUCT_EVENTS_PARTITION_MONTHS_AHEAD = int(os.getenv("PRODUCT_EVENTS_PARTITION_MONTHS_AHEAD", "2"))
+PRODUCT_EVENTS_PARTITION_INTERVAL = int(os.getenv("PRODUCT_EVENTS_PARTITION_INTERVAL", str(6 * 3600)))
+
+# --- Metrics ---
+# /api/metrics: если задан токен, требуется заголовок Authorization: Bearer <token>
+METRICS_AUTH_TOKEN = os.getenv("METRICS_AUTH_TOKEN", "")
+# Порт HTTP-экспортера метрик Celery-воркера (0 — выключен)
+CELERY_METRICS_PORT = int(os.getenv("CELERY_METRICS_PORT", "0"))
+# Общий каталог метрик процессов gunicorn / Celery prefork (prometheus_client multiprocess mode).
+# Задаётся в окружении до старта процессов и очищается при запуске сервиса (start_web.sh, start_worker.sh);
+# без него каждый процесс отдаёт в /metrics только свои значения.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+if PROMETHEUS_MULTIPROC_DIR:
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+# --- Tracing (OpenTelemetry) ---
+# none | console | otlp | "package.module:ExporterClass"; требует opentelemetry-sdk
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none")
+TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "tg-nanobanana")
+
+# --- Profiling по запросу (см. manage.py profiling) ---
+PROFILING_INTERVAL_MS = int(os.getenv("PROFILING_INTERVAL_MS", "5"))
+PROFILING_FLAG_TTL = int(os.getenv("PROFILING_FLAG_TTL", "900"))
+# Как долго процесс держит флаги в памяти, прежде чем перечитать их из Redis
+PROFILING_FLAG_CACHE_SECONDS = float(os.getenv("PROFILING_FLAG_CACHE_SECONDS", "5"))
+
+# --- Promocodes ---
+# Как часто число активаций переносится в Promocode.current_uses / total_*
+PROMOCODE_STATS_SYNC_INTERVAL = int(os.getenv("PROMOCODE_STATS_SYNC_INTERVAL", "60"))
+
+# --- Retention (см. botapp/business/retention.py); 0 — политика выключена ---
+CHAT_MESSAGE_RETENTION_DAYS = int(os.getenv("CHAT_MESSAGE_RETENTION_DAYS", "180"))
+PROVIDER_METADATA_RETENTION_DAYS = int(os.getenv("PROVIDER_METADATA_RETENTION_DAYS", "90"))
+PRODUCT_EVENTS_RETENTION_DAYS = int(os.getenv("PRODUCT_EVENTS_RETENTION_DAYS", "365"))
+PROFILE_REPORT_RETENTION_DAYS = int(os.getenv("PROFILE_REPORT_RETENTION_DAYS", "30"))
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+RETENTION_BATCH_PAUSE = float(os.getenv("RETENTION_BATCH_PAUSE", "0.2"))
+RETENTION_MAX_BATCHES = int(os.getenv("RETENTION_MAX_BATCHES", "200"))
+# Приватный bucket Supabase для архивов удаляемых строк; без него политики с архивом ничего не удаляют
+RETENTION_ARCHIVE_BUCKET = os.getenv("RETENTION_ARCHIVE_BUCKET", "")
+
+# --- Постановка Celery-задач из async-хендлеров (см. botapp/dispatch.py) ---
+TASK_DISPATCH_WORKERS = int(os.getenv("TASK_DISPATCH_WORKERS", "4"))
+TASK_DISPATCH_TIMEOUT = float(os.getenv("TASK_DISPATCH_TIMEOUT", "2"))
+TASK_OUTBOX_DRAIN_INTERVAL = int(os.getenv("TASK_OUTBOX_DRAIN_INTERVAL", "30"))
+
+# --- Media pool (см. botapp/media_pool.py): base64/Pillow из async-хендлеров вне event loop ---
+MEDIA_POOL_WORKERS = int(os.getenv("MEDIA_POOL_WORKERS", "2"))
+MEDIA_POOL_INLINE_BYTES = int(os.getenv("MEDIA_POOL_INLINE_BYTES", str(256 * 1024)))
+
+# --- Производные результатов (см. botapp/derivatives.py) ---
+RESULT_PREVIEW_MIME = os.getenv("RESULT_PREVIEW_MIME", "image/jpeg")  # image/jpeg или image/webp
+RESULT_PREVIEW_MAX_SIDE = int(os.getenv("RESULT_PREVIEW_MAX_SIDE", "2560"))
+RESULT_THUMBNAIL_SIDE = int(os.getenv("RESULT_THUMBNAIL_SIDE", "384"))
+RESULT_DERIVATIVE_WORKERS = int(os.getenv("RESULT_DERIVATIVE_WORKERS", "4"))
+
+# --- Дисковый кэш медиа на воркере (см. botapp/media_cache.py); 0 — кэш выключен ---
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", str(BASE_DIR / "var" / "media-cache"))
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+MEDIA_CACHE_MAX_ENTRY_BYTES = int(os.getenv("MEDIA_CACHE_MAX_ENTRY_BYTES", str(200 * 1024 * 1024)))
+
+# --- WebApp blobs (см. botapp/blobs.py) ---
+# Строки длиннее лимита (base64 файлов) передаются через брокер ссылками на Redis,
+# а во входных файлах GenRequest заменяются storage_url в Supabase Storage
+WEBAPP_BLOB_INLINE_LIMIT = int(os.getenv("WEBAPP_BLOB_INLINE_LIMIT", str(64 * 1024)))
+WEBAPP_BLOB_TTL = int(os.getenv("WEBAPP_BLOB_TTL", str(6 * 3600)))
+
+# --- Webhook ingress (см. botapp/webhooks.py) ---
+# Сколько помнить ключ идемпотентности события провайдера (повторные доставки отбрасываются)
+WEBHOOK_DEDUP_TTL = int(os.getenv("WEBHOOK_DEDUP_TTL", str(3 * 24 * 3600)))
+# Через сколько секунд событие в статусе received снова ставится в очередь
+WEBHOOK_REPLAY_AFTER = int(os.getenv("WEBHOOK_REPLAY_AFTER", "900"))
+WEBHOOK_REPLAY_INTERVAL = int(os.getenv("WEBHOOK_REPLAY_INTERVAL", "300"))
+WEBHOOK_EVENT_RETENTION_DAYS = int(os.getenv("WEBHOOK_EVENT_RETENTION_DAYS", "30"))
+
+# --- Celery beat ---
+CELERY_BEAT_SCHEDULE = {
+    "reconcile-geminigen-jobs": {
+        "task": "botapp.tasks.reconcile_geminigen_jobs_task",
+        "schedule": float(GEMINIGEN_RECONCILE_INTERVAL),
+    },
+    "reap-stuck-requests": {
+        "task": "botapp.tasks.reap_stuck_requests_task",
+        "schedule": float(GENERATION_REAPER_INTERVAL),
+    },
+    "refresh-analytics-rollups": {
+        "task": "botapp.tasks.refresh_analytics_rollups_task",
+        "schedule": float(ANALYTICS_ROLLUP_INTERVAL),
+    },
+    "ingest-product-events": {
+        "task": "botapp.tasks.ingest_product_events_task",
+        "schedule": float(PRODUCT_EVENTS_INGEST_INTERVAL),
+    },
+    "maintain-product-event-partitions": {
+        "task": "botapp.tasks.maintain_product_event_partitions_task",
+        "schedule": float(PRODUCT_EVENTS_PARTITION_INTERVAL),
+    },
+    "sync-promocode-stats": {
+        "task": "botapp.tasks.sync_promocode_stats_task",
+        "schedule": float(PROMOCODE_STATS_SYNC_INTERVAL),
+    },
+    "apply-retention-policies": {
+        "task": "botapp.tasks.apply_retention_policies_task",
+        "schedule": float(RETENTION_INTERVAL),
+    },
+    "refresh-lava-catalog": {
+        "task": "botapp.tasks.refresh_lava_catalog_task",
+        "schedule": float(LAVA_CATALOG_REFRESH_INTERVAL),
+    },
+    "replay-webhook-events": {
+        "task": "botapp.tasks.replay_webhook_events_task",
+        "schedule": float(WEBHOOK_REPLAY_INTERVAL),
+    },
+    "drain-task-outbox": {
+        "task": "botapp.tasks.drain_task_outbox_task",
+        "schedule": float(TASK_OUTBOX_DRAIN_INTERVAL),
+    },
+}
 
 # --- Upload limits ---
 # Поднимаем лимиты для WebApp: два base64 изображения могут быть крупными
@@ -8,4 +8,7 @@ urlpatterns = [
     path("", views.ChatListView.as_view(), name="chat_list"),
     path("chats/<int:pk>/", views.ChatDetailView.as_view(), name="chat_detail"),
     path("messages/<int:pk>/media/", views.MessageMediaProxyView.as_view(), name="message_media"),
+    path("export/<slug:dataset>.csv", views.AnalyticsExportView.as_view(), name="analytics_export"),
+    path("profiles/", views.ProfileListView.as_view(), name="profile_list"),
+    path("profiles/<int:pk>/folded/", views.ProfileDownloadView.as_view(), name="profile_download"),
 ]
@@ -5,14 +5,15 @@ import requests
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.db.models import Q
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse_lazy
 from django.utils.translation import gettext as _
 from django.views import View
 from django.views.generic import DetailView, ListView
 
-from botapp.models import ChatMessage, ChatThread
+from botapp.business.export import DATASETS, ExportError, aiter_csv_chunks, parse_moment
+from botapp.models import ChatMessage, ChatThread, ProfileReport
 
 
 class StaffRequiredMixin(LoginRequiredMixin, UserPassesTestMixin):
@@ -122,3 +123,54 @@ class MessageMediaProxyView(StaffRequiredMixin, View):
         if response.status_code != 200:
             raise Http404("Не удалось скачать файл")
         return response.content
+
+
+class AnalyticsExportView(StaffRequiredMixin, View):
+    """Потоковая CSV-выгрузка сырых данных (generations / transactions)."""
+
+    def get(self, request, dataset: str, *args, **kwargs):
+        if dataset not in DATASETS:
+            raise Http404("Неизвестный набор данных")
+        try:
+            since = parse_moment(request.GET.get('since'))
+            until = parse_moment(request.GET.get('until'), end_of_day=True)
+        except ExportError as exc:
+            return HttpResponseBadRequest(str(exc))
+        # Асинхронный генератор: под ASGI пачки отдаются по мере чтения, а не после сборки всего CSV
+        response = StreamingHttpResponse(
+            aiter_csv_chunks(DATASETS[dataset], since=since, until=until),
+            content_type='text/csv; charset=utf-8',
+        )
+        response['Content-Disposition'] = f'attachment; filename="{dataset}.csv"'
+        return response
+
+
+class ProfileListView(StaffRequiredMixin, ListView):
+    """Сохранённые профили задач и хендлеров."""
+
+    model = ProfileReport
+    template_name = "dashboard/profile_list.html"
+    paginate_by = 50
+
+    def get_queryset(self):
+        qs = ProfileReport.objects.defer('folded').order_by('-created_at')
+        target = self.request.GET.get('target', '').strip()
+        if target:
+            qs = qs.filter(target__icontains=target)
+        return qs
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['target'] = self.request.GET.get('target', '').strip()
+        context['section'] = 'profiles'
+        return context
+
+
+class ProfileDownloadView(StaffRequiredMixin, View):
+    """Профиль в формате folded stacks (speedscope / flamegraph.pl)."""
+
+    def get(self, request, pk: int, *args, **kwargs):
+        report = get_object_or_404(ProfileReport, pk=pk)
+        response = HttpResponse(report.folded, content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="profile-{report.pk}.folded"'
+        return response
@@ -3,14 +3,12 @@ from django.http import JsonResponse
 from django.conf import settings
 from django.utils import timezone
 from botapp.models import TgUser, UserBalance, Transaction, TokenPackage
-from botapp.business.pricing import usd_to_tokens
 from decimal import Decimal
 import hashlib
 import hmac
 from urllib.parse import parse_qsl
 import logging
 import uuid
-from asgiref.sync import async_to_sync
 import base64
 
 from config.ninja_api import build_ninja_api
@@ -292,13 +290,71 @@ def create_payment(request, data: CreatePaymentRequest):
         }
 
 
+def _lava_webhook_authorized(request) -> bool:
+    """Проверка авторизации согласно требованиям Lava.top (Basic + ApiKey)."""
+    auth_header = request.headers.get('Authorization', '')
+    api_key_header = request.headers.get('X-API-Key')
+
+    expected_secret = getattr(settings, 'LAVA_WEBHOOK_SECRET', None)
+    expected_api_key = getattr(settings, 'LAVA_API_KEY', None)
+
+    def _matches(value, *expected_values):
+        return any(value == candidate for candidate in expected_values if candidate)
+
+    auth_present = bool(auth_header)
+    api_key_present = api_key_header is not None and api_key_header != ""
+
+    auth_valid = True  # default to true when header not present
+    if auth_header:
+        header_value = auth_header.strip()
+        if header_value.lower().startswith('bearer '):
+            token = header_value.split(' ', 1)[1].strip()
+            auth_valid = _matches(token, expected_secret, expected_api_key)
+        elif header_value.lower().startswith('basic '):
+            try:
+                decoded = base64.b64decode(header_value.split(' ', 1)[1]).decode('utf-8')
+                username, _, password = decoded.partition(':')
+                auth_valid = (
+                    _matches(password, expected_secret, expected_api_key)
+                    or _matches(decoded, expected_secret, expected_api_key)
+                    or (not password and _matches(username, expected_secret, expected_api_key))
+                )
+            except Exception as exc:
+                logger.warning("Failed to decode Lava webhook basic auth header: %s", exc)
+                auth_valid = False
+        else:
+            auth_valid = _matches(header_value, expected_secret, expected_api_key)
+
+    api_key_valid = True
+    if api_key_present:
+        api_key_valid = _matches(api_key_header, expected_api_key, expected_secret)
+
+    if not auth_present and not api_key_present:
+        logger.warning("No authorization headers provided for Lava webhook")
+        return False
+
+    if auth_present and not auth_valid:
+        logger.warning("Invalid Lava webhook Authorization header")
+        return False
+
+    if api_key_present and not api_key_valid:
+        logger.warning("Invalid Lava webhook API key header")
+        return False
+
+    return True
+
+
 @miniapp_api.post("/lava-webhook")
 def lava_webhook(request):
     """
     Webhook для обработки платежей от Lava.top
+
+    Событие сохраняется в журнал и начисляется в Celery (lavatop.webhook.handle_payment_event),
+    повторные доставки того же события отбрасываются.
     """
-    from .webhook import parse_webhook_data
-    from django.db import transaction as db_transaction
+    from botapp import webhooks
+    from botapp.models import WebhookEvent
+    from .webhook import parse_webhook_data, webhook_event_id
     import json
 
     try:
@@ -310,210 +366,17 @@ def lava_webhook(request):
 
         logger.info(f"Lava webhook received: {payload}")
 
-        # Логируем важные поля для отладки
-        if isinstance(payload, dict):
-            logger.info(f"Event Type: {payload.get('eventType', 'N/A')}")
-            logger.info(f"Contract ID: {payload.get('contractId', 'N/A')}")
-            logger.info(f"Status: {payload.get('status', 'N/A')}")
-            if payload.get('product'):
-                logger.info(f"Product: {payload.get('product', {}).get('title', 'N/A')}")
-
-        # Проверка авторизации согласно требованиям Lava.top (Basic + ApiKey)
-        auth_header = request.headers.get('Authorization', '')
-        api_key_header = request.headers.get('X-API-Key')
-
-        expected_secret = getattr(settings, 'LAVA_WEBHOOK_SECRET', None)
-        expected_api_key = getattr(settings, 'LAVA_API_KEY', None)
-
-        def _matches(value, *expected_values):
-            return any(value == candidate for candidate in expected_values if candidate)
-
-        auth_present = bool(auth_header)
-        api_key_present = api_key_header is not None and api_key_header != ""
-
-        auth_valid = True  # default to true when header not present
-        if auth_header:
-            header_value = auth_header.strip()
-            if header_value.lower().startswith('bearer '):
-                token = header_value.split(' ', 1)[1].strip()
-                auth_valid = _matches(token, expected_secret, expected_api_key)
-            elif header_value.lower().startswith('basic '):
-                try:
-                    decoded = base64.b64decode(header_value.split(' ', 1)[1]).decode('utf-8')
-                    username, _, password = decoded.partition(':')
-                    auth_valid = (
-                        _matches(password, expected_secret, expected_api_key)
-                        or _matches(decoded, expected_secret, expected_api_key)
-                        or (not password and _matches(username, expected_secret, expected_api_key))
-                    )
-                except Exception as exc:
-                    logger.warning("Failed to decode Lava webhook basic auth header: %s", exc)
-                    auth_valid = False
-            else:
-                auth_valid = _matches(header_value, expected_secret, expected_api_key)
-
-        api_key_valid = True
-        if api_key_present:
-            api_key_valid = _matches(api_key_header, expected_api_key, expected_secret)
-
-        if not auth_present and not api_key_present:
-            logger.warning("No authorization headers provided for Lava webhook")
-            return JsonResponse({"ok": False, "error": "Unauthorized"}, status=401)
-
-        if auth_present and not auth_valid:
-            logger.warning("Invalid Lava webhook Authorization header")
-            return JsonResponse({"ok": False, "error": "Unauthorized"}, status=401)
-
-        if api_key_present and not api_key_valid:
-            logger.warning("Invalid Lava webhook API key header")
+        if not _lava_webhook_authorized(request):
             return JsonResponse({"ok": False, "error": "Unauthorized"}, status=401)
 
         # Парсим данные
         webhook_data = parse_webhook_data(payload)
-
-        # Ищем транзакцию
-        order_id = webhook_data.get('order_id')
-        if not order_id:
+        if not webhook_data.get('order_id'):
             logger.error("No order_id in Lava webhook")
             return JsonResponse({"ok": False, "error": "Missing order_id"}, status=400)
 
-        # Пытаемся найти транзакцию
-        trans = None
-
-        # Если order_id - это число, ищем по ID
-        try:
-            transaction_id = int(order_id)
-            trans = Transaction.objects.get(id=transaction_id)
-            logger.info(f"Found transaction by ID: {transaction_id}")
-        except (ValueError, Transaction.DoesNotExist):
-            # Если не число или не найдено по ID, пробуем найти по payment_id
-            try:
-                trans = Transaction.objects.filter(payment_id=order_id).first()
-                if trans:
-                    logger.info(f"Found transaction by payment_id: {order_id}")
-            except:
-                pass
-
-        # Фиксируем тип события заранее, чтобы использовать ниже даже если транзакция не найдена
-        event_type = webhook_data.get('event_type', '') or ''
-
-        # Если транзакция не найдена и это новый платеж, создаем новую
-        success_events = {
-            'payment.success',
-            'subscription.recurring.payment.success'
-        }
-
-        if not trans and event_type in success_events:
-            # Для новых платежей от Lava.top создаем транзакцию
-            logger.info(f"Creating new transaction for Lava.top payment: {order_id}")
-
-            # Пытаемся сопоставить платёж с существующим пользователем
-            fallback_chat_id = getattr(settings, "LAVA_FALLBACK_CHAT_ID", None)
-            target_user = None
-            if fallback_chat_id:
-                try:
-                    target_user = TgUser.objects.get(chat_id=int(fallback_chat_id))
-                except (TgUser.DoesNotExist, ValueError):
-                    target_user = None
-
-            if not target_user:
-                logger.error("Unable to map Lava webhook to a Telegram user (fallback chat id not configured)")
-                return JsonResponse({"ok": False, "error": "User not found for webhook"}, status=500)
-
-            try:
-                user_balance, _ = UserBalance.objects.get_or_create(user=target_user)
-
-                trans = Transaction.objects.create(
-                    user=target_user,
-                    type='deposit',
-                    amount=webhook_data.get('amount', Decimal('0')),
-                    balance_after=user_balance.balance,
-                    description=f"Payment from Lava.top: {webhook_data.get('product_title', 'Unknown')}",
-                    payment_method='lava.top',
-                    payment_id=order_id,
-                    is_pending=False,
-                    is_completed=False
-                )
-                logger.info(f"Created new transaction {trans.id} for Lava.top payment")
-            except Exception as e:
-                logger.error(f"Failed to create transaction: {e}")
-                return JsonResponse({"ok": False, "error": "Failed to create transaction"}, status=500)
-
-        if not trans:
-            logger.warning(f"Transaction {order_id} not found for event {event_type}, acknowledging to prevent retries")
-            return JsonResponse({"ok": True, "status": "ignored"}, status=200)
-
-        # Проверяем тип события и статус платежа
-        payment_status_raw = webhook_data.get('status')
-        payment_status = (payment_status_raw or '').lower()
-
-        # Обработка успешных платежей
-        if (event_type == 'payment.success' or
-            payment_status in ['success', 'paid', 'completed', 'subscription-active']):
-            # Платеж успешен - начисляем токены
-            with db_transaction.atomic():
-                # Блокируем баланс для обновления
-                user_balance = UserBalance.objects.select_for_update().get(
-                    user=trans.user
-                )
-
-                # Начисляем токены по текущему курсу
-                credits_amount = usd_to_tokens(trans.amount)
-                user_balance.balance += credits_amount
-                user_balance.total_deposited += credits_amount
-                user_balance.save()
-
-                # Обновляем транзакцию
-                trans.is_completed = True
-                trans.is_pending = False
-                trans.payment_id = webhook_data.get('payment_id')
-                trans.payment_data = webhook_data.get('raw_data', {})
-                trans.balance_after = user_balance.balance
-                trans.save()
-
-            logger.info(f"Payment {trans.id} completed. Credited {credits_amount} tokens to user {trans.user.chat_id}")
-
-            # Отправляем уведомление пользователю в Telegram
-            try:
-                from botapp.telegram import bot
-
-                message_text = (
-                    f"✅ **Платеж успешно выполнен!**\n\n"
-                    f"💰 Зачислено: {int(credits_amount)} токенов\n"
-                    f"💵 Сумма: ${trans.amount}\n\n"
-                    f"Ваш новый баланс: {int(user_balance.balance)} токенов\n\n"
-                    f"Спасибо за покупку! 🎉\n"
-                    f"Теперь вы можете создавать изображения и видео."
-                )
-
-                # Отправляем сообщение, не ломая текущий event loop
-                async_to_sync(bot.send_message)(
-                    chat_id=trans.user.chat_id,
-                    text=message_text,
-                    parse_mode="Markdown"
-                )
-                logger.info(f"Payment notification sent to user {trans.user.chat_id}")
-            except Exception as e:
-                logger.error(f"Failed to send payment notification: {e}")
-                # Не падаем, если не удалось отправить уведомление
-
-            return JsonResponse({"ok": True, "status": "completed"})
-
-        elif (event_type == 'payment.failed' or
-              payment_status in ['failed', 'cancelled', 'canceled', 'subscription-failed']):
-            # Платеж не прошел
-            trans.is_pending = False
-            trans.is_completed = False
-            trans.payment_data = webhook_data.get('raw_data', {})
-            trans.save()
-
-            logger.info(f"Payment {trans.id} failed/cancelled")
-            return JsonResponse({"ok": True, "status": "failed"})
-
-        else:
-            # Неизвестный статус - просто логируем
-            logger.warning(f"Unknown payment status: {payment_status}")
-            return JsonResponse({"ok": True, "status": "unknown"})
+        event = webhooks.ingest(WebhookEvent.Source.LAVA, webhook_event_id(webhook_data), payload)
+        return JsonResponse({"ok": True, "status": "queued" if event else "duplicate"})
 
     except Exception as e:
         logger.error(f"Error processing Lava webhook: {e}", exc_info=True)
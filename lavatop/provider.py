@@ -5,6 +5,10 @@ The provider tries to follow the reference flow from Lava documentation:
 2. Найти оффер (offerId) для нашего пакета токенов.
 3. Создать контракт `/api/v2/invoice` и вернуть `paymentUrl`.
 Если REST‑вызовы недоступны, используется статическая fallback‑ссылка из конфигурации.
+
+Шаги 1–2 выполняет фоновая задача `refresh_lava_catalog_task`: она строит индекс
+«пакет/валюта/цена → оффер» и кладёт его в Redis, общий для всех воркеров.
+`create_payment` только читает этот индекс и никогда не ходит в каталог Lava сам.
 """
 
 from __future__ import annotations
@@ -12,16 +16,77 @@ from __future__ import annotations
 import json
 import logging
 import time
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
 import requests
 from django.conf import settings
+from redis.exceptions import RedisError
+
+from botapp.redis_client import get_redis
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_API_BASE = "https://gate.lava.top"
-PRODUCTS_CACHE_TTL = 300  # seconds
+CATALOG_CACHE_KEY = "lava:catalog"
+CATALOG_REFRESH_LOCK_KEY = "lava:catalog:refreshing"
+LOCAL_CATALOG_TTL = 30  # seconds: сколько процесс доверяет своей копии индекса из Redis
+
+
+@lru_cache(maxsize=1)
+def load_products_config() -> Dict:
+    """config/products.json читается один раз на процесс."""
+    config_path = Path(__file__).resolve().parent / "config" / "products.json"
+    try:
+        return json.loads(config_path.read_text("utf-8"))
+    except Exception as exc:  # noqa: BLE001
+        logger.error("Failed to load Lava products config: %s", exc)
+        return {"products": []}
+
+
+def offer_key(entry: Dict) -> str:
+    """Ключ индекса офферов: пакет токенов, валюта и цена из конфигурации."""
+    price = entry.get("price")
+    price_part = f"{float(price):.2f}" if price is not None else "-"
+    return f"{entry.get('tokens')}:{entry.get('currency', 'USD')}:{price_part}"
+
+
+def build_offer_index(products: List[Dict], config: Dict) -> Dict[str, Dict]:
+    """Сопоставляет каждому активному пакету из конфигурации первый подходящий оффер каталога Lava."""
+    prices: List[Tuple[Dict, Dict, Dict]] = [
+        (product, offer, price)
+        for product in products
+        for offer in product.get("offers") or []
+        for price in offer.get("prices") or []
+    ]
+    index: Dict[str, Dict] = {}
+    for entry in config.get("products", []):
+        if not entry.get("active", True):
+            continue
+        currency = entry.get("currency", "USD")
+        amount = entry.get("price")
+        configured_product_id = entry.get("lava_product_id")
+        configured_offer_id = entry.get("offer_id")
+        for product, offer, price in prices:
+            if configured_product_id and product.get("id") != configured_product_id:
+                continue
+            if configured_offer_id and offer.get("id") != configured_offer_id:
+                continue
+            if currency and price.get("currency") != currency:
+                continue
+            if amount is not None and price.get("amount") is not None:
+                if abs(price["amount"] - amount) > 1e-6:
+                    continue
+            index[offer_key(entry)] = {
+                "product_id": product.get("id"),
+                "offer_id": offer.get("id"),
+                "currency": price.get("currency", currency),
+                "amount": price.get("amount", amount),
+                "periodicity": price.get("periodicity"),
+            }
+            break
+    return index
 
 
 class LavaProvider:
@@ -35,34 +100,21 @@ class LavaProvider:
             self.session.headers.update({"X-Api-Key": self.api_key})
         self.session.headers.update({"Accept": "application/json"})
 
-        self._products_cache: Optional[list] = None
-        self._products_cache_ts: float = 0.0
-        self.config = self._load_config()
+        self.config = load_products_config()
+        self._offers: Optional[Dict[str, Dict]] = None
+        self._offers_ts: float = 0.0
 
         # Для совместимости с webhook.verify_signature
         self.client = None
 
     # ------------------------------------------------------------------
-    # Конфигурация и данные из API
+    # Каталог Lava (обновляется фоновой задачей)
     # ------------------------------------------------------------------
-    @staticmethod
-    def _load_config() -> Dict:
-        config_path = Path(__file__).resolve().parent / "config" / "products.json"
-        try:
-            return json.loads(config_path.read_text("utf-8"))
-        except Exception as exc:  # noqa: BLE001
-            logger.error("Failed to load Lava products config: %s", exc)
-            return {"products": []}
-
-    def _fetch_products(self) -> list:
-        if self._products_cache and time.time() - self._products_cache_ts < PRODUCTS_CACHE_TTL:
-            return self._products_cache
-
+    def _fetch_products(self) -> Optional[list]:
+        """Блокирующий запрос каталога; None — каталог получить не удалось."""
         if not self.api_key:
             logger.warning("LAVA_API_KEY not configured; skipping Lava API request")
-            self._products_cache = []
-            self._products_cache_ts = time.time()
-            return self._products_cache
+            return []
 
         url = f"{self.api_base}/api/v2/products"
         try:
@@ -70,19 +122,63 @@ class LavaProvider:
             response.raise_for_status()
             data = response.json()
             items = data.get("items") or data.get("data") or []
-            self._products_cache = items
-            self._products_cache_ts = time.time()
             logger.debug("Fetched %s products from Lava", len(items))
+            return items
         except requests.HTTPError as exc:  # noqa: BLE001
             logger.error("Failed to fetch Lava products: %s - %s", exc.response.status_code, exc.response.text)
-            self._products_cache = []
-            self._products_cache_ts = time.time()
         except Exception as exc:  # noqa: BLE001
             logger.error("Failed to fetch Lava products: %s", exc)
-            self._products_cache = []
-            self._products_cache_ts = time.time()
-        return self._products_cache
+        return None
+
+    def refresh_catalog(self) -> Optional[int]:
+        """
+        Загружает каталог, строит индекс офферов и публикует его в Redis.
+
+        При ошибке API прежний индекс остаётся в Redis до истечения LAVA_CATALOG_CACHE_TTL.
+        Возвращает число проиндексированных пакетов или None, если каталог не получен.
+        """
+        products = self._fetch_products()
+        if products is None:
+            return None
+        offers = build_offer_index(products, self.config)
+        payload = json.dumps({"fetched_at": time.time(), "offers": offers})
+        get_redis().set(CATALOG_CACHE_KEY, payload, ex=int(settings.LAVA_CATALOG_CACHE_TTL))
+        self._offers, self._offers_ts = offers, time.monotonic()
+        logger.info("Lava catalog refreshed: %s products, %s offers indexed", len(products), len(offers))
+        return len(offers)
+
+    def _cached_offers(self) -> Dict[str, Dict]:
+        """Индекс офферов из Redis с короткой копией в процессе; пустой, если кеш ещё не прогрет."""
+        if self._offers is not None and time.monotonic() - self._offers_ts < LOCAL_CATALOG_TTL:
+            return self._offers
+        try:
+            raw = get_redis().get(CATALOG_CACHE_KEY)
+        except RedisError as exc:
+            logger.warning("Redis unavailable, Lava catalog cache not read: %s", exc)
+            return self._offers or {}
+        if raw is None:
+            self._schedule_refresh()
+            self._offers = {}
+        else:
+            self._offers = json.loads(raw).get("offers") or {}
+        self._offers_ts = time.monotonic()
+        return self._offers
+
+    @staticmethod
+    def _schedule_refresh() -> None:
+        """Холодный кеш: ставим обновление каталога в очередь (не чаще раза в минуту на все воркеры)."""
+        try:
+            if not get_redis().set(CATALOG_REFRESH_LOCK_KEY, "1", nx=True, ex=60):
+                return
+            from botapp.tasks import refresh_lava_catalog_task
 
+            refresh_lava_catalog_task.delay()
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Failed to schedule Lava catalog refresh: %s", exc)
+
+    # ------------------------------------------------------------------
+    # Конфигурация
+    # ------------------------------------------------------------------
     def _config_entry(self, credits: int) -> Optional[Dict]:
         for product in self.config.get("products", []):
             if product.get("tokens") == credits and product.get("active", True):
@@ -90,51 +186,21 @@ class LavaProvider:
         return None
 
     def _resolve_offer(self, entry: Dict) -> Optional[Dict]:
-        products = self._fetch_products()
-        currency = entry.get("currency", "USD")
-        amount = entry.get("price")
-        configured_product_id = entry.get("lava_product_id")
-        configured_offer_id = entry.get("offer_id")
-
-        candidate = None
-        for product in products:
-            if configured_product_id and product.get("id") != configured_product_id:
-                continue
-            for offer in product.get("offers") or []:
-                if configured_offer_id and offer.get("id") != configured_offer_id:
-                    continue
-                for price in offer.get("prices") or []:
-                    if currency and price.get("currency") != currency:
-                        continue
-                    if amount is not None and price.get("amount") is not None:
-                        if abs(price["amount"] - amount) > 1e-6:
-                            continue
-                    candidate = {
-                        "product_id": product.get("id"),
-                        "offer_id": offer.get("id"),
-                        "currency": price.get("currency", currency),
-                        "amount": price.get("amount", amount),
-                        "periodicity": price.get("periodicity"),
-                    }
-                    break
-                if candidate:
-                    break
-            if candidate:
-                break
-
+        candidate = self._cached_offers().get(offer_key(entry))
         if candidate:
             return candidate
 
+        configured_offer_id = entry.get("offer_id")
         if configured_offer_id:
             logger.warning(
-                "Offer %s not found in Lava API; using config fallback",
+                "Offer %s not found in Lava catalog cache; using config fallback",
                 configured_offer_id,
             )
             return {
-                "product_id": configured_product_id,
+                "product_id": entry.get("lava_product_id"),
                 "offer_id": configured_offer_id,
-                "currency": currency,
-                "amount": amount,
+                "currency": entry.get("currency", "USD"),
+                "amount": entry.get("price"),
                 "periodicity": entry.get("periodicity"),
             }
 
@@ -188,6 +188,168 @@ def process_webhook(payload: Dict, signature: str = None) -> Dict:
         }
 
 
+class LavaWebhookError(RuntimeError):
+    """Event cannot be applied yet; the ingress task retries it and then marks it failed."""
+
+
+def webhook_event_id(webhook_data: Dict) -> str:
+    """Idempotency key: Lava redelivers the same contract/event/status on retries."""
+    return ":".join(
+        str(webhook_data.get(field) or "")
+        for field in ("order_id", "event_type", "status")
+    )
+
+
+def _find_transaction(order_id: str):
+    from botapp.models import Transaction
+
+    # Если order_id - это число, ищем по ID
+    try:
+        trans = Transaction.objects.get(id=int(order_id))
+        logger.info(f"Found transaction by ID: {order_id}")
+        return trans
+    except (ValueError, Transaction.DoesNotExist):
+        pass
+    # Если не число или не найдено по ID, пробуем найти по payment_id
+    trans = Transaction.objects.filter(payment_id=order_id).first()
+    if trans:
+        logger.info(f"Found transaction by payment_id: {order_id}")
+    return trans
+
+
+def handle_payment_event(payload: Dict) -> str:
+    """
+    Apply a Lava.top payment event (runs in Celery via botapp.webhooks).
+
+    Returns the resulting status: completed, failed, ignored or unknown.
+    """
+    from django.db import transaction as db_transaction
+
+    from botapp.business.analytics import AnalyticsService
+    from botapp.models import TgUser, Transaction, UserBalance
+
+    webhook_data = parse_webhook_data(payload)
+    order_id = webhook_data.get('order_id')
+    event_type = webhook_data.get('event_type', '') or ''
+
+    trans = _find_transaction(order_id)
+
+    # Если транзакция не найдена и это новый платеж, создаем новую
+    success_events = {
+        'payment.success',
+        'subscription.recurring.payment.success'
+    }
+
+    if not trans and event_type in success_events:
+        # Для новых платежей от Lava.top создаем транзакцию
+        logger.info(f"Creating new transaction for Lava.top payment: {order_id}")
+
+        # Пытаемся сопоставить платёж с существующим пользователем
+        fallback_chat_id = getattr(settings, "LAVA_FALLBACK_CHAT_ID", None)
+        target_user = None
+        if fallback_chat_id:
+            try:
+                target_user = TgUser.objects.get(chat_id=int(fallback_chat_id))
+            except (TgUser.DoesNotExist, ValueError):
+                target_user = None
+
+        if not target_user:
+            raise LavaWebhookError("Unable to map Lava webhook to a Telegram user (fallback chat id not configured)")
+
+        user_balance, _ = UserBalance.objects.get_or_create(user=target_user)
+        trans = Transaction.objects.create(
+            user=target_user,
+            type='deposit',
+            amount=webhook_data.get('amount', Decimal('0')),
+            balance_after=user_balance.balance,
+            description=f"Payment from Lava.top: {webhook_data.get('product_title', 'Unknown')}",
+            payment_method='lava.top',
+            payment_id=order_id,
+            is_pending=False,
+            is_completed=False
+        )
+        logger.info(f"Created new transaction {trans.id} for Lava.top payment")
+
+    if not trans:
+        logger.warning(f"Transaction {order_id} not found for event {event_type}, ignoring")
+        return "ignored"
+
+    # Проверяем тип события и статус платежа
+    payment_status = (webhook_data.get('status') or '').lower()
+
+    # Обработка успешных платежей
+    if (event_type == 'payment.success' or
+            payment_status in ['success', 'paid', 'completed', 'subscription-active']):
+        with db_transaction.atomic():
+            # Блокируем транзакцию: повтор задачи не должен начислить токены второй раз
+            trans = Transaction.objects.select_for_update().select_related('user').get(pk=trans.pk)
+            if trans.is_completed:
+                logger.info(f"Payment {trans.id} already completed, skipping")
+                return "completed"
+
+            user_balance = UserBalance.objects.select_for_update().get(user=trans.user)
+
+            # Начисляем токены по текущему курсу
+            credits_amount = usd_to_tokens(trans.amount)
+            user_balance.balance += credits_amount
+            user_balance.total_deposited += credits_amount
+            user_balance.save()
+
+            # Обновляем транзакцию
+            trans.is_completed = True
+            trans.is_pending = False
+            trans.payment_id = webhook_data.get('payment_id')
+            trans.payment_data = webhook_data.get('raw_data', {})
+            trans.balance_after = user_balance.balance
+            trans.save()
+
+        logger.info(f"Payment {trans.id} completed. Credited {credits_amount} tokens to user {trans.user.chat_id}")
+        AnalyticsService.track_event(
+            trans.user,
+            "payment_completed",
+            {"transaction_id": trans.id, "amount_usd": str(trans.amount), "payment_method": trans.payment_method},
+        )
+
+        # Отправляем уведомление пользователю в Telegram
+        try:
+            from botapp.tasks import send_telegram_message
+
+            message_text = (
+                f"✅ **Платеж успешно выполнен!**\n\n"
+                f"💰 Зачислено: {int(credits_amount)} токенов\n"
+                f"💵 Сумма: ${trans.amount}\n\n"
+                f"Ваш новый баланс: {int(user_balance.balance)} токенов\n\n"
+                f"Спасибо за покупку! 🎉\n"
+                f"Теперь вы можете создавать изображения и видео."
+            )
+            send_telegram_message(trans.user.chat_id, message_text)
+            logger.info(f"Payment notification sent to user {trans.user.chat_id}")
+        except Exception as e:
+            logger.error(f"Failed to send payment notification: {e}")
+            # Не падаем, если не удалось отправить уведомление
+
+        return "completed"
+
+    if (event_type == 'payment.failed' or
+            payment_status in ['failed', 'cancelled', 'canceled', 'subscription-failed']):
+        if trans.is_completed:
+            # Запоздавшая доставка после успешной оплаты не отменяет начисление
+            logger.info(f"Payment {trans.id} already completed, ignoring {event_type or payment_status}")
+            return "completed"
+        # Платеж не прошел
+        trans.is_pending = False
+        trans.is_completed = False
+        trans.payment_data = webhook_data.get('raw_data', {})
+        trans.save()
+
+        logger.info(f"Payment {trans.id} failed/cancelled")
+        return "failed"
+
+    # Неизвестный статус - просто логируем
+    logger.warning(f"Unknown payment status: {payment_status}")
+    return "unknown"
+
+
 def create_webhook_response(result: Dict) -> Dict:
     """
     Create webhook response for Lava.top
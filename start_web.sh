@@ -12,6 +12,10 @@ python manage.py migrate
 echo "Setting Telegram webhook..."
 python manage.py set_webhook || echo "Warning: Failed to set webhook, continuing..."
 
+# Metrics of all gunicorn workers are aggregated through a shared directory (botapp/metrics.py)
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus-web}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 # Start Gunicorn
 echo "Starting Gunicorn..."
 exec gunicorn -k uvicorn.workers.UvicornWorker config.asgi:application --bind 0.0.0.0:$PORT --workers 2 --timeout 120
@@ -0,0 +1,15 @@
+#!/bin/bash
+set -e
+
+echo "Starting Celery worker..."
+
+# Metrics of all prefork processes are aggregated through a shared directory (botapp/metrics.py)
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus-worker}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+CELERY_BIN=celery
+if [ -x ./.venv/bin/celery ]; then
+    CELERY_BIN=./.venv/bin/celery
+fi
+
+exec "$CELERY_BIN" -A config.celery:app worker -Q default -l INFO "$@"